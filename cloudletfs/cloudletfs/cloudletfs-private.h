@@ -28,6 +28,13 @@
 #include <unistd.h>
 #include <sys/types.h>
 
+/* overlay map can be passed as "mapfile:<version>:<path>" */
+#define CHUNK_MAP_PREFIX "mapfile:"
+#define CHUNK_MAP_MAGIC "CFCM"
+#define CHUNK_MAP_VERSION 1
+/* argv[1] to print supported overlay map formats and exit */
+#define CAPABILITIES_OPTION "--capabilities"
+
 struct cloudletfs {
     struct cloudletfs_image *disk;
     struct cloudletfs_image *memory;
@@ -70,11 +77,6 @@ struct cloudletfs_fuse {
     struct fuse_chan *chan;
 };
 
-struct chunk_synthesis_info {
-    int chunk_number;
-    bool valid; // whether chunk is synthesized or not
-};
-
 struct cloudletfs_fuse_fh {
     const struct cloudletfs_fuse_ops *ops;
     void *data;
@@ -138,7 +140,7 @@ void _cloudletfs_fuse_stream_populate(struct cloudletfs_fuse_dentry *dir,
 bool _cloudletfs_interrupted(void);
 
 /* io */
-bool _cloudletfs_io_init(struct cloudletfs_image *img, GList* synthesis_chunk_info, GError **err);
+bool _cloudletfs_io_init(struct cloudletfs_image *img, const char *overlay_info, GError **err);
 void _cloudletfs_io_close(struct cloudletfs_image *img);
 bool _cloudletfs_io_image_is_closed(struct cloudletfs_image *img);
 void _cloudletfs_io_destroy(struct cloudletfs_image *img);
@@ -148,7 +150,7 @@ uint64_t _cloudletfs_io_write_chunk(struct cloudletfs_image *img, const void *da
         uint64_t chunk, uint32_t offset, uint32_t length, GError **err);
 
 /* ll_pristine */
-bool _cloudletfs_ll_pristine_init(struct cloudletfs_image *img, GList* synthesis_chunk_info, GError **err);
+bool _cloudletfs_ll_pristine_init(struct cloudletfs_image *img, const char *overlay_info, GError **err);
 void _cloudletfs_ll_pristine_destroy(struct cloudletfs_image *img);
 /* cloudlet */
 bool _cloudlet_read_chunk(struct cloudletfs_image *img, int read_fd, void *data,
@@ -171,6 +173,7 @@ struct bitmap *_cloudletfs_bit_new(struct bitmap_group *mgrp);
 void _cloudletfs_bit_free(struct bitmap *map);
 void _cloudletfs_bit_set(struct bitmap *map, uint64_t bit);
 void _cloudletfs_bit_set_force(struct bitmap *map, uint64_t bit, bool is_force_notify);
+void _cloudletfs_bit_set_nolock(struct bitmap *map, uint64_t bit);
 bool _cloudletfs_bit_test(struct bitmap *map, uint64_t bit);
 struct cloudletfs_stream_group *_cloudletfs_bit_get_stream_group(struct bitmap *map);
 
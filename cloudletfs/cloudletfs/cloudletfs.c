@@ -27,10 +27,12 @@
 #include <unistd.h>
 #include <signal.h>
 #include <errno.h>
+#include <inttypes.h>
 #include "cloudletfs-private.h"
 
 #define IMAGE_ARG_COUNT 5
 
+
 #define CLOUDLET_IO
 #ifdef CLOUDLET_IO
 #define CPRINTF(fmt, ...) \
@@ -140,66 +142,6 @@ static char **get_arguments(GIOChannel *chan, GError **err)
 }
 
 
-static GList *synthesis_chunk_list_new(const gchar *overlay_chunks,
-        GError **err) {
-    GList *chunk_list = NULL;
-    uint64_t chunk_number = 0;
-    long valid_bit = 0;
-    gchar **components;
-    gchar **overlay_info;
-    gchar **cur;
-    gchar *end;
-
-    components = g_strsplit(overlay_chunks, ",", 0);
-    for (cur = components; *cur != NULL; cur++) {
-        overlay_info = g_strsplit(*cur, ":", 0);
-        if (g_strv_length(overlay_info) != 2) {
-            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
-                    "Invalid overlay format %s", *cur);
-            g_strfreev(overlay_info);
-            g_strfreev(components);
-            return NULL;
-        }
-        chunk_number = g_ascii_strtoull(overlay_info[0], &end, 10);
-        if (overlay_info[0][0] == 0 || *end != 0) {
-            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
-                    "Invalid overlay format at chunk number %s",
-                    overlay_info[0]);
-            g_strfreev(overlay_info);
-            g_strfreev(components);
-            return NULL;
-        }
-        valid_bit = strtol(overlay_info[1], &end, 10);
-        if (overlay_info[1][0] == 0 || *end != 0) {
-            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
-                    "Invalid overlay format at valid bit %s", overlay_info[1]);
-            g_strfreev(overlay_info);
-            g_strfreev(components);
-            return NULL;
-        }
-
-        struct chunk_synthesis_info *chunk =
-                g_slice_new0(struct chunk_synthesis_info);
-        chunk->chunk_number = chunk_number;
-        chunk->valid = (valid_bit == 1) ? true : false;
-        chunk_list = g_list_prepend(chunk_list, chunk);
-        g_strfreev(overlay_info);
-    }
-    g_strfreev(components);
-    return chunk_list;
-}
-
-
-static void synthesis_chunk_unref(struct chunk_synthesis_info *info)
-{
-    g_slice_free(struct chunk_synthesis_info, info);
-}
-
-static void synthesis_chunk_list_free(GList *synthesis_chunk_info)
-{
-    g_list_free_full(synthesis_chunk_info, (GDestroyNotify) synthesis_chunk_unref);
-}
-
 static struct cloudletfs_image *image_new(char **argv, const char *type, GError **err)
 {
     struct cloudletfs_image *img;
@@ -237,12 +179,6 @@ static struct cloudletfs_image *image_new(char **argv, const char *type, GError
 		return NULL;
         }
     }
-    GList *synthesis_chunk_info = synthesis_chunk_list_new(overlay_info, &my_err);
-    if (my_err) {
-	g_propagate_error(err, my_err);
-	return NULL;
-    }
-
     img = g_slice_new0(struct cloudletfs_image);
     img->type = strdup(type);
     img->image_size = size;
@@ -254,13 +190,10 @@ static struct cloudletfs_image *image_new(char **argv, const char *type, GError
     img->bytes_written = _cloudletfs_stat_new();
     img->chunk_dirties = _cloudletfs_stat_new();
 
-    if (!_cloudletfs_io_init(img, synthesis_chunk_info, err)) {
-        synthesis_chunk_list_free(synthesis_chunk_info);
+    if (!_cloudletfs_io_init(img, overlay_info, err)) {
         _image_free(img);
         return NULL;
     }
-
-    synthesis_chunk_list_free(synthesis_chunk_info);
     return img;
 }
 
@@ -410,8 +343,15 @@ static gboolean shutdown_callback(void *data)
     return FALSE;
 }
 
-int main(int argc G_GNUC_UNUSED, char **argv G_GNUC_UNUSED)
+int main(int argc, char **argv)
 {
+    /* Report overlay map formats for run_fuse to choose from.  Older
+       daemons ignore the option and fail on the empty stdin. */
+    if (argc > 1 && strcmp(argv[1], CAPABILITIES_OPTION) == 0) {
+        printf("%s%d\n", CHUNK_MAP_PREFIX, CHUNK_MAP_VERSION);
+        return 0;
+    }
+
     fflush(stdout);
     struct cloudletfs *fs;
     GThread *loop_thread = NULL;
@@ -131,11 +131,11 @@ static void chunk_unlock(struct cloudletfs_image *img, uint64_t chunk)
     g_mutex_unlock(cs->lock);
 }
 
-bool _cloudletfs_io_init(struct cloudletfs_image *img, GList* synthesis_chunk_info, GError **err)
+bool _cloudletfs_io_init(struct cloudletfs_image *img, const char *overlay_info, GError **err)
 {
     img->bitmaps = _cloudletfs_bit_group_new((img->image_size +
             img->chunk_size - 1) / img->chunk_size);
-    if (!_cloudletfs_ll_pristine_init(img, synthesis_chunk_info, err)) {
+    if (!_cloudletfs_ll_pristine_init(img, overlay_info, err)) {
         _cloudletfs_bit_group_free(img->bitmaps);
         return false;
     }
@@ -20,6 +20,7 @@
 #include <sys/types.h>
 #include <sys/stat.h>
 #include <fcntl.h>
+#include <stdio.h>
 #include <string.h>
 #include <stdlib.h>
 #include <unistd.h>
@@ -27,25 +28,156 @@
 #include <errno.h>
 #include "cloudletfs-private.h"
 
+#define CHUNK_MAP_READ_COUNT 4096
+
+static void set_overlay_chunk(struct cloudletfs_image *img, uint64_t chunk,
+        bool valid)
+{
+    // maps are not shared until the image is mounted
+    _cloudletfs_bit_set_nolock(img->total_overlay_map, chunk);
+    if (valid) {
+        // Set bit for current_overlay_map only when the chunk is available
+        _cloudletfs_bit_set_nolock(img->current_overlay_map, chunk);
+    }
+}
+
+/* Read chunk map file written by elijah.provisioning.chunk_map into the
+ * overlay bitmaps.
+ * Header is magic, version (uint32) and entry count (uint64), followed by
+ * entries of (chunk_number << 1 | valid_bit). All in little endian. */
+static bool load_overlay_map_file(struct cloudletfs_image *img,
+        const gchar *map_arg, GError **err)
+{
+    uint64_t entries[CHUNK_MAP_READ_COUNT];
+    uint64_t version;
+    uint64_t count;
+    uint64_t read_count = 0;
+    uint32_t file_version;
+    char magic[4];
+    const gchar *path;
+    gchar *end;
+    FILE *fp;
+    size_t n;
+    size_t i;
+
+    version = g_ascii_strtoull(map_arg, &end, 10);
+    if (end == map_arg || *end != ':') {
+        g_set_error(err, CLOUDLETFS_CONFIG_ERROR,
+                CLOUDLETFS_CONFIG_ERROR_INVALID_ARGUMENT,
+                "Invalid chunk map argument %s", map_arg);
+        return false;
+    }
+    if (version != CHUNK_MAP_VERSION) {
+        g_set_error(err, CLOUDLETFS_CONFIG_ERROR,
+                CLOUDLETFS_CONFIG_ERROR_INVALID_ARGUMENT,
+                "Unsupported chunk map version %" PRIu64, version);
+        return false;
+    }
+    path = end + 1;
+    fp = fopen(path, "rb");
+    if (fp == NULL) {
+        g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                "Cannot open chunk map %s", path);
+        return false;
+    }
+    if (fread(magic, sizeof(magic), 1, fp) != 1 ||
+            memcmp(magic, CHUNK_MAP_MAGIC, sizeof(magic)) != 0 ||
+            fread(&file_version, sizeof(file_version), 1, fp) != 1 ||
+            GUINT32_FROM_LE(file_version) != version ||
+            fread(&count, sizeof(count), 1, fp) != 1) {
+        g_set_error(err, CLOUDLETFS_CONFIG_ERROR,
+                CLOUDLETFS_CONFIG_ERROR_INVALID_ARGUMENT,
+                "Invalid chunk map header at %s", path);
+        fclose(fp);
+        return false;
+    }
+    count = GUINT64_FROM_LE(count);
+
+    while (read_count < count) {
+        n = fread(entries, sizeof(uint64_t),
+                MIN(count - read_count, CHUNK_MAP_READ_COUNT), fp);
+        if (n == 0) {
+            break;
+        }
+        for (i = 0; i < n; i++) {
+            uint64_t entry = GUINT64_FROM_LE(entries[i]);
+            set_overlay_chunk(img, entry >> 1, (entry & 1) ? true : false);
+        }
+        read_count += n;
+    }
+    fclose(fp);
+    if (read_count != count) {
+        g_set_error(err, CLOUDLETFS_CONFIG_ERROR,
+                CLOUDLETFS_CONFIG_ERROR_INVALID_ARGUMENT,
+                "Truncated chunk map at %s", path);
+        return false;
+    }
+    return true;
+}
+
+/* Read "chunk_number:valid_bit,..." string into the overlay bitmaps. */
+static bool load_overlay_map_string(struct cloudletfs_image *img,
+        const gchar *overlay_chunks, GError **err)
+{
+    uint64_t chunk_number = 0;
+    long valid_bit = 0;
+    gchar **components;
+    gchar **overlay_info;
+    gchar **cur;
+    gchar *end;
+
+    components = g_strsplit(overlay_chunks, ",", 0);
+    for (cur = components; *cur != NULL; cur++) {
+        overlay_info = g_strsplit(*cur, ":", 0);
+        if (g_strv_length(overlay_info) != 2) {
+            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                    "Invalid overlay format %s", *cur);
+            g_strfreev(overlay_info);
+            g_strfreev(components);
+            return false;
+        }
+        chunk_number = g_ascii_strtoull(overlay_info[0], &end, 10);
+        if (overlay_info[0][0] == 0 || *end != 0) {
+            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                    "Invalid overlay format at chunk number %s",
+                    overlay_info[0]);
+            g_strfreev(overlay_info);
+            g_strfreev(components);
+            return false;
+        }
+        valid_bit = strtol(overlay_info[1], &end, 10);
+        if (overlay_info[1][0] == 0 || *end != 0) {
+            g_set_error(err, G_FILE_ERROR, g_file_error_from_errno(errno),
+                    "Invalid overlay format at valid bit %s", overlay_info[1]);
+            g_strfreev(overlay_info);
+            g_strfreev(components);
+            return false;
+        }
+        set_overlay_chunk(img, chunk_number, (valid_bit == 1) ? true : false);
+        g_strfreev(overlay_info);
+    }
+    g_strfreev(components);
+    return true;
+}
+
 bool _cloudletfs_ll_pristine_init(struct cloudletfs_image *img,
-        GList *synthesis_chunk_info, GError **err G_GNUC_UNUSED) {
+        const char *overlay_info, GError **err) {
+    bool ret;
+
     // initialize total_overlay_map with total overlay information
     img->total_overlay_map = _cloudletfs_bit_new(img->bitmaps);
     img->current_overlay_map = _cloudletfs_bit_new(img->bitmaps);
 
-    GList *chunk_list;
-    for (chunk_list = synthesis_chunk_info; chunk_list != NULL; chunk_list =
-            chunk_list->next) {
-        // Set bit for total_overlay_map
-        struct chunk_synthesis_info *cinfo =
-                (struct chunk_synthesis_info *) chunk_list->data;
-        _cloudletfs_bit_set(img->total_overlay_map, cinfo->chunk_number);
-        if (cinfo->valid) {
-            // Set bit for current_overlay_map only when the chunk is available
-            _cloudletfs_bit_set(img->current_overlay_map, cinfo->chunk_number);
-        }
+    if (g_str_has_prefix(overlay_info, CHUNK_MAP_PREFIX)) {
+        ret = load_overlay_map_file(img,
+                overlay_info + strlen(CHUNK_MAP_PREFIX), err);
+    } else {
+        ret = load_overlay_map_string(img, overlay_info, err);
     }
-    return true;
+    if (!ret) {
+        _cloudletfs_ll_pristine_destroy(img);
+    }
+    return ret;
 }
 
 
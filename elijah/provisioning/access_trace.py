@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Order overlay blobs with the chunk access trace of the VM.
+
+cloudletfs reports every disk and memory chunk the VM reads. The first
+touch order of those chunks approximates the working set of a resumed VM,
+so chunks in the trace are packed into their own blobs and those blobs are
+placed first in the overlay. The trace is saved in the overlay meta file.
+"""
+
+import zlib
+
+import numpy
+
+from .delta import DeltaItem
+from .configuration import Const
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AccessTraceError(Exception):
+    pass
+
+
+class AccessTrace(object):
+    """First touch order of disk and memory chunks. Each chunk is keyed
+    with (chunk number << 1 | is_memory)
+    """
+
+    def __init__(self, chunk_key_list):
+        self.chunk_key_list = list()
+        self.rank_dict = dict()
+        for chunk_key in chunk_key_list:
+            if chunk_key in self.rank_dict:
+                continue
+            self.rank_dict[chunk_key] = len(self.chunk_key_list)
+            self.chunk_key_list.append(chunk_key)
+
+    def __len__(self):
+        return len(self.chunk_key_list)
+
+    @staticmethod
+    def get_key(delta_type, chunk):
+        if delta_type == DeltaItem.DELTA_MEMORY or \
+                delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+            return long(chunk) << 1 | 1
+        return long(chunk) << 1
+
+    @staticmethod
+    def from_monitor(stream_monitor):
+        """Merge first access time of each chunk recorded by
+        cloudletfs.StreamMonitor
+        """
+        access_list = list()
+        for chunk, ctime in stream_monitor.disk_first_access_dict.items():
+            access_list.append(
+                (ctime, AccessTrace.get_key(DeltaItem.DELTA_DISK, chunk)))
+        for chunk, ctime in stream_monitor.mem_first_access_dict.items():
+            access_list.append(
+                (ctime, AccessTrace.get_key(DeltaItem.DELTA_MEMORY, chunk)))
+        access_list.sort()
+        return AccessTrace([chunk_key for (ctime, chunk_key) in access_list])
+
+    def get_rank(self, delta_item):
+        chunk_key = AccessTrace.get_key(delta_item.delta_type,
+                                        delta_item.offset/Const.CHUNK_SIZE)
+        return self.rank_dict.get(chunk_key, None)
+
+    def to_meta(self):
+        keys = numpy.array(self.chunk_key_list, dtype=numpy.int64)
+        if len(keys) > 1:
+            keys[1:] = numpy.diff(keys)
+        return zlib.compress(keys.astype("<i8").tostring(), 9)
+
+    @staticmethod
+    def from_meta(meta_dict):
+        trace_data = meta_dict.get(Const.META_OVERLAY_ACCESS_TRACE, None)
+        if trace_data is None:
+            return None
+        try:
+            keys = numpy.fromstring(zlib.decompress(trace_data), dtype="<i8")
+        except (zlib.error, ValueError) as e:
+            raise AccessTraceError("Invalid access trace: %s" % str(e))
+        return AccessTrace(numpy.cumsum(keys).tolist())
+
+
+class BlobPacker(object):
+    """Group DeltaItems into blobs of block_size. With an access trace,
+    chunks in the trace are packed into separate blobs sorted by their first
+    touch, so that a blob does not mix the working set with the others.
+    """
+    BLOB_ACCESSED = 0
+    BLOB_OTHERS = 1
+
+    def __init__(self, block_size, access_trace=None):
+        self.block_size = block_size
+        self.access_trace = access_trace
+        self.pending_list = [list(), list()]
+        self.pending_size = [0, 0]
+
+    def add(self, delta_item):
+        # accessed blobs must be recovered on their own, so a chunk that
+        # refers to another chunk goes with the others. DeltaDedup with the
+        # same trace keeps the data of accessed chunks
+        group = BlobPacker.BLOB_OTHERS
+        if self.access_trace is not None and \
+                self.access_trace.get_rank(delta_item) is not None and \
+                delta_item.ref_id != DeltaItem.REF_SELF and \
+                delta_item.ref_id != DeltaItem.REF_SELF_HASH:
+            group = BlobPacker.BLOB_ACCESSED
+        self.pending_list[group].append(delta_item)
+        self.pending_size[group] += (delta_item.data_len + 11 + 8)
+
+    def is_full(self):
+        return max(self.pending_size) >= self.block_size
+
+    def pop_blobs(self, flush=False):
+        """Return list of blobs (list of DeltaItem) that are ready
+        """
+        blob_list = list()
+        for group in (BlobPacker.BLOB_ACCESSED, BlobPacker.BLOB_OTHERS):
+            if len(self.pending_list[group]) == 0:
+                continue
+            if flush or self.pending_size[group] >= self.block_size:
+                deltaitem_list = self.pending_list[group]
+                if group == BlobPacker.BLOB_ACCESSED:
+                    deltaitem_list.sort(key=self.access_trace.get_rank)
+                blob_list.append(deltaitem_list)
+                self.pending_list[group] = list()
+                self.pending_size[group] = 0
+        return blob_list
+
+
+def _get_blob_rank(blob_info, access_trace):
+    rank_list = list()
+    for chunk in blob_info[Const.META_OVERLAY_FILE_DISK_CHUNKS]:
+        rank_list.append(access_trace.rank_dict.get(
+            AccessTrace.get_key(DeltaItem.DELTA_DISK, chunk), None))
+    for chunk in blob_info[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]:
+        rank_list.append(access_trace.rank_dict.get(
+            AccessTrace.get_key(DeltaItem.DELTA_MEMORY, chunk), None))
+    rank_list = [rank for rank in rank_list if rank is not None]
+    if len(rank_list) == 0:
+        return len(access_trace)
+    return min(rank_list)
+
+
+def order_overlay_files(overlay_info, access_trace):
+    """Sort blob list of the overlay meta by the first touch of their chunks.
+    Blobs without any accessed chunk keep their order at the end.
+    """
+    if access_trace is None or len(access_trace) == 0:
+        return overlay_info
+    ranked_list = [(_get_blob_rank(blob_info, access_trace), index, blob_info)
+                   for index, blob_info in enumerate(overlay_info)]
+    ranked_list.sort()
+    return [blob_info for (rank, index, blob_info) in ranked_list]
+
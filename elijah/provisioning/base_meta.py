@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Refresh base VM meta files after small changes of the base image.
+
+A region hash tree keeps md5 of every LEAF_SIZE region of the base
+image next to its meta file. To refresh the meta file, we hash the image
+region by region, and recompute chunk hashes only in the regions whose leaf
+hash changed.
+"""
+
+import os
+import struct
+from hashlib import md5
+from hashlib import sha256
+
+import numpy
+
+from . import disk
+from . import memory
+from . import similarity_index
+from .memory import Memory
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class BaseMetaError(Exception):
+    pass
+
+
+LEAF_SIZE = 2*1024*1024
+# record of disk meta file ("!QI32s")
+DISK_META_DTYPE = numpy.dtype([("offset", ">u8"), ("length", ">u4"),
+                               ("hash", "S32")])
+
+
+class RegionHashTree(object):
+    MAGIC = 0x52485452     # "RHTR"
+    HEADER_FORMAT = "!IIQQ"
+    LEAF_HASH_SIZE = 16     # md5
+
+    def __init__(self, leaf_size, image_size, leaf_list):
+        self.leaf_size = leaf_size
+        self.image_size = image_size
+        self.leaf_list = leaf_list
+
+    def root(self):
+        return sha256(''.join(self.leaf_list)).digest()
+
+    def get_changed_regions(self, other):
+        """Return (start, end) byte ranges of the leaves that differ
+        """
+        if self.leaf_size != other.leaf_size or \
+                self.image_size != other.image_size:
+            msg = "Cannot compare hash tree of different image or leaf size"
+            raise BaseMetaError(msg)
+        if self.root() == other.root():
+            return list()
+        region_list = list()
+        for index, (leaf, other_leaf) in \
+                enumerate(zip(self.leaf_list, other.leaf_list)):
+            if leaf != other_leaf:
+                start = index*self.leaf_size
+                end = min(start+self.leaf_size, self.image_size)
+                region_list.append((start, end))
+        return region_list
+
+    def to_file(self, tree_path):
+        with open(tree_path, "wb") as fd:
+            fd.write(struct.pack(self.HEADER_FORMAT, self.MAGIC,
+                                 self.leaf_size, self.image_size,
+                                 len(self.leaf_list)))
+            fd.write(''.join(self.leaf_list))
+
+    @staticmethod
+    def from_file(tree_path):
+        with open(tree_path, "rb") as fd:
+            header = fd.read(struct.calcsize(RegionHashTree.HEADER_FORMAT))
+            (magic, leaf_size, image_size, leaf_count) = struct.unpack(
+                RegionHashTree.HEADER_FORMAT, header)
+            if magic != RegionHashTree.MAGIC:
+                raise BaseMetaError("Invalid hash tree file %s" % tree_path)
+            leaf_data = fd.read(RegionHashTree.LEAF_HASH_SIZE*leaf_count)
+        if len(leaf_data) != RegionHashTree.LEAF_HASH_SIZE*leaf_count:
+            raise BaseMetaError("Truncated hash tree file %s" % tree_path)
+        leaf_list = [leaf_data[index:index+RegionHashTree.LEAF_HASH_SIZE]
+                     for index in xrange(0, len(leaf_data),
+                                         RegionHashTree.LEAF_HASH_SIZE)]
+        return RegionHashTree(leaf_size, image_size, leaf_list)
+
+
+def build_tree(image_path, leaf_size=LEAF_SIZE, entire_hash_size=None):
+    """Return (RegionHashTree, hexdigest of the first entire_hash_size
+    bytes). The image is read once for both of them.
+    """
+    image_size = os.path.getsize(image_path)
+    leaf_list = list()
+    entire_hashing = sha256()
+    hashed_size = 0
+    with open(image_path, "rb") as fd:
+        while True:
+            data = fd.read(leaf_size)
+            if not data:
+                break
+            # md5 is enough to detect local changes and much faster
+            leaf_list.append(md5(data).digest())
+            if entire_hash_size is not None and \
+                    hashed_size < entire_hash_size:
+                entire_hashing.update(data[:entire_hash_size-hashed_size])
+            hashed_size += len(data)
+    tree = RegionHashTree(leaf_size, image_size, leaf_list)
+    return tree, entire_hashing.hexdigest()
+
+
+def create_tree_file(image_path, tree_path, leaf_size=LEAF_SIZE):
+    tree, entire_hash = build_tree(image_path, leaf_size)
+    tree.to_file(tree_path)
+    return tree
+
+
+def _load_tree(tree_path):
+    if not os.path.exists(tree_path):
+        return None
+    try:
+        return RegionHashTree.from_file(tree_path)
+    except (BaseMetaError, struct.error) as e:
+        LOG.warning("Ignore hash tree at %s: %s" % (tree_path, str(e)))
+        return None
+
+
+def update_memory_meta(mem_path, meta_path, tree_path, leaf_size=LEAF_SIZE):
+    """Refresh base memory meta file and return changed regions
+    Records of the changed pages are rewritten in place.
+    """
+    new_tree, entire_hash = build_tree(mem_path, leaf_size)
+    old_tree = _load_tree(tree_path)
+    page_count = (new_tree.image_size + Memory.RAM_PAGE_SIZE - 1) / \
+        Memory.RAM_PAGE_SIZE
+    record_size = struct.calcsize("!qI32s")
+    if old_tree is None or old_tree.image_size != new_tree.image_size or \
+            old_tree.leaf_size != new_tree.leaf_size or \
+            not os.path.exists(meta_path) or \
+            os.path.getsize(meta_path) != page_count*record_size:
+        LOG.info("Regenerate entire memory meta at %s" % meta_path)
+        memory.hashing(mem_path).export_to_file(meta_path)
+        new_tree.to_file(tree_path)
+        return [(0, new_tree.image_size)]
+
+    region_list = old_tree.get_changed_regions(new_tree)
+    with open(mem_path, "rb") as mem_fd, open(meta_path, "r+b") as meta_fd:
+        for (start, end) in region_list:
+            mem_fd.seek(start)
+            data = mem_fd.read(end-start)
+            record_list = list()
+            for index in xrange(0, len(data), Memory.RAM_PAGE_SIZE):
+                page = data[index:index+Memory.RAM_PAGE_SIZE]
+                record_list.append(struct.pack(
+                    "!qI32s", start+index, len(page), sha256(page).digest()))
+            meta_fd.seek(start/Memory.RAM_PAGE_SIZE*record_size)
+            meta_fd.write(''.join(record_list))
+    new_tree.to_file(tree_path)
+    LOG.info("Refresh %d regions of memory meta at %s" %
+             (len(region_list), meta_path))
+    return region_list
+
+
+def update_disk_meta(disk_path, meta_path, tree_path,
+                     chunk_size=4096, window_size=512, leaf_size=LEAF_SIZE):
+    """Refresh base disk meta file and return (changed regions, sha256 of
+    the disk) like disk.hashing. Hashes of windows overlapping the changed
+    regions are dropped and recomputed; other records keep their order.
+    """
+    disk_size = os.path.getsize(disk_path)
+    if disk_size < chunk_size:
+        raise disk.DiskError("invalid raw disk size")
+    last_offset = (disk_size-chunk_size)/window_size*window_size
+    new_tree, entire_hash = build_tree(
+        disk_path, leaf_size, entire_hash_size=last_offset+chunk_size)
+    old_tree = _load_tree(tree_path)
+    if old_tree is None or old_tree.image_size != new_tree.image_size or \
+            old_tree.leaf_size != new_tree.leaf_size or \
+            not os.path.exists(meta_path):
+        LOG.info("Regenerate entire disk meta at %s" % meta_path)
+        entire_hash = disk.hashing(disk_path, meta_path,
+                                   chunk_size=chunk_size,
+                                   window_size=window_size)
+        new_tree.to_file(tree_path)
+        return [(0, new_tree.image_size)], entire_hash
+
+    region_list = old_tree.get_changed_regions(new_tree)
+    if len(region_list) == 0:
+        return region_list, entire_hash
+
+    # windows that overlap the changed regions
+    window_range_list = list()
+    for (start, end) in region_list:
+        window_start = max(start-chunk_size+window_size, 0)
+        window_start = window_start/window_size*window_size
+        window_end = min(end, last_offset+window_size)
+        if window_start >= window_end:
+            continue
+        if len(window_range_list) > 0 and \
+                window_range_list[-1][1] >= window_start:
+            window_range_list[-1] = (window_range_list[-1][0], window_end)
+        else:
+            window_range_list.append((window_start, window_end))
+    if len(window_range_list) == 0:
+        new_tree.to_file(tree_path)
+        return region_list, entire_hash
+    range_array = numpy.array(window_range_list, dtype=numpy.uint64)
+
+    # drop records of the changed windows
+    with open(meta_path, "rb") as meta_fd:
+        record_array = numpy.fromstring(meta_fd.read(),
+                                        dtype=DISK_META_DTYPE)
+    offset_array = record_array["offset"].astype(numpy.uint64)
+    range_index = numpy.searchsorted(range_array[:, 0], offset_array,
+                                     side="right") - 1
+    is_changed = (range_index >= 0) & \
+        (offset_array < range_array[range_index.clip(0), 1])
+    record_array = record_array[~is_changed]
+
+    # hash the changed windows
+    new_record_list = list()
+    with open(disk_path, "rb") as disk_fd:
+        for (window_start, window_end) in window_range_list:
+            disk_fd.seek(window_start)
+            data = disk_fd.read(window_end-window_start+chunk_size)
+            for index in xrange(0, window_end-window_start, window_size):
+                hashed_data = sha256(data[index:index+chunk_size]).digest()
+                new_record_list.append(
+                    (window_start+index, chunk_size, hashed_data))
+    new_array = numpy.array(new_record_list, dtype=DISK_META_DTYPE)
+    is_existing = numpy.in1d(new_array["hash"], record_array["hash"])
+    hash_set = set()
+    is_added = numpy.zeros(len(new_array), dtype=numpy.bool_)
+    for index, (offset, length, hashed_data) in enumerate(new_record_list):
+        if is_existing[index] or hashed_data in hash_set:
+            continue
+        hash_set.add(hashed_data)
+        is_added[index] = True
+
+    with open(meta_path, "r+b") as meta_fd:
+        meta_fd.write(record_array.tostring())
+        meta_fd.write(new_array[is_added].tostring())
+        meta_fd.truncate()
+    new_tree.to_file(tree_path)
+    LOG.info("Refresh %d regions of disk meta at %s" %
+             (len(region_list), meta_path))
+    return region_list, entire_hash
+
+
+def update_sketch(image_path, sketch_path, region_list, batch_chunks=1024):
+    """Recompute sketches of the chunks in the changed regions. Each region
+    is read and sketched in batches of batch_chunks to bound memory usage
+    """
+    if not os.path.exists(sketch_path):
+        return
+    header_size = struct.calcsize(similarity_index.SimilarityIndex.HEADER_FORMAT)
+    with open(sketch_path, "rb") as fd:
+        (magic, chunk_size, chunk_count) = struct.unpack(
+            similarity_index.SimilarityIndex.HEADER_FORMAT, fd.read(header_size))
+    if os.path.getsize(image_path)/chunk_size != chunk_count:
+        similarity_index.create_sketch_file(image_path, sketch_path,
+                                            chunk_size=chunk_size)
+        return
+    row_size = similarity_index.SUPER_FEATURE_COUNT*8
+    with open(image_path, "rb") as image_fd, open(sketch_path, "r+b") as fd:
+        for (start, end) in region_list:
+            start = start/chunk_size*chunk_size
+            end = min((end+chunk_size-1)/chunk_size*chunk_size,
+                      chunk_count*chunk_size)
+            image_fd.seek(start)
+            fd.seek(header_size + start/chunk_size*row_size)
+            for offset in xrange(start, end, batch_chunks*chunk_size):
+                data = image_fd.read(min(batch_chunks*chunk_size,
+                                         end-offset))
+                sketches = similarity_index.compute_sketches(data,
+                                                             chunk_size)
+                fd.write(sketches.astype("<u8").tostring())
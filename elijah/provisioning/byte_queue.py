@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+import time
+import ctypes
+import multiprocessing
+import multiprocessing.queues
+from Queue import Full
+
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+def get_item_size(item):
+    """Return bytes of data in a queue item. Lists of DeltaItem count the
+    data of each DeltaItem, and control messages count as their length.
+    """
+    if isinstance(item, basestring):
+        return len(item)
+    if isinstance(item, (list, tuple)):
+        return sum([get_item_size(each_item) for each_item in item])
+    data = getattr(item, "data", None)
+    if isinstance(data, basestring):
+        return len(data)
+    return 0
+
+
+class ByteBudgetQueue(multiprocessing.queues.Queue):
+    """multiprocessing.Queue bounded by the bytes of its items.
+
+    put() blocks while the bytes in the queue plus the new item exceed
+    max_bytes. An item bigger than max_bytes is accepted only into an empty
+    queue so that it does not block forever. The byte counter is shared
+    between processes, and the queue can still be selected on through
+    _reader like a multiprocessing.Queue.
+    """
+
+    def __init__(self, max_bytes, maxsize=0, size_func=get_item_size):
+        if max_bytes <= 0:
+            raise ValueError("Invalid byte budget %d" % max_bytes)
+        multiprocessing.queues.Queue.__init__(self, maxsize)
+        self._max_bytes = max_bytes
+        self._size_func = size_func
+        self._budget_cond = multiprocessing.Condition()
+        self._used_bytes = multiprocessing.Value(ctypes.c_longlong, 0,
+                                                 lock=False)
+        self._peak_bytes = multiprocessing.Value(ctypes.c_longlong, 0,
+                                                 lock=False)
+
+    def __getstate__(self):
+        return (multiprocessing.queues.Queue.__getstate__(self),
+                self._max_bytes, self._size_func, self._budget_cond,
+                self._used_bytes, self._peak_bytes)
+
+    def __setstate__(self, state):
+        (queue_state, self._max_bytes, self._size_func, self._budget_cond,
+         self._used_bytes, self._peak_bytes) = state
+        multiprocessing.queues.Queue.__setstate__(self, queue_state)
+
+    @property
+    def max_bytes(self):
+        return self._max_bytes
+
+    def get_used_bytes(self):
+        with self._budget_cond:
+            return self._used_bytes.value
+
+    def get_peak_bytes(self):
+        with self._budget_cond:
+            return self._peak_bytes.value
+
+    def put(self, obj, block=True, timeout=None):
+        item_size = self._size_func(obj)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._budget_cond:
+            while self._used_bytes.value > 0 and \
+                    self._used_bytes.value + item_size > self._max_bytes:
+                if not block:
+                    raise Full
+                if timeout is None:
+                    self._budget_cond.wait()
+                    continue
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Full
+                self._budget_cond.wait(remaining)
+            self._used_bytes.value += item_size
+            self._peak_bytes.value = max(self._peak_bytes.value,
+                                         self._used_bytes.value)
+        try:
+            multiprocessing.queues.Queue.put(
+                self, (item_size, obj), block, timeout)
+        except Full:
+            self._release(item_size)
+            raise
+
+    def get(self, block=True, timeout=None):
+        (item_size, obj) = multiprocessing.queues.Queue.get(
+            self, block, timeout)
+        self._release(item_size)
+        return obj
+
+    def _release(self, item_size):
+        with self._budget_cond:
+            self._used_bytes.value -= item_size
+            self._budget_cond.notify_all()
+
+
+def get_stage_queue(maxsize, max_bytes):
+    """Return a queue between pipeline stages. max_bytes of -1 keeps the
+    queue bounded only by item count.
+    """
+    if max_bytes is None or max_bytes <= 0:
+        return multiprocessing.Queue(maxsize=maxsize)
+    LOG.debug("Stage queue of %d bytes" % max_bytes)
+    return ByteBudgetQueue(max_bytes, maxsize=maxsize)
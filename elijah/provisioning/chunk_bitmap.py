@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Compressed set of chunk numbers.
+
+ChunkBitmap splits chunk numbers by their upper bits like roaring bitmap.
+Each 2^16 chunk range is a container, which is a sorted uint16 array while
+it has at most ARRAY_MAX chunks, and a 8 KB bitmap otherwise. Bulk
+operations work on whole containers with numpy.
+"""
+
+import struct
+
+import numpy
+
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ChunkBitmapError(Exception):
+    pass
+
+
+CONTAINER_BITS = 16
+CONTAINER_SIZE = 1 << CONTAINER_BITS
+LOW_MASK = CONTAINER_SIZE - 1
+ARRAY_MAX = 4096
+BITMAP_BYTES = CONTAINER_SIZE/8
+
+# popcount of each byte
+_POPCOUNT = numpy.array([bin(value).count("1") for value in xrange(256)],
+                        dtype=numpy.uint32)
+
+
+def _is_bitmap(container):
+    return container.dtype == numpy.uint8
+
+
+def _cardinality(container):
+    if _is_bitmap(container):
+        return int(_POPCOUNT[container].sum())
+    return len(container)
+
+
+def _values(container):
+    """Return sorted uint16 array of chunks in the container"""
+    if _is_bitmap(container):
+        return numpy.flatnonzero(
+            numpy.unpackbits(container)).astype(numpy.uint16)
+    return container
+
+
+def _container(values):
+    """Make container from sorted unique uint16 array"""
+    if len(values) <= ARRAY_MAX:
+        return values.astype(numpy.uint16)
+    bits = numpy.zeros(CONTAINER_SIZE, dtype=numpy.bool_)
+    bits[values] = True
+    return numpy.packbits(bits)
+
+
+def _bitmap_container(bits):
+    """Make container from bitmap, converting to array if sparse"""
+    if _cardinality(bits) <= ARRAY_MAX:
+        return _values(bits)
+    return bits
+
+
+class ChunkBitmap(object):
+    MAGIC = "CBMP"
+    VERSION = 1
+    HEADER_FORMAT = "<4sII"
+    CONTAINER_FORMAT = "<QBI"
+    TYPE_ARRAY = 0
+    TYPE_BITMAP = 1
+
+    def __init__(self, chunks=None):
+        self.containers = dict()    # upper bits: container
+        if chunks is not None:
+            self.update(chunks)
+
+    def update(self, chunks):
+        """Add chunks from iterable, numpy array, ChunkBitmap or an object
+        with to_array() such as overlay_meta.ChunkList
+        """
+        if isinstance(chunks, ChunkBitmap):
+            self.containers = self.union(chunks).containers
+            return
+        if isinstance(chunks, numpy.ndarray):
+            chunk_array = chunks.astype(numpy.uint64)
+        elif hasattr(chunks, "to_array"):
+            chunk_array = chunks.to_array().astype(numpy.uint64)
+        else:
+            chunk_array = numpy.fromiter(chunks, dtype=numpy.uint64)
+        if len(chunk_array) == 0:
+            return
+        chunk_array = numpy.unique(chunk_array)
+        high_array = chunk_array >> numpy.uint64(CONTAINER_BITS)
+        low_array = (chunk_array & numpy.uint64(LOW_MASK)).astype(
+            numpy.uint16)
+        boundary_list = numpy.flatnonzero(numpy.diff(high_array)) + 1
+        start_list = [0] + boundary_list.tolist()
+        end_list = boundary_list.tolist() + [len(chunk_array)]
+        for start, end in zip(start_list, end_list):
+            key = int(high_array[start])
+            values = low_array[start:end]
+            container = self.containers.get(key, None)
+            if container is not None:
+                values = numpy.union1d(_values(container), values)
+            self.containers[key] = _container(values)
+
+    def add(self, chunk):
+        self.update((chunk,))
+
+    def __contains__(self, chunk):
+        container = self.containers.get(chunk >> CONTAINER_BITS, None)
+        if container is None:
+            return False
+        low = chunk & LOW_MASK
+        if _is_bitmap(container):
+            return bool(container[low >> 3] & (0x80 >> (low & 7)))
+        index = numpy.searchsorted(container, low)
+        return index < len(container) and container[index] == low
+
+    def __len__(self):
+        return sum([_cardinality(container)
+                    for container in self.containers.itervalues()])
+
+    def __iter__(self):
+        for key in sorted(self.containers.keys()):
+            base = key << CONTAINER_BITS
+            for low in _values(self.containers[key]).tolist():
+                yield base + low
+
+    def __eq__(self, other):
+        if not isinstance(other, ChunkBitmap):
+            return NotImplemented
+        return numpy.array_equal(self.to_array(), other.to_array())
+
+    def __ne__(self, other):
+        ret = self.__eq__(other)
+        if ret is NotImplemented:
+            return ret
+        return not ret
+
+    def to_array(self):
+        """Return sorted uint64 array of chunks"""
+        array_list = list()
+        for key in sorted(self.containers.keys()):
+            values = _values(self.containers[key]).astype(numpy.uint64)
+            array_list.append(values + numpy.uint64(key << CONTAINER_BITS))
+        if len(array_list) == 0:
+            return numpy.zeros(0, dtype=numpy.uint64)
+        return numpy.concatenate(array_list)
+
+    def nbytes(self):
+        return sum([container.nbytes
+                    for container in self.containers.itervalues()])
+
+    def union(self, other):
+        result = ChunkBitmap()
+        for key in set(self.containers.keys()) | set(other.containers.keys()):
+            container = self.containers.get(key, None)
+            other_container = other.containers.get(key, None)
+            if container is None:
+                result.containers[key] = other_container.copy()
+            elif other_container is None:
+                result.containers[key] = container.copy()
+            elif _is_bitmap(container) and _is_bitmap(other_container):
+                result.containers[key] = container | other_container
+            else:
+                result.containers[key] = _container(numpy.union1d(
+                    _values(container), _values(other_container)))
+        return result
+
+    def intersection(self, other):
+        result = ChunkBitmap()
+        for key in set(self.containers.keys()) & set(other.containers.keys()):
+            container = self.containers[key]
+            other_container = other.containers[key]
+            if _is_bitmap(container) and _is_bitmap(other_container):
+                container = _bitmap_container(container & other_container)
+            elif _is_bitmap(container) or _is_bitmap(other_container):
+                if _is_bitmap(container):
+                    container, other_container = other_container, container
+                # test array items in the bitmap
+                is_set = other_container[container >> 3] & \
+                    (0x80 >> (container & 7)).astype(numpy.uint8)
+                container = container[is_set != 0]
+            else:
+                container = numpy.intersect1d(
+                    container, other_container).astype(numpy.uint16)
+            if _cardinality(container) > 0:
+                result.containers[key] = container
+        return result
+
+    __or__ = union
+    __and__ = intersection
+
+    def to_bytes(self):
+        data_list = [struct.pack(self.HEADER_FORMAT, self.MAGIC,
+                                 self.VERSION, len(self.containers))]
+        for key in sorted(self.containers.keys()):
+            container = self.containers[key]
+            if _is_bitmap(container):
+                data_list.append(struct.pack(
+                    self.CONTAINER_FORMAT, key, self.TYPE_BITMAP,
+                    len(container)))
+                data_list.append(container.tostring())
+            else:
+                data_list.append(struct.pack(
+                    self.CONTAINER_FORMAT, key, self.TYPE_ARRAY,
+                    len(container)))
+                data_list.append(container.astype("<u2").tostring())
+        return ''.join(data_list)
+
+    @staticmethod
+    def from_bytes(data):
+        header_size = struct.calcsize(ChunkBitmap.HEADER_FORMAT)
+        container_header_size = struct.calcsize(ChunkBitmap.CONTAINER_FORMAT)
+        try:
+            (magic, version, container_count) = struct.unpack(
+                ChunkBitmap.HEADER_FORMAT, data[:header_size])
+        except struct.error as e:
+            raise ChunkBitmapError("Invalid chunk bitmap: %s" % str(e))
+        if magic != ChunkBitmap.MAGIC or version != ChunkBitmap.VERSION:
+            raise ChunkBitmapError("Invalid chunk bitmap header")
+
+        bitmap = ChunkBitmap()
+        offset = header_size
+        for index in xrange(container_count):
+            try:
+                (key, container_type, length) = struct.unpack(
+                    ChunkBitmap.CONTAINER_FORMAT,
+                    data[offset:offset+container_header_size])
+            except struct.error as e:
+                raise ChunkBitmapError("Invalid chunk bitmap: %s" % str(e))
+            offset += container_header_size
+            if container_type == ChunkBitmap.TYPE_BITMAP:
+                if length != BITMAP_BYTES:
+                    raise ChunkBitmapError("Invalid bitmap container size")
+                byte_size = length
+            elif container_type == ChunkBitmap.TYPE_ARRAY:
+                byte_size = length*2
+            else:
+                raise ChunkBitmapError("Invalid container type %d" %
+                                       container_type)
+            payload = data[offset:offset+byte_size]
+            if len(payload) != byte_size:
+                raise ChunkBitmapError("Truncated chunk bitmap")
+            if container_type == ChunkBitmap.TYPE_BITMAP:
+                container = numpy.fromstring(payload, dtype=numpy.uint8)
+            else:
+                container = numpy.fromstring(
+                    payload, dtype="<u2").astype(numpy.uint16)
+            bitmap.containers[key] = container
+            offset += byte_size
+        return bitmap
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Overlay chunk map file for cloudletfs.
+
+Instead of a "chunk:valid_bit,..." string, run_fuse writes the overlay map
+of each image to a file and passes "mapfile:<version>:<path>" to the FUSE
+daemon. The file has a header of (magic, version, entry count) followed by
+sorted entries of (chunk << 1 | valid_bit), all in little endian.
+The reader is the reference for load_overlay_map_file() of
+cloudletfs/ll-pristine.c. Daemons that do not report the format with
+"--capabilities" get the string.
+"""
+
+import os
+import struct
+import subprocess
+
+import numpy
+
+from .chunk_bitmap import ChunkBitmap
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ChunkMapError(Exception):
+    pass
+
+
+CHUNK_MAP_MAGIC = "CFCM"
+CHUNK_MAP_VERSION = 1
+CHUNK_MAP_PREFIX = "mapfile"
+CAPABILITIES_OPTION = "--capabilities"
+HEADER_FORMAT = "<4sIQ"
+ENTRY_DTYPE = numpy.dtype("<u8")
+
+
+# (path, mtime) of cloudletfs binary: whether it reads the map file
+_daemon_support_cache = dict()
+
+
+def _to_array(chunks):
+    if isinstance(chunks, ChunkBitmap):
+        chunk_array = chunks.to_array()
+    elif isinstance(chunks, numpy.ndarray):
+        chunk_array = chunks.astype(numpy.uint64)
+    else:
+        chunk_array = numpy.fromiter(chunks, dtype=numpy.uint64)
+    return numpy.unique(chunk_array)
+
+
+def write_chunk_map(map_path, chunks, valid_bit=0):
+    """Write chunk map file and return the number of entries
+    :param chunks: iterable of chunk numbers, numpy array or ChunkBitmap
+    """
+    chunk_array = _to_array(chunks)
+    entries = (chunk_array << numpy.uint64(1)) | numpy.uint64(valid_bit & 1)
+    with open(map_path, "wb") as fd:
+        fd.write(struct.pack(HEADER_FORMAT, CHUNK_MAP_MAGIC,
+                             CHUNK_MAP_VERSION, len(entries)))
+        fd.write(entries.astype(ENTRY_DTYPE).tostring())
+    return len(entries)
+
+
+def read_chunk_map(map_path):
+    """Return (array of chunk numbers, array of valid bits)
+    """
+    header_size = struct.calcsize(HEADER_FORMAT)
+    with open(map_path, "rb") as fd:
+        header = fd.read(header_size)
+        if len(header) != header_size:
+            raise ChunkMapError("Invalid chunk map header at %s" % map_path)
+        (magic, version, count) = struct.unpack(HEADER_FORMAT, header)
+        if magic != CHUNK_MAP_MAGIC:
+            raise ChunkMapError("Invalid chunk map header at %s" % map_path)
+        if version != CHUNK_MAP_VERSION:
+            msg = "Unsupported chunk map version %d" % version
+            raise ChunkMapError(msg)
+        entries = numpy.fromfile(fd, dtype=ENTRY_DTYPE, count=count)
+    if len(entries) != count:
+        raise ChunkMapError("Truncated chunk map at %s" % map_path)
+    entries = entries.astype(numpy.uint64)
+    return entries >> numpy.uint64(1), (entries & numpy.uint64(1)) == 1
+
+
+def get_argument(map_path):
+    return "%s:%d:%s" % (CHUNK_MAP_PREFIX, CHUNK_MAP_VERSION,
+                         os.path.abspath(map_path))
+
+
+def parse_argument(overlay_map):
+    """Return path of the chunk map file in overlay map argument of
+    cloudletfs, or None for the "chunk:valid_bit,..." string
+    """
+    if not overlay_map.startswith(CHUNK_MAP_PREFIX + ":"):
+        return None
+    try:
+        prefix, version, map_path = overlay_map.split(":", 2)
+        version = int(version)
+    except ValueError:
+        raise ChunkMapError("Invalid chunk map argument %s" % overlay_map)
+    if version != CHUNK_MAP_VERSION:
+        raise ChunkMapError("Unsupported chunk map version %d" % version)
+    return map_path
+
+
+def get_string_argument(chunks, valid_bit=0):
+    """Return "chunk:valid_bit,..." overlay map for daemons without map file
+    support
+    """
+    return ','.join("%ld:%d" % (chunk, valid_bit)
+                    for chunk in _to_array(chunks).tolist())
+
+
+def is_supported(bin_path):
+    """Return True if cloudletfs at bin_path reads the current map file
+    version. The daemon prints its formats for CAPABILITIES_OPTION, while
+    older ones ignore the option and exit on the empty stdin.
+    """
+    try:
+        cache_key = (bin_path, os.path.getmtime(bin_path))
+    except OSError:
+        return False
+    supported = _daemon_support_cache.get(cache_key, None)
+    if supported is not None:
+        return supported
+    try:
+        proc = subprocess.Popen([bin_path, CAPABILITIES_OPTION],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, close_fds=True)
+        out, err = proc.communicate("")
+    except OSError as e:
+        LOG.warning("Cannot check capabilities of %s: %s" % (bin_path, e))
+        return False
+    supported = False
+    for line in out.splitlines():
+        if not line.startswith(CHUNK_MAP_PREFIX + ":"):
+            continue
+        try:
+            version = int(line.split(":", 1)[1])
+        except ValueError:
+            continue
+        if version == CHUNK_MAP_VERSION:
+            supported = True
+    if not supported:
+        LOG.info("%s does not read chunk map files, "
+                 "pass overlay maps as strings" % bin_path)
+    _daemon_support_cache[cache_key] = supported
+    return supported
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+import os
+import math
+import fcntl
+import struct
+from hashlib import sha256
+
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ChunkStoreError(Exception):
+    pass
+
+
+class BloomFilter(object):
+    """Bloom filter of chunk hashes.
+
+    Keys are sha256 digests, which are already uniformly distributed, so bit
+    positions are derived from the digest itself using double hashing.
+    """
+    KEY_BIT_SIZE = "bit_size"
+    KEY_HASH_COUNT = "hash_count"
+    KEY_BITS = "bits"
+
+    def __init__(self, bit_size, hash_count, bits=None):
+        if bit_size <= 0 or hash_count <= 0:
+            msg = "Invalid bloom filter size: %d bits, %d hashes" % \
+                (bit_size, hash_count)
+            raise ChunkStoreError(msg)
+        self.bit_size = long(bit_size)
+        self.hash_count = int(hash_count)
+        if bits is None:
+            self.bits = bytearray((self.bit_size+7)/8)
+        else:
+            self.bits = bytearray(bits)
+            if len(self.bits) != (self.bit_size+7)/8:
+                raise ChunkStoreError("Bloom filter size mismatch")
+
+    @staticmethod
+    def for_capacity(item_count, false_positive_rate=0.01):
+        item_count = max(item_count, 1)
+        bit_size = -item_count*math.log(false_positive_rate)/(math.log(2)**2)
+        bit_size = long(math.ceil(bit_size))
+        hash_count = max(int(round(bit_size*math.log(2)/item_count)), 1)
+        return BloomFilter(bit_size, hash_count)
+
+    def _positions(self, key):
+        if len(key) != 32:
+            key = sha256(key).digest()
+        (hash1, hash2) = struct.unpack("!QQ", key[0:16])
+        for index in xrange(self.hash_count):
+            yield (hash1 + index*hash2) % self.bit_size
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= (1 << (pos & 0x07))
+
+    def __contains__(self, key):
+        for pos in self._positions(key):
+            if (self.bits[pos >> 3] & (1 << (pos & 0x07))) == 0:
+                return False
+        return True
+
+    def to_dict(self):
+        return {
+            self.KEY_BIT_SIZE: self.bit_size,
+            self.KEY_HASH_COUNT: self.hash_count,
+            self.KEY_BITS: str(self.bits),
+        }
+
+    @staticmethod
+    def from_dict(dictionary):
+        return BloomFilter(dictionary[BloomFilter.KEY_BIT_SIZE],
+                           dictionary[BloomFilter.KEY_HASH_COUNT],
+                           bits=dictionary[BloomFilter.KEY_BITS])
+
+
+class ChunkStore(object):
+    """Content addressed store of chunks that a cloudlet already holds.
+
+    Chunk data is appended to a single data file and located by an index
+    file whose records are (sha256, offset, length). Handoffs to the same
+    cloudlet share the store, so reading and updating it holds a lock on
+    LOCK_FILE. When the data grows over capacity, the oldest chunks are
+    evicted (FIFO) by rewriting both files.
+    """
+    DATA_FILE = "chunk-data"
+    INDEX_FILE = "chunk-index"
+    LOCK_FILE = "chunk-lock"
+    INDEX_FORMAT = "!32sQI"
+    INDEX_RECORD_SIZE = struct.calcsize(INDEX_FORMAT)
+    # evict down to this ratio of capacity not to rewrite at every update
+    EVICT_RATIO = 0.8
+
+    def __init__(self, store_dir, capacity=None):
+        self.store_dir = os.path.abspath(store_dir)
+        if os.path.exists(self.store_dir) is False:
+            os.makedirs(self.store_dir)
+        self.data_path = os.path.join(self.store_dir, self.DATA_FILE)
+        self.index_path = os.path.join(self.store_dir, self.INDEX_FILE)
+        self.lock_path = os.path.join(self.store_dir, self.LOCK_FILE)
+        self.capacity = capacity
+        self.index_dict = dict()
+        self.record_count = 0
+        self.data_fd = None
+        self.lock_fd = None
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._load_index()
+        finally:
+            self._unlock()
+
+    def _lock(self, operation):
+        self.lock_fd = open(self.lock_path, "a")
+        fcntl.flock(self.lock_fd.fileno(), operation)
+
+    def _unlock(self):
+        fcntl.flock(self.lock_fd.fileno(), fcntl.LOCK_UN)
+        self.lock_fd.close()
+        self.lock_fd = None
+
+    def _read_index(self):
+        # list of (hash_value, offset, length) in the order of addition.
+        # A partial record of an interrupted update is ignored
+        record_list = list()
+        if os.path.exists(self.index_path) is False:
+            return record_list
+        with open(self.index_path, "rb") as fd:
+            while True:
+                data = fd.read(self.INDEX_RECORD_SIZE)
+                if len(data) < self.INDEX_RECORD_SIZE:
+                    break
+                record_list.append(struct.unpack(self.INDEX_FORMAT, data))
+        return record_list
+
+    def _load_index(self):
+        self.index_dict = dict()
+        record_list = self._read_index()
+        for (hash_value, offset, length) in record_list:
+            self.index_dict[hash_value] = (offset, length)
+        self.record_count = len(record_list)
+        # keep the data file open. Eviction by another handoff replaces the
+        # file, and this descriptor still points to the data we indexed
+        if self.data_fd is not None:
+            self.data_fd.close()
+            self.data_fd = None
+        if os.path.exists(self.data_path):
+            self.data_fd = open(self.data_path, "rb")
+
+    def __len__(self):
+        return len(self.index_dict)
+
+    def __contains__(self, hash_value):
+        return hash_value in self.index_dict
+
+    def get(self, hash_value):
+        item = self.index_dict.get(hash_value, None)
+        if item is None or self.data_fd is None:
+            return None
+        (offset, length) = item
+        self.data_fd.seek(offset)
+        data = self.data_fd.read(length)
+        if len(data) != length or sha256(data).digest() != hash_value:
+            LOG.warning("Corrupted chunk at %s (offset %ld)" %
+                        (self.data_path, offset))
+            return None
+        return data
+
+    def add(self, hash_value, data):
+        return self.add_chunks([(hash_value, data)]) == 1
+
+    def add_chunks(self, chunk_list):
+        """Add (hash_value, data) of chunk_list and return the number of
+        new chunks
+        """
+        added_count = 0
+        self._lock(fcntl.LOCK_EX)
+        try:
+            # other handoffs may have changed the store since it is loaded
+            self._load_index()
+            index_size = self.record_count*self.INDEX_RECORD_SIZE
+            with open(self.data_path, "ab") as data_fd, \
+                    open(self.index_path, "ab") as index_fd:
+                index_fd.truncate(index_size)
+                data_fd.seek(0, os.SEEK_END)
+                offset = data_fd.tell()
+                for (hash_value, data) in chunk_list:
+                    if hash_value in self.index_dict:
+                        continue
+                    data_fd.write(data)
+                    index_fd.write(struct.pack(self.INDEX_FORMAT, hash_value,
+                                               offset, len(data)))
+                    self.index_dict[hash_value] = (offset, len(data))
+                    offset += len(data)
+                    added_count += 1
+            if self.capacity is not None and offset > self.capacity:
+                self._evict()
+            self._load_index()
+        finally:
+            self._unlock()
+        return added_count
+
+    def _evict(self):
+        record_list = self._read_index()
+        keep_size = 0
+        keep_from = len(record_list)
+        for index in xrange(len(record_list)-1, -1, -1):
+            length = record_list[index][2]
+            if keep_size + length > self.capacity*self.EVICT_RATIO:
+                break
+            keep_size += length
+            keep_from = index
+
+        temp_data_path = self.data_path + ".evict"
+        temp_index_path = self.index_path + ".evict"
+        with open(self.data_path, "rb") as data_fd, \
+                open(temp_data_path, "wb") as temp_data_fd, \
+                open(temp_index_path, "wb") as temp_index_fd:
+            new_offset = 0
+            for (hash_value, offset, length) in record_list[keep_from:]:
+                data_fd.seek(offset)
+                temp_data_fd.write(data_fd.read(length))
+                temp_index_fd.write(struct.pack(self.INDEX_FORMAT, hash_value,
+                                                new_offset, length))
+                new_offset += length
+            temp_data_fd.flush()
+            os.fsync(temp_data_fd.fileno())
+            temp_index_fd.flush()
+            os.fsync(temp_index_fd.fileno())
+        # get() checks the hash, so a crash between the renames loses the
+        # chunks but does not return wrong data
+        os.rename(temp_data_path, self.data_path)
+        os.rename(temp_index_path, self.index_path)
+        LOG.info("Evict %d chunks from chunk store (%ld bytes remain)" %
+                 (keep_from, keep_size))
+
+    def get_bloom_filter(self, false_positive_rate=0.01):
+        bloom_filter = BloomFilter.for_capacity(
+            len(self.index_dict), false_positive_rate)
+        for hash_value in self.index_dict.iterkeys():
+            bloom_filter.add(hash_value)
+        return bloom_filter
+
+    def close(self):
+        if self.data_fd is not None:
+            self.data_fd.close()
+            self.data_fd = None
@@ -22,12 +22,20 @@ import os
 import subprocess
 import errno
 import select
+import fcntl
+import array
+import ctypes
+import ctypes.util
+import warnings
 import threading
 import multiprocessing
 import time
 import sys
+import numpy
 from . import log as logging
 from .configuration import Const
+from .delta import DeltaItem
+from .chunk_bitmap import ChunkBitmap
 
 LOG = logging.getLogger(__name__)
 
@@ -52,15 +60,17 @@ class CloudletFS(threading.Thread):
         self._pipe = None
         self.mountpoint = None
         self.stop = threading.Event()
-        self.modified_disk_chunks = list(
+        self.modified_disk_chunks = ChunkBitmap(
             modified_disk_chunks) if modified_disk_chunks else None
-        self.modified_memory_chunks = list(
+        self.modified_memory_chunks = ChunkBitmap(
             modified_memory_chunks) if modified_memory_chunks else None
 
         # fuse can handle on-demand fetching
         # TODO: passing these arguments through kwargs
         self.demanding_queue = kwargs.get("demanding_queue", None)
         self.meta_info = kwargs.get("meta_info", None)
+        # speculative fetching for the next blobs (prefetch.ChunkPrefetcher)
+        self.prefetcher = kwargs.get("prefetcher", None)
         threading.Thread.__init__(self, target=self.fuse_read)
 
     def fuse_read(self):
@@ -102,6 +112,11 @@ class CloudletFS(threading.Thread):
                         raise CloudletFSError(msg)
                     #LOG.debug("requesting chunk(%ld) at %s" % (chunk, url))
                     self.demanding_queue.put(url)
+                    if self.prefetcher is not None:
+                        delta_type = DeltaItem.DELTA_MEMORY
+                        if overlay_type == CloudletFS.FUSE_TYPE_DISK:
+                            delta_type = DeltaItem.DELTA_DISK
+                        self.prefetcher.on_demand(delta_type, chunk)
                 elif (len(request_split) > 0) and (request_split[0].find("STATISTICS-WAIT") > 0):
                     type_name, overlay_type = request_split[1].split(":")
                     chunk_name, chunk = request_split[2].split(":")
@@ -177,24 +192,177 @@ class CloudletFS(threading.Thread):
             # self.proc.terminate()
 
 
-class StreamMonitor(threading.Thread):
+IN_MODIFY = 0x00000002
+
+
+def _inotify_watch(path, mask=IN_MODIFY):
+    """Return non-blocking inotify fd watching path, or None if inotify is
+    not available
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        inotify_fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError) as e:
+        LOG.info("inotify is not available: %s" % str(e))
+        return None
+    if inotify_fd < 0:
+        return None
+    if libc.inotify_add_watch(inotify_fd, path, mask) < 0:
+        LOG.info("Cannot watch %s: %s" %
+                 (path, os.strerror(ctypes.get_errno())))
+        os.close(inotify_fd)
+        return None
+    return inotify_fd
+
+
+class _PollThread(threading.Thread):
+    """Thread waiting on a single poll loop of the registered fds.
+    Everything readable is handled before the next poll, and other threads
+    wake up the loop through a pipe instead of a polling interval.
+    """
+    POLL_READ = select.POLLIN | select.POLLPRI
+    POLL_CLOSED = select.POLLHUP | select.POLLERR | select.POLLNVAL
+    # poll delay of an fd that is readable without data (e.g. FUSE files,
+    # which do not support poll). It doubles while the fd stays idle, but
+    # stays close to the minimum because the first event after an idle
+    # period waits for the whole delay.
+    IDLE_DELAY_MIN = 0.01
+    IDLE_DELAY_MAX = 0.02
+
+    def __init__(self, poll_timeout=None):
+        """
+        :param poll_timeout: milliseconds to call handle_timeout() while
+        there is no event. Wait forever if None.
+        """
+        self._running = False
+        self.stop = False   # use boolean instead of Event to minimize
+                            # Condition.wait() overhead in green thread
+                            # of Openstack
+        self.poll_timeout = poll_timeout
+        self.handler_dict = dict()
+        self.idle_delay_dict = dict()
+        self.deferred_dict = dict()     # fd: time to poll again
+        self.poller = select.poll()
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        for wakeup_fd in (self.wakeup_read, self.wakeup_write):
+            flags = fcntl.fcntl(wakeup_fd, fcntl.F_GETFL)
+            fcntl.fcntl(wakeup_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.poller.register(self.wakeup_read, select.POLLIN)
+        threading.Thread.__init__(self, target=self.io_watch)
+
+    def register(self, fd, handler):
+        """handler(fd, event) is called when fd is readable or closed"""
+        self.handler_dict[fd] = handler
+        self.poller.register(fd, self.POLL_READ)
+
+    def unregister(self, fd):
+        if self.handler_dict.pop(fd, None) is not None:
+            self.idle_delay_dict.pop(fd, None)
+            if self.deferred_dict.pop(fd, None) is None:
+                self.poller.unregister(fd)
+            os.close(fd)
+
+    def defer(self, fd):
+        """Stop polling fd that woke up the loop without data for a while,
+        without delaying the other fds
+        """
+        delay = self.idle_delay_dict.get(fd, self.IDLE_DELAY_MIN/2)*2
+        delay = min(delay, self.IDLE_DELAY_MAX)
+        self.idle_delay_dict[fd] = delay
+        self.deferred_dict[fd] = time.time() + delay
+        self.poller.unregister(fd)
+
+    def set_active(self, fd):
+        """fd had data, so poll it without delay next time"""
+        self.idle_delay_dict.pop(fd, None)
+
+    def _get_poll_timeout(self):
+        if len(self.deferred_dict) == 0:
+            return self.poll_timeout
+        wait_time = min(self.deferred_dict.values()) - time.time()
+        timeout = int(max(wait_time, 0)*1000) + 1
+        if self.poll_timeout is not None:
+            timeout = min(timeout, self.poll_timeout)
+        return timeout
+
+    def _poll_deferred(self):
+        cur_time = time.time()
+        for fd, poll_time in self.deferred_dict.items():
+            if poll_time <= cur_time:
+                del self.deferred_dict[fd]
+                self.poller.register(fd, self.POLL_READ)
+
+    def wakeup(self):
+        try:
+            os.write(self.wakeup_write, 'w')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def io_watch(self):
+        self.handle_timeout()
+        while(not self.stop):
+            self._running = True
+            timeout = self._get_poll_timeout()
+            event_list = self.poller.poll(timeout)
+            self._poll_deferred()
+            if len(event_list) == 0 and timeout == self.poll_timeout:
+                self.handle_timeout()
+            for fd, event in event_list:
+                if fd == self.wakeup_read:
+                    self._drain(fd)
+                    continue
+                handler = self.handler_dict.get(fd, None)
+                if handler is not None:
+                    handler(fd, event)
+            self.handle_pending()
+
+        for fd in self.handler_dict.keys():
+            self.unregister(fd)
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
+        self.handle_finish()
+        self._running = False
+
+    def _drain(self, fd):
+        try:
+            while os.read(fd, 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def handle_timeout(self):
+        pass
+
+    def handle_pending(self):
+        pass
+
+    def handle_finish(self):
+        pass
+
+    def terminate(self):
+        self.stop = True
+        self.wakeup()
+
+
+class StreamMonitor(_PollThread):
     DISK_MODIFY = "DISK_MODIFY"
     DISK_ACCESS = "DISK_ACCESS"
     MEMORY_ACCESS = "MEMORY_ACCESS"
+    READ_SIZE = 1024*1024
 
     def __init__(self, modified_disk_queue=None):
-        self.monitor_file_list = list()
         self.stream_dict = dict()
-        self._running = False
-        self.stop = False   # use boolean instead of Event to minimize
-                            # Condition.wait() overhead in green thread
-                            # of Openstack
         self.modified_chunk_dict = dict()
         self.modified_disk_queue = modified_disk_queue
-        self.disk_access_chunk_list = list()
-        self.mem_access_chunk_list = list()
+        self.disk_access_chunk_list = array.array('l')
+        self.mem_access_chunk_list = array.array('l')
+        # time of the first access of each chunk
+        self.disk_first_access_dict = dict()
+        self.mem_first_access_dict = dict()
         self.del_list = list()
-        threading.Thread.__init__(self, target=self.io_watch)
+        _PollThread.__init__(self)
 
     def add_path(self, path, name):
         # We need to set O_NONBLOCK in open() because FUSE doesn't pass
@@ -202,141 +370,170 @@ class StreamMonitor(threading.Thread):
         LOG.info("start monitoring at %s" % path)
         fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
         self.stream_dict[fd] = {'name': name, 'buf': '', 'path': path}
-        self.monitor_file_list.append(fd)
+        self.register(fd, self._handle)
 
     def del_path(self, name):
-        # We need to set O_NONBLOCK in open() because FUSE doesn't pass
-        # through fcntl()
         for fileno, item in self.stream_dict.items():
             monitor_path = item['path']
             monitor_name = item['name']
             if name == monitor_name:
                 LOG.info("stop monitoring at %s" % monitor_path)
                 self.del_list.append(fileno)
+        self.wakeup()
 
-    def io_watch(self):
-        while(not self.stop):
-            self._running = True
-            input_ready, out_ready, err_ready = select.select(
-                self.monitor_file_list, [], []
-            )
-            for each_fd in input_ready:
-                self._handle(each_fd)
-
-            while len(self.del_list) > 0:
-                fileno = self.del_list.pop()
-                self.monitor_file_list.remove(fileno)
-                os.close(fileno)
-                del self.stream_dict[fileno]
-
-        for fileno, item in self.stream_dict.items():
-            self.monitor_file_list.remove(fileno)
-            os.close(fileno)
-            del self.stream_dict[fileno]
+    def handle_pending(self):
+        while len(self.del_list) > 0:
+            fileno = self.del_list.pop()
+            self._close_stream(fileno)
 
+    def handle_finish(self):
         if self.modified_disk_queue is not None:
             self.modified_disk_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
             self.modified_disk_queue = None
-
-        self._running = False
         LOG.info("close Stream monitoring thread")
 
-    def _handle(self, fd):
-        try:
-            buf = os.read(fd, 1024*1024)
-        except OSError as e:
-            if e.errno == errno.EAGAIN or e.errno == errno.EWOULDBLOCK:
-                time.sleep(0.1)
+    def _close_stream(self, fd):
+        if self.stream_dict.pop(fd, None) is not None:
+            self.unregister(fd)
+
+    def _handle(self, fd, event):
+        # read everything available at once
+        data_list = list()
+        while True:
+            try:
+                buf = os.read(fd, self.READ_SIZE)
+            except OSError as e:
+                if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
+                    LOG.warning("failed to read %s: %s" %
+                                (self.stream_dict[fd]['path'], str(e)))
+                break
+            if not buf:
+                break
+            data_list.append(buf)
+
+        if len(data_list) == 0:
+            if event & self.POLL_CLOSED:
+                self._close_stream(fd)
             else:
-                pass
+                # readable without data
+                self.defer(fd)
             return
+        self.set_active(fd)
 
-        # We got some output
-        lines = (self.stream_dict[fd]['buf'] + buf).split('\n')
+        stream_name = self.stream_dict[fd]['name']
+        data = self.stream_dict[fd]['buf'] + ''.join(data_list)
+        line_end = data.rfind('\n')
         # Save partial last line, if any
-        self.stream_dict[fd]['buf'] = lines.pop()
-        for line in lines:
-            stream_name = self.stream_dict[fd]['name']
-            if stream_name == StreamMonitor.DISK_MODIFY:
-                self._handle_chunks_modification(line)
-            elif stream_name == StreamMonitor.DISK_ACCESS:
-                self._handle_disk_access(line)
-            elif stream_name == StreamMonitor.MEMORY_ACCESS:
-                self._handle_memory_access(line)
-            else:
-                raise IOError("Error, invalid stream")
-                break
-        # Yield to other thread (Eventlet) after reading data from file.
-        time.sleep(0.1)
-
-    def _handle_chunks_modification(self, line):
-        try:
+        self.stream_dict[fd]['buf'] = data[line_end+1:]
+        if line_end < 0:
+            return
+        ctime_list, chunk_list = self._parse_lines(
+            data[:line_end+1], stream_name == StreamMonitor.DISK_MODIFY)
+        if stream_name == StreamMonitor.DISK_MODIFY:
+            self._handle_chunks_modification(ctime_list, chunk_list)
+        elif stream_name == StreamMonitor.DISK_ACCESS:
+            self._handle_access(ctime_list, chunk_list,
+                                self.disk_access_chunk_list,
+                                self.disk_first_access_dict)
+        elif stream_name == StreamMonitor.MEMORY_ACCESS:
+            self._handle_access(ctime_list, chunk_list,
+                                self.mem_access_chunk_list,
+                                self.mem_first_access_dict)
+        else:
+            raise IOError("Error, invalid stream")
+
+    @staticmethod
+    def _parse_lines(data, allow_no_time=False):
+        """Parse "ctime\\tchunk" lines into (list of ctime, list of chunk)
+        """
+        line_count = data.count('\n')
+        with warnings.catch_warnings():
+            # numpy warns at the first token that is not a number
+            warnings.simplefilter("ignore")
+            values = numpy.fromstring(data, dtype=numpy.float64, sep=' ')
+        if len(values) == line_count*2 and data.count('\t') == line_count:
+            return values[0::2].tolist(), \
+                values[1::2].astype(numpy.int64).tolist()
+
+        # fall back to parse line by line
+        ctime_list = list()
+        chunk_list = list()
+        for line in data.split('\n')[:line_count]:
             values = line.split("\t")
-            if len(values) == 2:
-                # expected result
-                ctime = float(values[0])
-                chunk = int(values[1])
-            elif len(values) == 1:
-                # This happens when there's a modified chunk before opening
-                # the stream file. We encounter this problem at commit
-                # 333992a5a4a99e96a5ffc7c39ff7b3ab459ce1fc because we execute
-                # handoff code using serializable DS, which reopens log file.
-                # To workaround, we assign the recent time for those modified
-                # chunks. This may increase handoff size by preventing TRIM,
-                # but preserve correctness.
-                ctime = time.time()
-                chunk = int(values[0])
+            try:
+                if len(values) == 2:
+                    # expected result
+                    ctime = float(values[0])
+                    chunk = int(values[1])
+                elif len(values) == 1 and allow_no_time:
+                    # This happens when there's a modified chunk before
+                    # opening the stream file. We encounter this problem at
+                    # commit 333992a5a4a99e96a5ffc7c39ff7b3ab459ce1fc because
+                    # we execute handoff code using serializable DS, which
+                    # reopens log file. To workaround, we assign the recent
+                    # time for those modified chunks. This may increase
+                    # handoff size by preventing TRIM, but preserve
+                    # correctness.
+                    ctime = time.time()
+                    chunk = int(values[0])
+                else:
+                    continue
+            except ValueError as e:
+                LOG.debug("warning failed to parse chunk: %s" % str(e))
+                continue
+            ctime_list.append(ctime)
+            chunk_list.append(chunk)
+        return ctime_list, chunk_list
+
+    def _handle_chunks_modification(self, ctime_list, chunk_list):
+        for ctime, chunk in zip(ctime_list, chunk_list):
             self.modified_chunk_dict[chunk] = ctime
             if self.modified_disk_queue is not None:
                 self.modified_disk_queue.put((chunk, ctime))
-        except ValueError as e:
-            LOG.debug("warning failed to handle modified chunks: %s" % str(e))
 
-    def _handle_disk_access(self, line):
-        ctime, chunk = line.split("\t")
-        ctime = float(ctime)
-        chunk = int(chunk)
-        self.disk_access_chunk_list.append(chunk)
+    def _handle_access(self, ctime_list, chunk_list, access_chunk_list,
+                       first_access_dict):
+        access_chunk_list.extend(chunk_list)
+        for ctime, chunk in zip(ctime_list, chunk_list):
+            first_access_dict.setdefault(chunk, ctime)
 
-    def _handle_memory_access(self, line):
-        try:
-            ctime, chunk = line.split("\t")
-            ctime = float(ctime)
-            chunk = int(chunk)
-            self.mem_access_chunk_list.append(chunk)
-        except ValueError as e:
-            #LOG.warning("failed to handle memory access")
-            pass
-
-    def terminate(self):
-        self.stop = True
 
-
-class FileMonitor(threading.Thread):
+class FileMonitor(_PollThread):
     QEMU_LOG = "QEMU_LOG"
+    READ_SIZE = 64*1024
+    # polling interval in ms when inotify is not available
+    POLL_INTERVAL = 1000
 
     def __init__(self, path, name):
-        self.stream_dict = dict()
-        self._running = False
-        self.stop = False   # use boolean instead of thread to minimize
-                            # Condition.wait() overhead in green thread
-                            # of Openstack
         self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
         self.buf = ''
-        threading.Thread.__init__(self, target=self.io_watch)
+        self.inotify_fd = _inotify_watch(path)
+        if self.inotify_fd is None:
+            _PollThread.__init__(self, poll_timeout=self.POLL_INTERVAL)
+        else:
+            _PollThread.__init__(self)
+            self.register(self.inotify_fd, self._handle_inotify)
         LOG.info("start monitoring at %s" % path)
 
-    def io_watch(self):
-        while(not self.stop):
-            self._running = True
-            line = os.read(self.fd, 1024)
-            lines = (self.buf+line).split('\n')
-            self.buf = lines.pop()
-            for line in lines:
-                self._handle_qemu_log(line)
-            else:
-                time.sleep(1)
-        self._running = False
+    def _handle_inotify(self, fd, event):
+        self._drain(fd)
+        self.handle_timeout()
+
+    def handle_timeout(self):
+        # read appended log
+        data_list = list()
+        while True:
+            data = os.read(self.fd, self.READ_SIZE)
+            if not data:
+                break
+            data_list.append(data)
+        lines = (self.buf + ''.join(data_list)).split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            self._handle_qemu_log(line)
+
+    def handle_finish(self):
+        os.close(self.fd)
         LOG.info("close File monitoring thread")
 
     def _handle_qemu_log(self, line):
@@ -355,9 +552,6 @@ class FileMonitor(threading.Thread):
                 "invalid log: (%s)(%s)(%s)\n" %
                 (event_time, header, data))
 
-    def terminate(self):
-        self.stop = True
-
 
 class FuseFeedingProc(multiprocessing.Process):
 
@@ -7,8 +7,10 @@ import msgpack
 import multiprocessing
 import traceback
 import ctypes
+import Queue
 
 from .delta import DeltaItem
+from .access_trace import BlobPacker
 
 import lzma
 import bz2
@@ -16,10 +18,26 @@ import zlib
 from .configuration import Const
 from .configuration import VMOverlayCreationMode
 from .package import VMOverlayPackage
+from . import overlay_meta
 from . import process_manager
 from . import log as logging
 
+
+# to work with OpenStack's eventlet
+try:
+    from eventlet import patcher
+    if patcher.is_monkey_patched("thread"):
+        native_threading = patcher.original("threading")
+    else:
+        raise ImportError("threading is not monkey-patched")
+except ImportError as e:
+    import threading
+    native_threading = threading
+
+
 LOG = logging.getLogger(__name__)
+# smallest input slice for decompressors without an output limit
+SLICE_SIZE_MIN = 4096
 
 
 class CompressionError(Exception):
@@ -30,10 +48,13 @@ class CompressProc(process_manager.ProcWorker):
 
     def __init__(self, delta_list_queue, comp_delta_queue,
                  overlay_mode,
-                 block_size=1024*1024*2):
+                 block_size=1024*1024*2,
+                 access_trace=None):
         """
         comparisons of compression algorithm
         http://pokecraft.first-world.info/wiki/Quick_Benchmark:_Gzip_vs_Bzip2_vs_LZMA_vs_XZ_vs_LZ4_vs_LZO
+        :param access_trace: access_trace.AccessTrace to pack accessed
+        chunks into separate blobs
         """
         self.delta_list_queue = delta_list_queue
         self.comp_delta_queue = comp_delta_queue
@@ -42,6 +63,7 @@ class CompressProc(process_manager.ProcWorker):
         self.comp_type = overlay_mode.COMPRESSION_ALGORITHM_TYPE
         self.comp_level = overlay_mode.COMPRESSION_ALGORITHM_SPEED
         self.block_size = block_size
+        self.access_trace = access_trace
         self.proc_list = list()
 
         # monitor value specific to compression
@@ -51,17 +73,32 @@ class CompressProc(process_manager.ProcWorker):
         super(CompressProc, self).__init__(target=self.compress_stream)
 
     def change_mode(self, new_mode):
+        # new children start with the latest mode
+        if new_mode.get("comp_type", None) is not None:
+            self.comp_type = new_mode.get("comp_type")
+        if new_mode.get("comp_level", None) is not None:
+            self.comp_level = new_mode.get("comp_level")
         for (proc, c_queue, m_queue) in self.proc_list:
             if proc.is_alive():
                 m_queue.put(("new_mode", new_mode))
 
+    def _create_child(self):
+        command_queue = multiprocessing.Queue()
+        mode_queue = multiprocessing.Queue()
+        comp_proc = CompChildProc(
+            command_queue,
+            self.task_queue,
+            mode_queue,
+            self.comp_delta_queue,
+            self.comp_type,
+            self.comp_level)
+        return (comp_proc, command_queue, mode_queue)
+
     def _chunk_blob(self):
-        input_size = 0
-        input_deltalist = list()
         is_last_blob = False
         input_list = [self.control_queue._reader.fileno(),
                       self.delta_list_queue._reader.fileno()]
-        while input_size < self.block_size:
+        while not self.blob_packer.is_full():
             (input_ready, [], []) = select.select(input_list, [], [], 0.01)
             if self.control_queue._reader.fileno() in input_ready:
                 control_msg = self.control_queue.get()
@@ -85,12 +122,9 @@ class CompressProc(process_manager.ProcWorker):
                 if deltaitem_list == Const.QUEUE_SUCCESS_MESSAGE:
                     is_last_blob = True
                     break
-                recved_size = 0
                 for delta_item in deltaitem_list:
-                    recved_size += (delta_item.data_len + 11 + 8)
-                input_size += recved_size
-                input_deltalist += deltaitem_list
-        return is_last_blob, input_deltalist
+                    self.blob_packer.add(delta_item)
+        return is_last_blob, self.blob_packer.pop_blobs(flush=is_last_blob)
 
     @staticmethod
     def averaged_value(measure_hist, cur_time):
@@ -112,6 +146,7 @@ class CompressProc(process_manager.ProcWorker):
         self.time_first_recv = 0
         self.measure_history = list()
         self.measure_history_cur = list()
+        self.blob_packer = BlobPacker(self.block_size, self.access_trace)
         try:
             time_start = time.time()
 
@@ -119,25 +154,18 @@ class CompressProc(process_manager.ProcWorker):
             self.task_queue = multiprocessing.Queue(
                 maxsize=VMOverlayCreationMode.MAX_THREAD_NUM)
             for i in range(self.num_proc):
-                command_queue = multiprocessing.Queue()
-                mode_queue = multiprocessing.Queue()
-                comp_proc = CompChildProc(
-                    command_queue,
-                    self.task_queue,
-                    mode_queue,
-                    self.comp_delta_queue,
-                    self.comp_type,
-                    self.comp_level)
+                (comp_proc, command_queue, mode_queue) = self._create_child()
                 comp_proc.start()
                 self.proc_list.append((comp_proc, command_queue, mode_queue))
 
             is_last_blob = False
             while is_last_blob is False:
                 # read data
-                is_last_blob, input_deltalist = self._chunk_blob()
+                is_last_blob, blob_list = self._chunk_blob()
 
-                if len(input_deltalist) > 0:
-                    self.task_queue.put(input_deltalist)
+                if len(blob_list) > 0:
+                    for input_deltalist in blob_list:
+                        self.task_queue.put(input_deltalist)
                     # measurement
                     total_process_time = 0
                     total_block_count = 0
@@ -200,8 +228,7 @@ class CompressProc(process_manager.ProcWorker):
             self.finish_processing_input.value = True
 
             # send end meesage to every process
-            for index in self.proc_list:
-                self.task_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+            self.send_end_messages(self.task_queue)
 
             # after this for loop, all processing finished, but child process still
             # alive until all data pass to the next step
@@ -321,6 +348,10 @@ class CompChildProc(multiprocessing.Process):
                     new_num_cores = value
                     if new_num_cores is not None:
                         VMOverlayCreationMode.set_num_cores(new_num_cores)
+                elif command == "retire":
+                    # remaining tasks go to the other children
+                    is_proc_running = False
+                    break
             if self.task_queue._reader.fileno() in inready:
                 input_task = self.task_queue.get()
                 if input_task == Const.QUEUE_SUCCESS_MESSAGE:
@@ -330,20 +361,7 @@ class CompChildProc(multiprocessing.Process):
                 comp_type_cur = self.comp_type
                 loop_counter += 1
 
-                # get compressor
-                if comp_type_cur == Const.COMPRESSION_LZMA:
-                    # mode = 2 indicates LZMA_SYNC_FLUSH, which show all output
-                    # right after input
-                    comp = lzma.LZMACompressor(
-                        options={'format': 'xz',
-                                 'level': self.comp_level})
-                elif comp_type_cur == Const.COMPRESSION_BZIP2:
-                    comp = bz2.BZ2Compressor(self.comp_level)
-                elif comp_type_cur == Const.COMPRESSION_GZIP:
-                    comp = zlib.compressobj(
-                        self.comp_level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
-                else:
-                    raise CompressionError("Not supporting")
+                comp = get_compressor(comp_type_cur, self.comp_level)
 
                 # compression for each block
                 modified_memory_chunks = list()
@@ -404,12 +422,59 @@ class CompChildProc(multiprocessing.Process):
             sys.stdout.write(msg)
 
 
-class DecompProc(multiprocessing.Process):
+def get_compressor(comp_type, comp_level):
+    if comp_type == Const.COMPRESSION_LZMA:
+        # mode = 2 indicates LZMA_SYNC_FLUSH, which show all output
+        # right after input
+        return lzma.LZMACompressor(options={'format': 'xz',
+                                            'level': comp_level})
+    elif comp_type == Const.COMPRESSION_BZIP2:
+        return bz2.BZ2Compressor(comp_level)
+    elif comp_type == Const.COMPRESSION_GZIP:
+        return zlib.compressobj(comp_level, zlib.DEFLATED,
+                                zlib.MAX_WBITS | 16)
+    raise CompressionError("Not supporting")
+
+
+def decompress_blob(comp_type, comp_data):
+    if comp_type == Const.COMPRESSION_LZMA:
+        decompressor = lzma.LZMADecompressor()
+        decomp_data = decompressor.decompress(comp_data)
+        decomp_data += decompressor.flush()
+    elif comp_type == Const.COMPRESSION_BZIP2:
+        decompressor = bz2.BZ2Decompressor()
+        decomp_data = decompressor.decompress(comp_data)
+    elif comp_type == Const.COMPRESSION_GZIP:
+        decomp_data = zlib.decompress(
+            comp_data,
+            zlib.MAX_WBITS | 16)
+    else:
+        raise CompressionError("Not valid compression option")
+    return decomp_data
 
-    def __init__(self, input_queue, output_queue, num_proc=4):
+
+class DecompProc(multiprocessing.Process):
+    """Decompress blobs in parallel and output them in the input order.
+    Each blob gets a sequence number and goes to the task queue of a child
+    in turn. Children block on their own task queue; when a blob goes to a
+    busy child, an idle child is told to steal from the other task
+    queues. Decompressed
+    blobs wait in the reorder buffer until the blobs before them are out,
+    and at most reorder_window blobs are in flight.
+    """
+    REORDER_WINDOW_PER_PROC = 4
+
+    def __init__(self, input_queue, output_queue, num_proc=None,
+                 reorder_window=None):
         self.input_queue = input_queue
         self.output_queue = output_queue
+        if num_proc is None:
+            # leave a core for the next stage
+            num_proc = max(1, VMOverlayCreationMode.get_num_cores()-1)
         self.num_proc = num_proc
+        if reorder_window is None:
+            reorder_window = self.REORDER_WINDOW_PER_PROC*num_proc
+        self.reorder_window = max(reorder_window, num_proc)
         self.proc_list = list()
         multiprocessing.Process.__init__(self, target=self.decompress_blobs)
 
@@ -417,20 +482,31 @@ class DecompProc(multiprocessing.Process):
         time_start = time.time()
 
         # launch child processes
-        output_fd_list = list()
-        output_fd_dict = dict()
-        for i in range(self.num_proc):
+        result_queue = multiprocessing.Queue()
+        task_queue_list = [multiprocessing.Queue()
+                           for i in range(self.num_proc)]
+        for task_queue in task_queue_list:
             command_queue = multiprocessing.Queue()
-            task_queue = multiprocessing.Queue(maxsize=1)
+            steal_queue_list = [each_queue for each_queue in task_queue_list
+                                if each_queue is not task_queue]
             comp_proc = DecompChildProc(
                 command_queue,
                 task_queue,
-                self.output_queue)
+                result_queue,
+                steal_queue_list=steal_queue_list)
             comp_proc.start()
             self.proc_list.append((comp_proc, task_queue, command_queue))
-            output_fd_list.append(task_queue._writer.fileno())
-            output_fd_dict[task_queue._writer.fileno()] = task_queue
 
+        self.window = native_threading.Semaphore(self.reorder_window)
+        # blobs of each child's task queue that are not decompressed yet
+        self.pending_count = [0]*self.num_proc
+        self.pending_lock = native_threading.Lock()
+        self.input_finished = native_threading.Event()
+        self.is_failed = False
+        self.blob_count = 0
+        reorder_thread = native_threading.Thread(
+            target=self._reorder, args=(result_queue,))
+        reorder_thread.start()
         try:
             while True:
                 recv_data = self.input_queue.get()
@@ -441,14 +517,20 @@ class DecompProc(multiprocessing.Process):
                     break
 
                 (comp_type, comp_data) = recv_data
-                ([], output_ready, []) = select.select([], output_fd_list, [])
-                task_queue = output_fd_dict[output_ready[0]]
-                task_queue.put(recv_data)
+                self.window.acquire()
+                if self.is_failed:
+                    break
+                owner = self.blob_count % self.num_proc
+                task_queue_list[owner].put(
+                    (self.blob_count, comp_type, comp_data))
+                self.blob_count += 1
+                self._signal_backlog(task_queue_list, owner)
         except Exception as e:
             sys.stdout.write("[decomp] Exception")
             sys.stderr.write(traceback.format_exc())
             sys.stderr.write("%s\n" % str(e))
-            self.output_queue.put(Const.QUEUE_FAILED_MESSAGE)
+            self.is_failed = True
+        self.input_finished.set()
 
         # send end meesage to every process
         for (proc, t_queue, c_queue) in self.proc_list:
@@ -457,111 +539,324 @@ class DecompProc(multiprocessing.Process):
 
         # after this for loop, all processing finished, but child process still
         # alive until all data pass to the next step
+        steal_count = 0
         for (proc, t_queue, c_queue) in self.proc_list:
-            c_queue.get()
+            (task_count, stolen_count) = c_queue.get()
+            steal_count += stolen_count
+        reorder_thread.join()
         time_end = time.time()
 
         for (proc, t_queue, c_queue) in self.proc_list:
             proc.join()
         # send end message after the next stage finishes processing
-        self.output_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        if self.is_failed:
+            self.output_queue.put(Const.QUEUE_FAILED_MESSAGE)
+        else:
+            self.output_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
         sys.stdout.write(
-            "[time] Decomp using %d proc (%s~%s): %s s\n" %
-            (self.num_proc, time_start, time_end, (time_end-time_start)))
+            "[time] Decomp using %d proc (%s~%s): %s s, "
+            "%d blobs (%d stolen)\n" %
+            (self.num_proc, time_start, time_end, (time_end-time_start),
+             self.blob_count, steal_count))
+
+    def _signal_backlog(self, task_queue_list, owner):
+        """Wake up an idle child to steal if the owner of the new blob is
+        already busy
+        """
+        with self.pending_lock:
+            self.pending_count[owner] += 1
+            if self.pending_count[owner] < 2:
+                return
+            for index, count in enumerate(self.pending_count):
+                if count == 0:
+                    task_queue_list[index].put(DecompChildProc.STEAL_MESSAGE)
+                    return
+
+    def _reorder(self, result_queue):
+        reorder_buffer = dict()
+        next_seq = 0
+        recv_count = 0
+        # keep draining results after a failure so that children can exit
+        while True:
+            if self.input_finished.is_set() and recv_count == self.blob_count:
+                break
+            try:
+                (seq, decomp_data) = result_queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            recv_count += 1
+            with self.pending_lock:
+                self.pending_count[seq % self.num_proc] -= 1
+            if self.is_failed:
+                continue
+            if decomp_data is None:
+                LOG.error("Failed to decompress blob %d" % seq)
+                self.is_failed = True
+                reorder_buffer.clear()
+                # wake up the input loop
+                for index in xrange(self.reorder_window):
+                    self.window.release()
+                continue
+            reorder_buffer[seq] = decomp_data
+            while next_seq in reorder_buffer:
+                self.output_queue.put(reorder_buffer.pop(next_seq))
+                next_seq += 1
+                self.window.release()
 
 
 class DecompChildProc(multiprocessing.Process):
+    # parent asks an idle child to steal with this message
+    STEAL_MESSAGE = "steal"
+    # steal anyway if nothing arrives for this long
+    STEAL_TIMEOUT = 0.5
 
-    def __init__(self, command_queue, task_queue, output_queue):
+    def __init__(self, command_queue, task_queue, output_queue,
+                 steal_queue_list=None):
         self.command_queue = command_queue
         self.task_queue = task_queue
         self.output_queue = output_queue
+        # task queues of the other children
+        self.steal_queue_list = steal_queue_list or list()
         super(DecompChildProc, self).__init__(target=self._decomp)
 
+    def _get_task(self):
+        try:
+            task = self.task_queue.get(timeout=self.STEAL_TIMEOUT)
+        except Queue.Empty:
+            task = self.STEAL_MESSAGE
+        if task != self.STEAL_MESSAGE:
+            return task, False
+        for steal_queue in self.steal_queue_list:
+            try:
+                task = steal_queue.get_nowait()
+            except Queue.Empty:
+                continue
+            if task == Const.QUEUE_SUCCESS_MESSAGE:
+                # end message belongs to the owner
+                steal_queue.put(task)
+                continue
+            if task == self.STEAL_MESSAGE:
+                # the other child was idle, and this one is stealing now
+                continue
+            return task, True
+        return None, False
+
     def _decomp(self):
-        is_proc_running = True
-        input_list = [self.task_queue._reader.fileno()]
-        while is_proc_running:
-            inready, outread, errready = select.select(input_list, [], [])
-            if self.task_queue._reader.fileno() in inready:
-                input_task = self.task_queue.get()
-                if input_task == Const.QUEUE_SUCCESS_MESSAGE:
-                    is_proc_running = False
+        task_count = 0
+        stolen_count = 0
+        while True:
+            (input_task, is_stolen) = self._get_task()
+            if input_task is None:
+                continue
+            if input_task == Const.QUEUE_SUCCESS_MESSAGE:
+                break
+            (seq, comp_type, comp_data) = input_task
+            try:
+                decomp_data = decompress_blob(comp_type, comp_data)
+            except Exception as e:
+                LOG.error("Failed to decompress blob %d: %s" % (seq, str(e)))
+                decomp_data = None
+            LOG.debug("%f\tdecompress one blob" % (time.time()))
+            self.output_queue.put((seq, decomp_data))
+            task_count += 1
+            stolen_count += int(is_stolen)
+        self.command_queue.put((task_count, stolen_count))
+
+
+def _iter_sliced_decompress(decompressor, comp_iter, max_size):
+    """Feed a decompressor that has no output limit with input slices
+    sized from the expansion ratio so far, so that each call returns about
+    max_size bytes. The slice at most doubles per call, so a burst of
+    highly compressed data is caught before it expands much further.
+    """
+    slice_size = SLICE_SIZE_MIN
+    total_in = 0
+    total_out = 0
+    for comp_data in comp_iter:
+        offset = 0
+        while offset < len(comp_data):
+            if decompressor.unused_data:
+                return
+            data = comp_data[offset:offset+slice_size]
+            offset += len(data)
+            decomp_data = decompressor.decompress(data)
+            yield decomp_data
+            total_in += len(data)
+            total_out += len(decomp_data)
+            estimate = total_in*max_size/max(total_out, 1)
+            slice_size = max(SLICE_SIZE_MIN,
+                             min(slice_size*2, estimate, max_size))
+
+
+def iter_decompress(comp_type, comp_iter, max_size=1024*1024):
+    """Decompress a blob given as an iterator of compressed pieces.
+    Output is cut at about max_size bytes so that a small piece of highly
+    compressed data does not expand into a whole blob at once. Gzip and
+    LZMA are cut exactly. Bzip2 has no output limit and returns a whole
+    block at once, so its pieces can exceed max_size by one block, which
+    is 900KB unless the block has long runs of a repeated byte.
+    """
+    if comp_type == Const.COMPRESSION_LZMA:
+        decompressor = lzma.LZMADecompressor()
+        for comp_data in comp_iter:
+            while comp_data:
+                yield decompressor.decompress(comp_data, max_size)
+                comp_data = decompressor.unconsumed_tail
+        # drain output that is pending without further input
+        while True:
+            decomp_data = decompressor.decompress("", max_size)
+            if not decomp_data:
+                break
+            yield decomp_data
+        yield decompressor.flush()
+    elif comp_type == Const.COMPRESSION_BZIP2:
+        decompressor = bz2.BZ2Decompressor()
+        for decomp_data in _iter_sliced_decompress(decompressor, comp_iter,
+                                                   max_size):
+            yield decomp_data
+    elif comp_type == Const.COMPRESSION_GZIP:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        for comp_data in comp_iter:
+            while comp_data:
+                yield decompressor.decompress(comp_data, max_size)
+                comp_data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+    else:
+        raise CompressionError("Not valid compression option")
+
+
+def _iter_file(filename, read_size):
+    with open(filename, "rb") as comp_fd:
+        while True:
+            comp_data = comp_fd.read(read_size)
+            if not comp_data:
+                break
+            yield comp_data
+
+
+class _BlobDecompThread(native_threading.Thread):
+    """Take blobs from the task queue in order and put their decompressed
+    pieces to the output queue of each blob, ending with None. The thread
+    gives up on its blob once stop_event is set.
+    """
+    PUT_WAIT = 0.1
+
+    def __init__(self, task_queue, read_size, stop_event):
+        self.task_queue = task_queue
+        self.read_size = read_size
+        self.stop_event = stop_event
+        super(_BlobDecompThread, self).__init__(target=self._decomp)
+        self.daemon = True
+
+    def _put(self, output_queue, item):
+        # the reader may be gone, so do not block on a full queue forever
+        while not self.stop_event.is_set():
+            try:
+                output_queue.put(item, timeout=self.PUT_WAIT)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def _decomp(self):
+        while not self.stop_event.is_set():
+            task = self.task_queue.get()
+            if task is None:
+                break
+            (comp_type, comp_iter, output_queue) = task
+            try:
+                for decomp_data in iter_decompress(comp_type, comp_iter,
+                                                   self.read_size):
+                    if decomp_data and \
+                            not self._put(output_queue, decomp_data):
+                        return
+                self._put(output_queue, None)
+            except Exception as e:
+                self._put(output_queue, e)
+
+
+def decomp_blobs_to_file(blob_list, out_fd, num_threads=None,
+                         read_size=1024*1024, queue_depth=4):
+    """Decompress blobs with a thread pool and write them to out_fd in
+    order. blob_list has (comp_type, comp_iter) of each blob. Each blob
+    keeps at most queue_depth pieces of read_size bytes in memory.
+    """
+    if num_threads is None:
+        num_threads = VMOverlayCreationMode.get_num_cores()
+    num_threads = max(1, min(num_threads, len(blob_list)))
+    task_queue = Queue.Queue()
+    output_queue_list = list()
+    for (comp_type, comp_iter) in blob_list:
+        output_queue = Queue.Queue(maxsize=queue_depth)
+        output_queue_list.append(output_queue)
+        task_queue.put((comp_type, comp_iter, output_queue))
+    stop_event = native_threading.Event()
+    thread_list = list()
+    for index in xrange(num_threads):
+        task_queue.put(None)
+        decomp_thread = _BlobDecompThread(task_queue, read_size, stop_event)
+        decomp_thread.start()
+        thread_list.append(decomp_thread)
+
+    # threads take blobs in order, so the blob being written always has
+    # a thread working on it
+    try:
+        for output_queue in output_queue_list:
+            while True:
+                decomp_data = output_queue.get()
+                if decomp_data is None:
                     break
-                (comp_type, comp_data) = input_task
-
-                if comp_type == Const.COMPRESSION_LZMA:
-                    decompressor = lzma.LZMADecompressor()
-                    decomp_data = decompressor.decompress(comp_data)
-                    decomp_data += decompressor.flush()
-                elif comp_type == Const.COMPRESSION_BZIP2:
-                    decompressor = bz2.BZ2Decompressor()
-                    decomp_data = decompressor.decompress(comp_data)
-                elif comp_type == Const.COMPRESSION_GZIP:
-                    decomp_data = zlib.decompress(
-                        comp_data,
-                        zlib.MAX_WBITS | 16)
-                else:
-                    raise CompressionError("Not valid compression option")
-                LOG.debug("%f\tdecompress one blob" % (time.time()))
-                self.output_queue.put(decomp_data)
-        self.command_queue.put("Compressed processed everything")
-
-
-def decomp_overlay(meta, output_path):
-    meta_dict = msgpack.unpackb(open(meta, "r").read())
+                if isinstance(decomp_data, Exception):
+                    raise CompressionError(
+                        "Failed to decompress blob: %s" % str(decomp_data))
+                out_fd.write(decomp_data)
+    finally:
+        # threads still working on later blobs stop at their next piece
+        stop_event.set()
+        for decomp_thread in thread_list:
+            decomp_thread.join()
+
+
+def decomp_overlay(meta, output_path, num_threads=None, read_size=1024*1024):
+    meta_dict = overlay_meta.unpack_meta(open(meta, "r").read())
     decomp_start_time = time.time()
-    comp_overlay_files = meta_dict[Const.META_OVERLAY_FILES]
-    comp_overlay_files = [item
-                          [Const.META_OVERLAY_FILE_NAME]
-                          for item in comp_overlay_files]
-    comp_overlay_files = [os.path.join
-                          (os.path.dirname(meta), item)
-                          for item in comp_overlay_files]
+    blob_list = list()
+    for blob_info in meta_dict[Const.META_OVERLAY_FILES]:
+        comp_file = os.path.join(os.path.dirname(meta),
+                                 blob_info[Const.META_OVERLAY_FILE_NAME])
+        comp_type = blob_info.get(
+            Const.META_OVERLAY_FILE_COMPRESSION,
+            Const.COMPRESSION_LZMA)
+        blob_list.append((comp_type, _iter_file(comp_file, read_size)))
     overlay_file = open(output_path, "w+b")
-    for comp_file in comp_overlay_files:
-        decompressor = lzma.LZMADecompressor()
-        comp_data = open(comp_file, "r").read()
-        decomp_data = decompressor.decompress(comp_data)
-        decomp_data += decompressor.flush()
-        overlay_file.write(decomp_data)
+    decomp_blobs_to_file(blob_list, overlay_file, num_threads=num_threads,
+                         read_size=read_size)
     sys.stdout.write(
         "Overlay decomp time for %d files: %f at %s\n" %
-        (len(comp_overlay_files), (time.time()-decomp_start_time), output_path))
+        (len(blob_list), (time.time()-decomp_start_time), output_path))
     overlay_file.close()
 
     return meta_dict
 
 
-def decomp_overlayzip(overlay_path, outfilename):
+def decomp_overlayzip(overlay_path, outfilename, num_threads=None,
+                      read_size=1024*1024):
     overlay_package = VMOverlayPackage(overlay_path)
     meta_raw = overlay_package.read_meta()
-    meta_info = msgpack.unpackb(meta_raw)
+    meta_info = overlay_meta.unpack_meta(meta_raw)
     comp_overlay_files = meta_info[Const.META_OVERLAY_FILES]
 
-    out_fd = open(outfilename, "w+b")
+    blob_list = list()
     for blob_info in comp_overlay_files:
         comp_filename = blob_info[Const.META_OVERLAY_FILE_NAME]
         comp_type = blob_info.get(
             Const.META_OVERLAY_FILE_COMPRESSION,
             Const.COMPRESSION_LZMA)
-        if comp_type == Const.COMPRESSION_LZMA:
-            comp_data = overlay_package.read_blob(comp_filename)
-            decompressor = lzma.LZMADecompressor()
-            decomp_data = decompressor.decompress(comp_data)
-            decomp_data += decompressor.flush()
-            out_fd.write(decomp_data)
-        elif comp_type == Const.COMPRESSION_BZIP2:
-            comp_data = overlay_package.read_blob(comp_filename)
-            decompressor = bz2.BZ2Decompressor()
-            decomp_data = decompressor.decompress(comp_data)
-            out_fd.write(decomp_data)
-        elif comp_type == Const.COMPRESSION_GZIP:
-            comp_data = overlay_package.read_blob(comp_filename)
-            decomp_data = zlib.decompress(comp_data, zlib.MAX_WBITS | 16)
-            out_fd.write(decomp_data)
-        else:
-            raise CompressionError("Not valid compression option")
+        blob_list.append(
+            (comp_type, overlay_package.iter_blob(comp_filename, read_size)))
 
+    out_fd = open(outfilename, "w+b")
+    decomp_blobs_to_file(blob_list, out_fd, num_threads=num_threads,
+                         read_size=read_size)
     out_fd.close()
     return meta_info
@@ -58,6 +58,11 @@ class Const(object):
     BASE_DISK_META = ".base-img-meta"
     BASE_MEM_META = ".base-mem-meta"
     BASE_HASH_VALUE = ".base-hash"
+    BASE_MEM_FREE_PROFILE = ".base-mem-free-profile"
+    BASE_DISK_SKETCH = ".base-img-sketch"
+    BASE_MEM_SKETCH = ".base-mem-sketch"
+    BASE_DISK_TREE = ".base-img-tree"
+    BASE_MEM_TREE = ".base-mem-tree"
     OVERLAY_URIs = ".overlay-URIs"
     OVERLAY_META = "overlay-meta"
     OVERLAY_FILE_PREFIX = "overlay-blob"
@@ -70,6 +75,8 @@ class Const(object):
     COMPRESSION_BZIP2 = 2
     COMPRESSION_GZIP = 3
 
+    # format of the meta file, see overlay_meta. 1 if missing
+    META_VERSION = "meta_version"
     META_BASE_VM_SHA256 = "base_vm_sha256"
     META_RESUME_VM_DISK_SIZE = "resumed_vm_disk_size"
     META_RESUME_VM_MEMORY_SIZE = "resumed_vm_memory_size"
@@ -79,10 +86,11 @@ class Const(object):
     META_OVERLAY_FILE_SIZE = "overlay_size"
     META_OVERLAY_FILE_DISK_CHUNKS = "disk_chunk"
     META_OVERLAY_FILE_MEMORY_CHUNKS = "memory_chunk"
+    # first touch order of chunks, see access_trace.AccessTrace
+    META_OVERLAY_ACCESS_TRACE = "access_trace"
 
     MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
     QEMU_BIN_PATH = which("cloudlet_qemu-system-x86_64")
-    FREE_MEMORY_BIN_PATH = which("cloudlet_free_page_scan")
     CLOUDLETFS_PATH = which("cloudlet_vmnetfs")
     XRAY_BIN_PATH = which("cloudlet_disk_analyzer")
 
@@ -91,11 +99,17 @@ class Const(object):
         os.path.join( HOME_DIR, ".cloudlet/config/cloudlet.db"))
     BASE_VM_DIR = os.path.abspath(
         os.path.join( HOME_DIR, ".cloudlet", "baseVM"))
+    CHUNK_STORE_DIR = os.path.abspath(
+        os.path.join( HOME_DIR, ".cloudlet", "chunk-store"))
+    CHUNK_STORE_CAPACITY = 1024*1024*1024*4     # bytes
 
     # global configuration files
     CLOUDLET_DB_SCHEMA = os.path.join(CONFIGURATION_DIR, "schema.sql")
     BASEVM_PACKAGE_SCHEMA = os.path.join(CONFIGURATION_DIR, "package.xsd")
     TEMPLATE_XML = os.path.join(CONFIGURATION_DIR, "VM_TEMPLATE.xml")
+    DIFF_COST_MODEL = os.path.join(CONFIGURATION_DIR, "diff-cost-model.json")
+    MODE_SWITCH_COST_MODEL = os.path.join(CONFIGURATION_DIR,
+                                          "mode-switch-cost.json")
     TEMPLATE_OVF = os.path.join(CONFIGURATION_DIR, "ovftransport.iso")
     CHUNK_SIZE = 4096
     LIBVIRT_HEADER_SIZE = CHUNK_SIZE*2
@@ -133,6 +147,28 @@ class Const(object):
         dir_path = os.path.dirname(base_disk_path)
         return os.path.join(dir_path, image_name+Const.BASE_HASH_VALUE)
 
+    @staticmethod
+    def get_free_profile_path(base_mem_path):
+        image_name = os.path.splitext(os.path.basename(base_mem_path))[0]
+        dir_path = os.path.dirname(base_mem_path)
+        return os.path.join(dir_path, image_name+Const.BASE_MEM_FREE_PROFILE)
+
+    @staticmethod
+    def get_base_sketchpath(base_path):
+        image_name = os.path.splitext(os.path.basename(base_path))[0]
+        dir_path = os.path.dirname(base_path)
+        disk_sketch = os.path.join(dir_path, image_name+Const.BASE_DISK_SKETCH)
+        mem_sketch = os.path.join(dir_path, image_name+Const.BASE_MEM_SKETCH)
+        return disk_sketch, mem_sketch
+
+    @staticmethod
+    def get_base_treepath(base_path):
+        image_name = os.path.splitext(os.path.basename(base_path))[0]
+        dir_path = os.path.dirname(base_path)
+        disk_tree = os.path.join(dir_path, image_name+Const.BASE_DISK_TREE)
+        mem_tree = os.path.join(dir_path, image_name+Const.BASE_MEM_TREE)
+        return disk_tree, mem_tree
+
 
 class Options(object):
 
@@ -159,6 +195,9 @@ class Options(object):
 class VMOverlayCreationMode(object):
     PIPE_ONE_ELEMENT_SIZE = 4096*100  # 400KB == Max Pipe size is 1MB
     EMULATED_BANDWIDTH_Mbps = 100000  # Mbps
+    # trace file of "time_sec bandwidth_mbps [latency_ms]" lines. If it is
+    # set, emulated network follows this trace instead of the static bandwidth
+    EMULATED_NETWORK_TRACE = None
     # only used for experiement. If it's bigger than 0, adaptation use this
     # value to transmit over the network
     USE_STATIC_NETWORK_BANDWIDTH = -1
@@ -169,6 +208,13 @@ class VMOverlayCreationMode(object):
     PROFILE_DATAPATH = os.path.join(
         Const.CONFIGURATION_DIR,
         "mode-profile.face")
+    # update the profile from each handoff. The learned profile is kept in
+    # LEARNED_PROFILE_DIR and replaces PROFILE_DATAPATH until it changes
+    LEARN_MODE_PROFILE = False
+    LEARNED_PROFILE_DIR = os.path.join(Const.HOME_DIR, ".cloudlet", "config")
+    # seconds of data assumed to remain when the input size of the handoff
+    # is unknown. It weighs the gain of a mode change against its cost
+    MODE_SWITCH_HORIZON = 10
     VARYING_PARAMETERS = [
         'MEMORY_DIFF_ALGORITHM',
         'DISK_DIFF_ALGORITHM',
@@ -189,17 +235,33 @@ class VMOverlayCreationMode(object):
         self.QUEUE_SIZE_DISK_DELTA_LIST = -1  # -1 for infinite
         self.QUEUE_SIZE_OPTIMIZATION = -1  # one per DeltaImte
         self.QUEUE_SIZE_COMPRESSION = -1  # one per DeltaImte
+        # byte budget of each queue above. -1 bounds only by item count
+        self.QUEUE_BYTES_MEMORY_DELTA_LIST = -1
+        self.QUEUE_BYTES_DISK_DELTA_LIST = -1
+        self.QUEUE_BYTES_OPTIMIZATION = -1
+        self.QUEUE_BYTES_COMPRESSION = -1
 
         # number of CPU allocated
         VMOverlayCreationMode.set_num_cores(num_cores)
+        # opt-in: give each pipeline stage its own CPUs in proportion to
+        # its processing time. See cpu_allocator
+        self.CPU_AFFINITY_PER_STAGE = False
 
         self.OPTIMIZATION_DEDUP_BASE_DISK = True
         self.OPTIMIZATION_DEDUP_BASE_MEMORY = True
         self.OPTIMIZATION_DEDUP_BASE_SELF = True
-
-        # "xdelta3", "bsdiff", "xor", "none"
+        # ask destination for chunks it already has before the transfer
+        self.OPTIMIZATION_DEDUP_REMOTE_CHUNK = False
+        # diff a modified chunk against the most similar base chunk at any
+        # offset when it does not diff well with the base chunk at the same
+        # offset. Needs sketch files of the base VM
+        self.OPTIMIZATION_SIMILAR_BASE_CHUNK = False
+
+        # "xdelta3", "bsdiff", "xor", "none", "adaptive"
+        # "adaptive" selects one of them for each chunk using
+        # Const.DIFF_COST_MODEL
         self.MEMORY_DIFF_ALGORITHM = "xdelta3"
-        # "xdelta3", "bsdiff", "xor", "none"
+        # "xdelta3", "bsdiff", "xor", "none", "adaptive"
         self.DISK_DIFF_ALGORITHM = "xdelta3"
         self.COMPRESSION_ALGORITHM_TYPE = Const.COMPRESSION_LZMA
         self.COMPRESSION_ALGORITHM_SPEED = 5  # 1 (fastest) ~ 9
@@ -221,17 +283,26 @@ class VMOverlayCreationMode(object):
         # Installation of OpenStack Kilo uses pstuil version 1.2.1
         if version >= (2, 0):
             cpu_count = psutil.cpu_count()
-            num_cores = min(cpu_count, num_cores)
+        else:
+            # version below 2.0
+            cpu_count = psutil.NUM_CPUS
+        num_cores = min(cpu_count, num_cores)
+        VMOverlayCreationMode.set_cpu_affinity(list(range(num_cores)))
+
+    @staticmethod
+    def set_cpu_affinity(desired_cpus, pid=None):
+        import psutil
+        version = psutil.version_info
+        if pid is None:
             p = psutil.Process()
-            desired_cpus = list(range(num_cores))
+        else:
+            p = psutil.Process(pid)
+        # Installation of OpenStack Kilo uses pstuil version 1.2.1
+        if version >= (2, 0):
             p.cpu_affinity(desired_cpus)
             updated_cpu = p.cpu_affinity()
         else:
             # version below 2.0
-            cpu_count = psutil.NUM_CPUS
-            num_cores = min(cpu_count, num_cores)
-            p = psutil.Process()
-            desired_cpus = list(range(num_cores))
             p.set_cpu_affinity(desired_cpus)
             try:
                 # psutil 1.2.1 has issue with large number of cores
@@ -240,7 +311,7 @@ class VMOverlayCreationMode(object):
             except OSError as e:
                 updated_cpu = desired_cpus
                 pass
-        if desired_cpus != updated_cpu:
+        if sorted(desired_cpus) != sorted(updated_cpu):
             raise Exception(
                 "Cannot not set affinity mask: from %s to %s" %
                 (desired_cpus, updated_cpu))
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Assign disjoint CPU sets to pipeline stages.
+
+CPUs are taken one physical core at a time, filling a NUMA node before
+moving to the next one, and hyperthread siblings come last. Each stage
+gets a contiguous run of the selected CPUs, sized in proportion to its
+processing time per block, so that a stage stays within a node and
+adjacent stages share a node when they can.
+"""
+
+import os
+import re
+from collections import namedtuple
+
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+SYSFS_CPU_PATH = "/sys/devices/system/cpu"
+# pipeline stages in the order that data flows
+PIPELINE_STAGES = ["CreateMemoryDeltalist", "CreateDiskDeltalist",
+                   "DeltaDedup", "CompressProc"]
+
+
+class CPUAllocatorError(Exception):
+    pass
+
+
+CPUInfo = namedtuple("CPUInfo", ["cpu_id", "node_id", "package_id",
+                                 "core_id", "thread_index"])
+
+
+def parse_cpu_list(cpu_list_str):
+    """Parse the sysfs cpu list format, e.g. "0-3,8,10-11"."""
+    cpu_list = list()
+    for item in cpu_list_str.strip().split(","):
+        if len(item) == 0:
+            continue
+        try:
+            if "-" in item:
+                (start, end) = item.split("-")
+                cpu_list += range(int(start), int(end)+1)
+            else:
+                cpu_list.append(int(item))
+        except ValueError:
+            raise CPUAllocatorError("Invalid cpu list: %s" % cpu_list_str)
+    return sorted(set(cpu_list))
+
+
+def _read_int(path, default):
+    try:
+        with open(path, "r") as fd:
+            return int(fd.read().strip())
+    except (IOError, ValueError):
+        return default
+
+
+class CPUTopology(object):
+
+    def __init__(self, cpu_info_list):
+        if len(cpu_info_list) == 0:
+            raise CPUAllocatorError("No CPU in the topology")
+        self.cpu_info_list = sorted(cpu_info_list,
+                                    key=lambda info: info.cpu_id)
+
+    def __len__(self):
+        return len(self.cpu_info_list)
+
+    @staticmethod
+    def from_sysfs(sysfs_path=SYSFS_CPU_PATH):
+        online_path = os.path.join(sysfs_path, "online")
+        if os.path.exists(online_path):
+            with open(online_path, "r") as fd:
+                cpu_id_list = parse_cpu_list(fd.read())
+        else:
+            cpu_id_list = sorted(
+                [int(name[3:]) for name in os.listdir(sysfs_path)
+                 if re.match(r"^cpu\d+$", name)])
+
+        cpu_key_list = list()
+        for cpu_id in cpu_id_list:
+            cpu_dir = os.path.join(sysfs_path, "cpu%d" % cpu_id)
+            topology_dir = os.path.join(cpu_dir, "topology")
+            package_id = _read_int(
+                os.path.join(topology_dir, "physical_package_id"), 0)
+            core_id = _read_int(os.path.join(topology_dir, "core_id"),
+                                cpu_id)
+            # cpuN/nodeM exists on NUMA kernels
+            node_id = package_id
+            if os.path.isdir(cpu_dir):
+                for name in sorted(os.listdir(cpu_dir)):
+                    matched = re.match(r"^node(\d+)$", name)
+                    if matched:
+                        node_id = int(matched.group(1))
+                        break
+            cpu_key_list.append((cpu_id, node_id, package_id, core_id))
+
+        # order of the hyperthread within its physical core
+        thread_count = dict()
+        cpu_info_list = list()
+        for (cpu_id, node_id, package_id, core_id) in cpu_key_list:
+            core_key = (node_id, package_id, core_id)
+            thread_index = thread_count.get(core_key, 0)
+            thread_count[core_key] = thread_index + 1
+            cpu_info_list.append(CPUInfo(cpu_id, node_id, package_id,
+                                         core_id, thread_index))
+        return CPUTopology(cpu_info_list)
+
+    def select_cpus(self, num_cpus, allowed_cpus=None):
+        """Return CPUInfo of num_cpus CPUs, preferring physical cores in
+        lower NUMA nodes. Returned CPUs are ordered by node and core.
+        """
+        cpu_info_list = self.cpu_info_list
+        if allowed_cpus is not None:
+            allowed_cpus = set(allowed_cpus)
+            cpu_info_list = [info for info in cpu_info_list
+                             if info.cpu_id in allowed_cpus]
+        if len(cpu_info_list) == 0:
+            raise CPUAllocatorError("No allowed CPU")
+        num_cpus = max(1, min(num_cpus, len(cpu_info_list)))
+        selected = sorted(cpu_info_list, key=lambda info: (
+            info.thread_index, info.node_id, info.package_id,
+            info.core_id, info.cpu_id))[:num_cpus]
+        return sorted(selected, key=lambda info: (
+            info.node_id, info.thread_index, info.package_id,
+            info.core_id, info.cpu_id))
+
+
+def get_stage_weights(p_dict, size_dict_in):
+    """Return (stage, weight) in pipeline order. Weight is processing time
+    per block, and memory and disk deltas are weighted by their input share
+    as in MigrationMode.get_total_P.
+    """
+    memory_in = size_dict_in.get("CreateMemoryDeltalist", 0)
+    disk_in = size_dict_in.get("CreateDiskDeltalist", 0)
+    alpha = 0.5
+    if memory_in + disk_in > 0:
+        alpha = float(memory_in)/(memory_in+disk_in)
+    share_dict = {"CreateMemoryDeltalist": alpha,
+                  "CreateDiskDeltalist": 1-alpha}
+    stage_weights = list()
+    for stage in PIPELINE_STAGES:
+        if stage not in p_dict:
+            continue
+        stage_weights.append(
+            (stage, p_dict[stage]*share_dict.get(stage, 1.0)))
+    return stage_weights
+
+
+class CPUAllocator(object):
+
+    def __init__(self, topology):
+        self.topology = topology
+
+    def get_cpu_counts(self, stage_weights, num_cpus):
+        """Split num_cpus among stages in proportion to the weights by the
+        largest remainder, giving each stage at least one CPU.
+        """
+        num_stages = len(stage_weights)
+        weight_list = [max(float(weight or 0), 0.0)
+                       for (stage, weight) in stage_weights]
+        total_weight = sum(weight_list)
+        if total_weight <= 0:
+            # nothing measured yet
+            weight_list = [1.0]*num_stages
+            total_weight = float(num_stages)
+        spare_cpus = num_cpus - num_stages
+        share_list = [spare_cpus*weight/total_weight
+                      for weight in weight_list]
+        count_list = [1 + int(share) for share in share_list]
+        remaining = num_cpus - sum(count_list)
+        order = sorted(range(num_stages),
+                       key=lambda index: int(share_list[index]) -
+                       share_list[index])
+        for index in order[:remaining]:
+            count_list[index] += 1
+        return count_list
+
+    def allocate(self, stage_weights, num_cpus, allowed_cpus=None):
+        """Return {stage: [cpu_id, ...]} for stage_weights, a list of
+        (stage, weight) in pipeline order. Stages share CPUs only when
+        there are fewer CPUs than stages.
+        """
+        if len(stage_weights) == 0:
+            return dict()
+        cpu_list = [info.cpu_id for info in
+                    self.topology.select_cpus(num_cpus, allowed_cpus)]
+        allocation = dict()
+        if len(cpu_list) < len(stage_weights):
+            for index, (stage, weight) in enumerate(stage_weights):
+                allocation[stage] = [cpu_list[index % len(cpu_list)]]
+            return allocation
+
+        count_list = self.get_cpu_counts(stage_weights, len(cpu_list))
+        start_index = 0
+        for (stage, weight), count in zip(stage_weights, count_list):
+            allocation[stage] = sorted(
+                cpu_list[start_index:start_index+count])
+            start_index += count
+        return allocation
@@ -1,3 +1,6 @@
+from cpython.bytes cimport PyBytes_AS_STRING
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
 cdef char c[4096]
 def cython_xor(char *a,char *b):
     cdef int i
@@ -10,3 +13,29 @@ def cython_xor_vectorised(char *a,char *b):
     for i in range(512):
         (<unsigned long long *>c)[i]=(<unsigned long long *>a)[i]^(<unsigned long long *>b)[i]
     return c[:4096]
+
+def xor_batch(list source_list, list modi_list):
+    # XOR every pair in a single call. Each result has its own buffer, so
+    # this is safe to use from multiple threads unlike cython_xor
+    cdef Py_ssize_t i, j, length, word_count
+    cdef bytes source, modi, ret
+    cdef char *src
+    cdef char *mod
+    cdef char *out
+    xor_list = list()
+    for i in range(len(source_list)):
+        source = source_list[i]
+        modi = modi_list[i]
+        length = len(modi)
+        ret = PyBytes_FromStringAndSize(NULL, length)
+        src = PyBytes_AS_STRING(source)
+        mod = PyBytes_AS_STRING(modi)
+        out = PyBytes_AS_STRING(ret)
+        word_count = length/8
+        for j in range(word_count):
+            (<unsigned long long *>out)[j] = \
+                (<unsigned long long *>src)[j] ^ (<unsigned long long *>mod)[j]
+        for j in range(word_count*8, length):
+            out[j] = src[j] ^ mod[j]
+        xor_list.append(ret)
+    return xor_list
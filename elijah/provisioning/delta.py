@@ -29,6 +29,7 @@ import process_manager
 from configuration import Const
 import log as logging
 import collections
+import itertools
 
 
 LOG = logging.getLogger(__name__)
@@ -55,6 +56,9 @@ class DeltaItem(object):
     REF_BSDIFF          = 0x70
     REF_SELF_HASH       = 0x80
     REF_XOR             = 0x90
+    # patch against the most similar base chunk at another offset
+    # data: source offset (!Q) + ref_id of the patch (!c) + patch
+    REF_BASE_SIMILAR    = 0xA0
 
     def __init__(self, delta_type, offset, offset_len, hash_value, ref_id,
                  data_len=0, data=None, live_seq=0):
@@ -96,7 +100,8 @@ class DeltaItem(object):
         if self.ref_id == DeltaItem.REF_RAW or \
                 self.ref_id == DeltaItem.REF_XDELTA or \
                 self.ref_id == DeltaItem.REF_XOR or \
-                self.ref_id == DeltaItem.REF_BSDIFF:
+                self.ref_id == DeltaItem.REF_BSDIFF or \
+                self.ref_id == DeltaItem.REF_BASE_SIMILAR:
             data += struct.pack("!Q", self.data_len)
             if self.data_len != 0:
                 data += struct.pack("!%ds" % self.data_len, self.data)
@@ -138,7 +143,8 @@ class DeltaItem(object):
         if ref_id == DeltaItem.REF_RAW or \
                 ref_id == DeltaItem.REF_XDELTA or \
                 ref_id == DeltaItem.REF_XOR or \
-                ref_id == DeltaItem.REF_BSDIFF:
+                ref_id == DeltaItem.REF_BSDIFF or \
+                ref_id == DeltaItem.REF_BASE_SIMILAR:
             data_len = struct.unpack("!Q", stream.read(8))[0]
             data = stream.read(data_len)
         elif ref_id == DeltaItem.REF_BASE_DISK or \
@@ -246,7 +252,8 @@ class DeltaList(object):
                 if delta_item.ref_id == DeltaItem.REF_XDELTA or \
                         delta_item.ref_id == DeltaItem.REF_RAW or \
                         delta_item.ref_id == DeltaItem.REF_XOR or \
-                        delta_item.ref_id == DeltaItem.REF_BSDIFF:
+                        delta_item.ref_id == DeltaItem.REF_BSDIFF or \
+                        delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR:
                     # same data/hash
                     # save reference start offset
                     delta_item.ref_id = DeltaItem.REF_SELF
@@ -352,7 +359,8 @@ class DeltaList(object):
                     disk_from_base_mem += 1
             elif delta_item.ref_id == DeltaItem.REF_XDELTA or \
                 delta_item.ref_id == DeltaItem.REF_XOR or \
-                delta_item.ref_id == DeltaItem.REF_BSDIFF:
+                delta_item.ref_id == DeltaItem.REF_BSDIFF or \
+                delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR:
                 if delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
                         (delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE):
                     memory_from_xdelta += 1
@@ -453,7 +461,8 @@ def diff_with_deltalist(delta_list, const_deltalist, ref_id):
                 ((delta.ref_id == DeltaItem.REF_XDELTA) or \
                  (delta.ref_id == DeltaItem.REF_RAW) or \
                  (delta.ref_id == DeltaItem.REF_XOR) or \
-                 (delta.ref_id == DeltaItem.REF_BSDIFF)):
+                 (delta.ref_id == DeltaItem.REF_BSDIFF) or \
+                 (delta.ref_id == DeltaItem.REF_BASE_SIMILAR)):
             if delta.offset_len != const_delta.offset_len:
                 message = "Hash is same but length is different %d != %d" % \
                         (delta.offset_len, const_delta.offset_len)
@@ -492,7 +501,8 @@ def diff_with_hashlist(base_hashlist, delta_list, ref_id):
                 ((delta.ref_id == DeltaItem.REF_XDELTA) or \
                  (delta.ref_id == DeltaItem.REF_RAW) or \
                  (delta.ref_id == DeltaItem.REF_XOR) or \
-                 (delta.ref_id == DeltaItem.REF_BSDIFF)):
+                 (delta.ref_id == DeltaItem.REF_BSDIFF) or \
+                 (delta.ref_id == DeltaItem.REF_BASE_SIMILAR)):
             matching_count += 1
             #LOG.debug("page %ld is matching base %ld" % (s_start, start))
             delta.ref_id = ref_id
@@ -532,11 +542,73 @@ def create_overlay(memory_deltalist, memory_chunk_size,
     return delta_list
 
 
+def recover_xor_items(deltaitem_list, raw_mem, raw_disk, delta_times=None):
+    """Recover every REF_XOR item of the list with a single batched XOR.
+    Recovered items are changed to REF_RAW, so they are handled as raw data
+    at the following per-item recovery.
+    """
+    xor_item_list = [item for item in deltaitem_list
+                     if item.ref_id == DeltaItem.REF_XOR]
+    if len(xor_item_list) == 0:
+        return 0
+
+    start_time = time.time()
+    base_list = list()
+    for delta_item in xor_item_list:
+        start_offset = delta_item.offset
+        end_offset = delta_item.offset + delta_item.offset_len
+        if delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
+                delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+            base_list.append(raw_mem[start_offset:end_offset])
+        elif delta_item.delta_type == DeltaItem.DELTA_DISK or\
+                delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
+            base_list.append(raw_disk[start_offset:end_offset])
+        else:
+            raise DeltaError("Delta type should be either disk or memory")
+    recover_list = tool.xor_batch(
+        base_list, [item.data for item in xor_item_list])
+    for delta_item, recover_data in zip(xor_item_list, recover_list):
+        delta_item.ref_id = DeltaItem.REF_RAW
+        delta_item.data = recover_data
+        delta_item.data_len = len(recover_data)
+    if delta_times is not None:
+        delta_times[DeltaItem.REF_XOR] += (time.time() - start_time)
+    return len(xor_item_list)
+
+
+def recover_similar_data(delta_item, raw_mem, raw_disk):
+    """Recover REF_BASE_SIMILAR item using the base chunk it refers to
+    """
+    header_size = struct.calcsize("!Qc")
+    (source_offset, patch_ref) = struct.unpack(
+        "!Qc", delta_item.data[0:header_size])
+    patch_ref = ord(patch_ref)
+    patch_data = delta_item.data[header_size:]
+    source_end = source_offset + delta_item.offset_len
+    if delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
+            delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+        base_data = raw_mem[source_offset:source_end]
+    elif delta_item.delta_type == DeltaItem.DELTA_DISK or\
+            delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
+        base_data = raw_disk[source_offset:source_end]
+    else:
+        raise DeltaError("Delta type should be either disk or memory")
+
+    if patch_ref == DeltaItem.REF_XDELTA:
+        return tool.merge_data(base_data, patch_data, len(base_data)*5)
+    elif patch_ref == DeltaItem.REF_BSDIFF:
+        return tool.merge_data_bsdiff(base_data, patch_data)
+    elif patch_ref == DeltaItem.REF_XOR:
+        return tool.xor_data(base_data, patch_data)
+    raise DeltaError("Invalid patch type of similar chunk: %d" % patch_ref)
+
+
 class Recovered_delta(multiprocessing.Process):
 #class Recovered_delta(threading.Thread):
     FUSE_INDEX_DISK = 1
     FUSE_INDEX_MEMORY = 2
     END_OF_PIPE = "end_of_pipe"
+    XOR_BATCH_SIZE = 256
 
     def __init__(self, base_disk, base_mem, overlay_path, 
                  output_mem_path, output_mem_size, 
@@ -591,16 +663,24 @@ class Recovered_delta(multiprocessing.Process):
         delta_counter = collections.Counter()
         delta_times = collections.Counter()
         unresolved_deltaitem_list = []
-        for delta_item in DeltaList.from_stream(overlay_stream, delta_times):
-            #LOG.debug("[Delta] proceesing %d" % count)
-            ret = self.recover_item(delta_item, delta_counter, delta_times)
-            if ret == None:
-                # cannot find self reference point due to the parallel
-                # compression. Save this and do it later
-                unresolved_deltaitem_list.append(delta_item)
-                continue
-            self.process_deltaitem(delta_item, delta_counter, delta_times)
-            count += 1
+        delta_stream = DeltaList.from_stream(overlay_stream, delta_times)
+        while True:
+            deltaitem_list = list(itertools.islice(
+                delta_stream, Recovered_delta.XOR_BATCH_SIZE))
+            if len(deltaitem_list) == 0:
+                break
+            recover_xor_items(deltaitem_list, self.raw_mem, self.raw_disk,
+                              delta_times)
+            for delta_item in deltaitem_list:
+                #LOG.debug("[Delta] proceesing %d" % count)
+                ret = self.recover_item(delta_item, delta_counter, delta_times)
+                if ret == None:
+                    # cannot find self reference point due to the parallel
+                    # compression. Save this and do it later
+                    unresolved_deltaitem_list.append(delta_item)
+                    continue
+                self.process_deltaitem(delta_item, delta_counter, delta_times)
+                count += 1
 
         LOG.info("[Delta] Handle dangling DeltaItem (%d)" % len(unresolved_deltaitem_list))
         for delta_item in unresolved_deltaitem_list:
@@ -694,7 +774,10 @@ class Recovered_delta(multiprocessing.Process):
                 base_data = self.raw_disk[delta_item.offset:delta_item.offset+patch_original_size]
             else:
                 raise DeltaError("Delta type should be either disk or memory")
-            recover_data = tool.cython_xor(base_data, patch_data)
+            recover_data = tool.xor_data(base_data, patch_data)
+        elif delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR:
+            recover_data = recover_similar_data(
+                delta_item, self.raw_mem, self.raw_disk)
         else:
             raise MemoryError("Cannot recover: invalid referce id %d" % delta_item.ref_id)
 
@@ -803,7 +886,8 @@ def deduplicate_deltaitem(hash_dict, delta_item, ref_id):
         if ((delta_item.ref_id == DeltaItem.REF_XDELTA) or \
             (delta_item.ref_id == DeltaItem.REF_RAW) or \
             (delta_item.ref_id == DeltaItem.REF_XOR) or \
-            (delta_item.ref_id == DeltaItem.REF_BSDIFF)):
+            (delta_item.ref_id == DeltaItem.REF_BSDIFF) or \
+            (delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR)):
             delta_item.ref_id = ref_id
             delta_item.data_len = 8
             delta_item.data = ref_offset
@@ -816,7 +900,9 @@ class DeltaDedup(process_manager.ProcWorker):
                  disk_deltalist_queue, disk_chunk_size,
                  merged_deltalist_queue,
                  overlay_creation_mode,
-                 basedisk_hashdict=None, basemem_hashdict=None):
+                 basedisk_hashdict=None, basemem_hashdict=None,
+                 remote_chunk_filter=None, remote_chunk_dict=None,
+                 access_trace=None):
         self.memory_deltalist_queue = memory_deltalist_queue
         self.memory_chunk_size = memory_chunk_size
         self.disk_deltalist_queue = disk_deltalist_queue
@@ -825,9 +911,21 @@ class DeltaDedup(process_manager.ProcWorker):
         self.overlay_creation_mode = overlay_creation_mode
         self.basedisk_hashdict = basedisk_hashdict
         self.basemem_hashdict= basemem_hashdict
+        # chunks that the destination already has. Original delta item is
+        # kept at remote_chunk_dict to resend it for false positives
+        self.remote_chunk_filter = remote_chunk_filter
+        self.remote_chunk_dict = remote_chunk_dict
+        # chunks of the access trace are packed into the first blobs, so
+        # they keep their data rather than referring to a chunk that can be
+        # in a later blob
+        self.access_trace = access_trace
 
         self.self_hashdict = dict()
         self.self_hashset = set()
+        # memory page offset --> (live_seq, hash) of the item last sent for
+        # the page. A re-dirtied page that is back to that content needs
+        # neither data nor a self reference
+        self.live_sent_dict = dict()
 
         # shared data with other process
         #self.manager = multiprocessing.Manager()
@@ -842,6 +940,30 @@ class DeltaDedup(process_manager.ProcWorker):
         #self.statistics['number_of_self_ref_memory'] = 0
         super(DeltaDedup, self).__init__(target=self.perform_dedup)
 
+    def _is_unchanged_live_page(self, delta_item):
+        if delta_item.delta_type != DeltaItem.DELTA_MEMORY_LIVE:
+            return False
+        last_sent = self.live_sent_dict.get(delta_item.offset, None)
+        if last_sent is None:
+            return False
+        (last_seq, last_hash) = last_sent
+        return last_seq < delta_item.live_seq and \
+            last_hash == delta_item.hash_value
+
+    def _update_live_page(self, delta_item):
+        if delta_item.delta_type != DeltaItem.DELTA_MEMORY and \
+                delta_item.delta_type != DeltaItem.DELTA_MEMORY_LIVE:
+            return
+        last_sent = self.live_sent_dict.get(delta_item.offset, None)
+        # items of different iterations can arrive out of order
+        if last_sent is None or last_sent[0] <= delta_item.live_seq:
+            self.live_sent_dict[delta_item.offset] = \
+                (delta_item.live_seq, delta_item.hash_value)
+
+    def _is_traced(self, delta_item):
+        return self.access_trace is not None and \
+            self.access_trace.get_rank(delta_item) is not None
+
     def perform_dedup(self):
         total_process_time = 0
         total_process_time_block = 0
@@ -865,6 +987,9 @@ class DeltaDedup(process_manager.ProcWorker):
             number_of_base_mem_memory = 0
             number_of_self_ref_disk = 0
             number_of_self_ref_memory = 0
+            number_of_remote_ref = 0
+            number_of_unchanged_live = 0
+            number_of_traced_kept = 0
 
             if self.memory_chunk_size != self.disk_chunk_size:
                 raise DeltaError("Expect same chunk size for Disk and Memory")
@@ -908,8 +1033,15 @@ class DeltaDedup(process_manager.ProcWorker):
 
                     indata_size_cur = 0
                     outdata_size_cur = 0
+                    deduped_list = list()
+                    remote_chunk_batch = dict()
                     for delta_item in deltaitem_list:
                         indata_size_cur += (delta_item.data_len+11)
+                        if self._is_unchanged_live_page(delta_item):
+                            # receiver already has the same page from
+                            # previous iteration
+                            number_of_unchanged_live += 1
+                            continue
                         if deduplicate_deltaitem(zero_hash_dict, delta_item,
                                                 DeltaItem.REF_ZEROS) == True:
                             if delta_item.delta_type == DeltaItem.DELTA_DISK or\
@@ -940,26 +1072,45 @@ class DeltaDedup(process_manager.ProcWorker):
                             if ((delta_item.ref_id == DeltaItem.REF_XDELTA)\
                                 or (delta_item.ref_id == DeltaItem.REF_RAW)\
                                 or (delta_item.ref_id == DeltaItem.REF_XOR)\
-                                or (delta_item.ref_id == DeltaItem.REF_BSDIFF)):
+                                or (delta_item.ref_id == DeltaItem.REF_BSDIFF)\
+                                or (delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR)):
                                 if delta_item.hash_value in self.self_hashset:
-                                    delta_item.ref_id = delta_item.REF_SELF_HASH
-                                    delta_item.data_len = 32
-                                    delta_item.data = delta_item.hash_value
-                                    if delta_item.delta_type == DeltaItem.DELTA_DISK or\
-                                            delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
-                                        number_of_self_ref_disk += 1
-                                    elif delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
-                                        delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
-                                        number_of_self_ref_memory += 1
+                                    if self._is_traced(delta_item):
+                                        number_of_traced_kept += 1
+                                    else:
+                                        delta_item.ref_id = delta_item.REF_SELF_HASH
+                                        delta_item.data_len = 32
+                                        delta_item.data = delta_item.hash_value
+                                        if delta_item.delta_type == DeltaItem.DELTA_DISK or\
+                                                delta_item.delta_type == DeltaItem.DELTA_DISK_LIVE:
+                                            number_of_self_ref_disk += 1
+                                        elif delta_item.delta_type == DeltaItem.DELTA_MEMORY or\
+                                            delta_item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
+                                            number_of_self_ref_memory += 1
                                 else:
                                     self.self_hashset.add(delta_item.hash_value)
+                                    if self.remote_chunk_filter is not None and\
+                                            delta_item.hash_value in self.remote_chunk_filter:
+                                        remote_chunk_batch[delta_item.hash_value] =\
+                                            delta_item.get_serialized()
+                                        delta_item.ref_id = delta_item.REF_SELF_HASH
+                                        delta_item.data_len = 32
+                                        delta_item.data = delta_item.hash_value
+                                        number_of_remote_ref += 1
 
                         # now delta item has new data length
                         outdata_size_cur += (delta_item.data_len+11)
+                        self._update_live_page(delta_item)
+                        deduped_list.append(delta_item)
                     self.in_size += indata_size_cur
                     self.out_size += outdata_size_cur
+                    if len(remote_chunk_batch) > 0:
+                        # remote_chunk_dict is a Manager dict, so update it
+                        # once for the list rather than for every chunk
+                        self.remote_chunk_dict.update(remote_chunk_batch)
                     time_process_finish = time.clock()
-                    self.merged_deltalist_queue.put(deltaitem_list)
+                    if len(deduped_list) > 0:
+                        self.merged_deltalist_queue.put(deduped_list)
 
                     # measurement
                     total_process_time_cur = (time_process_finish-time_process_start)
@@ -1002,6 +1153,12 @@ class DeltaDedup(process_manager.ProcWorker):
             LOG.debug("profiling\t%s\ttime\t%f\t%f\t%f\t%f" %\
                     (self.__class__.__name__, time_start, time_end,
                      (time_end-time_start), total_process_time))
+            LOG.debug("profiling\t%s\tremote-ref\t%ld" % (self.__class__.__name__,
+                                                          number_of_remote_ref))
+            LOG.debug("profiling\t%s\tunchanged-live\t%ld" % (self.__class__.__name__,
+                                                              number_of_unchanged_live))
+            LOG.debug("profiling\t%s\ttraced-kept\t%ld" % (self.__class__.__name__,
+                                                           number_of_traced_kept))
             LOG.debug("profiling\t%s\tblock-size\t%f\t%f\t%d" % (self.__class__.__name__,
                                                                 float(self.in_size)/self.total_block_count,
                                                                 float(self.out_size)/self.total_block_count,
@@ -1266,25 +1423,24 @@ def divide_blobs(delta_list, overlay_path, blob_size_kb,
 
 
 def discard_free_chunks(merged_modified_list, chunk_size, disk_discard, memory_discard):
-    removing_item = list()
     if disk_discard == None:
         disk_discard = dict()
     if memory_discard == None:
         memory_discard = dict()
-    
+
+    remaining_list = list()
     for item in merged_modified_list:
         chunk_number = item.offset/chunk_size
         if item.delta_type == DeltaItem.DELTA_DISK or\
                 item.delta_type == DeltaItem.DELTA_DISK_LIVE:
-            if disk_discard.get(chunk_number, None) != None:
-                removing_item.append(item)
+            if chunk_number in disk_discard:
+                continue
         if item.delta_type == DeltaItem.DELTA_MEMORY or\
                 item.delta_type == DeltaItem.DELTA_MEMORY_LIVE:
-            if memory_discard.get(chunk_number, None) != None:
-                removing_item.append(item)
-
-    for item in removing_item:
-        merged_modified_list.remove(item)
+            if chunk_number in memory_discard:
+                continue
+        remaining_list.append(item)
+    merged_modified_list[:] = remaining_list
 
 
 def residue_merge_deltalist(old_deltalist, new_deltalist):
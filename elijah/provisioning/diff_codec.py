@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Select diff algorithm for each chunk.
+
+A mostly unchanged chunk is best sent as XOR, which compresses to almost
+nothing, while a chunk whose content moved within the chunk needs a
+real delta encoder, and a chunk with new content is best sent raw. We
+estimate the number of changed bytes and the number of bytes that do not
+appear anywhere in the base chunk, then pick the algorithm with the
+lowest cost using a linear model calibrated offline (see calibrate()).
+"""
+
+import os
+import sys
+import json
+import time
+import zlib
+import random
+
+import numpy
+
+from . import tool
+from .delta import DeltaItem
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class DiffCodecError(Exception):
+    pass
+
+
+DIFF_REF_ID = {
+    "xdelta3": DeltaItem.REF_XDELTA,
+    "bsdiff": DeltaItem.REF_BSDIFF,
+    "xor": DeltaItem.REF_XOR,
+    "none": DeltaItem.REF_RAW,
+}
+
+
+def diff_chunk(algorithm, source_data, modi_data, batch_xor=False):
+    """Return (diff_data, ref_id) of the algorithm
+    Raise IOError if the patch is bigger than the chunk, so that the caller
+    can send the chunk as raw data instead.
+    :param batch_xor: return modi_data for xor, which the caller XORs
+    later in a batch with tool.xor_batch
+    """
+    chunk_data_len = len(modi_data)
+    if algorithm == "xdelta3":
+        diff_data = tool.diff_data(source_data, modi_data,
+                                   2*len(source_data))
+        if len(diff_data) > chunk_data_len:
+            raise IOError("xdelta3 patch is bigger than origianl")
+    elif algorithm == "bsdiff":
+        diff_data = tool.diff_data_bsdiff(source_data, modi_data)
+        if len(diff_data) > chunk_data_len:
+            raise IOError("bsdiff patch is bigger than origianl")
+    elif algorithm == "xor":
+        if len(source_data) != chunk_data_len:
+            raise IOError("base chunk is smaller than modified chunk")
+        if batch_xor:
+            diff_data = modi_data
+        else:
+            diff_data = tool.xor_data(source_data, modi_data)
+    elif algorithm == "none":
+        diff_data = modi_data
+    else:
+        raise DiffCodecError("%s algorithm is not supported" % algorithm)
+    return diff_data, DIFF_REF_ID[algorithm]
+
+
+class ChunkFeature(object):
+    """Cheap estimate of how a chunk changed from its base chunk
+
+    changed_bytes: bytes that differ at the same offset
+    novel_bytes: estimated bytes whose content is not in the base chunk
+    """
+    ANCHOR_SIZE = 16
+    ANCHOR_COUNT = 16
+
+    def __init__(self, chunk_len, changed_bytes, novel_bytes):
+        self.chunk_len = chunk_len
+        self.changed_bytes = changed_bytes
+        self.novel_bytes = novel_bytes
+
+    def get_value(self, algorithm):
+        """Return the variable that the output size of the algorithm is
+        proportional to
+        """
+        if algorithm == "none":
+            return self.chunk_len
+        elif algorithm == "xor":
+            return self.changed_bytes
+        else:
+            # delta encoders also reuse content that moved
+            return min(self.changed_bytes, self.novel_bytes)
+
+    @staticmethod
+    def from_chunk(source_data, modi_data):
+        chunk_len = len(modi_data)
+        if len(source_data) != chunk_len:
+            return ChunkFeature(chunk_len, chunk_len, chunk_len)
+        source_array = numpy.frombuffer(source_data, dtype=numpy.uint8)
+        modi_array = numpy.frombuffer(modi_data, dtype=numpy.uint8)
+        changed_bytes = int(numpy.count_nonzero(source_array != modi_array))
+        if changed_bytes == 0:
+            return ChunkFeature(chunk_len, 0, 0)
+
+        # sample anchors and look them up in the base chunk
+        anchor_size = ChunkFeature.ANCHOR_SIZE
+        step = max(chunk_len/ChunkFeature.ANCHOR_COUNT, anchor_size)
+        anchor_count = 0
+        novel_count = 0
+        for offset in xrange(0, chunk_len-anchor_size+1, step):
+            anchor = modi_data[offset:offset+anchor_size]
+            anchor_count += 1
+            if source_data.find(anchor) == -1:
+                novel_count += 1
+        novel_bytes = chunk_len*novel_count/max(anchor_count, 1)
+        return ChunkFeature(chunk_len, changed_bytes, novel_bytes)
+
+
+class DiffCostModel(object):
+    """Linear cost model of diff algorithms
+
+    estimated size = size_slope*feature + size_intercept  (compressed bytes)
+    estimated time = time_per_chunk (seconds)
+    cost = estimated size transmitted at bandwidth_mbps + estimated time
+    """
+    KEY_BANDWIDTH = "bandwidth_mbps"
+    KEY_ALGORITHMS = "algorithms"
+    KEY_SIZE_SLOPE = "size_slope"
+    KEY_SIZE_INTERCEPT = "size_intercept"
+    KEY_TIME = "time_per_chunk"
+
+    def __init__(self, algorithm_dict, bandwidth_mbps):
+        if len(algorithm_dict) == 0:
+            raise DiffCodecError("Need at least one diff algorithm")
+        for algorithm in algorithm_dict.keys():
+            if algorithm not in DIFF_REF_ID:
+                msg = "%s algorithm is not supported" % algorithm
+                raise DiffCodecError(msg)
+        self.algorithm_dict = algorithm_dict
+        self.bandwidth_mbps = float(bandwidth_mbps)
+
+    def estimate(self, algorithm, feature):
+        coefficient = self.algorithm_dict[algorithm]
+        size = coefficient[self.KEY_SIZE_SLOPE]*feature.get_value(algorithm) + \
+            coefficient[self.KEY_SIZE_INTERCEPT]
+        return max(size, 0), coefficient[self.KEY_TIME]
+
+    def get_cost(self, algorithm, feature):
+        size, cpu_time = self.estimate(algorithm, feature)
+        return 8.0*size/(self.bandwidth_mbps*1024*1024) + cpu_time
+
+    def select(self, feature):
+        selected = None
+        selected_cost = None
+        for algorithm in self.algorithm_dict.iterkeys():
+            cost = self.get_cost(algorithm, feature)
+            if selected_cost is None or cost < selected_cost:
+                selected = algorithm
+                selected_cost = cost
+        return selected
+
+    def to_dict(self):
+        return {
+            self.KEY_BANDWIDTH: self.bandwidth_mbps,
+            self.KEY_ALGORITHMS: self.algorithm_dict,
+        }
+
+    @staticmethod
+    def from_dict(dictionary):
+        return DiffCostModel(dictionary[DiffCostModel.KEY_ALGORITHMS],
+                             dictionary[DiffCostModel.KEY_BANDWIDTH])
+
+    @staticmethod
+    def from_file(model_path):
+        with open(model_path, "r") as fd:
+            return DiffCostModel.from_dict(json.loads(fd.read()))
+
+    def to_file(self, model_path):
+        with open(model_path, "w") as fd:
+            fd.write(json.dumps(self.to_dict(), indent=4, sort_keys=True))
+
+
+class DiffCodecSelector(object):
+    """Pick diff algorithm of each chunk for MemoryDiffProc/DiskDiffProc
+    """
+
+    def __init__(self, cost_model):
+        self.cost_model = cost_model
+        self.selected_counter = dict()
+
+    @staticmethod
+    def load(model_path):
+        if model_path is None or os.path.exists(model_path) is False:
+            LOG.warning("No diff cost model at %s" % str(model_path))
+            return None
+        return DiffCodecSelector(DiffCostModel.from_file(model_path))
+
+    def select(self, source_data, modi_data):
+        feature = ChunkFeature.from_chunk(source_data, modi_data)
+        algorithm = self.cost_model.select(feature)
+        self.selected_counter[algorithm] = \
+            self.selected_counter.get(algorithm, 0) + 1
+        return algorithm
+
+
+def calibrate(chunk_pairs, algorithm_list, bandwidth_mbps):
+    """Fit DiffCostModel by running each algorithm on sample chunks
+    :param chunk_pairs: list of (source_data, modi_data)
+    """
+    feature_list = [ChunkFeature.from_chunk(source, modi)
+                    for (source, modi) in chunk_pairs]
+    algorithm_dict = dict()
+    for algorithm in algorithm_list:
+        size_list = list()
+        diff_time = float(0)
+        for (source, modi) in chunk_pairs:
+            time_start = time.clock()
+            try:
+                diff_data, ref_id = diff_chunk(algorithm, source, modi)
+            except IOError as e:
+                diff_data = modi
+            diff_time += (time.clock() - time_start)
+            size_list.append(len(zlib.compress(diff_data, 6)))
+        time_per_chunk = diff_time/len(chunk_pairs)
+        value_list = [feature.get_value(algorithm) for feature in feature_list]
+        if len(set(value_list)) > 1:
+            slope, intercept = numpy.polyfit(value_list, size_list, 1)
+        else:
+            slope, intercept = 0.0, numpy.mean(size_list)
+        algorithm_dict[algorithm] = {
+            DiffCostModel.KEY_SIZE_SLOPE: float(slope),
+            DiffCostModel.KEY_SIZE_INTERCEPT: float(intercept),
+            DiffCostModel.KEY_TIME: time_per_chunk,
+        }
+    return DiffCostModel(algorithm_dict, bandwidth_mbps)
+
+
+def generate_synthetic_chunks(chunk_count, chunk_size=4096, seed=1234):
+    """Return (source, modi) chunk pairs of mixed workload
+    lightly edited chunks, chunks whose content moved, and new chunks
+    """
+    rand = random.Random(seed)
+
+    def _random_data(length):
+        # compressible, but not repetitive within a chunk
+        words = ["cloudlet", "handoff", "overlay", "\0\0\0\0", "base",
+                 "\xff\xff", "synthesis", "kvm"]
+        data = list()
+        data_len = 0
+        while data_len < length:
+            word = rand.choice(words) if rand.random() < 0.7 else \
+                chr(rand.randint(0, 255))
+            data.append(word)
+            data_len += len(word)
+        return ''.join(data)[:length]
+
+    chunk_pairs = list()
+    for index in xrange(chunk_count):
+        source = _random_data(chunk_size)
+        workload = index % 3
+        if workload == 0:
+            # lightly edited
+            modi = bytearray(source)
+            for edit in xrange(rand.randint(1, 64)):
+                modi[rand.randint(0, chunk_size-1)] = rand.randint(0, 255)
+            modi = str(modi)
+        elif workload == 1:
+            # content moved within the chunk
+            shift = rand.randint(1, chunk_size/4)
+            modi = (_random_data(shift) + source)[:chunk_size]
+        else:
+            modi = _random_data(chunk_size)
+        chunk_pairs.append((source, modi))
+    return chunk_pairs
+
+
+def compare_algorithms(chunk_pairs, algorithm_list, selector):
+    """Return {algorithm: (compressed overlay size, diff time)} including
+    per-chunk selection by the selector as 'adaptive'
+    """
+    result = dict()
+    for algorithm in algorithm_list + ["adaptive"]:
+        diff_list = list()
+        time_start = time.clock()
+        for (source, modi) in chunk_pairs:
+            if algorithm == "adaptive":
+                selected = selector.select(source, modi)
+            else:
+                selected = algorithm
+            try:
+                diff_data, ref_id = diff_chunk(selected, source, modi)
+            except IOError as e:
+                diff_data = modi
+            diff_list.append(diff_data)
+        diff_time = time.clock() - time_start
+        overlay_size = len(zlib.compress(''.join(diff_list), 6))
+        result[algorithm] = (overlay_size, diff_time)
+    return result
+
+
+if __name__ == "__main__":
+    # calibrate: diff_codec.py calibrate output_path bandwidth_mbps [algorithm ...]
+    # compare: diff_codec.py compare model_path [algorithm ...]
+    if len(sys.argv) < 4:
+        sys.stderr.write("usage: %s calibrate|compare path value [algorithm ...]\n"
+                         % sys.argv[0])
+        sys.exit(1)
+    command = sys.argv[1]
+    algorithm_list = sys.argv[4:] or ["xdelta3", "bsdiff", "xor", "none"]
+    if command == "calibrate":
+        chunk_pairs = generate_synthetic_chunks(3000, seed=1)
+        cost_model = calibrate(chunk_pairs, algorithm_list,
+                               float(sys.argv[3]))
+        cost_model.to_file(sys.argv[2])
+        print json.dumps(cost_model.to_dict(), indent=4, sort_keys=True)
+    elif command == "compare":
+        selector = DiffCodecSelector(DiffCostModel.from_file(sys.argv[2]))
+        chunk_pairs = generate_synthetic_chunks(int(sys.argv[3]), seed=2)
+        result = compare_algorithms(chunk_pairs, algorithm_list, selector)
+        for algorithm, (overlay_size, diff_time) in sorted(result.iteritems()):
+            print "%s\t%d bytes\t%f s" % (algorithm, overlay_size, diff_time)
+        print "adaptive selection: %s" % selector.selected_counter
@@ -38,6 +38,10 @@ from . import process_manager
 from .delta import DeltaItem
 from .delta import DeltaList
 from .delta import Recovered_delta
+from . import diff_codec
+from .diff_codec import DiffCodecSelector
+from . import similarity_index
+from .similarity_index import SimilarityIndex
 from .progressbar import AnimatedProgressBar
 from .configuration import Const
 from .configuration import VMOverlayCreationMode
@@ -51,7 +55,29 @@ class DiskError(Exception):
     pass
 
 
-def hashing(disk_path, meta_path, chunk_size=4096, window_size=512):
+# number of windows hashed by a worker at once in parallel hashing
+HASH_RANGE_WINDOWS = 16384
+
+
+def hashing(disk_path, meta_path, chunk_size=4096, window_size=512,
+            num_proc=None, sketch_path=None):
+    """Save hash of every chunk_size window at window_size step of the disk
+    to meta_path and return sha256 of the entire disk
+    :param num_proc: number of hashing processes (default: number of CPUs)
+    :param sketch_path: also save sketches of every chunk, computed while
+    the disk is read for hashing
+    """
+    if num_proc is None:
+        num_proc = multiprocessing.cpu_count()
+    if num_proc > 1:
+        return _hashing_parallel(disk_path, meta_path, chunk_size,
+                                 window_size, num_proc, sketch_path)
+    return _hashing_serial(disk_path, meta_path, chunk_size, window_size,
+                           sketch_path)
+
+
+def _hashing_serial(disk_path, meta_path, chunk_size, window_size,
+                    sketch_path=None):
 
     prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
     total_iteration = os.path.getsize(disk_path)/window_size
@@ -66,6 +92,11 @@ def hashing(disk_path, meta_path, chunk_size=4096, window_size=512):
 
     entire_hashing = sha256()
     entire_hashing.update(data)
+    sketch_writer = None
+    if sketch_path is not None:
+        sketch_writer = similarity_index.SketchWriter(
+            sketch_path, os.path.getsize(disk_path), chunk_size)
+        sketch_writer.update(data)
 
     s_offset = 0
     data_len = len(data)
@@ -86,16 +117,112 @@ def hashing(disk_path, meta_path, chunk_size=4096, window_size=512):
         s_offset += window_size
         data = data[window_size:] + added_data
         entire_hashing.update(added_data)
+        if sketch_writer is not None:
+            sketch_writer.update(added_data)
 
     for hashed_data, s_offset, data_len in list(hash_dic.values()):
         out_file.write(struct.pack("!QI%ds" % len(hashed_data),
                                    s_offset, data_len, hashed_data))
     disk_file.close()
     out_file.close()
+    if sketch_writer is not None:
+        sketch_writer.close()
 
     return entire_hashing.hexdigest()
 
 
+def _hash_disk_range(args):
+    # process pool worker of _hashing_parallel
+    # returns "!32sQ" records (hash, offset) of the windows starting in
+    # [start, end) in offset order, only for the first appearance of a hash,
+    # and sketches of the chunks starting in [start, end) if requested
+    (disk_path, start_offset, end_offset, chunk_size, window_size,
+     is_sketch) = args
+    hash_set = set()
+    record_list = list()
+    sketches = None
+    with open(disk_path, "rb") as disk_file:
+        disk_mmap = mmap.mmap(disk_file.fileno(), 0, prot=mmap.PROT_READ)
+        for s_offset in xrange(start_offset, end_offset, window_size):
+            hashed_data = sha256(
+                disk_mmap[s_offset:s_offset+chunk_size]).digest()
+            if hashed_data not in hash_set:
+                hash_set.add(hashed_data)
+                record_list.append(struct.pack("!32sQ", hashed_data, s_offset))
+        if is_sketch:
+            chunk_start = (start_offset+chunk_size-1)/chunk_size*chunk_size
+            chunk_count = max(end_offset-chunk_start+chunk_size-1, 0) / \
+                chunk_size
+            sketches = similarity_index.compute_range_sketches(
+                disk_mmap, chunk_start, chunk_start+chunk_count*chunk_size,
+                chunk_size)
+        disk_mmap.close()
+    return ''.join(record_list), sketches
+
+
+def _hashing_parallel(disk_path, meta_path, chunk_size, window_size,
+                      num_proc, sketch_path=None):
+    # Split windows into ranges hashed by a process pool and merge them in
+    # offset order, so that the meta file is the same as _hashing_serial
+    disk_size = os.path.getsize(disk_path)
+    if disk_size < chunk_size:
+        raise DiskError("invalid raw disk size")
+    last_offset = (disk_size-chunk_size)/window_size*window_size
+    range_size = HASH_RANGE_WINDOWS*window_size
+    range_list = [(disk_path, start, min(start+range_size, last_offset+1),
+                   chunk_size, window_size, sketch_path is not None)
+                  for start in xrange(0, last_offset+1, range_size)]
+    sketch_writer = None
+    if sketch_path is not None:
+        sketch_writer = similarity_index.SketchWriter(sketch_path, disk_size,
+                                                      chunk_size)
+    LOG.info("Hashing disk using %d processes" % num_proc)
+    prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
+
+    hash_dic = dict()
+    record_size = struct.calcsize("!32sQ")
+    pool = multiprocessing.Pool(num_proc)
+    try:
+        # imap returns the results in offset order
+        result_iter = pool.imap(_hash_disk_range, range_list)
+
+        # hash of the entire disk while the workers hash windows
+        entire_hashing = sha256()
+        with open(disk_path, "rb") as disk_file:
+            remain_size = last_offset+chunk_size
+            while remain_size > 0:
+                data = disk_file.read(min(remain_size, 1024*1024))
+                entire_hashing.update(data)
+                remain_size -= len(data)
+
+        for range_item, (records, sketches) in zip(range_list, result_iter):
+            if sketch_writer is not None:
+                sketch_writer.write_sketches(sketches)
+            for index in xrange(0, len(records), record_size):
+                hashed_data, s_offset = struct.unpack(
+                    "!32sQ", records[index:index+record_size])
+                if hash_dic.get(hashed_data) is None:
+                    hash_dic[hashed_data] = (hashed_data, s_offset, chunk_size)
+            prog_bar.set_percent(100.0*range_item[2]/(last_offset+1))
+            prog_bar.show_progress()
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    prog_bar.finish()
+    if sketch_writer is not None:
+        sketch_writer.close()
+
+    with open(meta_path, "w+b") as out_file:
+        for hashed_data, s_offset, data_len in list(hash_dic.values()):
+            out_file.write(struct.pack("!QI%ds" % len(hashed_data),
+                                       s_offset, data_len, hashed_data))
+    return entire_hashing.hexdigest()
+
+
 def _pack_hashlist(hash_list):
     # pack hash list
     original_length = len(hash_list)
@@ -332,14 +459,34 @@ class CreateDiskDeltalist(process_manager.ProcWorker):
         self.overlay_mode = overlay_mode
         self.num_proc = VMOverlayCreationMode.MAX_THREAD_NUM
         self.diff_algorithm = overlay_mode.DISK_DIFF_ALGORITHM
+        # loaded once and shared with the diff children
+        self.similarity_index = None
+        if overlay_mode.OPTIMIZATION_SIMILAR_BASE_CHUNK:
+            self.similarity_index = SimilarityIndex.load(
+                Const.get_base_sketchpath(basedisk_path)[0])
 
         super(CreateDiskDeltalist, self).__init__(target=self.create_disk_deltalist)
 
     def change_mode(self, new_mode):
+        # new children start with the latest mode
+        if new_mode.get("diff_algorithm", None) is not None:
+            self.diff_algorithm = new_mode.get("diff_algorithm")
         for (proc, c_queue, m_queue) in self.proc_list:
             if proc.is_alive():
                 m_queue.put(("new_mode", new_mode))
 
+    def _create_child(self):
+        command_queue = multiprocessing.Queue()
+        mode_queue = multiprocessing.Queue()
+        diff_proc = DiskDiffProc(command_queue, self.task_queue, mode_queue,
+                                 self.disk_deltalist_queue,
+                                 self.diff_algorithm,
+                                 self.basedisk_path,
+                                 self.modified_disk,
+                                 self.chunk_size,
+                                 similarity_index=self.similarity_index)
+        return (diff_proc, command_queue, mode_queue)
+
     @staticmethod
     def averaged_value(measure_hist, cur_time):
         avg_p = float(0)
@@ -378,17 +525,10 @@ class CreateDiskDeltalist(process_manager.ProcWorker):
         xrayed_list = []
 
         # launch child processes
-        task_queue = multiprocessing.Queue(
+        self.task_queue = multiprocessing.Queue(
             maxsize=VMOverlayCreationMode.MAX_THREAD_NUM)
         for i in range(self.num_proc):
-            command_queue = multiprocessing.Queue()
-            mode_queue = multiprocessing.Queue()
-            diff_proc = DiskDiffProc(command_queue, task_queue, mode_queue,
-                                     self.disk_deltalist_queue,
-                                     self.diff_algorithm,
-                                     self.basedisk_path,
-                                     self.modified_disk,
-                                     self.chunk_size)
+            (diff_proc, command_queue, mode_queue) = self._create_child()
             diff_proc.start()
             self.proc_list.append((diff_proc, command_queue, mode_queue))
 
@@ -438,7 +578,7 @@ class CreateDiskDeltalist(process_manager.ProcWorker):
 
                     modified_chunk_length = len(modified_chunk_list)
                     if modified_chunk_length > 255:  # 1MB
-                        task_queue.put(modified_chunk_list)
+                        self.task_queue.put(modified_chunk_list)
                         modified_chunk_list = []
 
                         total_process_time = 0
@@ -507,13 +647,11 @@ class CreateDiskDeltalist(process_manager.ProcWorker):
 
             # send last chunks
             if len(modified_chunk_list) > 0:
-                task_queue.put(modified_chunk_list)
+                self.task_queue.put(modified_chunk_list)
                 modified_chunk_list = []
 
             # send end meesage to every process
-            for index in self.proc_list:
-                task_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
-                #LOG.debug("[Disk] send end message to each child")
+            self.send_end_messages(self.task_queue)
 
             # after this for loop, all processing finished, but child process still
             # alive until all data pass to the next step
@@ -620,7 +758,8 @@ def recover_disk(base_disk, base_mem, overlay_mem,
 class DiskDiffProc(multiprocessing.Process):
 
     def __init__(self, command_queue, task_queue, mode_queue, deltalist_queue,
-                 diff_algorithm, basedisk_path, modified_disk, chunk_size):
+                 diff_algorithm, basedisk_path, modified_disk, chunk_size,
+                 similarity_index=None):
         self.command_queue = command_queue
         self.task_queue = task_queue
         self.mode_queue = mode_queue
@@ -629,6 +768,7 @@ class DiskDiffProc(multiprocessing.Process):
         self.basedisk_path = basedisk_path
         self.modified_disk = modified_disk
         self.chunk_size = chunk_size
+        self.similarity_index = similarity_index
 
         # shared variables between processes
         self.child_process_time_total = multiprocessing.RawValue(
@@ -646,6 +786,8 @@ class DiskDiffProc(multiprocessing.Process):
         base_fd = open(self.basedisk_path, "rb")
         base_mmap = mmap.mmap(base_fd.fileno(), 0, prot=mmap.PROT_READ)
         modified_fd = open(self.modified_disk, "rb")
+        self.diff_selector = None
+        self.is_diff_selector_loaded = False
 
         time_process_total_time = float(0)
         child_total_block = 0
@@ -672,6 +814,10 @@ class DiskDiffProc(multiprocessing.Process):
                     # print "[disk] child receives cores: %s" % (new_num_cores)
                     if new_num_cores is not None:
                         VMOverlayCreationMode.set_num_cores(new_num_cores)
+                elif command == "retire":
+                    # remaining tasks go to the other children
+                    is_proc_running = False
+                    break
             if self.task_queue._reader.fileno() in inready:
                 task_list = self.task_queue.get()
                 if task_list == Const.QUEUE_SUCCESS_MESSAGE:
@@ -681,6 +827,8 @@ class DiskDiffProc(multiprocessing.Process):
 
                 time_process_start = time.clock()
                 deltaitem_list = list()
+                xor_source_list = list()
+                xor_item_list = list()
                 child_cur_block_count = 0
                 indata_size_cur = 0
                 outdata_size_cur = 0
@@ -691,35 +839,25 @@ class DiskDiffProc(multiprocessing.Process):
                     data = modified_fd.read(self.chunk_size)
                     chunk_data_len = len(data)
                     source_data = base_mmap[offset:offset+chunk_data_len]
+                    diff_algorithm = self.get_diff_algorithm(source_data,
+                                                             data)
                     try:
-                        if self.diff_algorithm == "xdelta3":
-                            diff_data = tool.diff_data(source_data,
-                                data, 2 * len(source_data))
-                            diff_type = DeltaItem.REF_XDELTA
-                            if len(diff_data) > chunk_data_len:
-                                msg = "xdelta3 patch is bigger than origianl"
-                                raise IOError(msg)
-                        elif self.diff_algorithm == "bsdiff":
-                            diff_data = tool.diff_data_bsdiff( source_data, data)
-                            diff_type = DeltaItem.REF_BSDIFF
-                            if len(diff_data) > chunk_data_len:
-                                msg = "bsdiff patch is bigger than origianl"
-                                raise IOError(msg)
-                        elif self.diff_algorithm == "xor":
-                            diff_data = tool.cython_xor(source_data, data)
-                            diff_type = DeltaItem.REF_XOR
-                            if len(diff_data) > chunk_data_len:
-                                msg = "xorpatch is bigger than origianl"
-                                raise IOError(msg)
-                        elif self.diff_algorithm == "none":
-                            diff_data = data
-                            diff_type = DeltaItem.REF_RAW
-                        else:
-                            msg = "%s algorithm is not supported" % self.diff_algorithm
-                            raise DiskError(msg)
+                        diff_data, diff_type = diff_codec.diff_chunk(
+                            diff_algorithm, source_data, data,
+                            batch_xor=True)
                     except IOError as e:
                         diff_data = data
                         diff_type = DeltaItem.REF_RAW
+                    if self.similarity_index is not None and \
+                            diff_algorithm in SimilarityIndex.DIFF_ALGORITHMS and \
+                            len(diff_data) > chunk_data_len*SimilarityIndex.POOR_DIFF_RATIO:
+                        # poor diff at the same offset
+                        similar_data = self.similarity_index.diff_similar_chunk(
+                            base_mmap, offset, data, diff_algorithm)
+                        if similar_data is not None and \
+                                len(similar_data) < len(diff_data):
+                            diff_data = similar_data
+                            diff_type = DeltaItem.REF_BASE_SIMILAR
 
                     diff_data_len = len(diff_data)
                     indata_size_cur += (chunk_data_len+11)
@@ -732,6 +870,14 @@ class DiskDiffProc(multiprocessing.Process):
                                            data_len=diff_data_len,
                                            data=diff_data)
                     deltaitem_list.append(delta_item)
+                    if diff_type == DeltaItem.REF_XOR:
+                        xor_source_list.append(source_data)
+                        xor_item_list.append(delta_item)
+                if len(xor_item_list) > 0:
+                    xor_data_list = tool.xor_batch(
+                        xor_source_list, [item.data for item in xor_item_list])
+                    for delta_item, xor_data in zip(xor_item_list, xor_data_list):
+                        delta_item.data = xor_data
                 time_process_end = time.clock()
                 child_total_block += child_cur_block_count
                 time_process_cur_time = (time_process_end - time_process_start)
@@ -750,6 +896,12 @@ class DiskDiffProc(multiprocessing.Process):
         LOG.debug(
             "[Disk][Child] Child finished. process %d jobs (%f)" %
             (child_total_block, time_process_total_time))
+        if self.diff_selector is not None:
+            LOG.debug("[Disk][Child] adaptive diff selection: %s" %
+                      self.diff_selector.selected_counter)
+        if self.similarity_index is not None:
+            LOG.debug("[Disk][Child] %d chunks diffed with similar base chunk" %
+                      self.similarity_index.similar_count)
         self.command_queue.put(
             (indata_size, outdata_size,
              child_total_block, time_process_total_time))
@@ -757,3 +909,14 @@ class DiskDiffProc(multiprocessing.Process):
             self.mode_queue.get_nowait()
             msg = "Empty new compression mode that does not refelected"
             sys.stdout.write(msg)
+
+    def get_diff_algorithm(self, source_data, data):
+        if self.diff_algorithm != "adaptive":
+            return self.diff_algorithm
+        if self.is_diff_selector_loaded is False:
+            # cost model is loaded only when adaptive mode is used
+            self.diff_selector = DiffCodecSelector.load(Const.DIFF_COST_MODEL)
+            self.is_diff_selector_loaded = True
+        if self.diff_selector is None:
+            return "xdelta3"
+        return self.diff_selector.select(source_data, data)
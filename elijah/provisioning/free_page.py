@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Find free guest memory pages from a memory snapshot.
+
+Linux keeps one struct page per physical frame in the mem_map array. A free
+block of the buddy allocator is marked at its first page, either with the
+PG_buddy flag (older kernels) or with a special _mapcount value (newer
+kernels), and the order of the block is stored at page->private. We read
+the mem_map array straight out of the snapshot and mark every frame of each
+free block.
+
+A wrong struct page layout would discard live pages as free, so a profile
+is used only after it is validated against the guest kernel: the buddy
+heads found with the profile must agree with PG_buddy of /proc/kpageflags
+dumped inside the guest right before the base VM snapshot.
+"""
+
+import os
+import json
+import mmap
+
+import numpy
+
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+PAGE_SIZE = 4096
+
+# mem_map of the 32-bit base VM kernels that the former free page scanner
+# had built in (virtual address of struct page[0] per memory size). Only a
+# starting point for validating a base VM without a free memory profile.
+KERNEL_PAGE_OFFSET = 0xc0000000
+BUILTIN_MEM_MAP_VADDR = {
+    1024*1024*1024: 0xf73fd000,
+    2048*1024*1024: 0xf553c000,
+}
+
+# /proc/kpageflags has a 64-bit flag word per pfn. KPF_BUDDY is set at the
+# first page of a free buddy block (and at the rest of the block on newer
+# kernels), so every head page the profile finds must have it.
+KPF_BUDDY = 10
+# The dump and the snapshot are not taken at the same instant, so a few
+# blocks may be allocated in between. A wrong layout matches almost none.
+VALIDATION_MATCH_RATIO = 0.99
+
+
+class FreePageError(Exception):
+    pass
+
+
+class FreePageProfile(object):
+    """Kernel layout of the guest needed to walk struct page.
+
+    mem_map_paddr       : guest physical address of mem_map (struct page[0])
+    struct_page_size    : sizeof(struct page)
+    flags_offset        : offset of page->flags
+    buddy_flag_bit      : bit number of PG_buddy, or None
+    mapcount_offset     : offset of page->_mapcount
+    buddy_mapcount_value: _mapcount value of free buddy pages, or None
+    private_offset      : offset of page->private (order of the free block)
+    max_order           : MAX_ORDER of the buddy allocator
+    word_size           : size of unsigned long of the guest kernel
+    validated           : True once checked against the guest kernel
+    """
+    KEYS = ["mem_map_paddr", "struct_page_size", "flags_offset",
+            "buddy_flag_bit", "mapcount_offset", "buddy_mapcount_value",
+            "private_offset", "max_order", "word_size", "validated"]
+
+    def __init__(self, **kwargs):
+        self.mem_map_paddr = kwargs.get("mem_map_paddr", None)
+        self.struct_page_size = kwargs.get("struct_page_size", 32)
+        self.flags_offset = kwargs.get("flags_offset", 0)
+        self.buddy_flag_bit = kwargs.get("buddy_flag_bit", None)
+        self.mapcount_offset = kwargs.get("mapcount_offset", 12)
+        self.buddy_mapcount_value = kwargs.get("buddy_mapcount_value", -128)
+        self.private_offset = kwargs.get("private_offset", 16)
+        self.max_order = kwargs.get("max_order", 11)
+        self.word_size = kwargs.get("word_size", 4)
+        self.validated = kwargs.get("validated", False)
+
+        if self.mem_map_paddr is None:
+            raise FreePageError("Need physical address of mem_map")
+        if self.buddy_flag_bit is None and self.buddy_mapcount_value is None:
+            raise FreePageError("Need either PG_buddy bit or buddy mapcount")
+        if self.word_size not in (4, 8):
+            raise FreePageError("Invalid word size: %s" % str(self.word_size))
+
+    def to_dict(self):
+        return dict([(key, getattr(self, key)) for key in self.KEYS])
+
+    @staticmethod
+    def from_file(profile_path):
+        with open(profile_path, "r") as fd:
+            profile_dict = json.loads(fd.read())
+        profile_dict = dict([(str(key), value) for key, value in
+                             profile_dict.iteritems()])
+        unknown_keys = set(profile_dict.keys()) - set(FreePageProfile.KEYS)
+        if len(unknown_keys) > 0:
+            msg = "Invalid key at %s: %s" % (profile_path, list(unknown_keys))
+            raise FreePageError(msg)
+        return FreePageProfile(**profile_dict)
+
+    def to_file(self, profile_path):
+        with open(profile_path, "w") as fd:
+            fd.write(json.dumps(self.to_dict(), indent=4))
+
+    @staticmethod
+    def get_builtin(mem_size):
+        """Return profile of the built-in base VM kernel, or None"""
+        mem_map_vaddr = BUILTIN_MEM_MAP_VADDR.get(mem_size, None)
+        if mem_map_vaddr is None:
+            return None
+        return FreePageProfile(mem_map_paddr=mem_map_vaddr-KERNEL_PAGE_OFFSET)
+
+
+class FreePageBitmap(object):
+    """Packed bitmap of free page frame numbers.
+
+    Supports 'pfn in bitmap' in O(1) so that it can be used where a
+    dictionary of free pfn was used.
+    """
+
+    def __init__(self, page_count, bits=None):
+        self.page_count = long(page_count)
+        if bits is None:
+            bits = bytearray((self.page_count+7)/8)
+        self.bits = bytearray(bits)
+        self.free_count = None
+
+    @staticmethod
+    def from_bool_array(free_array, pfn_offset=0):
+        page_count = len(free_array) + pfn_offset
+        if pfn_offset % 8 != 0:
+            free_array = numpy.concatenate(
+                [numpy.zeros(pfn_offset, dtype=numpy.bool_), free_array])
+            pfn_offset = 0
+        bits = numpy.zeros((page_count+7)/8, dtype=numpy.uint8)
+        packed = numpy.packbits(free_array.astype(numpy.bool_))
+        bits[pfn_offset/8:pfn_offset/8+len(packed)] = packed
+        return FreePageBitmap(page_count, bits.tostring())
+
+    def __contains__(self, pfn):
+        if pfn < 0 or pfn >= self.page_count:
+            return False
+        return (self.bits[pfn >> 3] & (0x80 >> (pfn & 0x07))) != 0
+
+    def __len__(self):
+        if self.free_count is None:
+            self.free_count = long(numpy.unpackbits(
+                numpy.frombuffer(bytes(self.bits), dtype=numpy.uint8)).sum())
+        return self.free_count
+
+
+def _scan_buddy_heads(mem_data, mem_size, profile):
+    """Return pfn and order of the head page of each free buddy block"""
+    page_count = mem_size/PAGE_SIZE
+    mem_map_size = page_count*profile.struct_page_size
+    if profile.mem_map_paddr + mem_map_size > len(mem_data):
+        msg = "mem_map (0x%x + %d) is out of memory size %d" % \
+            (profile.mem_map_paddr, mem_map_size, len(mem_data))
+        raise FreePageError(msg)
+
+    word_type = numpy.dtype("<u%d" % profile.word_size)
+    mem_map = numpy.frombuffer(mem_data, dtype=numpy.uint8,
+                               count=mem_map_size,
+                               offset=profile.mem_map_paddr)
+    mem_map = mem_map.reshape(page_count, profile.struct_page_size)
+
+    def _field(offset, dtype):
+        field = mem_map[:, offset:offset+dtype.itemsize]
+        return numpy.ascontiguousarray(field).view(dtype).reshape(page_count)
+
+    # head page of each free buddy block
+    if profile.buddy_flag_bit is not None:
+        flags = _field(profile.flags_offset, word_type)
+        is_head = (flags >> profile.buddy_flag_bit) & 1 == 1
+    else:
+        mapcount = _field(profile.mapcount_offset, numpy.dtype("<i4"))
+        is_head = mapcount == profile.buddy_mapcount_value
+    head_pfns = numpy.nonzero(is_head)[0]
+    orders = _field(profile.private_offset, word_type)[head_pfns]
+    return head_pfns, orders
+
+
+def scan_free_pages(mem_data, mem_size, profile):
+    """Return boolean array of free pfn
+    :param mem_data: buffer of guest physical memory (e.g. mmap)
+    :param mem_size: size of guest physical memory
+    :param profile: FreePageProfile of the guest kernel
+    """
+    page_count = mem_size/PAGE_SIZE
+    head_pfns, orders = _scan_buddy_heads(mem_data, mem_size, profile)
+
+    # mark every page of free blocks
+    is_free = numpy.zeros(page_count, dtype=numpy.bool_)
+    for order in xrange(profile.max_order):
+        block_heads = head_pfns[orders == order]
+        if len(block_heads) == 0:
+            continue
+        block_pages = (block_heads[:, None] +
+                       numpy.arange(1 << order)[None, :]).ravel()
+        block_pages = block_pages[block_pages < page_count]
+        is_free[block_pages] = True
+    invalid_count = numpy.count_nonzero(orders >= profile.max_order)
+    if invalid_count > 0:
+        LOG.warning("Ignore %d free blocks with invalid order" % invalid_count)
+    return is_free
+
+
+def read_kpageflags(kpageflags_path, page_count):
+    """Return boolean array of buddy head pfn from a /proc/kpageflags dump"""
+    with open(kpageflags_path, "rb") as fd:
+        flags = numpy.frombuffer(fd.read(page_count*8),
+                                 dtype=numpy.dtype("<u8"))
+    if len(flags) < page_count:
+        msg = "%s has %d pages, but memory has %d pages" % \
+            (kpageflags_path, len(flags), page_count)
+        raise FreePageError(msg)
+    return (flags >> KPF_BUDDY) & 1 == 1
+
+
+def validate_profile(mem_data, mem_size, profile, kpageflags_path):
+    """Check the profile against /proc/kpageflags of the same guest and
+    mark it validated. Raise FreePageError when they do not agree.
+    """
+    head_pfns = _scan_buddy_heads(mem_data, mem_size, profile)[0]
+    if len(head_pfns) == 0:
+        raise FreePageError("No free block is found with the profile")
+    is_buddy = read_kpageflags(kpageflags_path, mem_size/PAGE_SIZE)
+    match_count = numpy.count_nonzero(is_buddy[head_pfns])
+    match_ratio = float(match_count)/len(head_pfns)
+    LOG.info("%d of %d free blocks match PG_buddy of %s" %
+             (match_count, len(head_pfns), kpageflags_path))
+    if match_ratio < VALIDATION_MATCH_RATIO:
+        msg = "Only %d of %d free blocks are buddy pages at %s" % \
+            (match_count, len(head_pfns), kpageflags_path)
+        raise FreePageError(msg)
+    profile.validated = True
+
+
+def _scan_snapshot(snapshot_path, mem_size, mem_offset, scan_func):
+    with open(snapshot_path, "rb") as fd:
+        snapshot_mmap = mmap.mmap(fd.fileno(), 0, prot=mmap.PROT_READ)
+        mem_data = numpy.frombuffer(snapshot_mmap, dtype=numpy.uint8,
+                                    count=mem_size, offset=mem_offset)
+        try:
+            return scan_func(mem_data)
+        finally:
+            del mem_data
+            snapshot_mmap.close()
+
+
+def validate_profile_file(snapshot_path, mem_size, mem_offset, profile_path,
+                          kpageflags_path):
+    """Validate the free memory profile of the snapshot and save it.
+    Start from the built-in layout if the base VM has no profile yet.
+    :param kpageflags_path: /proc/kpageflags dumped inside the guest right
+    before the snapshot
+    """
+    if os.path.exists(profile_path):
+        profile = FreePageProfile.from_file(profile_path)
+    else:
+        profile = FreePageProfile.get_builtin(mem_size)
+        if profile is None:
+            raise FreePageError("No free memory profile at %s" % profile_path)
+    _scan_snapshot(snapshot_path, mem_size, mem_offset,
+                   lambda mem_data: validate_profile(mem_data, mem_size,
+                                                     profile,
+                                                     kpageflags_path))
+    profile.to_file(profile_path)
+    return profile
+
+
+def get_free_page_bitmap(snapshot_path, mem_size, mem_offset, profile_path):
+    """Return FreePageBitmap of the memory snapshot.
+    Page number of the bitmap is the page index of the snapshot file, which
+    is pfn + mem_offset/page_size
+    :param mem_size: size of pc.ram in bytes
+    :param mem_offset: file offset of pc.ram in the snapshot
+    """
+    if profile_path is None or not os.path.exists(profile_path):
+        LOG.warning("No free memory profile at %s" % str(profile_path))
+        return None
+    profile = FreePageProfile.from_file(profile_path)
+    if profile.validated is not True:
+        LOG.warning("Free memory profile at %s is not validated "
+                    "against the guest kernel" % profile_path)
+        return None
+
+    LOG.info("Start getting free memory pages")
+    is_free = _scan_snapshot(snapshot_path, mem_size, mem_offset,
+                             lambda mem_data: scan_free_pages(mem_data,
+                                                              mem_size,
+                                                              profile))
+    free_bitmap = FreePageBitmap.from_bool_array(
+        is_free, pfn_offset=mem_offset/PAGE_SIZE)
+    LOG.info("Free memory pages : %ld" % len(free_bitmap))
+    return free_bitmap
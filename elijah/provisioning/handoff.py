@@ -30,8 +30,11 @@ import libvirt
 import shutil
 import traceback
 import struct
+import mmap
+import zlib
 import msgpack
 import psutil
+import numpy
 from tempfile import NamedTemporaryFile
 from tempfile import mkdtemp
 from xml.etree import ElementTree
@@ -49,12 +52,16 @@ from .package import VMOverlayPackage
 from . import delta
 from .delta import DeltaList
 from .delta import DeltaItem
+from .chunk_bitmap import ChunkBitmap
 from .tool import comp_lzma
 from .progressbar import AnimatedProgressBar
 from .package import VMOverlayPackage
 from . import compression
 from . import process_manager
 from . import qmp_af_unix
+from . import network_emulator
+from . import byte_queue
+from . import overlay_meta
 from . import log as logging
 
 
@@ -480,7 +487,13 @@ class _MonitoringInfo(object):
 
 class StreamSynthesisFile(native_threading.Thread):
 
-    def __init__(self, basevm_uuid, compdata_queue, temp_compfile_dir):
+    def __init__(self, basevm_uuid, compdata_queue, temp_compfile_dir,
+                 emulate_network=True):
+        """
+        :param emulate_network: write blobs at the emulated network
+        bandwidth as handoff to a file does. False to write at disk speed,
+        e.g. for VM overlay creation
+        """
         self.basevm_uuid = basevm_uuid
         self.compdata_queue = compdata_queue
         self.temp_compfile_dir = temp_compfile_dir
@@ -491,6 +504,12 @@ class StreamSynthesisFile(native_threading.Thread):
             self.temp_compfile_dir, "overlay-info")
         self.overlay_filenames = os.path.join(
             self.temp_compfile_dir, "overlay-names")
+        # emulate network bandwidth with a token bucket
+        self.token_bucket = None
+        if emulate_network:
+            self.token_bucket = network_emulator.get_token_bucket(
+                VMOverlayCreationMode.EMULATED_BANDWIDTH_Mbps,
+                trace_path=VMOverlayCreationMode.EMULATED_NETWORK_TRACE)
         native_threading.Thread.__init__(self, target=self.save_to_file)
 
     def get_overlay_info(self):
@@ -509,7 +528,6 @@ class StreamSynthesisFile(native_threading.Thread):
             input_ready, out_ready, err_ready = select.select(input_fd, [], [])
             if self.compdata_queue._reader.fileno() in input_ready:
                 comp_task = self.compdata_queue.get()
-                time_process_start = time.time()
                 if comp_task == Const.QUEUE_SUCCESS_MESSAGE:
                     break
                 if comp_task == Const.QUEUE_FAILED_MESSAGE:
@@ -524,6 +542,9 @@ class StreamSynthesisFile(native_threading.Thread):
                     (Const.OVERLAY_FILE_PREFIX, comp_file_counter))
                 comp_file_counter += 1
                 output_fd = open(blob_filename, "wb+")
+                if self.token_bucket is not None:
+                    output_fd = network_emulator.ShapedFile(
+                        output_fd, self.token_bucket)
                 output_fd.write(compdata)
                 output_fd.close()
                 blob_dict = {
@@ -534,55 +555,42 @@ class StreamSynthesisFile(native_threading.Thread):
                     Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks}
                 self.overlay_files.append(blob_filename)
                 self.overlay_info.append(blob_dict)
-                time_process_end = time.time()
 
-                # wait to emulate network badwidth
-                processed_time = time_process_end-time_process_start
-                processed_size = os.path.getsize(blob_filename)
-                emulated_time = (
-                    processed_size*8) / (VMOverlayCreationMode.EMULATED_BANDWIDTH_Mbps*1024.0*1024)
-                if emulated_time > processed_time:
-                    sleep_time = (emulated_time-processed_time)
-                    time.sleep(sleep_time)
 
+def create_memory_delta_proc(options, overlay_mode, base_mem, base_memmeta,
+                             free_memory_dict, modified_mem_queue,
+                             process_controller):
+    """start the memory delta stage and return its output queue"""
+    memory_deltalist_queue = byte_queue.get_stage_queue(
+        overlay_mode.QUEUE_SIZE_MEMORY_DELTA_LIST,
+        overlay_mode.QUEUE_BYTES_MEMORY_DELTA_LIST)
+    memory_deltalist_proc = memory.CreateMemoryDeltalist(
+        modified_mem_queue,
+        memory_deltalist_queue,
+        base_memmeta,
+        base_mem,
+        overlay_mode,
+        options.FREE_SUPPORT,
+        free_memory_dict)
+    memory_deltalist_proc.start()
+    if overlay_mode.PROCESS_PIPELINED == False:
+        _waiting_to_finish(process_controller, "CreateMemoryDeltalist")
+    return memory_deltalist_queue
 
-def create_delta_proc(monitoring_info, options, overlay_mode,
-                      base_image, base_mem, base_memmeta,
-                      basedisk_hashdict, basemem_hashdict,
-                      modified_disk, modified_mem_queue,
-                      merged_deltalist_queue, process_controller):
 
+def create_disk_delta_proc(monitoring_info, overlay_mode, base_image,
+                           modified_disk, disk_deltalist_queue,
+                           process_controller):
+    """start the disk delta stage writing to disk_deltalist_queue.
+    TRIM and used block information of monitoring_info are read at start
+    """
     INFO = _MonitoringInfo
-    free_memory_dict = getattr(monitoring_info, INFO.MEMORY_FREE_BLOCKS, None)
     m_chunk_queue = getattr(monitoring_info, INFO.DISK_MODIFIED_BLOCKS, dict())
     trim_dict = getattr(monitoring_info, INFO.DISK_FREE_BLOCKS, None)
     used_blocks_dict = getattr(monitoring_info, INFO.DISK_USED_BLOCKS, None)
     dma_dict = dict()
     apply_discard = True
 
-    LOG.info("Get memory delta")
-    time_s = time.time()
-
-    # memory hashdict is needed at memory delta and dedup
-    if not options.DISK_ONLY:
-        memory_deltalist_queue = multiprocessing.Queue(
-            maxsize=overlay_mode.QUEUE_SIZE_MEMORY_DELTA_LIST)
-        memory_deltalist_proc = memory.CreateMemoryDeltalist(
-            modified_mem_queue,
-            memory_deltalist_queue,
-            base_memmeta,
-            base_mem,
-            overlay_mode,
-            options.FREE_SUPPORT,
-            free_memory_dict)
-        memory_deltalist_proc.start()
-        if overlay_mode.PROCESS_PIPELINED == False:
-            _waiting_to_finish(process_controller, "CreateMemoryDeltalist")
-        time_mem_delta = time.time()
-
-    LOG.info("Get disk delta")
-    disk_deltalist_queue = multiprocessing.Queue(
-        maxsize=overlay_mode.QUEUE_SIZE_DISK_DELTA_LIST)
     disk_deltalist_proc = disk.CreateDiskDeltalist(modified_disk,
                                                    m_chunk_queue,
                                                    Const.CHUNK_SIZE,
@@ -596,9 +604,12 @@ def create_delta_proc(monitoring_info, options, overlay_mode,
     disk_deltalist_proc.start()
     if overlay_mode.PROCESS_PIPELINED == False:
         _waiting_to_finish(process_controller, "CreateDiskDeltalist")
-    time_disk_delta = time.time()
 
-    LOG.info("Generate VM overlay using deduplication")
+
+def create_dedup_proc(overlay_mode, basedisk_hashdict, basemem_hashdict,
+                      memory_deltalist_queue, disk_deltalist_queue,
+                      merged_deltalist_queue, remote_chunk_filter=None,
+                      remote_chunk_dict=None, access_trace=None):
     dedup_proc = delta.DeltaDedup(
         memory_deltalist_queue,
         memory.Memory.RAM_PAGE_SIZE,
@@ -607,8 +618,50 @@ def create_delta_proc(monitoring_info, options, overlay_mode,
         merged_deltalist_queue,
         overlay_mode,
         basedisk_hashdict=basedisk_hashdict,
-        basemem_hashdict=basemem_hashdict)
+        basemem_hashdict=basemem_hashdict,
+        remote_chunk_filter=remote_chunk_filter,
+        remote_chunk_dict=remote_chunk_dict,
+        access_trace=access_trace)
     dedup_proc.start()
+    return dedup_proc
+
+
+def create_delta_proc(monitoring_info, options, overlay_mode,
+                      base_image, base_mem, base_memmeta,
+                      basedisk_hashdict, basemem_hashdict,
+                      modified_disk, modified_mem_queue,
+                      merged_deltalist_queue, process_controller,
+                      remote_chunk_filter=None, remote_chunk_dict=None):
+
+    INFO = _MonitoringInfo
+    free_memory_dict = getattr(monitoring_info, INFO.MEMORY_FREE_BLOCKS, None)
+
+    LOG.info("Get memory delta")
+    time_s = time.time()
+
+    # memory hashdict is needed at memory delta and dedup
+    if not options.DISK_ONLY:
+        memory_deltalist_queue = create_memory_delta_proc(
+            options, overlay_mode, base_mem, base_memmeta,
+            free_memory_dict, modified_mem_queue, process_controller)
+        time_mem_delta = time.time()
+
+    LOG.info("Get disk delta")
+    disk_deltalist_queue = byte_queue.get_stage_queue(
+        overlay_mode.QUEUE_SIZE_DISK_DELTA_LIST,
+        overlay_mode.QUEUE_BYTES_DISK_DELTA_LIST)
+    create_disk_delta_proc(monitoring_info, overlay_mode, base_image,
+                           modified_disk, disk_deltalist_queue,
+                           process_controller)
+    time_disk_delta = time.time()
+
+    LOG.info("Generate VM overlay using deduplication")
+    dedup_proc = create_dedup_proc(overlay_mode, basedisk_hashdict,
+                                   basemem_hashdict, memory_deltalist_queue,
+                                   disk_deltalist_queue,
+                                   merged_deltalist_queue,
+                                   remote_chunk_filter=remote_chunk_filter,
+                                   remote_chunk_dict=remote_chunk_dict)
     time_merge_delta = time.time()
 
     #LOG.info("Print statistics")
@@ -698,7 +751,7 @@ def _waiting_to_finish(process_controller, worker_name):
 
 
 def _generate_overlaymeta(overlay_metapath, overlay_info, base_hashvalue,
-                          launchdisk_size, launchmem_size):
+                          launchdisk_size, launchmem_size, access_trace=None):
     # create metadata
     fout = open(overlay_metapath, "wrb")
 
@@ -707,8 +760,10 @@ def _generate_overlaymeta(overlay_metapath, overlay_info, base_hashvalue,
     meta_dict[Const.META_RESUME_VM_DISK_SIZE] = long(launchdisk_size)
     meta_dict[Const.META_RESUME_VM_MEMORY_SIZE] = long(launchmem_size)
     meta_dict[Const.META_OVERLAY_FILES] = overlay_info
+    if access_trace is not None:
+        meta_dict[Const.META_OVERLAY_ACCESS_TRACE] = access_trace.to_meta()
 
-    serialized = msgpack.packb(meta_dict)
+    serialized = overlay_meta.pack_meta(meta_dict)
     fout.write(serialized)
     fout.close()
 
@@ -760,6 +815,122 @@ class CPUMonitor(native_threading.Thread):
         self.stop.set()
 
 
+class BaseHashIndex(object):
+    """Hash index of a base VM kept on disk as the disk or memory meta file
+
+    Handoff data refers to the index by path, size, mtime and checksum
+    instead of carrying the hash dict, which has an entry for every chunk of the base
+    VM and takes seconds to pack and unpack. A loaded index answers get()
+    like the hash dict, reading records from the mmap of the meta file
+    through a sorted array of hash prefixes.
+    """
+    INDEX_DISK = "disk"
+    INDEX_MEMORY = "memory"
+    RECORD_FORMAT = "!qI32s"    # start_offset, length, hash
+    RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+    HASH_START = struct.calcsize("!qI")
+    # first 8 bytes of the hash of each record
+    PREFIX_DTYPE = numpy.dtype({"names": ["prefix"], "formats": [">u8"],
+                                "offsets": [HASH_START],
+                                "itemsize": RECORD_SIZE})
+    CHECKSUM_BLOCK_SIZE = 1024*1024
+
+    def __init__(self, index_type, meta_path, meta_stat=None):
+        if index_type not in (self.INDEX_DISK, self.INDEX_MEMORY):
+            raise HandoffError("Invalid base hash index type %s" % index_type)
+        self.index_type = index_type
+        self.meta_path = meta_path
+        if meta_stat is None:
+            meta_stat = BaseHashIndex.get_stat(meta_path)
+        self.meta_stat = tuple(meta_stat)
+        self.meta_mmap = None
+        self.prefix_list = None
+        self.record_index_list = None
+
+    @staticmethod
+    def get_stat(meta_path):
+        # size and mtime catch a rewritten meta file, and the checksum catches
+        # one changed in place without changing them
+        meta_stat = os.stat(meta_path)
+        return (meta_stat.st_size, meta_stat.st_mtime,
+                BaseHashIndex.get_checksum(meta_path))
+
+    @staticmethod
+    def get_checksum(meta_path):
+        # CRC32 reads the meta file at disk speed, far below the cost of
+        # packing the hash dict
+        checksum = 0
+        with open(meta_path, "rb") as meta_fd:
+            while True:
+                data = meta_fd.read(BaseHashIndex.CHECKSUM_BLOCK_SIZE)
+                if not data:
+                    break
+                checksum = zlib.crc32(data, checksum)
+        return checksum & 0xffffffff
+
+    def load(self):
+        """Check that the meta file is unchanged and map it for get().
+        Return self to be used in place of the hash dict.
+        """
+        if not os.path.exists(self.meta_path):
+            msg = "Base hash index does not exist at %s" % self.meta_path
+            raise HandoffError(msg)
+        if BaseHashIndex.get_stat(self.meta_path) != self.meta_stat:
+            msg = "Base hash index at %s is changed" % self.meta_path
+            raise HandoffError(msg)
+        meta_size = self.meta_stat[0]
+        if meta_size % self.RECORD_SIZE != 0:
+            msg = "Invalid base hash index at %s" % self.meta_path
+            raise HandoffError(msg)
+        if meta_size == 0:
+            self.meta_mmap = ""
+            prefix_list = numpy.zeros(0, dtype=numpy.uint64)
+        else:
+            with open(self.meta_path, "rb") as meta_fd:
+                self.meta_mmap = mmap.mmap(meta_fd.fileno(), 0,
+                                           prot=mmap.PROT_READ)
+            prefix_list = numpy.frombuffer(
+                self.meta_mmap, dtype=self.PREFIX_DTYPE)["prefix"].astype(
+                    numpy.uint64)
+        # stable sort keeps the records of the same hash in file order
+        self.record_index_list = numpy.argsort(prefix_list, kind="mergesort")
+        self.prefix_list = prefix_list[self.record_index_list]
+        return self
+
+    def get(self, hash_value, default=None):
+        """Return start offset of the chunk of hash_value. The last record
+        of the hash wins as in DeltaDedup's hash dict.
+        """
+        prefix = numpy.uint64(struct.unpack("!Q", hash_value[:8])[0])
+        start = self.prefix_list.searchsorted(prefix, "left")
+        end = self.prefix_list.searchsorted(prefix, "right")
+        for index in xrange(end-1, start-1, -1):
+            record_start = int(self.record_index_list[index])*self.RECORD_SIZE
+            record_hash = self.meta_mmap[record_start+self.HASH_START:
+                                         record_start+self.RECORD_SIZE]
+            if record_hash == hash_value:
+                return struct.unpack_from("!q", self.meta_mmap,
+                                          record_start)[0]
+        return default
+
+    def __len__(self):
+        # number of records, including those of duplicated hashes
+        return len(self.prefix_list)
+
+    def to_dict(self):
+        return {
+            "index_type": self.index_type,
+            "meta_path": self.meta_path,
+            "meta_stat": list(self.meta_stat),
+        }
+
+    @staticmethod
+    def from_dict(dictionary):
+        return BaseHashIndex(dictionary['index_type'],
+                             dictionary['meta_path'],
+                             dictionary['meta_stat'])
+
+
 class HandoffDataSend(object):
 
     def __init__(self):
@@ -789,22 +960,41 @@ class HandoffDataSend(object):
     def to_file(self, filename):
         serialized_buf = dict()
         for key, value in self.__dict__.iteritems():
+            # hash dicts are loaded again from the base hash index
+            if key in ('basedisk_hashdict', 'basemem_hashdict'):
+                continue
             serialized_buf[key] = value
+        (base_disk, base_mem, base_diskmeta, base_memmeta) = \
+            self.base_vm_paths
+        serialized_buf['basedisk_hashindex'] = BaseHashIndex(
+            BaseHashIndex.INDEX_DISK, base_diskmeta).to_dict()
+        serialized_buf['basemem_hashindex'] = BaseHashIndex(
+            BaseHashIndex.INDEX_MEMORY, base_memmeta).to_dict()
         serialized_buf['options'] = self.options.to_dict()
+        if isinstance(self.dirty_disk_chunks, ChunkBitmap):
+            serialized_buf['dirty_disk_chunks'] = \
+                self.dirty_disk_chunks.to_bytes()
         with open(filename, "w") as fd:
             fd.write(msgpack.packb(serialized_buf))
 
     @staticmethod
-    def from_file(handoff_datafile):
+    def from_file(handoff_datafile, load_vm_data=True):
         with open(handoff_datafile, "r") as handoff_fd:
             handoff_data_dict = msgpack.unpackb(handoff_fd.read())
             option = Options.from_dict(handoff_data_dict['options'])
+            dirty_disk_chunks = handoff_data_dict['dirty_disk_chunks']
+            if isinstance(dirty_disk_chunks, str):
+                dirty_disk_chunks = ChunkBitmap.from_bytes(dirty_disk_chunks)
+            basedisk_hashindex = BaseHashIndex.from_dict(
+                handoff_data_dict['basedisk_hashindex'])
+            basemem_hashindex = BaseHashIndex.from_dict(
+                handoff_data_dict['basemem_hashindex'])
             handoff_data = HandoffDataSend()
             handoff_data.save_data(
                 handoff_data_dict['base_vm_paths'],
                 handoff_data_dict['basevm_sha256_hash'],
-                handoff_data_dict['basedisk_hashdict'],
-                handoff_data_dict['basemem_hashdict'],
+                basedisk_hashindex.load(),
+                basemem_hashindex.load(),
                 option,
                 handoff_data_dict['handoff_addr'],
                 handoff_data_dict['overlay_mode'],
@@ -812,10 +1002,11 @@ class HandoffDataSend(object):
                 handoff_data_dict['qemu_logpath'],
                 handoff_data_dict['qmp_channel_path'],
                 handoff_data_dict['vm_id'],
-                handoff_data_dict['dirty_disk_chunks'],
+                dirty_disk_chunks,
                 handoff_data_dict['libvirt_conn_addr']
             )
-            handoff_data._load_vm_data()
+            if load_vm_data:
+                handoff_data._load_vm_data()
             return handoff_data
         return None
 
@@ -883,6 +1074,19 @@ class MockLibvirtUtil(object):
         pass
 
 
+def _get_migration_dest(migration_url):
+    url_value = migration_url.netloc.split(":")
+    if len(url_value) == 1:
+        migration_dest_ip = url_value[0]
+        migration_dest_port = VMOverlayCreationMode.HANDOFF_DEST_PORT_DEFAULT
+    elif len(url_value) == 2:
+        migration_dest_ip = url_value[0]
+        migration_dest_port = url_value[1]
+    else:
+        raise HandoffError("Invalid handoff address: %s" % migration_url.netloc)
+    return migration_dest_ip, migration_dest_port
+
+
 def perform_handoff(handoff_data):
     '''Perform VM handoff
     @param handoff_data: object of HandoffDataSend
@@ -940,10 +1144,12 @@ def perform_handoff(handoff_data):
 
     memory_snapshot_queue = multiprocessing.Queue(
         overlay_mode.QUEUE_SIZE_MEMORY_SNAPSHOT)
-    residue_deltalist_queue = multiprocessing.Queue(
-        maxsize=overlay_mode.QUEUE_SIZE_OPTIMIZATION)
-    compdata_queue = multiprocessing.Queue(
-        maxsize=overlay_mode.QUEUE_SIZE_COMPRESSION)
+    residue_deltalist_queue = byte_queue.get_stage_queue(
+        overlay_mode.QUEUE_SIZE_OPTIMIZATION,
+        overlay_mode.QUEUE_BYTES_OPTIMIZATION)
+    compdata_queue = byte_queue.get_stage_queue(
+        overlay_mode.QUEUE_SIZE_COMPRESSION,
+        overlay_mode.QUEUE_BYTES_COMPRESSION)
     vm_monitor = VMMonitor(handoff_data, base_disk, base_mem)
     monitoring_info = vm_monitor.get_monitoring_info()
     time_ss = time.time()
@@ -972,6 +1178,21 @@ def perform_handoff(handoff_data):
         qmp_thread.start()
         _waiting_to_finish(process_controller, "MemoryReadProcess")
 
+    # get chunks that the destination already has
+    migration_url = urlsplit(handoff_data.handoff_addr)
+    remote_chunk_filter = None
+    remote_chunk_dict = None
+    if migration_url.scheme == "tcp" and \
+            overlay_mode.OPTIMIZATION_DEDUP_REMOTE_CHUNK:
+        from .stream_client import request_chunk_filter
+        migration_dest_ip, migration_dest_port = \
+            _get_migration_dest(migration_url)
+        remote_chunk_filter = request_chunk_filter(migration_dest_ip,
+                                                   migration_dest_port)
+        if remote_chunk_filter is not None:
+            remote_chunk_manager = multiprocessing.Manager()
+            remote_chunk_dict = remote_chunk_manager.dict()
+
     # process for getting VM overlay
     dedup_proc = create_delta_proc(monitoring_info, handoff_data.options,
                                    overlay_mode,
@@ -982,7 +1203,9 @@ def perform_handoff(handoff_data):
                                    handoff_data._resumed_disk,
                                    memory_snapshot_queue,
                                    residue_deltalist_queue,
-                                   process_controller)
+                                   process_controller,
+                                   remote_chunk_filter=remote_chunk_filter,
+                                   remote_chunk_dict=remote_chunk_dict)
     time_dedup = time.time()
     if overlay_mode.PROCESS_PIPELINED == False:
         _waiting_to_finish(process_controller, "DeltaDedup")
@@ -997,16 +1220,10 @@ def perform_handoff(handoff_data):
     if overlay_mode.PROCESS_PIPELINED == False:
         _waiting_to_finish(process_controller, "CompressProc")
 
-    migration_url = urlsplit(handoff_data.handoff_addr)
     if migration_url.scheme == "tcp":
         from .stream_client import StreamSynthesisClient
-        url_value = migration_url.netloc.split(":")
-        if len(url_value) == 1:
-            migration_dest_ip = url_value[0]
-            migration_dest_port = VMOverlayCreationMode.HANDOFF_DEST_PORT_DEFAULT
-        elif len(url_value) == 2:
-            migration_dest_ip = url_value[0]
-            migration_dest_port = url_value[1]
+        migration_dest_ip, migration_dest_port = \
+            _get_migration_dest(migration_url)
         resume_disk_size = os.path.getsize(handoff_data._resumed_disk)
 
         # wait until getting the memory snapshot size
@@ -1014,6 +1231,9 @@ def perform_handoff(handoff_data):
         LOG.debug("waiting to get memory size")
         while resume_memory_size < 0:
             resume_memory_size = memory_read_proc.get_memory_snapshot_size()
+        # memory snapshot is the bulk of the input. ProcessManager weighs
+        # the gain of a mode change over the input that remains
+        process_controller.set_total_input_size(resume_memory_size)
         time_memory_snapshot_size = time.time()
         LOG.debug(
             "[time] Getting memory snapshot size (%f~%f):%f" %
@@ -1027,7 +1247,8 @@ def perform_handoff(handoff_data):
         metadata[Const.META_RESUME_VM_MEMORY_SIZE] = resume_memory_size
         time_network_start = time.time()
         client = StreamSynthesisClient(migration_dest_ip, migration_dest_port,
-                                       metadata, compdata_queue)
+                                       metadata, compdata_queue,
+                                       remote_chunk_dict=remote_chunk_dict)
         client.start()
         client.join()
         cpu_stat_end = psutil.cpu_times(percpu=True)
@@ -1104,6 +1325,9 @@ def perform_handoff(handoff_data):
         while resume_memory_size < 0:
             resume_memory_size = memory_read_proc.get_memory_snapshot_size()
             time.sleep(0.001)
+        # memory snapshot is the bulk of the input. ProcessManager weighs
+        # the gain of a mode change over the input that remains
+        process_controller.set_total_input_size(resume_memory_size)
         time_memory_snapshot_size = time.time()
         LOG.debug(
             "[time] Getting memory snapshot size (%f~%f):%f" %
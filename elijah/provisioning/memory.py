@@ -23,7 +23,6 @@ import sys
 import select
 import struct
 import mmap
-import subprocess
 import time
 import multiprocessing
 import traceback
@@ -33,12 +32,17 @@ from hashlib import sha256
 
 from . import tool
 from . import memory_util
+from . import free_page
 from .configuration import Const
 from .configuration import VMOverlayCreationMode
 from .progressbar import AnimatedProgressBar
 from .delta import DeltaItem
 from .delta import DeltaList
 from .delta import Recovered_delta
+from . import diff_codec
+from .diff_codec import DiffCodecSelector
+from . import similarity_index
+from .similarity_index import SimilarityIndex
 from . import process_manager
 from . import log as logging
 
@@ -77,6 +81,9 @@ class Memory(object):
     CHUNK_POS_MASK = (1 << ITER_SEQ_SHIFT) - 1
     ITER_SEQ_MASK = ((1 << (CHUNK_HEADER_SIZE * 8)) - 1) - CHUNK_POS_MASK
 
+    # number of pages hashed by a worker at once in parallel hashing
+    HASH_RANGE_PAGES = 16384
+
     def __init__(self):
         self.hash_list = []
         self.raw_file = ''
@@ -106,11 +113,13 @@ class Memory(object):
         """
         kwargs
          diff: compare hash_list with self object
-         free_pfn_dict: free memory physical frame number as a dictionary {'#':1, ... }
+         free_pfn_dict: free memory physical frame number (supports 'pfn in free_pfn_dict')
+         sketch_writer: SketchWriter fed with every page without diff
         """
         diff = kwargs.get("diff", None)
         apply_free_memory = kwargs.get("apply_free_memory", True)
         free_pfn_dict = kwargs.get("free_pfn_dict", None)
+        sketch_writer = kwargs.get("sketch_writer", None)
         LOG.info("Get hash list of memory page")
         prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
 
@@ -122,6 +131,8 @@ class Memory(object):
             data = fin.read(Memory.RAM_PAGE_SIZE)
             if not diff:
                 hash_list.append((ram_offset, len(data), sha256(data).digest()))
+                if sketch_writer is not None:
+                    sketch_writer.update(data)
             else:
                 # compare input with hash or corresponding base memory, save
                 # only when it is different
@@ -134,7 +145,7 @@ class Memory(object):
                 if self_hash_value != sha256(data).digest():
                     is_free_memory = False
                     if (free_pfn_dict is not None) and \
-                            (free_pfn_dict.get(long(ram_offset/Memory.RAM_PAGE_SIZE), None) == 1):
+                            (long(ram_offset/Memory.RAM_PAGE_SIZE) in free_pfn_dict):
                         is_free_memory = True
 
                     if is_free_memory and apply_free_memory:
@@ -186,6 +197,44 @@ class Memory(object):
         prog_bar.finish()
         return freed_page_counter
 
+    @staticmethod
+    def _get_mem_hash_parallel(filepath, file_size, num_proc,
+                               sketch_writer=None):
+        """Hash every page of the file using a process pool. Returns the
+        same hash list as _get_mem_hash without diff
+        """
+        LOG.info("Get hash list of memory page using %d processes" % num_proc)
+        prog_bar = AnimatedProgressBar(end=100, width=80, stdout=sys.stdout)
+        range_size = Memory.RAM_PAGE_SIZE*Memory.HASH_RANGE_PAGES
+        range_list = [(filepath, start, min(start+range_size, file_size),
+                       sketch_writer is not None)
+                      for start in xrange(0, file_size, range_size)]
+        hash_list = list()
+        pool = multiprocessing.Pool(num_proc)
+        try:
+            # imap returns the results in offset order
+            result_iter = pool.imap(_hash_mem_range, range_list)
+            for (path, start, end, is_sketch), (digests, sketches) in \
+                    zip(range_list, result_iter):
+                if sketch_writer is not None:
+                    sketch_writer.write_sketches(sketches)
+                for index, ram_offset in \
+                        enumerate(xrange(start, end, Memory.RAM_PAGE_SIZE)):
+                    length = min(Memory.RAM_PAGE_SIZE, end-ram_offset)
+                    hash_list.append(
+                        (ram_offset, length, digests[index*32:(index+1)*32]))
+                prog_bar.set_percent(100.0*end/file_size)
+                prog_bar.show_progress()
+        except:
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+        prog_bar.finish()
+        return hash_list
+
     @staticmethod
     def _seek_to_end_of_ram(fin):
         # get ram total length
@@ -243,6 +292,8 @@ class Memory(object):
         """
         diff = kwargs.get("diff", None)
         apply_free_memory = kwargs.get("apply_free_memory", True)
+        num_proc = kwargs.get("num_proc", 1)
+        sketch_path = kwargs.get("sketch_path", None)
         if diff and len(self.hash_list) == 0:
             raise MemoryError("Cannot compare give file this self.hashlist")
 
@@ -272,10 +323,15 @@ class Memory(object):
                 if ram_end_offset == Memory.RAM_PAGE_SIZE:
                     LOG.debug("end offset: %ld" % (ram_end_offset))
                     raise MemoryError("ram header+data is not aligned with page size")
-                mem_size_mb = ram_info.get('pc.ram').get('length')/1024/1024
+                mem_size = ram_info.get('pc.ram').get('length')
                 mem_abs_offset = ram_info.get('pc.ram').get('offset')
-                self.free_pfn_dict = get_free_pfn_dict(filepath, mem_size_mb,
-                                                       mem_abs_offset)
+                profile_path = None
+                if isinstance(self.raw_file, file):
+                    profile_path = Const.get_free_profile_path(
+                        self.raw_file.name)
+                self.free_pfn_dict = get_free_pfn_dict(filepath, mem_size,
+                                                       mem_abs_offset,
+                                                       profile_path)
             else:
                 self.free_pfn_dict = None
 
@@ -286,9 +342,21 @@ class Memory(object):
                 apply_free_memory=apply_free_memory)
         else:
             # case for generating base memory hash list
-            fin.seek(0)
-            freed_counter = self._get_mem_hash(fin, file_size, hash_list,
-                                               diff=diff, free_pfn_dict=None)
+            sketch_writer = None
+            if sketch_path is not None:
+                sketch_writer = similarity_index.SketchWriter(sketch_path,
+                                                              file_size)
+            if num_proc > 1 and file_size > 0:
+                hash_list = Memory._get_mem_hash_parallel(
+                    filepath, file_size, num_proc, sketch_writer=sketch_writer)
+                freed_counter = 0
+            else:
+                fin.seek(0)
+                freed_counter = self._get_mem_hash(
+                    fin, file_size, hash_list, diff=diff, free_pfn_dict=None,
+                    sketch_writer=sketch_writer)
+            if sketch_writer is not None:
+                sketch_writer.close()
 
         # get hash of memory area
         self.freed_counter = freed_counter
@@ -375,11 +443,36 @@ def base_hashlist(base_memmeta_path):
     return hashlist
 
 
-def hashing(filepath):
+def _hash_mem_range(args):
+    # process pool worker of Memory._get_mem_hash_parallel
+    # returns concatenated sha256 digests of the pages in [start, end) and
+    # sketches of the pages if requested
+    (filepath, start_offset, end_offset, is_sketch) = args
+    digest_list = list()
+    sketches = None
+    with open(filepath, "rb") as fd:
+        raw_mmap = mmap.mmap(fd.fileno(), 0, prot=mmap.PROT_READ)
+        for ram_offset in xrange(start_offset, end_offset,
+                                 Memory.RAM_PAGE_SIZE):
+            page_end = min(ram_offset+Memory.RAM_PAGE_SIZE, end_offset)
+            digest_list.append(sha256(raw_mmap[ram_offset:page_end]).digest())
+        if is_sketch:
+            sketches = similarity_index.compute_range_sketches(
+                raw_mmap, start_offset, end_offset, Memory.RAM_PAGE_SIZE)
+        raw_mmap.close()
+    return ''.join(digest_list), sketches
+
+
+def hashing(filepath, num_proc=None, sketch_path=None):
     # Contstuct KVM Base Memory DS from KVM migrated memory
     # filepath  : input KVM Memory Snapshot file path
+    # num_proc  : number of hashing processes (default: number of CPUs)
+    # sketch_path : also save sketches of every page while hashing
+    if num_proc is None:
+        num_proc = multiprocessing.cpu_count()
     memory = Memory()
-    hash_list = memory._load_file(filepath)
+    hash_list = memory._load_file(filepath, num_proc=num_proc,
+                                  sketch_path=sketch_path)
     memory.hash_list = hash_list
     return memory
 
@@ -457,6 +550,11 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
         self.overlay_mode = overlay_mode
         self.num_proc = VMOverlayCreationMode.MAX_THREAD_NUM
         self.diff_algorithm = overlay_mode.MEMORY_DIFF_ALGORITHM
+        # loaded once and shared with the diff children
+        self.similarity_index = None
+        if overlay_mode.OPTIMIZATION_SIMILAR_BASE_CHUNK:
+            self.similarity_index = SimilarityIndex.load(
+                Const.get_base_sketchpath(basemem_path)[1])
 
         self.monitor_current_iteration = multiprocessing.RawValue(
             ctypes.c_ulong, 0)
@@ -503,10 +601,31 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
             self.deltalist_queue.put(Const.QUEUE_FAILED_MESSAGE)
 
     def change_mode(self, new_mode):
+        # new children start with the latest mode
+        if new_mode.get("diff_algorithm", None) is not None:
+            self.diff_algorithm = new_mode.get("diff_algorithm")
         for (proc, c_queue, m_queue) in self.proc_list:
             if proc.is_alive():
                 m_queue.put(("new_mode", new_mode))
 
+    def _create_child(self):
+        command_queue = multiprocessing.Queue()
+        mode_queue = multiprocessing.Queue()
+        diff_proc = MemoryDiffProc(
+            command_queue,
+            self.task_queue,
+            mode_queue,
+            self.deltalist_queue,
+            self.diff_algorithm,
+            self.basemem_path,
+            len(self.memory_hashlist),
+            self.memory_hashlist,
+            self.libvirt_header_offset,
+            self.free_pfn_dict,
+            self.apply_free_memory,
+            similarity_index=self.similarity_index)
+        return (diff_proc, command_queue, mode_queue)
+
     def _process_libvirt_header(self, libvirt_header_list):
         base_memory_fd = open(self.basemem_path)
         delta_list = list()
@@ -521,28 +640,30 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
             base_hashvalue = sha256(base_data).digest()
             if chunk_hashvalue == base_hashvalue:
                 continue
+            # use xdelta3 for the few header pages in adaptive mode
+            diff_algorithm = self.diff_algorithm
+            if diff_algorithm == "adaptive":
+                diff_algorithm = "xdelta3"
             try:
-                if self.diff_algorithm == "xdelta3":
+                if diff_algorithm == "xdelta3":
                     diff_data = tool.diff_data(base_data, data,
                                                2 * len(base_data))
                     diff_type = DeltaItem.REF_XDELTA
                     if len(diff_data) > len(data):
                         raise IOError("xdelta3 patch is bigger than origianl")
-                elif self.diff_algorithm == "bsdiff":
+                elif diff_algorithm == "bsdiff":
                     diff_data = tool.diff_data_bsdiff(base_data, data)
                     diff_type = DeltaItem.REF_BSDIFF
                     if len(diff_data) > len(data):
                         raise IOError("bsdiff patch is bigger than origianl")
-                elif self.diff_algorithm == "xor":
-                    diff_data = tool.cython_xor(base_data, data)
+                elif diff_algorithm == "xor":
+                    diff_data = tool.xor_data(base_data, data)
                     diff_type = DeltaItem.REF_XOR
-                    if len(diff_data) > len(data):
-                        raise IOError("xor patch is bigger than origianl")
-                elif self.diff_algorithm == "none":
+                elif diff_algorithm == "none":
                     diff_data = data
                     diff_type = DeltaItem.REF_RAW
                 else:
-                    msg = "%s algorithm is not supported" % self.diff_algorithm
+                    msg = "%s algorithm is not supported" % diff_algorithm
                     raise MemoryError(msg)
             except IOError as e:
                 diff_data = data
@@ -623,7 +744,8 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
         for index in range(0, len(libvirt_header_data), Memory.RAM_PAGE_SIZE):
             chunked_data = libvirt_header_data[ index:index + Memory.RAM_PAGE_SIZE]
             libvirt_header_list.append(chunked_data)
-        libvirt_header_offset = len(libvirt_header_list)*Memory.RAM_PAGE_SIZE
+        self.libvirt_header_offset = \
+            len(libvirt_header_list)*Memory.RAM_PAGE_SIZE
         header_in_size, header_out_size = self._process_libvirt_header(
             libvirt_header_list)
         self.in_size += header_in_size
@@ -635,24 +757,10 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
         memory_data_queue = fin.data_queue
 
         # launch child processes
-        base_hashlist_length = len(self.memory_hashlist)
         self.task_queue = multiprocessing.Queue(
             maxsize=VMOverlayCreationMode.MAX_THREAD_NUM)
         for i in range(self.num_proc):
-            command_queue = multiprocessing.Queue()
-            mode_queue = multiprocessing.Queue()
-            diff_proc = MemoryDiffProc(
-                command_queue,
-                self.task_queue,
-                mode_queue,
-                self.deltalist_queue,
-                self.diff_algorithm,
-                self.basemem_path,
-                base_hashlist_length,
-                self.memory_hashlist,
-                libvirt_header_offset,
-                self.free_pfn_dict,
-                self.apply_free_memory)
+            (diff_proc, command_queue, mode_queue) = self._create_child()
             diff_proc.start()
             self.proc_list.append((diff_proc, command_queue, mode_queue))
 
@@ -764,10 +872,8 @@ class CreateMemoryDeltalist(process_manager.ProcWorker):
         self.finish_processing_input.value = True
 
         # send end meesage to every process
-        for child_proc in self.proc_list:
-            LOG.debug("[Memory] send end message to each child")
-            # select.select([], [self.task_queue._writer.fileno()], [])
-            self.task_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        LOG.debug("[Memory] send end message to each child")
+        self.send_end_messages(self.task_queue)
 
         # after this for loop, all processing finished, but child process still
         # alive until all data pass to the next step
@@ -889,57 +995,35 @@ def recover_memory(base_disk,
     return ','.join(chunk_list)
 
 
-def get_free_pfn_dict(snapshot_path, mem_size, mem_offset):
-    if mem_size == 1024:
-        pglist_addr = 'c1840a80'
-        pgn0_addr = 'f73fd000'
-    elif mem_size == 2048:
-        pglist_addr = 'c1840a80'
-        pgn0_addr = 'f553c000'
-    else:
-        LOG.error("Error, memory size %ld KB is not valid" % (mem_size))
-        return None
-
-    free_pfn_list = _get_free_pfn_list(snapshot_path, pglist_addr, pgn0_addr,
-                                       mem_size, mem_offset)
-    if free_pfn_list:
-        # free_pfn_list starts from the pc.ram so add offset of of pc.ram
-        offset = (mem_offset)/Memory.RAM_PAGE_SIZE
-        free_pfn_aligned = dict(
-            [(long(page)+offset, True) for page in free_pfn_list])
-        return free_pfn_aligned
-    else:
+def get_free_pfn_dict(snapshot_path, mem_size, mem_offset, profile_path):
+    """get free memory page number of the snapshot
+    :param mem_size: size of pc.ram in bytes
+    :param mem_offset: file offset of pc.ram
+    :param profile_path: path to FreePageProfile of the guest kernel
+    """
+    try:
+        return free_page.get_free_page_bitmap(snapshot_path, mem_size,
+                                              mem_offset, profile_path)
+    except free_page.FreePageError as e:
+        LOG.warning("Error in getting free memory : %s" % str(e))
         return None
 
 
-def _get_free_pfn_list(snapshot_path,
-                       pglist_addr,
-                       pgn0_addr,
-                       mem_size_gb,
-                       mem_offset):
-    """get list of free memory page number
+def validate_free_profile(base_mempath, kpageflags_path):
+    """validate free memory profile of the base memory snapshot
+    :param kpageflags_path: /proc/kpageflags dumped inside the guest right
+    before the base VM snapshot
     """
-    BIN_PATH = Const.FREE_MEMORY_BIN_PATH
-    cmd = ["%s" % BIN_PATH,
-           "%s" % snapshot_path,
-           "%s" % pglist_addr,
-           "%s" % pgn0_addr,
-           "%d" % mem_size_gb,
-           "%d" % mem_offset,]
-    _PIPE = subprocess.PIPE
-    LOG.info("Start getting free memory pages")
-    proc = subprocess.Popen(cmd, close_fds=True,
-                            stdin=_PIPE, stdout=_PIPE, stderr=_PIPE)
-    out, err = proc.communicate()
-    if err:
-        LOG.warning("Error in getting free memory : %s" % str(err))
-        return list()
-    free_pfn_list = out.split("\n")
-    if len(free_pfn_list[-1].strip()) == 0:
-        free_pfn_list = free_pfn_list[:-1]
-    LOG.info("Free memory pages : %ld" % len(free_pfn_list))
-    LOG.info("Finish getting free memory pages")
-    return free_pfn_list
+    with open(base_mempath, "rb") as fin:
+        libvirt_mem_hdr = memory_util._QemuMemoryHeader(fin)
+        libvirt_mem_hdr.seek_body(fin)
+        ram_end_offset, ram_info = Memory._seek_to_end_of_ram(fin)
+    mem_size = ram_info.get('pc.ram').get('length')
+    mem_abs_offset = ram_info.get('pc.ram').get('offset')
+    profile_path = Const.get_free_profile_path(base_mempath)
+    free_page.validate_profile_file(base_mempath, mem_size, mem_abs_offset,
+                                    profile_path, kpageflags_path)
+    return profile_path
 
 
 class SeekablePipe(object):
@@ -986,7 +1070,7 @@ class MemoryDiffProc(multiprocessing.Process):
     def __init__(self, command_queue, task_queue, mode_queue, deltalist_queue,
                  diff_algorithm, basemem_path, base_hashlist_length,
                  memory_hashlist, libvirt_header_offset,
-                 free_pfn_dict, apply_free_memory):
+                 free_pfn_dict, apply_free_memory, similarity_index=None):
         self.command_queue = command_queue
         self.task_queue = task_queue
         self.mode_queue = mode_queue
@@ -998,6 +1082,7 @@ class MemoryDiffProc(multiprocessing.Process):
         self.libvirt_header_offset = libvirt_header_offset
         self.free_pfn_dict = free_pfn_dict
         self.apply_free_memory = apply_free_memory
+        self.similarity_index = similarity_index
 
         # shared variables between processes
         self.child_process_time_total = multiprocessing.RawValue(
@@ -1016,6 +1101,8 @@ class MemoryDiffProc(multiprocessing.Process):
         self.raw_mmap = mmap.mmap(
             self.raw_file.fileno(), 0, prot=mmap.PROT_READ)
         self.raw_filesize = os.path.getsize(self.basemem_path)
+        self.diff_selector = None
+        self.is_diff_selector_loaded = False
 
         time_process_total_time = float(0)
         child_total_block = 0
@@ -1043,6 +1130,10 @@ class MemoryDiffProc(multiprocessing.Process):
                     new_num_cores = value
                     if new_num_cores is not None:
                         VMOverlayCreationMode.set_num_cores(new_num_cores)
+                elif command == "retire":
+                    # remaining tasks go to the other children
+                    is_proc_running = False
+                    break
             if self.task_queue._reader.fileno() in inready:
                 memory_chunk_list = self.task_queue.get()
                 if memory_chunk_list == Const.QUEUE_SUCCESS_MESSAGE:
@@ -1053,6 +1144,8 @@ class MemoryDiffProc(multiprocessing.Process):
 
                 time_process_start = time.clock()
                 deltaitem_list = list()
+                xor_source_list = list()
+                xor_item_list = list()
                 child_cur_block_count = 0
                 indata_size_cur = 0
                 outdata_size_cur = 0
@@ -1088,6 +1181,7 @@ class MemoryDiffProc(multiprocessing.Process):
                         delta_type = DeltaItem.DELTA_MEMORY_LIVE
 
                     if is_modified:
+                        diff_algorithm = None
                         try:
                             # get diff compared to the base VM
                             source_data = self.get_raw_data(
@@ -1098,35 +1192,24 @@ class MemoryDiffProc(multiprocessing.Process):
                                     ram_offset, ram_offset+chunk_data_len, self.raw_filesize)
                                 # LOG.debug(msg)
                                 raise IOError(msg)
-                            if self.diff_algorithm == "xdelta3":
-                                diff_data = tool.diff_data(
-                                    source_data, data, 2 * len(source_data))
-                                diff_type = DeltaItem.REF_XDELTA
-                                if len(diff_data) > chunk_data_len:
-                                    msg = "xdelta3 patch is bigger than origianl"
-                                    raise IOError(msg)
-                            elif self.diff_algorithm == "bsdiff":
-                                diff_data = tool.diff_data_bsdiff(
-                                    source_data, data)
-                                diff_type = DeltaItem.REF_BSDIFF
-                                if len(diff_data) > chunk_data_len:
-                                    msg = "bsdiff patch is bigger than origianl"
-                                    raise IOError(msg)
-                            elif self.diff_algorithm == "xor":
-                                diff_data = tool.cython_xor(source_data, data)
-                                diff_type = DeltaItem.REF_XOR
-                                if len(diff_data) > len(data):
-                                    msg = "xor patch is bigger than origianl"
-                                    raise IOError(msg)
-                            elif self.diff_algorithm == "none":
-                                diff_data = data
-                                diff_type = DeltaItem.REF_RAW
-                            else:
-                                diff_data = data
-                                diff_type = DeltaItem.REF_RAW
+                            diff_algorithm = self.get_diff_algorithm(
+                                source_data, data)
+                            diff_data, diff_type = diff_codec.diff_chunk(
+                                diff_algorithm, source_data, data,
+                                batch_xor=True)
                         except IOError as e:
                             diff_data = data
                             diff_type = DeltaItem.REF_RAW
+                        if self.similarity_index is not None and \
+                                diff_algorithm in SimilarityIndex.DIFF_ALGORITHMS and \
+                                len(diff_data) > chunk_data_len*SimilarityIndex.POOR_DIFF_RATIO:
+                            # poor diff at the same offset
+                            similar_data = self.similarity_index.diff_similar_chunk(
+                                self.raw_mmap, ram_offset, data, diff_algorithm)
+                            if similar_data is not None and \
+                                    len(similar_data) < len(diff_data):
+                                diff_data = similar_data
+                                diff_type = DeltaItem.REF_BASE_SIMILAR
 
                         diff_data_len = len(diff_data)
                         indata_size_cur += (chunk_data_len+11)
@@ -1140,6 +1223,14 @@ class MemoryDiffProc(multiprocessing.Process):
                                                data=diff_data,
                                                live_seq=iter_seq)
                         deltaitem_list.append(delta_item)
+                        if diff_type == DeltaItem.REF_XOR:
+                            xor_source_list.append(source_data)
+                            xor_item_list.append(delta_item)
+                if len(xor_item_list) > 0:
+                    xor_data_list = tool.xor_batch(
+                        xor_source_list, [item.data for item in xor_item_list])
+                    for delta_item, xor_data in zip(xor_item_list, xor_data_list):
+                        delta_item.data = xor_data
                 time_process_end = time.clock()
 
                 time_process_cur_time = (time_process_end - time_process_start)
@@ -1161,6 +1252,12 @@ class MemoryDiffProc(multiprocessing.Process):
         LOG.debug(
             "[Memory][Child] Child finished. process %d jobs (%f)" %
             (child_total_block, time_process_total_time))
+        if self.diff_selector is not None:
+            LOG.debug("[Memory][Child] adaptive diff selection: %s" %
+                      self.diff_selector.selected_counter)
+        if self.similarity_index is not None:
+            LOG.debug("[Memory][Child] %d chunks diffed with similar base chunk" %
+                      self.similarity_index.similar_count)
         self.command_queue.put((indata_size, outdata_size,
                                 child_total_block, time_process_total_time))
         # self.task_queue.put(freed_page_counter)
@@ -1176,6 +1273,17 @@ class MemoryDiffProc(multiprocessing.Process):
         else:
             return None
 
+    def get_diff_algorithm(self, source_data, data):
+        if self.diff_algorithm != "adaptive":
+            return self.diff_algorithm
+        if self.is_diff_selector_loaded is False:
+            # cost model is loaded only when adaptive mode is used
+            self.diff_selector = DiffCodecSelector.load(Const.DIFF_COST_MODEL)
+            self.is_diff_selector_loaded = True
+        if self.diff_selector is None:
+            return "xdelta3"
+        return self.diff_selector.select(source_data, data)
+
 
 if __name__ == "__main__":
     EXT_META = "-meta"
@@ -2,8 +2,10 @@
 import sys
 import os
 import ast
+import tempfile
 import json
 import math
+import hashlib
 from collections import OrderedDict
 from .configuration import VMOverlayCreationMode
 from operator import itemgetter
@@ -142,14 +144,23 @@ class MigrationMode(object):
         exp.block_size_out = json.loads(fd.readline())
         exp.block_size_ratio = json.loads(fd.readline())
         exp.block_time = json.loads(fd.readline())
+        exp.update_total()
+        return exp
 
-        memory_in_size = (exp.block_size_in['CreateMemoryDeltalist'])
-        disk_in_size = (exp.block_size_in['CreateDiskDeltalist'])
-        alpha = float(memory_in_size)/(memory_in_size+disk_in_size)
-        exp.total_p = MigrationMode.get_total_P(exp.block_time, alpha)
-        exp.total_r = MigrationMode.get_total_R(exp.block_size_ratio, alpha)
+    @staticmethod
+    def from_creation_mode(creation_mode):
+        exp = MigrationMode()
+        for key in VMOverlayCreationMode.VARYING_PARAMETERS:
+            exp.mode[key] = getattr(creation_mode, key)
         return exp
 
+    def update_total(self):
+        memory_in_size = (self.block_size_in['CreateMemoryDeltalist'])
+        disk_in_size = (self.block_size_in['CreateDiskDeltalist'])
+        alpha = float(memory_in_size)/(memory_in_size+disk_in_size)
+        self.total_p = MigrationMode.get_total_P(self.block_time, alpha)
+        self.total_r = MigrationMode.get_total_R(self.block_size_ratio, alpha)
+
 
 class ModeProfileError(Exception):
     pass
@@ -159,12 +170,21 @@ class ModeProfile(object):
     MATCHING_BEST_EFFORT = 1
     MATCHING_ONE = 2
     MATCHING_MULTIPLE = 3
+    # step of the moving average for an observation of full confidence
+    LEARNING_RATE = 0.2
+    # number of samples for a full confidence observation
+    LEARNING_SAMPLE_COUNT = 50
+    LEARNED_PROFILE_SUFFIX = ".learned"
+    # first line of a learned profile, followed by the checksum of the
+    # profile it is learned from
+    LEARNED_PROFILE_HEADER = "# learned from sha256:"
 
     def __init__(self, overlay_mode_list):
         self.overlay_mode_list = overlay_mode_list
 
     def predict_new_mode(self, cur_mode, cur_p, cur_r,
-                         cur_block_size, network_bw):
+                         cur_block_size, network_bw,
+                         remaining_blocks=None, switch_cost=None):
         overlay_mode = ModeProfile.find_same_mode(
             self.overlay_mode_list,
             cur_mode)
@@ -175,7 +195,9 @@ class ModeProfile(object):
         item = self.find_matching_mode(overlay_mode,
                                        cur_mode,
                                        cur_p, cur_r, cur_block_size,
-                                       network_bw)
+                                       network_bw,
+                                       remaining_blocks=remaining_blocks,
+                                       switch_cost=switch_cost)
         return item
 
     @staticmethod
@@ -193,7 +215,12 @@ class ModeProfile(object):
         return None
 
     def find_matching_mode(self, profiled_mode_obj, cur_mode, cur_p,
-                           cur_r, cur_block_size, network_bw):
+                           cur_r, cur_block_size, network_bw,
+                           remaining_blocks=None, switch_cost=None):
+        """Return (mode, block_per_sec, misc) of the mode to switch to, or
+        None. With switch_cost (mode_switch.ModeSwitchCost), switch only
+        when the time saved over remaining_blocks exceeds the switch cost.
+        """
         # get scaling factor between current workload and profiled data
         profiled_mode_total_p = profiled_mode_obj.total_p
         profiled_mode_total_r = profiled_mode_obj.total_r
@@ -209,6 +236,15 @@ class ModeProfile(object):
         scaled_mode_list, current_block_per_sec = self.list_scaled_modes(
             cur_mode, scale_p, scale_r, network_bw)
 
+        if switch_cost is not None and remaining_blocks is not None:
+            if isinstance(cur_mode, MigrationMode):
+                cur_mode_dict = cur_mode.mode
+            else:
+                cur_mode_dict = cur_mode.__dict__
+            return switch_cost.select(cur_mode_dict, scaled_mode_list,
+                                      current_block_per_sec,
+                                      remaining_blocks, network_bw)
+
         sorted_mode_list = sorted(scaled_mode_list, key=itemgetter(1),
                                   reverse=True)
         selected_item = sorted_mode_list[0]
@@ -280,11 +316,95 @@ class ModeProfile(object):
             print "%d: %s\t(%s %s)/(%s %s) --> (%s, %s)" % (index, mode_diff_str[:],  pivot_p, pivot_r, other_p, other_r, ratio_p, ratio_r)
         return comp_list
 
+    def update_mode(self, observed_mode, block_time, block_size_ratio,
+                    block_size_in, confidence=1.0):
+        """Move per block P and R of the profiled mode toward an observation.
+
+        Each stage takes an exponentially weighted step of
+        LEARNING_RATE*confidence toward the observed value, so a noisy or
+        short observation moves the profile less. observed_mode is a
+        MigrationMode. A mode that is not in the profile is added as
+        observed, and block_size_in only gives its memory and disk share.
+        """
+        confidence = max(0.0, min(1.0, float(confidence)))
+        for stage_name in stage_names:
+            if block_time.get(stage_name, 0) <= 0 or \
+                    block_size_ratio.get(stage_name, 0) <= 0:
+                return None
+        if confidence == 0:
+            return None
+
+        profiled_mode = ModeProfile.find_same_mode(self.overlay_mode_list,
+                                                   observed_mode)
+        if profiled_mode is None:
+            profiled_mode = MigrationMode()
+            profiled_mode.workload = "learned"
+            profiled_mode.mode = dict(observed_mode.mode)
+            for stage_name in stage_names:
+                profiled_mode.block_time[stage_name] = block_time[stage_name]
+                profiled_mode.block_size_ratio[stage_name] = \
+                    block_size_ratio[stage_name]
+                profiled_mode.block_size_in[stage_name] = \
+                    block_size_in.get(stage_name, 0)
+            self.overlay_mode_list.append(profiled_mode)
+        else:
+            weight = self.LEARNING_RATE * confidence
+            for stage_name in stage_names:
+                for (profiled, observed) in \
+                        ((profiled_mode.block_time, block_time),
+                         (profiled_mode.block_size_ratio, block_size_ratio)):
+                    profiled[stage_name] += weight * \
+                        (observed[stage_name] - profiled[stage_name])
+        profiled_mode.update_total()
+        LOG.debug("mode-learning\t%s\t%0.2f\t%f\t%f" %
+                  (profiled_mode.get_mode_id(), confidence,
+                   profiled_mode.total_p, profiled_mode.total_r))
+        return profiled_mode
+
     @staticmethod
-    def load_from_file(profile_path):
+    def get_confidence(total_p_list):
+        """Confidence of an observation from its samples of total P. It
+        grows with the number of samples and falls with their variation.
+        """
+        sample_count = len(total_p_list)
+        if sample_count == 0:
+            return 0.0
+        mean_p = sum(total_p_list)/float(sample_count)
+        if mean_p <= 0:
+            return 0.0
+        variance = sum([(p-mean_p)**2 for p in total_p_list])/sample_count
+        coeff_var = math.sqrt(variance)/mean_p
+        count_factor = min(
+            1.0, float(sample_count)/ModeProfile.LEARNING_SAMPLE_COUNT)
+        return count_factor/(1.0+coeff_var)
+
+    @staticmethod
+    def get_learned_path(profile_path, learned_dir=None):
+        if learned_dir is None:
+            learned_dir = VMOverlayCreationMode.LEARNED_PROFILE_DIR
+        return os.path.join(
+            learned_dir,
+            os.path.basename(profile_path) + ModeProfile.LEARNED_PROFILE_SUFFIX)
+
+    @staticmethod
+    def get_checksum(profile_path):
+        with open(profile_path, "rb") as fd:
+            return hashlib.sha256(fd.read()).hexdigest()
+
+    @staticmethod
+    def load_from_file(profile_path, source_checksum=None):
+        """Load a profile. With source_checksum, profile_path is a learned
+        profile, and it returns None unless it is learned from the profile
+        of that checksum.
+        """
         exp_list = list()
         try:
             with open(profile_path, "r") as fd:
+                if source_checksum is not None:
+                    header = fd.readline().rstrip("\n")
+                    if header != ModeProfile.LEARNED_PROFILE_HEADER + \
+                            source_checksum:
+                        return None
                 while True:
                     exp = MigrationMode.from_file(fd)
                     exp_list.append(exp)
@@ -293,10 +413,26 @@ class ModeProfile(object):
         return ModeProfile(exp_list)
 
     @staticmethod
-    def save_to_file(profile_path, exp_list):
-        with open(profile_path, "w+") as fd:
-            for each_exp in exp_list:
-                MigrationMode.to_file(each_exp, fd)
+    def save_to_file(profile_path, exp_list, source_checksum=None):
+        # replace the profile at once so that a reader never sees a partial
+        # profile
+        profile_dir = os.path.dirname(os.path.abspath(profile_path))
+        fd, temp_path = tempfile.mkstemp(
+            dir=profile_dir, prefix=".%s-" % os.path.basename(profile_path))
+        try:
+            with os.fdopen(fd, "w") as profile_fd:
+                if source_checksum is not None:
+                    profile_fd.write(ModeProfile.LEARNED_PROFILE_HEADER +
+                                     source_checksum + "\n")
+                for each_exp in exp_list:
+                    MigrationMode.to_file(each_exp, profile_fd)
+                profile_fd.flush()
+                os.fsync(profile_fd.fileno())
+            os.rename(temp_path, profile_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
 
 def parse_each_experiement(lines):
@@ -436,7 +572,8 @@ def select_mediam_exp(exps):
         d = {"xdelta3": 3,
              "bsdiff": 4,
              "xor": 2,
-             "none": 1}
+             "none": 1,
+             "adaptive": 5}
         return (d[a.mode['DISK_DIFF_ALGORITHM']], -
                 a.mode['COMPRESSION_ALGORITHM_TYPE'], a.mode['COMPRESSION_ALGORITHM_SPEED'])
     selected_exp_list = list()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Decide whether changing the overlay creation mode pays off.
+
+A mode change is not free. The stages get new CPU sets and children,
+and every compressor flushes the blob in hand, which loses the context
+it built for the rest of the blob. ModeProfile.find_matching_mode uses
+ModeSwitchCost to switch only when the time saved over the remaining
+data exceeds that cost, and only to a mode faster by a margin
+(hysteresis), so that a bandwidth hovering around the break-even point
+does not make the mode oscillate.
+"""
+
+import os
+import sys
+import json
+import time
+import multiprocessing
+
+from .configuration import Const
+from .configuration import VMOverlayCreationMode
+from .migration_profile import MigrationMode
+from .migration_profile import ModeProfile
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class ModeSwitchError(Exception):
+    pass
+
+
+class ModeSwitchCost(object):
+    """Cost of a mode change in seconds
+
+    cost = switch_time + (largest lost_bytes of the changed parameters)
+    sent at the network bandwidth. Changing the compression type and level
+    together still flushes each compressor once.
+    """
+    KEY_HYSTERESIS = "hysteresis"
+    KEY_SWITCH_TIME = "switch_time"
+    KEY_PARAMETERS = "parameters"
+    KEY_LOST_BYTES = "lost_bytes"
+
+    def __init__(self, parameter_dict, switch_time, hysteresis):
+        for parameter in parameter_dict.keys():
+            if parameter not in VMOverlayCreationMode.VARYING_PARAMETERS:
+                msg = "%s is not a varying parameter" % parameter
+                raise ModeSwitchError(msg)
+        self.parameter_dict = parameter_dict
+        self.switch_time = float(switch_time)
+        self.hysteresis = float(hysteresis)
+
+    def get_cost(self, changed_dict, network_bw):
+        """Return seconds lost by changing the parameters in changed_dict
+        """
+        if len(changed_dict) == 0:
+            return 0.0
+        # a switch flushes the blob in hand once, however many parameters
+        # of the compressors it changes
+        lost_bytes = 0
+        for parameter in changed_dict.keys():
+            coefficient = self.parameter_dict.get(parameter, dict())
+            lost_bytes = max(lost_bytes,
+                             coefficient.get(self.KEY_LOST_BYTES, 0))
+        lost_time = 0.0
+        if network_bw > 0:
+            lost_time = 8.0*lost_bytes/(network_bw*1024*1024)
+        return self.switch_time + lost_time
+
+    @staticmethod
+    def get_gain(cur_block_per_sec, new_block_per_sec, remaining_blocks):
+        """Return seconds saved by processing remaining_blocks at the new
+        rate
+        """
+        if cur_block_per_sec <= 0 or new_block_per_sec <= 0:
+            return 0.0
+        return float(remaining_blocks)/cur_block_per_sec - \
+            float(remaining_blocks)/new_block_per_sec
+
+    def select(self, cur_mode_dict, scaled_mode_list, cur_block_per_sec,
+               remaining_blocks, network_bw):
+        """Return the item of scaled_mode_list with the largest gain net of
+        the switch cost, or None to stay at the current mode
+        :param scaled_mode_list: list of (mode_obj, block_per_sec, misc)
+        from ModeProfile.list_scaled_modes
+        """
+        selected_item = None
+        selected_net_gain = 0.0
+        for item in scaled_mode_list:
+            (mode_obj, block_per_sec, misc) = item
+            if block_per_sec <= cur_block_per_sec*(1+self.hysteresis):
+                continue
+            changed_dict = MigrationMode.mode_diff(cur_mode_dict,
+                                                   mode_obj.mode)
+            if len(changed_dict) == 0:
+                continue
+            gain = self.get_gain(cur_block_per_sec, block_per_sec,
+                                 remaining_blocks)
+            net_gain = gain - self.get_cost(changed_dict, network_bw)
+            if net_gain > selected_net_gain:
+                selected_item = item
+                selected_net_gain = net_gain
+        return selected_item
+
+    def to_dict(self):
+        return {
+            self.KEY_HYSTERESIS: self.hysteresis,
+            self.KEY_SWITCH_TIME: self.switch_time,
+            self.KEY_PARAMETERS: self.parameter_dict,
+        }
+
+    @staticmethod
+    def from_dict(dictionary):
+        return ModeSwitchCost(dictionary[ModeSwitchCost.KEY_PARAMETERS],
+                              dictionary[ModeSwitchCost.KEY_SWITCH_TIME],
+                              dictionary[ModeSwitchCost.KEY_HYSTERESIS])
+
+    @staticmethod
+    def from_file(model_path):
+        with open(model_path, "r") as fd:
+            return ModeSwitchCost.from_dict(json.loads(fd.read()))
+
+    def to_file(self, model_path):
+        with open(model_path, "w") as fd:
+            fd.write(json.dumps(self.to_dict(), indent=4, sort_keys=True))
+
+    @staticmethod
+    def load(model_path):
+        if model_path is None or os.path.exists(model_path) is False:
+            LOG.warning("No mode switch cost model at %s" % str(model_path))
+            return None
+        return ModeSwitchCost.from_file(model_path)
+
+
+def _compressed_size(comp_type, comp_level, data):
+    # compression imports process_manager, which imports this module
+    from .compression import get_compressor
+    comp = get_compressor(comp_type, comp_level)
+    return len(comp.compress(data)) + len(comp.flush())
+
+
+def _start_child(ready_queue):
+    ready_queue.put(os.getpid())
+
+
+def calibrate(blob_data, comp_mode_list, num_proc, repeat=5):
+    """Measure ModeSwitchCost
+
+    switch_time is the time to start num_proc children of a stage, as a
+    mode change reallocates CPUs and children. lost_bytes of compression
+    parameters is the size added by flushing a half-done blob in each of
+    num_proc compressors, averaged over comp_mode_list.
+    Diff algorithms work per chunk and lose nothing.
+    """
+    time_list = list()
+    for index in xrange(repeat):
+        ready_queue = multiprocessing.Queue()
+        time_start = time.time()
+        proc_list = [multiprocessing.Process(target=_start_child,
+                                             args=(ready_queue,))
+                     for proc_index in xrange(num_proc)]
+        for proc in proc_list:
+            proc.start()
+        for proc in proc_list:
+            ready_queue.get()
+        time_list.append(time.time() - time_start)
+        for proc in proc_list:
+            proc.join()
+    switch_time = sorted(time_list)[len(time_list)/2]
+
+    lost_list = list()
+    half = len(blob_data)/2
+    for (comp_type, comp_level) in comp_mode_list:
+        whole_size = _compressed_size(comp_type, comp_level, blob_data)
+        split_size = \
+            _compressed_size(comp_type, comp_level, blob_data[:half]) + \
+            _compressed_size(comp_type, comp_level, blob_data[half:])
+        lost_list.append(max(split_size - whole_size, 0))
+    lost_bytes = num_proc*sum(lost_list)/len(lost_list)
+
+    parameter_dict = {
+        'COMPRESSION_ALGORITHM_TYPE': {
+            ModeSwitchCost.KEY_LOST_BYTES: lost_bytes},
+        'COMPRESSION_ALGORITHM_SPEED': {
+            ModeSwitchCost.KEY_LOST_BYTES: lost_bytes},
+        'MEMORY_DIFF_ALGORITHM': {ModeSwitchCost.KEY_LOST_BYTES: 0},
+        'DISK_DIFF_ALGORITHM': {ModeSwitchCost.KEY_LOST_BYTES: 0},
+    }
+    return ModeSwitchCost(parameter_dict, switch_time, 0.1)
+
+
+def simulate(mode_profile, start_mode, trace, total_blocks, penalty,
+             switch_cost=None, predict_interval=5, time_step=0.1):
+    """Replay a bandwidth trace through the mode predictor
+
+    Each profiled mode runs at its profiled P and R, limited by the
+    bandwidth of the trace. The predictor runs every predict_interval
+    seconds as in ProcessManager, with switch_cost, and every switch
+    stalls the pipeline for the time penalty charges.
+    :param trace: network_emulator.NetworkTrace
+    :return (completion time, number of switches)
+    """
+    cur_mode = start_mode
+    processed_blocks = 0.0
+    switch_count = 0
+    time_cur = 0.0
+    time_stall_end = 0.0
+    time_prev_predict = 0.0
+    while processed_blocks < total_blocks:
+        network_bw = trace.get_bandwidth(time_cur)
+        if time_cur - time_prev_predict >= predict_interval:
+            time_prev_predict = time_cur
+            item = mode_profile.predict_new_mode(
+                cur_mode, cur_mode.block_time, cur_mode.block_size_ratio,
+                cur_mode.block_size_in, network_bw,
+                remaining_blocks=total_blocks-processed_blocks,
+                switch_cost=switch_cost)
+            if item is not None:
+                new_mode = item[0]
+                changed_dict = MigrationMode.mode_diff(cur_mode.mode,
+                                                       new_mode.mode)
+                time_stall_end = time_cur + \
+                    penalty.get_cost(changed_dict, network_bw)
+                cur_mode = new_mode
+                switch_count += 1
+        if time_cur >= time_stall_end:
+            scaled_mode_list, block_per_sec = mode_profile.list_scaled_modes(
+                cur_mode, 1.0, 1.0, network_bw)
+            processed_blocks += block_per_sec*time_step
+        time_cur += time_step
+    return time_cur, switch_count
+
+
+if __name__ == "__main__":
+    # calibrate: mode_switch.py calibrate output_path [num_proc]
+    # simulate: mode_switch.py simulate profile_path trace_path total_MB
+    #           [cost_model_path]
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: %s calibrate|simulate path ...\n" %
+                         sys.argv[0])
+        sys.exit(1)
+    command = sys.argv[1]
+    if command == "calibrate":
+        from .diff_codec import generate_synthetic_chunks
+        num_proc = int(sys.argv[3]) if len(sys.argv) > 3 else \
+            VMOverlayCreationMode.MAX_THREAD_NUM
+        # a blob of CompressProc
+        chunk_pairs = generate_synthetic_chunks(512, seed=1)
+        blob_data = ''.join([modi for (source, modi) in chunk_pairs])
+        comp_mode_list = [(comp_type, comp_level)
+                          for comp_type in (Const.COMPRESSION_LZMA,
+                                            Const.COMPRESSION_BZIP2,
+                                            Const.COMPRESSION_GZIP)
+                          for comp_level in (1, 5, 9)]
+        switch_cost = calibrate(blob_data, comp_mode_list, num_proc)
+        switch_cost.to_file(sys.argv[2])
+        print json.dumps(switch_cost.to_dict(), indent=4, sort_keys=True)
+    elif command == "simulate":
+        from .network_emulator import NetworkTrace
+        mode_profile = ModeProfile.load_from_file(sys.argv[2])
+        trace = NetworkTrace.load_from_file(sys.argv[3])
+        total_blocks = float(sys.argv[4])*1024*1024/Const.CHUNK_SIZE
+        cost_path = sys.argv[5] if len(sys.argv) > 5 else \
+            Const.MODE_SWITCH_COST_MODEL
+        penalty = ModeSwitchCost.from_file(cost_path)
+        start_mode = mode_profile.overlay_mode_list[0]
+        for (name, switch_cost) in (("always switch", None),
+                                    ("switch cost", penalty)):
+            completion_time, switch_count = simulate(
+                mode_profile, start_mode, trace, total_blocks, penalty,
+                switch_cost=switch_cost)
+            print "%s\t%f s\t%d switches" % (name, completion_time,
+                                              switch_count)
+    else:
+        sys.stderr.write("Invalid command\n")
+        sys.exit(1)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+import time
+import threading
+from bisect import bisect_right
+
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class NetworkEmulatorError(Exception):
+    pass
+
+
+class NetworkTrace(object):
+    """Piecewise-constant bandwidth/latency schedule.
+
+    Each entry is (start_time_sec, bandwidth_mbps, latency_ms) and is valid
+    until the start time of the next entry. The last entry lasts forever.
+    Bandwidth uses the same unit as VMOverlayCreationMode (1 Mbps ==
+    1024*1024 bits per second).
+    """
+
+    def __init__(self, entries):
+        if len(entries) == 0:
+            raise NetworkEmulatorError("Empty network trace")
+        entries = sorted(entries, key=lambda item: item[0])
+        if entries[0][0] != 0:
+            msg = "Network trace should start at time 0, not %s" % \
+                str(entries[0][0])
+            raise NetworkEmulatorError(msg)
+        for (start_time, bw_mbps, latency_ms) in entries:
+            if bw_mbps < 0 or latency_ms < 0:
+                msg = "Invalid trace entry: (%s, %s, %s)" % \
+                    (start_time, bw_mbps, latency_ms)
+                raise NetworkEmulatorError(msg)
+        self.entries = entries
+        self.start_times = [item[0] for item in entries]
+
+    @staticmethod
+    def constant(bandwidth_mbps, latency_ms=0):
+        return NetworkTrace([(0, float(bandwidth_mbps), float(latency_ms))])
+
+    @staticmethod
+    def load_from_file(trace_path):
+        """Load trace file.
+        Each line is "time_sec bandwidth_mbps [latency_ms]". Empty lines and
+        lines starting with '#' are ignored.
+        """
+        entries = list()
+        with open(trace_path, "r") as fd:
+            for line_num, line in enumerate(fd):
+                line = line.strip()
+                if len(line) == 0 or line.startswith("#"):
+                    continue
+                values = line.split()
+                if len(values) not in (2, 3):
+                    msg = "Invalid format at %s:%d : %s" % \
+                        (trace_path, line_num+1, line)
+                    raise NetworkEmulatorError(msg)
+                start_time = float(values[0])
+                bw_mbps = float(values[1])
+                latency_ms = float(values[2]) if len(values) == 3 else 0.0
+                entries.append((start_time, bw_mbps, latency_ms))
+        return NetworkTrace(entries)
+
+    def _index(self, elapsed_time):
+        return max(bisect_right(self.start_times, elapsed_time) - 1, 0)
+
+    def get_bandwidth(self, elapsed_time):
+        return self.entries[self._index(elapsed_time)][1]
+
+    def get_latency(self, elapsed_time):
+        return self.entries[self._index(elapsed_time)][2]
+
+    def next_change(self, elapsed_time):
+        """Return the time of the next schedule change, or None."""
+        index = self._index(elapsed_time) + 1
+        if index >= len(self.entries):
+            return None
+        return self.start_times[index]
+
+    def transferable_bytes(self, time_from, time_to):
+        """Bytes the trace allows to send between two elapsed times."""
+        total_bytes = 0.0
+        cur_time = time_from
+        while cur_time < time_to:
+            next_time = self.next_change(cur_time)
+            if next_time is None or next_time > time_to:
+                next_time = time_to
+            bytes_per_sec = self.get_bandwidth(cur_time)*1024*1024/8.0
+            total_bytes += bytes_per_sec*(next_time-cur_time)
+            cur_time = next_time
+        return total_bytes
+
+
+class TokenBucket(object):
+    """Token bucket shaper driven by a NetworkTrace.
+
+    Tokens (bytes) are refilled at the bandwidth of the trace and capped at
+    bucket_size. consume() is allowed to drive the bucket into debt and then
+    blocks until the debt is paid back, so the long-term sending rate follows
+    the trace regardless of the write size.
+    """
+
+    def __init__(self, bandwidth_mbps=None, trace=None, bucket_size=64*1024):
+        if trace is None:
+            if bandwidth_mbps is None:
+                raise NetworkEmulatorError("Need either bandwidth or trace")
+            trace = NetworkTrace.constant(bandwidth_mbps)
+        self.trace = trace
+        self.bucket_size = bucket_size
+        self.tokens = 0.0
+        self.time_start = None
+        self.time_last_refill = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.time_start is None:
+                self.time_start = time.time()
+                self.time_last_refill = self.time_start
+
+    def elapsed_time(self):
+        if self.time_start is None:
+            return 0.0
+        return time.time() - self.time_start
+
+    def current_bandwidth(self):
+        return self.trace.get_bandwidth(self.elapsed_time())
+
+    def current_latency(self):
+        return self.trace.get_latency(self.elapsed_time())
+
+    def is_idle(self):
+        """True if the bucket has been refilled, i.e. the link is idle."""
+        with self.lock:
+            self._refill()
+            return self.tokens >= self.bucket_size
+
+    def _refill(self):
+        cur_time = time.time()
+        self.tokens += self.trace.transferable_bytes(
+            self.time_last_refill - self.time_start,
+            cur_time - self.time_start)
+        self.tokens = min(self.tokens, self.bucket_size)
+        self.time_last_refill = cur_time
+
+    def consume(self, size):
+        self.start()
+        with self.lock:
+            self._refill()
+            self.tokens -= size
+            while self.tokens < 0:
+                elapsed_time = self.time_last_refill - self.time_start
+                bytes_per_sec = self.trace.get_bandwidth(elapsed_time)*1024*1024/8.0
+                next_change = self.trace.next_change(elapsed_time)
+                if bytes_per_sec > 0:
+                    wait_time = (-self.tokens)/bytes_per_sec
+                    if next_change is not None:
+                        wait_time = min(wait_time, next_change - elapsed_time)
+                elif next_change is not None:
+                    wait_time = next_change - elapsed_time
+                else:
+                    msg = "Network trace has zero bandwidth without recovery"
+                    raise NetworkEmulatorError(msg)
+                time.sleep(max(wait_time, 0.0))
+                self._refill()
+
+    def try_consume(self, size):
+        """Non-blocking consume. Return False without taking tokens if the
+        bucket cannot pay for size (or a full bucket for a larger size).
+        A bucket used only with try_consume starts full.
+        """
+        with self.lock:
+            if self.time_start is None:
+                self.time_start = time.time()
+                self.time_last_refill = self.time_start
+                self.tokens = float(self.bucket_size)
+            self._refill()
+            if self.tokens < min(size, self.bucket_size):
+                return False
+            self.tokens -= size
+            return True
+
+
+class _ShapedWriter(object):
+    """Common part of shaped file/socket wrappers.
+
+    Data is split into bucket sized pieces so that the writer never bursts
+    more than the bucket allows. Latency is charged once when transmission
+    resumes from an idle link, which emulates the propagation delay of a
+    stream without reducing its throughput.
+    """
+
+    def __init__(self, target, token_bucket):
+        self.target = target
+        self.token_bucket = token_bucket
+
+    def _shaped_write(self, data, write_func):
+        if self.token_bucket.time_start is None or self.token_bucket.is_idle():
+            self.token_bucket.start()
+            latency_ms = self.token_bucket.current_latency()
+            if latency_ms > 0:
+                time.sleep(latency_ms/1000.0)
+        piece_size = self.token_bucket.bucket_size
+        for offset in xrange(0, len(data), piece_size):
+            piece = data[offset:offset+piece_size]
+            self.token_bucket.consume(len(piece))
+            write_func(piece)
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+class ShapedFile(_ShapedWriter):
+
+    def write(self, data):
+        self._shaped_write(data, self.target.write)
+
+
+class ShapedSocket(_ShapedWriter):
+
+    def sendall(self, data):
+        self._shaped_write(data, self.target.sendall)
+
+    def send(self, data):
+        self._shaped_write(data, self.target.sendall)
+        return len(data)
+
+
+def get_token_bucket(bandwidth_mbps, trace_path=None):
+    """Return token bucket for given trace file or static bandwidth."""
+    if trace_path is not None:
+        trace = NetworkTrace.load_from_file(trace_path)
+        LOG.info("Emulate network using trace at %s" % trace_path)
+        return TokenBucket(trace=trace)
+    return TokenBucket(bandwidth_mbps=bandwidth_mbps)
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Serialization of the overlay meta file.
+
+Version 1 stores the disk and memory chunks of each blob as msgpack lists
+of integers. Version 2 stores each list as a byte string of
+(encoding, count) followed by either zigzag delta varints of the chunks or
+varint pairs of (delta to the run start, run length). The order of the
+chunks is preserved. unpack_meta() wraps the byte strings in ChunkList,
+which decodes them only when the chunks are used.
+"""
+
+import struct
+
+import msgpack
+import numpy
+
+from .chunk_bitmap import ChunkBitmap
+from .configuration import Const
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class OverlayMetaError(Exception):
+    pass
+
+
+META_VERSION_1 = 1
+META_VERSION_2 = 2
+CHUNK_KEYS = (Const.META_OVERLAY_FILE_DISK_CHUNKS,
+              Const.META_OVERLAY_FILE_MEMORY_CHUNKS)
+
+ENCODING_DELTA = 1
+ENCODING_RUN = 2
+ENCODING_HEADER = "<BQ"
+ENCODING_HEADER_SIZE = struct.calcsize(ENCODING_HEADER)
+MAX_VARINT_BYTES = 10
+
+
+def _encode_varints(values):
+    """Return LEB128 bytes of uint64 array"""
+    values = values.astype(numpy.uint64)
+    byte_counts = numpy.ones(len(values), dtype=numpy.int64)
+    for index in xrange(1, MAX_VARINT_BYTES):
+        byte_counts += (values >> numpy.uint64(7*index)) != 0
+    ends = numpy.cumsum(byte_counts)
+    starts = ends - byte_counts
+    total = int(ends[-1]) if len(values) > 0 else 0
+    output = numpy.zeros(total, dtype=numpy.uint8)
+    for index in xrange(int(byte_counts.max()) if len(values) > 0 else 0):
+        selected = byte_counts > index
+        value_bytes = (values[selected] >> numpy.uint64(7*index)) & \
+            numpy.uint64(0x7f)
+        has_more = (byte_counts[selected] > index+1).astype(numpy.uint64)
+        output[starts[selected]+index] = value_bytes | (has_more << 7)
+    return output.tostring()
+
+
+def _decode_varints(data):
+    """Return uint64 array of LEB128 bytes"""
+    byte_array = numpy.fromstring(data, dtype=numpy.uint8)
+    if len(byte_array) == 0:
+        return numpy.zeros(0, dtype=numpy.uint64)
+    is_last = byte_array < 0x80
+    if not is_last[-1]:
+        raise OverlayMetaError("Truncated varint")
+    starts = numpy.flatnonzero(numpy.concatenate(([True], is_last[:-1])))
+    value_index = numpy.cumsum(is_last) - is_last
+    positions = numpy.arange(len(byte_array)) - starts[value_index]
+    if positions.max() >= MAX_VARINT_BYTES:
+        raise OverlayMetaError("Invalid varint")
+    parts = (byte_array & 0x7f).astype(numpy.uint64) << \
+        (positions*7).astype(numpy.uint64)
+    return numpy.add.reduceat(parts, starts)
+
+
+def _zigzag(values):
+    values = values.astype(numpy.int64)
+    return ((values << 1) ^ (values >> 63)).view(numpy.uint64)
+
+
+def _unzigzag(values):
+    values = values.astype(numpy.uint64)
+    return (values >> numpy.uint64(1)).astype(numpy.int64) ^ \
+        -(values & numpy.uint64(1)).astype(numpy.int64)
+
+
+def encode_chunk_list(chunks):
+    """Return byte string of the chunk list with the smaller encoding
+    """
+    chunk_array = numpy.asarray(chunks, dtype=numpy.int64)
+    if len(chunk_array) == 0:
+        return struct.pack(ENCODING_HEADER, ENCODING_DELTA, 0)
+    if chunk_array.min() < 0:
+        raise OverlayMetaError("Negative chunk number")
+    deltas = numpy.diff(chunk_array)
+    delta_data = _encode_varints(
+        _zigzag(numpy.concatenate((chunk_array[:1], deltas))))
+
+    # runs of consecutive chunks
+    run_starts = numpy.flatnonzero(
+        numpy.concatenate(([True], deltas != 1)))
+    run_lengths = numpy.diff(numpy.append(run_starts, len(chunk_array)))
+    run_begins = chunk_array[run_starts]
+    run_ends = run_begins + run_lengths
+    pairs = numpy.empty(len(run_starts)*2, dtype=numpy.uint64)
+    pairs[0::2] = _zigzag(run_begins - numpy.concatenate(([0], run_ends[:-1])))
+    pairs[1::2] = run_lengths
+    run_data = _encode_varints(pairs)
+
+    if len(run_data) < len(delta_data):
+        encoding, payload = ENCODING_RUN, run_data
+    else:
+        encoding, payload = ENCODING_DELTA, delta_data
+    return struct.pack(ENCODING_HEADER, encoding, len(chunk_array)) + payload
+
+
+def decode_chunk_list(data):
+    """Return int64 array of chunks encoded by encode_chunk_list()
+    """
+    try:
+        (encoding, count) = struct.unpack(
+            ENCODING_HEADER, data[:ENCODING_HEADER_SIZE])
+    except struct.error as e:
+        raise OverlayMetaError("Invalid chunk list: %s" % str(e))
+    values = _decode_varints(data[ENCODING_HEADER_SIZE:])
+    if encoding == ENCODING_DELTA:
+        chunk_array = numpy.cumsum(_unzigzag(values))
+    elif encoding == ENCODING_RUN:
+        if len(values) % 2 != 0:
+            raise OverlayMetaError("Invalid run length chunk list")
+        run_lengths = values[1::2].astype(numpy.int64)
+        run_offsets = numpy.cumsum(run_lengths) - run_lengths
+        run_begins = numpy.cumsum(_unzigzag(values[0::2])) + run_offsets
+        chunk_array = numpy.repeat(run_begins - run_offsets, run_lengths) + \
+            numpy.arange(run_lengths.sum(), dtype=numpy.int64)
+    else:
+        raise OverlayMetaError("Invalid chunk list encoding %d" % encoding)
+    if len(chunk_array) != count:
+        raise OverlayMetaError("Chunk list has %d chunks instead of %d" %
+                               (len(chunk_array), count))
+    return chunk_array.astype(numpy.int64)
+
+
+class ChunkList(object):
+    """Chunk list of a blob in the v2 meta file, decoded on first use
+    """
+
+    def __init__(self, data):
+        try:
+            (self.encoding, self.count) = struct.unpack(
+                ENCODING_HEADER, data[:ENCODING_HEADER_SIZE])
+        except struct.error as e:
+            raise OverlayMetaError("Invalid chunk list: %s" % str(e))
+        self.data = data
+        self._chunk_array = None
+
+    def to_array(self):
+        if self._chunk_array is None:
+            self._chunk_array = decode_chunk_list(self.data)
+        return self._chunk_array
+
+    def to_bitmap(self):
+        return ChunkBitmap(self.to_array())
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.to_array().tolist())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.to_array()[index].tolist()
+        return int(self.to_array()[index])
+
+    def __eq__(self, other):
+        if isinstance(other, ChunkList):
+            other = other.to_array()
+        return self.to_array().tolist() == list(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+def get_chunk_array(chunks):
+    """Return int64 array of a chunk list in either version of meta file
+    """
+    if isinstance(chunks, ChunkList):
+        return chunks.to_array()
+    return numpy.array(chunks, dtype=numpy.int64)
+
+
+def get_chunk_bitmap(blob_list, key):
+    """Return ChunkBitmap of the chunks at key of every blob
+    """
+    chunk_array_list = [get_chunk_array(blob_info[key])
+                        for blob_info in blob_list]
+    if len(chunk_array_list) == 0:
+        return ChunkBitmap()
+    return ChunkBitmap(numpy.concatenate(chunk_array_list))
+
+
+def pack_meta(meta_dict, version=META_VERSION_2):
+    """Return msgpack serialized overlay meta. Chunk lists are encoded at
+    version 2.
+    """
+    meta_dict = dict(meta_dict)
+    blob_list = list()
+    for blob_info in meta_dict.get(Const.META_OVERLAY_FILES, list()):
+        blob_info = dict(blob_info)
+        for key in CHUNK_KEYS:
+            chunks = blob_info.get(key, None)
+            if chunks is None:
+                continue
+            if version == META_VERSION_1:
+                blob_info[key] = get_chunk_array(chunks).tolist()
+            elif isinstance(chunks, ChunkList):
+                blob_info[key] = chunks.data
+            else:
+                blob_info[key] = encode_chunk_list(chunks)
+        blob_list.append(blob_info)
+    if Const.META_OVERLAY_FILES in meta_dict:
+        meta_dict[Const.META_OVERLAY_FILES] = blob_list
+    if version == META_VERSION_1:
+        meta_dict.pop(Const.META_VERSION, None)
+    elif version == META_VERSION_2:
+        meta_dict[Const.META_VERSION] = version
+    else:
+        raise OverlayMetaError("Unsupported meta version %d" % version)
+    return msgpack.packb(meta_dict)
+
+
+def unpack_meta(meta_raw):
+    """Return overlay meta dict of either version. Chunk lists of version 2
+    are ChunkList.
+    """
+    meta_dict = msgpack.unpackb(meta_raw)
+    version = meta_dict.get(Const.META_VERSION, META_VERSION_1)
+    if version == META_VERSION_1:
+        return meta_dict
+    if version != META_VERSION_2:
+        raise OverlayMetaError("Unsupported meta version %d" % version)
+    for blob_info in meta_dict.get(Const.META_OVERLAY_FILES, list()):
+        for key in CHUNK_KEYS:
+            chunks = blob_info.get(key, None)
+            if chunks is not None:
+                blob_info[key] = ChunkList(chunks)
+    return meta_dict
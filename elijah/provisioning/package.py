@@ -352,14 +352,16 @@ class _FileFile(file):
     # pylint: enable=E1103
 
     def iter_content(self, offset, size, chunk_size):
-        self.seek(offset)
-        total_read = 0
-        try:
+        # use a separate handle so that blobs can be read concurrently
+        with open(self.name, "rb") as fd:
+            fd.seek(offset)
+            total_read = 0
             while total_read < size:
-                data = self.read(chunk_size)
+                data = fd.read(min(chunk_size, size-total_read))
+                if not data:
+                    break
+                total_read += len(data)
                 yield data
-        except:
-            raise StopIteration()
 
 
 class _PackageObject(object):
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Speculative fetching of overlay blobs during on-demand synthesis.
+
+Each demand miss reported by cloudletfs is fed to ChunkPrefetcher, which
+predicts the blobs the VM will touch next and puts them to a prefetch
+queue. Fetch steps serve the demanding queue first, then the prefetch
+queue, then the remaining blobs in meta order.
+
+Prediction uses blob transition counts learned from the chunk access traces
+saved with the overlay (access_trace.AccessTrace). Without a trace, or at a
+blob that the traces never left, a stride detector over the demanded chunks
+is used instead. Speculative bytes are limited by a token bucket.
+"""
+
+from .configuration import Const
+from .delta import DeltaItem
+from .access_trace import AccessTrace
+from .network_emulator import TokenBucket
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+def pop_priority_url(demanding_queue, prefetch_queue, is_requested):
+    """Return (url, is_demand) of the blob to fetch before the blobs in meta
+    order, or (None, False) if there is nothing urgent.
+    Both queues can have the same url multiple times.
+    :param is_requested: function returning True for url already fetched
+    """
+    for queue, is_demand in ((demanding_queue, True), (prefetch_queue, False)):
+        if queue is None:
+            continue
+        while not queue.empty():
+            url = queue.get()
+            if not is_requested(url):
+                return url, is_demand
+    return None, False
+
+
+class ChunkPrefetcher(object):
+    PREFETCH_DEPTH = 4
+    MIN_PROBABILITY = 0.3
+    BANDWIDTH_BUDGET_MBPS = 40
+    BURST_SIZE = 1024*1024
+
+    def __init__(self, meta_info, prefetch_queue, access_trace_list=None,
+                 bandwidth_mbps=BANDWIDTH_BUDGET_MBPS,
+                 burst_size=BURST_SIZE, depth=PREFETCH_DEPTH):
+        """
+        :param access_trace_list: list of AccessTrace to learn from. Use the
+        trace in meta_info if None.
+        :param bandwidth_mbps: budget for speculative fetching
+        """
+        self.prefetch_queue = prefetch_queue
+        self.depth = depth
+        self.budget = TokenBucket(bandwidth_mbps=bandwidth_mbps,
+                                  bucket_size=burst_size)
+        self.chunk_url_dict = dict()
+        self.url_size_dict = dict()
+        for blob in meta_info[Const.META_OVERLAY_FILES]:
+            url = blob[Const.META_OVERLAY_FILE_NAME]
+            self.url_size_dict[url] = blob[Const.META_OVERLAY_FILE_SIZE]
+            for chunk in blob[Const.META_OVERLAY_FILE_DISK_CHUNKS]:
+                chunk_key = AccessTrace.get_key(DeltaItem.DELTA_DISK, chunk)
+                self.chunk_url_dict[chunk_key] = url
+            for chunk in blob[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]:
+                chunk_key = AccessTrace.get_key(DeltaItem.DELTA_MEMORY, chunk)
+                self.chunk_url_dict[chunk_key] = url
+
+        if access_trace_list is None:
+            access_trace = AccessTrace.from_meta(meta_info)
+            access_trace_list = [access_trace] if access_trace else list()
+        self.transition_dict = dict()
+        for access_trace in access_trace_list:
+            self.learn(access_trace)
+
+        self.requested_set = set()
+        self.last_chunk = dict()    # delta_type: (chunk, stride)
+        self.prefetch_count = 0
+        self.prefetch_size = 0
+
+    def learn(self, access_trace):
+        """Count transitions between blobs in the order of the trace
+        """
+        prev_url = None
+        for chunk_key in access_trace.chunk_key_list:
+            url = self.chunk_url_dict.get(chunk_key, None)
+            if url is None or url == prev_url:
+                continue
+            if prev_url is not None:
+                next_dict = self.transition_dict.setdefault(prev_url, dict())
+                next_dict[url] = next_dict.get(url, 0) + 1
+            prev_url = url
+
+    def _predict_transition(self, url):
+        """Follow the most likely next blob. Blobs that are already
+        requested are passed through without counting for the depth.
+        """
+        predicted_list = list()
+        cur_url = url
+        visited_set = set([url])
+        while len(predicted_list) < self.depth and \
+                len(visited_set) <= self.depth*8:
+            next_dict = self.transition_dict.get(cur_url, None)
+            if not next_dict:
+                break
+            total_count = float(sum(next_dict.values()))
+            candidate_list = sorted(next_dict.items(),
+                                    key=lambda item: item[1], reverse=True)
+            cur_url = None
+            for next_url, count in candidate_list:
+                if count/total_count < self.MIN_PROBABILITY:
+                    break
+                if next_url not in visited_set:
+                    cur_url = next_url
+                    break
+            if cur_url is None:
+                break
+            visited_set.add(cur_url)
+            if cur_url not in self.requested_set:
+                predicted_list.append(cur_url)
+        return predicted_list
+
+    def _predict_stride(self, delta_type, chunk):
+        (last_chunk, last_stride) = self.last_chunk.get(delta_type, (None, 0))
+        stride = 0
+        if last_chunk is not None:
+            stride = chunk - last_chunk
+        self.last_chunk[delta_type] = (chunk, stride)
+        if stride == 0 or stride != last_stride:
+            return list()
+        predicted_list = list()
+        next_chunk = chunk
+        # skip chunks that are not in the overlay up to a bounded distance
+        for index in xrange(self.depth*8):
+            next_chunk += stride
+            url = self.chunk_url_dict.get(
+                AccessTrace.get_key(delta_type, next_chunk), None)
+            if url is None or url in predicted_list or \
+                    url in self.requested_set:
+                continue
+            predicted_list.append(url)
+            # a miss right after the predicted chunks continues the stride
+            self.last_chunk[delta_type] = (next_chunk, stride)
+            if len(predicted_list) >= self.depth:
+                break
+        return predicted_list
+
+    def on_demand(self, delta_type, chunk):
+        """Handle demand miss of a chunk and return list of urls put to the
+        prefetch queue
+        """
+        url = self.chunk_url_dict.get(
+            AccessTrace.get_key(delta_type, chunk), None)
+        if url is None:
+            return list()
+        self.requested_set.add(url)
+        predicted_list = self._predict_transition(url)
+        stride_list = self._predict_stride(delta_type, chunk)
+        if len(predicted_list) == 0:
+            predicted_list = stride_list
+
+        prefetch_list = list()
+        for predicted_url in predicted_list:
+            if predicted_url in self.requested_set:
+                continue
+            size = self.url_size_dict[predicted_url]
+            if not self.budget.try_consume(size):
+                break
+            self.requested_set.add(predicted_url)
+            self.prefetch_queue.put(predicted_url)
+            prefetch_list.append(predicted_url)
+            self.prefetch_count += 1
+            self.prefetch_size += size
+        return prefetch_list
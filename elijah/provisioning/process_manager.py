@@ -25,9 +25,12 @@ import sys
 import traceback
 import Queue
 
+from .configuration import Const
 from .configuration import VMOverlayCreationMode
 from .migration_profile import MigrationMode
 from .migration_profile import ModeProfile
+from .mode_switch import ModeSwitchCost
+from . import cpu_allocator
 from . import log as logging
 
 
@@ -50,6 +53,9 @@ def kill_instance():
 
     if _process_controller is not None:
         _process_controller.terminate()
+        # let the manager save what it learned from this handoff
+        if _process_controller.is_alive():
+            _process_controller.join(1)
         _process_controller = None
 
 
@@ -69,17 +75,48 @@ class ProcessManager(threading.Thread):
 
         # load profiling information
         profile_path = os.path.abspath(VMOverlayCreationMode.PROFILE_DATAPATH)
-        LOG.info("Load adaptation profile at: %s" % profile_path)
         if os.path.exists(profile_path) is False:
             raise ProcessManagerError(
                 "Cannot load profile at : %s" % profile_path)
-        self.mode_profile = ModeProfile.load_from_file(profile_path)
+        self.profile_checksum = ModeProfile.get_checksum(profile_path)
+        self.learned_profile_path = ModeProfile.get_learned_path(profile_path)
+        self.mode_profile = None
+        if VMOverlayCreationMode.LEARN_MODE_PROFILE and \
+                os.path.exists(self.learned_profile_path):
+            self.mode_profile = self._load_learned_profile()
+        if self.mode_profile is None:
+            LOG.info("Load adaptation profile at: %s" % profile_path)
+            self.mode_profile = ModeProfile.load_from_file(profile_path)
+        self.mode_observation = None
+        self.switch_cost = ModeSwitchCost.load(Const.MODE_SWITCH_COST_MODEL)
+        self.total_input_size = -1
+
+        # CPU topology for per stage affinity
+        self.cpu_allocator = None
+        try:
+            topology = cpu_allocator.CPUTopology.from_sysfs()
+            self.cpu_allocator = cpu_allocator.CPUAllocator(topology)
+        except (IOError, OSError, cpu_allocator.CPUAllocatorError) as e:
+            LOG.warning("Cannot read CPU topology: %s" % str(e))
+        self.cpu_allocation = None
         super(ProcessManager, self).__init__(target=self.start_managing)
 
     def set_mode(self, new_mode, migration_dest):
         self.overlay_creation_mode = new_mode
         self.migration_dest = migration_dest
 
+    def set_total_input_size(self, total_input_size):
+        # expected input of memory and disk stages for the switch cost
+        self.total_input_size = total_input_size
+
+    def _get_remaining_blocks(self, size_dict_in, block_per_sec):
+        if self.total_input_size > 0:
+            processed_size = size_dict_in['CreateMemoryDeltalist'] + \
+                size_dict_in['CreateDiskDeltalist']
+            remaining_size = max(self.total_input_size - processed_size, 0)
+            return float(remaining_size)/Const.CHUNK_SIZE
+        return block_per_sec*VMOverlayCreationMode.MODE_SWITCH_HORIZON
+
     def _send_query(self, query, worker_names, data=None):
         sent_worker_name = list()
         for worker_name in worker_names:
@@ -121,6 +158,104 @@ class ProcessManager(threading.Thread):
                                  [worker_name],
                                  data={"num_cores": new_num_cores})
 
+    def _rebalance_cpus(self, p_dict, size_dict_in):
+        if self.cpu_allocator is None or \
+                not getattr(self.overlay_creation_mode,
+                            "CPU_AFFINITY_PER_STAGE", False):
+            return
+        stage_weights = cpu_allocator.get_stage_weights(p_dict, size_dict_in)
+        num_cores = VMOverlayCreationMode.get_num_cores()
+        allocation = self.cpu_allocator.allocate(stage_weights, num_cores)
+        if allocation == self.cpu_allocation:
+            return
+        self.cpu_allocation = allocation
+        worker_names = self.process_list.keys()
+        for worker_name, cpu_list in allocation.iteritems():
+            if worker_name in worker_names:
+                self._send_query("change_cpus",
+                                 [worker_name],
+                                 data={"cpus": cpu_list})
+        LOG.debug("cpu-allocation\t%f\t%s\t%s" %
+                  (time.time(), stage_weights, allocation))
+
+    def _change_num_proc(self, worker_name, num_proc):
+        if worker_name in self.process_list.keys():
+            self._send_query("change_num_proc", [worker_name],
+                             data={"num_proc": num_proc})
+
+    def _observe_mode(self, p_dict, r_dict, size_dict_in, total_p):
+        mode_id = self.overlay_creation_mode.get_mode_id()
+        if self.mode_observation is None or \
+                self.mode_observation['mode_id'] != mode_id:
+            self._learn_mode()
+            self.mode_observation = {
+                'mode_id': mode_id,
+                'mode': MigrationMode.from_creation_mode(
+                    self.overlay_creation_mode),
+                'p_list': list(),
+                'r_list': list(),
+                'total_p_list': list()}
+        for value in p_dict.values() + r_dict.values():
+            if value <= 0:
+                return
+        self.mode_observation['p_list'].append(p_dict)
+        self.mode_observation['r_list'].append(r_dict)
+        self.mode_observation['total_p_list'].append(total_p)
+        self.mode_observation['size_dict_in'] = size_dict_in
+
+    def _learn_mode(self):
+        observation = self.mode_observation
+        self.mode_observation = None
+        if observation is None or len(observation['total_p_list']) == 0:
+            return
+        sample_count = len(observation['total_p_list'])
+        p_dict = dict()
+        r_dict = dict()
+        for stage_name in observation['p_list'][0].keys():
+            p_dict[stage_name] = sum(
+                [p[stage_name] for p in observation['p_list']])/sample_count
+            r_dict[stage_name] = sum(
+                [r[stage_name] for r in observation['r_list']])/sample_count
+        confidence = ModeProfile.get_confidence(observation['total_p_list'])
+        self.mode_profile.update_mode(observation['mode'], p_dict, r_dict,
+                                      observation['size_dict_in'],
+                                      confidence)
+
+    def _load_learned_profile(self):
+        # the learned profile is stale once the shipped profile changes
+        try:
+            mode_profile = ModeProfile.load_from_file(
+                self.learned_profile_path,
+                source_checksum=self.profile_checksum)
+        except IOError as e:
+            LOG.warning("Cannot load learned profile: %s" % str(e))
+            return None
+        if mode_profile is None:
+            LOG.info("Discard learned adaptation profile of another "
+                     "profile at: %s" % self.learned_profile_path)
+            try:
+                os.remove(self.learned_profile_path)
+            except OSError as e:
+                LOG.warning("Cannot remove learned profile: %s" % str(e))
+            return None
+        LOG.info("Load learned adaptation profile at: %s" %
+                 self.learned_profile_path)
+        return mode_profile
+
+    def _save_mode_profile(self):
+        self._learn_mode()
+        try:
+            learned_dir = os.path.dirname(self.learned_profile_path)
+            if os.path.exists(learned_dir) is False:
+                os.makedirs(learned_dir)
+            ModeProfile.save_to_file(self.learned_profile_path,
+                                     self.mode_profile.overlay_mode_list,
+                                     source_checksum=self.profile_checksum)
+            LOG.info("Save learned adaptation profile at: %s" %
+                     self.learned_profile_path)
+        except (IOError, OSError) as e:
+            LOG.warning("Cannot save learned profile: %s" % str(e))
+
     def _change_comp_mode(self, comp_type, comp_level):
         worker_names = self.process_list.keys()
         if "CompressProc" in worker_names:
@@ -334,6 +469,8 @@ class ProcessManager(threading.Thread):
         time_first_measurement = 0
         mode_change_history = list()
         time_prev_mode_change = self.time_start
+        time_mode_applied = self.time_start
+        is_mode_learned = False
         while (not self.stop.wait(0.1)):
             try:
                 network_bw = self.get_network_speed()  # mega bit/s
@@ -354,6 +491,15 @@ class ProcessManager(threading.Thread):
                     total_size_dict_in, system_block_per_sec,\
                     system_out_bw_cur_est, system_in_bw_cur_est,\
                     system_out_bw_actual, system_in_bw_actual = system_speed
+                if self.cpu_allocation is None:
+                    self._rebalance_cpus(p_dict_cur, total_size_dict_in)
+                # skip the measurements mixed with the previous mode
+                if VMOverlayCreationMode.LEARN_MODE_PROFILE and \
+                        time_current_iter - time_mode_applied > \
+                        VMOverlayCreationMode.MEASURE_AVERAGE_TIME:
+                    self._observe_mode(p_dict_cur, r_dict_cur,
+                                       total_size_dict_in, total_p_cur)
+                    is_mode_learned = True
                 msg = "adaptation\t%f\t%0.2f\t%0.2f\t%0.4f\t%0.4f\t%0.4f\t%0.4f\t%0.4f\t%0.4f\t%0.4f\t%0.4f" % \
                     (time_current_iter,
                      time_from_start,
@@ -368,12 +514,16 @@ class ProcessManager(threading.Thread):
 
                 # first predict at 2 seconds and then for every 5 seconds
                 if time_from_start > 5 and (time_current_iter-time_prev_mode_change) > 5:
+                    remaining_blocks = self._get_remaining_blocks(
+                        total_size_dict_in, system_block_per_sec)
                     item = self.mode_profile.predict_new_mode(
                         self.overlay_creation_mode,
                         p_dict_cur,
                         r_dict_cur,
                         total_size_dict_in,
-                        network_bw)
+                        network_bw,
+                        remaining_blocks=remaining_blocks,
+                        switch_cost=self.switch_cost)
                     diff_mode = None
                     if item is not None:
                         (new_mode_obj, actual_block_per_sec, misc) = item
@@ -421,6 +571,10 @@ class ProcessManager(threading.Thread):
                         old_mode_dict = self.overlay_creation_mode.__dict__.copy()
                         self.overlay_creation_mode.update_mode(
                             new_mode_obj.mode)
+                        time_mode_applied = time_current_iter
+                        # use profiled stage speed of the new mode
+                        self._rebalance_cpus(new_mode_obj.block_time,
+                                             total_size_dict_in)
                         mode_change_history.append(
                             (time_current_iter, old_mode_dict, new_mode_obj.mode)
                         )
@@ -445,6 +599,8 @@ class ProcessManager(threading.Thread):
                 sys.stderr.write(traceback.format_exc())
                 sys.stderr.write("%s\n" % str(e))
                 sys.stdout.write("[manager] Exception\n")
+        if is_mode_learned:
+            self._save_mode_profile()
 
     def register(self, worker):
         worker_name = getattr(worker, "worker_name", "NoName")
@@ -490,6 +646,8 @@ class ProcWorker(multiprocessing.Process):
         self.finish_processing_input = multiprocessing.RawValue(ctypes.c_bool)
         self.is_processing_alive.value = True
         self.finish_processing_input.value = False
+        # children asked to retire. They stay in proc_list for measurement
+        self.retired_proc_list = list()
 
         self.worker_name = str(
             kwargs.pop('worker_name',
@@ -511,6 +669,69 @@ class ProcWorker(multiprocessing.Process):
             if proc.is_alive():
                 m_queue.put(("new_num_cores", new_num_cores))
 
+    def get_active_children(self):
+        return [item for item in self.proc_list
+                if item[0] not in self.retired_proc_list]
+
+    def send_end_messages(self, task_queue):
+        """Put an end message for each active child to the shared task
+        queue. A retiring child sees the retire message only at its next
+        select and could take an end message meant for an active child
+        before that, so retired children must leave first.
+        """
+        for (proc, c_queue, m_queue) in self.proc_list:
+            if proc in self.retired_proc_list:
+                # child exits only after it takes the retire message
+                proc.join()
+        for index in self.get_active_children():
+            task_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+
+    def change_num_children(self, num_proc):
+        """Stages with children have proc_list and _create_child(), which
+        returns (proc, command_queue, mode_queue) of a new child that takes
+        tasks from the shared task queue
+        """
+        if getattr(self, "proc_list", None) is None or \
+                not hasattr(self, "_create_child"):
+            LOG.warning("%s cannot change the number of children" %
+                        self.worker_name)
+            return
+        num_proc = max(1, num_proc)
+        if len(self.proc_list) == 0:
+            # children are not launched yet
+            self.num_proc = num_proc
+            return
+        if self.finish_processing_input.value:
+            # end messages are counted by the children
+            return
+        active_children = self.get_active_children()
+        if num_proc > len(active_children):
+            for index in range(num_proc - len(active_children)):
+                (proc, c_queue, m_queue) = self._create_child()
+                proc.start()
+                self.proc_list.append((proc, c_queue, m_queue))
+        else:
+            for (proc, c_queue, m_queue) in active_children[num_proc:]:
+                # finishes the task in hand and leaves the rest to others
+                m_queue.put(("retire", None))
+                self.retired_proc_list.append(proc)
+        LOG.debug("change-children\t%f\t%s\t%d -> %d" %
+                  (time.time(), self.worker_name, len(active_children),
+                   num_proc))
+        self.num_proc = num_proc
+
+    def change_cpus(self, cpu_list):
+        VMOverlayCreationMode.set_cpu_affinity(cpu_list)
+        for (proc, c_queue, m_queue) in getattr(self, "proc_list", list()):
+            if not proc.is_alive():
+                continue
+            try:
+                VMOverlayCreationMode.set_cpu_affinity(cpu_list, pid=proc.pid)
+            except Exception as e:
+                # child can finish in the meantime
+                LOG.warning("Cannot set affinity of %d: %s" %
+                            (proc.pid, str(e)))
+
     def _handle_control_msg(self, control_msg):
         if control_msg == "current_bw":
             self.response_queue.put(self.monitor_current_bw)
@@ -529,6 +750,16 @@ class ProcWorker(multiprocessing.Process):
                 if getattr(self, "proc_list", None):
                     self.change_affinity_child(num_cores)
             return True
+        elif control_msg == "change_cpus":
+            cpu_list = self.control_queue.get().get("cpus", None)
+            if cpu_list is not None:
+                self.change_cpus(cpu_list)
+            return True
+        elif control_msg == "change_num_proc":
+            num_proc = self.control_queue.get().get("num_proc", None)
+            if num_proc is not None:
+                self.change_num_children(num_proc)
+            return True
         else:
             # sys.stdout.write("Cannot be handled in super class\n")
             return False
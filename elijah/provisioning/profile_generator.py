@@ -0,0 +1,477 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Generate a mode profile without VM handoffs.
+
+The scripts at test/handoff-profiling run a real handoff for every mode
+and parse the "profiling" logs of each stage. Instead, we run the work
+each stage does per block (diff and hash of a modified chunk,
+deduplication, and compression of blobs) on memory and disk chunks that
+are either synthetic or read from a base and a modified image, and
+measure per block P and R the same way the stages do.
+
+Only a sample of the input is used, and the stage results that do not
+depend on the whole mode are shared between modes: the diff of memory
+depends only on MEMORY_DIFF_ALGORITHM, and compression of memory items
+only on the memory diff and the compression mode. An exhaustive run that
+processes all the input for each mode is kept to check the sampled
+profile (see compare_profiles()).
+"""
+
+import os
+import sys
+import time
+import random
+import itertools
+from hashlib import sha256
+
+from .configuration import Const
+from .configuration import VMOverlayCreationMode
+from .delta import DeltaItem
+from .delta import deduplicate_deltaitem
+from .diff_codec import diff_chunk
+from .diff_codec import generate_synthetic_chunks
+from .compression import get_compressor
+from .migration_profile import MigrationMode
+from .migration_profile import ModeProfile
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+DIFF_ALGORITHMS = ["xdelta3", "bsdiff", "xor", "none"]
+COMPRESSION_TYPES = [Const.COMPRESSION_LZMA, Const.COMPRESSION_BZIP2,
+                     Const.COMPRESSION_GZIP]
+COMPRESSION_LEVELS = range(1, 10)
+# block_size of CompressProc
+BLOB_SIZE = 1024*1024*2
+
+
+class ProfileGeneratorError(Exception):
+    pass
+
+
+class StageInput(object):
+    """Modified chunks of memory or disk with the chunks at the same offset
+    of the base VM
+    """
+
+    def __init__(self, delta_type, chunk_list):
+        # list of (offset, base_data, modified_data)
+        self.delta_type = delta_type
+        self.chunk_list = chunk_list
+
+    def __len__(self):
+        return len(self.chunk_list)
+
+    def sample(self, sample_count, seed=1234):
+        if sample_count is None or sample_count >= len(self.chunk_list):
+            return self
+        rand = random.Random(seed)
+        chunk_list = rand.sample(self.chunk_list, sample_count)
+        return StageInput(self.delta_type,
+                          sorted(chunk_list, key=lambda chunk: chunk[0]))
+
+    def get_base_hashdict(self):
+        hash_dict = dict()
+        for (offset, base_data, modi_data) in self.chunk_list:
+            hash_dict[sha256(base_data).digest()] = offset
+        return hash_dict
+
+    @staticmethod
+    def synthetic(delta_type, chunk_count, seed=1234):
+        """Synthetic chunks of diff_codec with zero pages and duplicated
+        pages mixed in for deduplication
+        """
+        rand = random.Random(seed)
+        chunk_pairs = generate_synthetic_chunks(chunk_count, seed=seed)
+        zero_data = chr(0x00)*Const.CHUNK_SIZE
+        chunk_list = list()
+        for index, (base_data, modi_data) in enumerate(chunk_pairs):
+            choice = rand.random()
+            if choice < 0.1:
+                modi_data = zero_data
+            elif choice < 0.2 and index > 0:
+                modi_data = chunk_list[rand.randint(0, index-1)][2]
+            chunk_list.append((index*Const.CHUNK_SIZE, base_data, modi_data))
+        return StageInput(delta_type, chunk_list)
+
+    @staticmethod
+    def from_files(delta_type, base_path, modified_path, max_chunks=None):
+        """Chunks that differ between a recorded base image and modified
+        image, e.g. a memory snapshot or a disk image
+        """
+        chunk_list = list()
+        with open(base_path, "rb") as base_fd, \
+                open(modified_path, "rb") as modi_fd:
+            offset = 0
+            while max_chunks is None or len(chunk_list) < max_chunks:
+                modi_data = modi_fd.read(Const.CHUNK_SIZE)
+                if len(modi_data) == 0:
+                    break
+                base_data = base_fd.read(Const.CHUNK_SIZE)
+                if len(base_data) < len(modi_data):
+                    base_data += chr(0x00)*(len(modi_data)-len(base_data))
+                if base_data != modi_data:
+                    chunk_list.append((offset, base_data, modi_data))
+                offset += len(modi_data)
+        if len(chunk_list) == 0:
+            msg = "No modified chunk between %s and %s" % (base_path,
+                                                           modified_path)
+            raise ProfileGeneratorError(msg)
+        return StageInput(delta_type, chunk_list)
+
+
+class StageResult(object):
+
+    def __init__(self, in_size=0, out_size=0, block_count=0,
+                 process_time=0.0):
+        self.in_size = in_size
+        self.out_size = out_size
+        self.block_count = block_count
+        self.process_time = process_time    # seconds
+
+    def __add__(self, other):
+        return StageResult(self.in_size + other.in_size,
+                           self.out_size + other.out_size,
+                           self.block_count + other.block_count,
+                           self.process_time + other.process_time)
+
+
+def run_diff_stage(stage_input, diff_algorithm):
+    """Work of MemoryDiffProc/DiskDiffProc for each modified chunk
+    :return (StageResult, list of DeltaItem)
+    """
+    result = StageResult()
+    delta_list = list()
+    time_start = time.clock()
+    for (offset, base_data, modi_data) in stage_input.chunk_list:
+        chunk_len = len(modi_data)
+        hash_value = sha256(modi_data).digest()
+        try:
+            diff_data, ref_id = diff_chunk(diff_algorithm, base_data,
+                                           modi_data)
+        except IOError as e:
+            diff_data, ref_id = modi_data, DeltaItem.REF_RAW
+        result.in_size += chunk_len + 11
+        result.out_size += len(diff_data) + 11
+        delta_list.append(DeltaItem(stage_input.delta_type, offset,
+                                    chunk_len, hash_value=hash_value,
+                                    ref_id=ref_id, data_len=len(diff_data),
+                                    data=diff_data))
+    result.process_time = time.clock() - time_start
+    result.block_count = len(delta_list)
+    return result, delta_list
+
+
+def run_dedup_stage(delta_list, base_hashdict):
+    """Work of DeltaDedup on the delta items of memory and disk
+    :return (StageResult, list of deduplicated DeltaItem)
+    """
+    zero_hash_dict = {sha256(chr(0x00)*Const.CHUNK_SIZE).digest(): 0}
+    self_hashset = set()
+    result = StageResult()
+    deduped_list = list()
+    time_start = time.clock()
+    for delta_item in delta_list:
+        # do not change the input which other modes share
+        delta_item = DeltaItem(delta_item.delta_type, delta_item.offset,
+                               delta_item.offset_len,
+                               hash_value=delta_item.hash_value,
+                               ref_id=delta_item.ref_id,
+                               data_len=delta_item.data_len,
+                               data=delta_item.data)
+        result.in_size += delta_item.data_len + 11
+        if deduplicate_deltaitem(zero_hash_dict, delta_item,
+                                 DeltaItem.REF_ZEROS):
+            pass
+        elif deduplicate_deltaitem(base_hashdict, delta_item,
+                                   DeltaItem.REF_BASE_DISK):
+            pass
+        elif delta_item.hash_value in self_hashset:
+            delta_item.ref_id = DeltaItem.REF_SELF_HASH
+            delta_item.data_len = 32
+            delta_item.data = delta_item.hash_value
+        else:
+            self_hashset.add(delta_item.hash_value)
+        result.out_size += delta_item.data_len + 11
+        deduped_list.append(delta_item)
+    result.process_time = time.clock() - time_start
+    result.block_count = len(deduped_list)
+    return result, deduped_list
+
+
+def run_compress_stage(delta_list, comp_type, comp_level,
+                       blob_size=BLOB_SIZE):
+    """Work of CompChildProc, a compressor per blob of blob_size
+    """
+    result = StageResult()
+    time_start = time.clock()
+    comp = None
+    blob_in_size = 0
+    for delta_item in delta_list:
+        if comp is None:
+            comp = get_compressor(comp_type, comp_level)
+        delta_bytes = delta_item.get_serialized()
+        result.out_size += len(comp.compress(delta_bytes))
+        result.in_size += len(delta_bytes)
+        blob_in_size += len(delta_bytes)
+        if blob_in_size >= blob_size:
+            result.out_size += len(comp.flush())
+            comp = None
+            blob_in_size = 0
+    if comp is not None:
+        result.out_size += len(comp.flush())
+    result.process_time = time.clock() - time_start
+    result.block_count = len(delta_list)
+    return result
+
+
+def get_mode_list(diff_algorithms=DIFF_ALGORITHMS,
+                  comp_types=COMPRESSION_TYPES,
+                  comp_levels=COMPRESSION_LEVELS):
+    """Every combination of VMOverlayCreationMode.VARYING_PARAMETERS
+    """
+    value_dict = {
+        'MEMORY_DIFF_ALGORITHM': diff_algorithms,
+        'DISK_DIFF_ALGORITHM': diff_algorithms,
+        'COMPRESSION_ALGORITHM_TYPE': comp_types,
+        'COMPRESSION_ALGORITHM_SPEED': comp_levels,
+    }
+    parameters = VMOverlayCreationMode.VARYING_PARAMETERS
+    mode_list = list()
+    for values in itertools.product(*[value_dict[key]
+                                      for key in parameters]):
+        mode_list.append(dict(zip(parameters, values)))
+    return mode_list
+
+
+def to_migration_mode(workload, mode_dict, result_dict):
+    """MigrationMode as parse_each_experiement builds from the logs
+    :param result_dict: {stage name: StageResult}
+    """
+    exp = MigrationMode()
+    exp.workload = workload
+    exp.mode = dict(mode_dict)
+    for (stage_name, result) in result_dict.iteritems():
+        block_count = max(result.block_count, 1)
+        exp.stage_size_in[stage_name] = result.in_size
+        exp.stage_size_out[stage_name] = result.out_size
+        exp.stage_size_ratio[stage_name] = \
+            float(result.out_size)/max(result.in_size, 1)
+        exp.stage_time[stage_name] = result.process_time
+        exp.block[stage_name] = result.block_count
+        exp.block_size_in[stage_name] = float(result.in_size)/block_count
+        exp.block_size_out[stage_name] = float(result.out_size)/block_count
+        exp.block_size_ratio[stage_name] = exp.stage_size_ratio[stage_name]
+        exp.block_time[stage_name] = round(
+            result.process_time*1000/block_count, 6)
+    exp.update_total()
+    return exp
+
+
+def _split_by_type(delta_list, delta_type):
+    return [delta_item for delta_item in delta_list
+            if delta_item.delta_type == delta_type]
+
+
+def generate_profile(memory_input, disk_input, mode_list=None,
+                     sample_count=1024, seed=1234, workload="synthetic"):
+    """Return MigrationMode of each mode measured on sample_count chunks
+    of memory and disk. Stage results are shared between modes.
+    """
+    if mode_list is None:
+        mode_list = get_mode_list()
+    memory_input = memory_input.sample(sample_count, seed)
+    disk_input = disk_input.sample(sample_count, seed+1)
+    base_hashdict = memory_input.get_base_hashdict()
+    base_hashdict.update(disk_input.get_base_hashdict())
+
+    diff_cache = dict()
+    dedup_cache = dict()
+    comp_cache = dict()
+    exp_list = list()
+    time_start = time.time()
+    for mode_dict in mode_list:
+        diff_result = dict()
+        for (stage_name, stage_input, parameter) in (
+                ("CreateMemoryDeltalist", memory_input,
+                 'MEMORY_DIFF_ALGORITHM'),
+                ("CreateDiskDeltalist", disk_input, 'DISK_DIFF_ALGORITHM')):
+            key = (stage_name, mode_dict[parameter])
+            if key not in diff_cache:
+                diff_cache[key] = run_diff_stage(stage_input,
+                                                 mode_dict[parameter])
+            diff_result[stage_name] = diff_cache[key]
+
+        memory_diff = mode_dict['MEMORY_DIFF_ALGORITHM']
+        disk_diff = mode_dict['DISK_DIFF_ALGORITHM']
+        if (memory_diff, disk_diff) not in dedup_cache:
+            delta_list = diff_result["CreateMemoryDeltalist"][1] + \
+                diff_result["CreateDiskDeltalist"][1]
+            dedup_cache[(memory_diff, disk_diff)] = \
+                run_dedup_stage(delta_list, base_hashdict)
+        (dedup_result, deduped_list) = dedup_cache[(memory_diff, disk_diff)]
+
+        # items of memory and disk are compressed separately and the result
+        # of one is shared by modes with the same diff of the other
+        comp_result = StageResult()
+        for (delta_type, diff_algorithm) in (
+                (DeltaItem.DELTA_MEMORY, memory_diff),
+                (DeltaItem.DELTA_DISK, disk_diff)):
+            key = (delta_type, diff_algorithm,
+                   mode_dict['COMPRESSION_ALGORITHM_TYPE'],
+                   mode_dict['COMPRESSION_ALGORITHM_SPEED'])
+            if key not in comp_cache:
+                comp_cache[key] = run_compress_stage(
+                    _split_by_type(deduped_list, delta_type),
+                    mode_dict['COMPRESSION_ALGORITHM_TYPE'],
+                    mode_dict['COMPRESSION_ALGORITHM_SPEED'])
+            comp_result = comp_result + comp_cache[key]
+
+        result_dict = {
+            "CreateMemoryDeltalist": diff_result["CreateMemoryDeltalist"][0],
+            "CreateDiskDeltalist": diff_result["CreateDiskDeltalist"][0],
+            "DeltaDedup": dedup_result,
+            "CompressProc": comp_result,
+        }
+        exp_list.append(to_migration_mode(workload, mode_dict, result_dict))
+    LOG.info("Generate profile of %d modes in %f s" %
+             (len(exp_list), time.time()-time_start))
+    return exp_list
+
+
+def generate_exhaustive_profile(memory_input, disk_input, mode_list=None,
+                                workload="synthetic"):
+    """Return MigrationMode of each mode running every stage on all the
+    input without sharing any result between modes
+    """
+    if mode_list is None:
+        mode_list = get_mode_list()
+    base_hashdict = memory_input.get_base_hashdict()
+    base_hashdict.update(disk_input.get_base_hashdict())
+    exp_list = list()
+    for mode_dict in mode_list:
+        memory_result, memory_list = run_diff_stage(
+            memory_input, mode_dict['MEMORY_DIFF_ALGORITHM'])
+        disk_result, disk_list = run_diff_stage(
+            disk_input, mode_dict['DISK_DIFF_ALGORITHM'])
+        dedup_result, deduped_list = run_dedup_stage(
+            memory_list + disk_list, base_hashdict)
+        comp_result = run_compress_stage(
+            deduped_list, mode_dict['COMPRESSION_ALGORITHM_TYPE'],
+            mode_dict['COMPRESSION_ALGORITHM_SPEED'])
+        result_dict = {
+            "CreateMemoryDeltalist": memory_result,
+            "CreateDiskDeltalist": disk_result,
+            "DeltaDedup": dedup_result,
+            "CompressProc": comp_result,
+        }
+        exp_list.append(to_migration_mode(workload, mode_dict, result_dict))
+    return exp_list
+
+
+def compare_profiles(exp_list1, exp_list2, threshold_percent=20):
+    """Compare P and R of the modes in both profiles relative to their mean
+    in each profile, as ModeProfile uses them only relative to the current
+    mode. A single pivot mode would add its own measurement noise to every
+    mode.
+    :return (number of modes within threshold_percent for both P and R,
+    number of modes in both profiles)
+    """
+    exp_dict1 = dict([(exp.get_mode_id(), exp) for exp in exp_list1])
+    exp_dict2 = dict([(exp.get_mode_id(), exp) for exp in exp_list2])
+    mode_ids = [mode_id for mode_id in exp_dict1.keys()
+                if mode_id in exp_dict2]
+    if len(mode_ids) == 0:
+        raise ProfileGeneratorError("No mode in both profiles")
+    mean_p1 = sum([exp_dict1[key].total_p for key in mode_ids])/len(mode_ids)
+    mean_p2 = sum([exp_dict2[key].total_p for key in mode_ids])/len(mode_ids)
+    mean_r1 = sum([exp_dict1[key].total_r for key in mode_ids])/len(mode_ids)
+    mean_r2 = sum([exp_dict2[key].total_r for key in mode_ids])/len(mode_ids)
+    matched_count = 0
+    for mode_id in mode_ids:
+        exp1 = exp_dict1[mode_id]
+        exp2 = exp_dict2[mode_id]
+        ratio_p1 = exp1.total_p/mean_p1
+        ratio_p2 = exp2.total_p/mean_p2
+        ratio_r1 = exp1.total_r/mean_r1
+        ratio_r2 = exp2.total_r/mean_r2
+        p_diff_percent = abs(ratio_p1-ratio_p2)/ratio_p1*100
+        r_diff_percent = abs(ratio_r1-ratio_r2)/ratio_r1*100
+        if p_diff_percent < threshold_percent and \
+                r_diff_percent < threshold_percent:
+            matched_count += 1
+        else:
+            LOG.debug("profile-diff\t%s\t(%f, %f) - (%f, %f)" %
+                      (mode_id, ratio_p1, ratio_r1, ratio_p2, ratio_r2))
+    return matched_count, len(mode_ids)
+
+
+if __name__ == "__main__":
+    # generate: profile_generator.py generate output_path sample_count
+    #           [base_memory modified_memory base_disk modified_disk]
+    # check: profile_generator.py check sample_count
+    #           [base_memory modified_memory base_disk modified_disk]
+    if len(sys.argv) < 3:
+        sys.stderr.write("usage: %s generate output_path sample_count [...]\n"
+                         "       %s check sample_count [...]\n" %
+                         (sys.argv[0], sys.argv[0]))
+        sys.exit(1)
+    command = sys.argv[1]
+    if command == "generate":
+        (output_path, sample_count) = (sys.argv[2], int(sys.argv[3]))
+        image_paths = sys.argv[4:8]
+    elif command == "check":
+        sample_count = int(sys.argv[2])
+        image_paths = sys.argv[3:7]
+    else:
+        sys.stderr.write("Invalid command\n")
+        sys.exit(1)
+
+    if len(image_paths) == 4:
+        workload = os.path.basename(image_paths[1])
+        memory_input = StageInput.from_files(DeltaItem.DELTA_MEMORY,
+                                             image_paths[0], image_paths[1])
+        disk_input = StageInput.from_files(DeltaItem.DELTA_DISK,
+                                           image_paths[2], image_paths[3])
+    else:
+        workload = "synthetic"
+        memory_input = StageInput.synthetic(DeltaItem.DELTA_MEMORY,
+                                            sample_count*4, seed=1)
+        disk_input = StageInput.synthetic(DeltaItem.DELTA_DISK,
+                                          sample_count*4, seed=2)
+
+    if command == "generate":
+        exp_list = generate_profile(memory_input, disk_input,
+                                    sample_count=sample_count,
+                                    workload=workload)
+        ModeProfile.save_to_file(output_path, exp_list)
+        print "saved %d modes at %s" % (len(exp_list), output_path)
+    else:
+        exp_list = generate_profile(memory_input, disk_input,
+                                    sample_count=sample_count,
+                                    workload=workload)
+        exhaustive_list = generate_exhaustive_profile(
+            memory_input, disk_input, workload=workload)
+        matched_count, total_count = compare_profiles(exhaustive_list,
+                                                      exp_list)
+        print "%d out of %d modes within 20 percent" % (matched_count,
+                                                        total_count)
@@ -31,6 +31,8 @@ import shutil
 import threading
 
 import synthesis as synthesis
+import prefetch as prefetch
+import overlay_meta as overlay_meta
 from package import VMOverlayPackage
 from db.api import DBConnector
 from db.table_def import BaseVM, Session, OverlayVM
@@ -153,12 +155,14 @@ class NetworkStepThread(threading.Thread):
     MAX_REQUEST_SIZE = 1024*512 # 512 KB
 
     def __init__(self, network_handler, overlay_urls, overlay_urls_size, 
-            demanding_queue, out_queue, time_queue, chunk_size):
+            demanding_queue, out_queue, time_queue, chunk_size,
+            prefetch_queue=None):
         self.network_handler = network_handler
         self.read_stream = network_handler.rfile
         self.overlay_urls = overlay_urls
         self.overlay_urls_size = overlay_urls_size
         self.demanding_queue = demanding_queue
+        self.prefetch_queue = prefetch_queue
         self.out_queue = out_queue
         self.time_queue = time_queue
         self.chunk_size = chunk_size
@@ -176,6 +180,7 @@ class NetworkStepThread(threading.Thread):
         finished_url = dict()
         requesting_list = list()
         out_of_order_count = 0
+        prefetch_count = 0
         total_urls_count = len(self.overlay_urls)
         start_time = time.time()
 
@@ -188,19 +193,19 @@ class NetworkStepThread(threading.Thread):
                     break;
 
                 # find overlay to request
-                urgent_overlay_url = None
-                while not self.demanding_queue.empty():
-                    # demanding_queue can have multiple same request
-                    demanding_url = self.demanding_queue.get()
-                    if (finished_url.get(demanding_url, False) == False) and \
-                            (demanding_url not in requesting_list):
-                        urgent_overlay_url = demanding_url
-                        break
+                # demand misses first, then predicted blobs
+                urgent_overlay_url, is_demand = prefetch.pop_priority_url(
+                    self.demanding_queue, self.prefetch_queue,
+                    lambda url: finished_url.get(url, False) or \
+                        url in requesting_list)
 
                 requesting_overlay = None
                 if urgent_overlay_url != None:
                     requesting_overlay = urgent_overlay_url
-                    out_of_order_count += 1
+                    if is_demand:
+                        out_of_order_count += 1
+                    else:
+                        prefetch_count += 1
                     if requesting_overlay in self.overlay_urls:
                         self.overlay_urls.remove(requesting_overlay)
                 else:
@@ -260,6 +265,9 @@ class NetworkStepThread(threading.Thread):
         LOG.info("[Transfer] out-of-order fetching : %d / %d == %5.2f %%" % \
                 (out_of_order_count, total_urls_count, \
                 100.0*out_of_order_count/total_urls_count))
+        LOG.info("[Transfer] prefetching : %d / %d == %5.2f %%" % \
+                (prefetch_count, total_urls_count, \
+                100.0*prefetch_count/total_urls_count))
         try:
             LOG.info("[Transfer] : (%s)~(%s)=(%s) (%d loop, %d bytes, %lf Mbps)" % \
                     (start_time, end_time, (time_delta),\
@@ -323,11 +331,13 @@ class URLFetchStep(threading.Thread):
     MAX_REQUEST_SIZE = 1024*512 # 512 KB
 
     def __init__(self, overlay_package, overlay_files, overlay_files_size, 
-            demanding_queue, out_queue, time_queue, chunk_size):
+            demanding_queue, out_queue, time_queue, chunk_size,
+            prefetch_queue=None):
         self.overlay_files = overlay_files
         self.overlay_files_size = overlay_files_size
         self.overlay_package = overlay_package
         self.demanding_queue = demanding_queue
+        self.prefetch_queue = prefetch_queue
         self.out_queue = out_queue
         self.time_queue = time_queue
         self.chunk_size = chunk_size
@@ -343,23 +353,23 @@ class URLFetchStep(threading.Thread):
         counter = 0
         finished_url = dict()
         out_of_order_count = 0
+        prefetch_count = 0
         total_urls_count = len(self.overlay_files)
         start_time = time.time()
 
         while len(finished_url) < total_urls_count:
-            # find overlay blob for on-demand request
-            urgent_overlay_url = None
-            while not self.demanding_queue.empty():
-                # demanding_queue can have multiple same request
-                demanding_url = self.demanding_queue.get()
-                if (finished_url.get(demanding_url, False) == False):
-                    urgent_overlay_url = demanding_url
-                    break
+            # find overlay blob for on-demand request, then predicted blobs
+            urgent_overlay_url, is_demand = prefetch.pop_priority_url(
+                self.demanding_queue, self.prefetch_queue,
+                lambda url: finished_url.get(url, False))
 
             requesting_overlay = None
             if urgent_overlay_url != None:
                 requesting_overlay = urgent_overlay_url
-                out_of_order_count += 1
+                if is_demand:
+                    out_of_order_count += 1
+                else:
+                    prefetch_count += 1
                 if requesting_overlay in self.overlay_files:
                     self.overlay_files.remove(requesting_overlay)
             else:
@@ -392,6 +402,9 @@ class URLFetchStep(threading.Thread):
         LOG.info("[Transfer] out-of-order fetching : %d / %d == %5.2f %%" % \
                 (out_of_order_count, total_urls_count, \
                 100.0*out_of_order_count/total_urls_count))
+        LOG.info("[Transfer] prefetching : %d / %d == %5.2f %%" % \
+                (prefetch_count, total_urls_count, \
+                100.0*prefetch_count/total_urls_count))
         try:
             LOG.info("[Transfer] : (%s)~(%s)=(%s) (%d loop, %d bytes, %lf Mbps)" % \
                     (start_time, end_time, (time_delta),\
@@ -460,7 +473,7 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             header_data = self.request.recv(meta_file_size)
             while len(header_data) < meta_file_size:
                 header_data += self.request.recv(meta_file_size- len(header_data))
-            header = NetworkUtil.decoding(header_data)
+            header = overlay_meta.unpack_meta(header_data)
             base_hashvalue = header.get(Cloudlet_Const.META_BASE_VM_SHA256, None)
 
             # check base VM
@@ -525,17 +538,20 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
 
         # overlay
         demanding_queue = Queue()
+        prefetch_queue = Queue()
+        prefetcher = prefetch.ChunkPrefetcher(meta_info, prefetch_queue)
         download_queue = JoinableQueue()
         download_process = NetworkStepThread(self, 
                     overlay_urls, overlay_urls_size, demanding_queue, 
                     download_queue, time_transfer, Synthesis_Const.TRANSFER_SIZE, 
-                    )
+                    prefetch_queue=prefetch_queue)
         decomp_process = DecompStepProc(
                 download_queue, self.overlay_pipe, time_decomp, temp_overlay_file,
                 )
         modified_img, modified_mem, self.fuse, self.delta_proc, self.fuse_proc = \
                 synthesis.recover_launchVM(base_path, meta_info, self.overlay_pipe, 
-                        log=sys.stdout, demanding_queue=demanding_queue)
+                        log=sys.stdout, demanding_queue=demanding_queue,
+                        prefetcher=prefetcher)
         self.delta_proc.time_queue = time_delta # for measurement
         self.fuse_proc.time_queue = time_fuse # for measurement
 
@@ -640,7 +656,7 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
             # receive overlay meta file
             overlay_url = message.get(Protocol.KEY_OVERLAY_URL)
             overlay_package = VMOverlayPackage(overlay_url)
-            metadata = NetworkUtil.decoding(overlay_package.read_meta())
+            metadata = overlay_meta.unpack_meta(overlay_package.read_meta())
             base_hashvalue = metadata.get(Cloudlet_Const.META_BASE_VM_SHA256, None)
 
             # check base VM
@@ -715,16 +731,20 @@ class SynthesisHandler(SocketServer.StreamRequestHandler):
 
         # overlay
         demanding_queue = Queue()
+        prefetch_queue = Queue()
+        prefetcher = prefetch.ChunkPrefetcher(meta_info, prefetch_queue)
         download_queue = JoinableQueue()
         download_process = URLFetchStep(overlay_package, overlay_urls, 
                 overlay_urls_size, demanding_queue, download_queue, 
-                time_transfer, Synthesis_Const.TRANSFER_SIZE, )
+                time_transfer, Synthesis_Const.TRANSFER_SIZE,
+                prefetch_queue=prefetch_queue)
         decomp_process = DecompStepProc(
                 download_queue, self.overlay_pipe, time_decomp, temp_overlay_file,
                 )
         modified_img, modified_mem, self.fuse, self.delta_proc, self.fuse_proc = \
                 synthesis.recover_launchVM(base_path, meta_info, self.overlay_pipe, 
-                        log=sys.stdout, demanding_queue=demanding_queue)
+                        log=sys.stdout, demanding_queue=demanding_queue,
+                        prefetcher=prefetcher)
         self.delta_proc.time_queue = time_delta # for measurement
         self.fuse_proc.time_queue = time_fuse # for measurement
 
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+#
+# cloudlet infrastructure for mobile computing
+#
+#   author: kiryong ha <krha@cmu.edu>
+#
+#   copyright (c) 2011-2013 carnegie mellon university
+#   licensed under the apache license, version 2.0 (the "license");
+#   you may not use this file except in compliance with the license.
+#   you may obtain a copy of the license at
+#
+#       http://www.apache.org/licenses/license-2.0
+#
+#   unless required by applicable law or agreed to in writing, software
+#   distributed under the license is distributed on an "as is" basis,
+#   without warranties or conditions of any kind, either express or implied.
+#   see the license for the specific language governing permissions and
+#   limitations under the license.
+#
+
+"""Find the most similar base chunk of a modified chunk.
+
+Each chunk is summarized by super-features: we hash every small window of
+the chunk, keep the maximum of each of FEATURE_COUNT random linear
+transforms of the window hashes, and group the features into
+SUPER_FEATURE_COUNT super-features. Two chunks that share a super-feature
+are very likely to share most of their content, so a modified chunk can be
+diffed against a base chunk at any offset.
+"""
+
+import os
+import struct
+
+import numpy
+
+from . import diff_codec
+from . import log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+
+class SimilarityIndexError(Exception):
+    pass
+
+
+WINDOW_SIZE = 8
+FEATURE_COUNT = 12
+SUPER_FEATURE_COUNT = 4
+_WINDOW_PRIME = numpy.uint32(0x01000193)
+_rand = numpy.random.RandomState(0x5eed)
+_TRANSFORM_MUL = (_rand.randint(1, 2**31, FEATURE_COUNT).astype(numpy.uint32)
+                  * numpy.uint32(2) + numpy.uint32(1))
+_TRANSFORM_ADD = _rand.randint(0, 2**31, FEATURE_COUNT).astype(numpy.uint32)
+_SF_MUL = numpy.uint64(0x9E3779B97F4A7C15)
+
+
+def compute_sketches(data, chunk_size):
+    """Return super-features of each chunk as (chunk_count,
+    SUPER_FEATURE_COUNT) uint64 array. Chunks filled with a single byte
+    value have all zero super-features since they are not worth indexing.
+    """
+    chunk_count = len(data)/chunk_size
+    chunks = numpy.frombuffer(data, dtype=numpy.uint8,
+                              count=chunk_count*chunk_size)
+    chunks = chunks.reshape(chunk_count, chunk_size)
+    window_count = chunk_size - WINDOW_SIZE + 1
+
+    # polynomial hash of every window
+    window_hash = numpy.zeros((chunk_count, window_count), dtype=numpy.uint32)
+    for index in xrange(WINDOW_SIZE):
+        window_hash *= _WINDOW_PRIME
+        window_hash += chunks[:, index:index+window_count]
+
+    features = numpy.empty((chunk_count, FEATURE_COUNT), dtype=numpy.uint64)
+    transformed = numpy.empty_like(window_hash)
+    for index in xrange(FEATURE_COUNT):
+        numpy.multiply(window_hash, _TRANSFORM_MUL[index], out=transformed)
+        transformed += _TRANSFORM_ADD[index]
+        features[:, index] = transformed.max(axis=1)
+
+    group_size = FEATURE_COUNT/SUPER_FEATURE_COUNT
+    sketches = numpy.zeros((chunk_count, SUPER_FEATURE_COUNT),
+                           dtype=numpy.uint64)
+    for index in xrange(SUPER_FEATURE_COUNT):
+        for feature in features[:, index*group_size:(index+1)*group_size].T:
+            sketches[:, index] = sketches[:, index]*_SF_MUL + feature
+    uniform = (chunks == chunks[:, 0:1]).all(axis=1)
+    sketches[uniform] = 0
+    return sketches
+
+
+def compute_range_sketches(data, start, end, chunk_size, batch_chunks=1024):
+    """Return sketches of the chunks in [start, end) of a large buffer (e.g.
+    mmap), computed in batches to bound memory usage
+    """
+    batch_size = batch_chunks*chunk_size
+    sketch_list = [compute_sketches(data[offset:min(offset+batch_size, end)],
+                                    chunk_size)
+                   for offset in xrange(start, end, batch_size)]
+    if len(sketch_list) == 0:
+        return numpy.zeros((0, SUPER_FEATURE_COUNT), dtype=numpy.uint64)
+    return numpy.concatenate(sketch_list)
+
+
+class SketchWriter(object):
+    """Write the sketch file of an image from its data given in order, so
+    that sketches are computed in the same pass that hashes the image
+    """
+
+    def __init__(self, sketch_path, image_size, chunk_size=4096,
+                 batch_chunks=1024):
+        self.sketch_path = sketch_path
+        self.chunk_size = chunk_size
+        self.chunk_count = image_size/chunk_size
+        self.batch_size = batch_chunks*chunk_size
+        self.written_count = 0
+        self.data_list = list()
+        self.data_size = 0
+        self.out_fd = open(sketch_path, "wb")
+        self.out_fd.write(struct.pack(SimilarityIndex.HEADER_FORMAT,
+                                      SimilarityIndex.MAGIC, chunk_size,
+                                      self.chunk_count))
+
+    def update(self, data):
+        self.data_list.append(data)
+        self.data_size += len(data)
+        if self.data_size >= self.batch_size:
+            self._flush()
+
+    def write_sketches(self, sketches):
+        """Append sketches of the next chunks, e.g. computed by hashing
+        workers with compute_range_sketches
+        """
+        self.out_fd.write(sketches.astype("<u8").tostring())
+        self.written_count += len(sketches)
+
+    def _flush(self):
+        data = ''.join(self.data_list)
+        remain_size = (self.chunk_count-self.written_count)*self.chunk_size
+        sketch_size = min(len(data)/self.chunk_size*self.chunk_size,
+                          remain_size)
+        if sketch_size > 0:
+            self.write_sketches(compute_sketches(data[:sketch_size],
+                                                 self.chunk_size))
+        self.data_list = [data[sketch_size:]]
+        self.data_size = len(data) - sketch_size
+
+    def close(self):
+        self._flush()
+        self.out_fd.close()
+        if self.written_count != self.chunk_count:
+            msg = "Sketch of %d chunks out of %d at %s" % \
+                (self.written_count, self.chunk_count, self.sketch_path)
+            raise SimilarityIndexError(msg)
+        LOG.info("Create sketch of %d chunks at %s" %
+                 (self.chunk_count, self.sketch_path))
+
+
+def create_sketch_file(base_path, sketch_path, chunk_size=4096,
+                       batch_chunks=1024):
+    """Compute sketches of every chunk of the base image and save them
+    """
+    sketch_writer = SketchWriter(sketch_path, os.path.getsize(base_path),
+                                 chunk_size, batch_chunks)
+    with open(base_path, "rb") as base_fd:
+        while True:
+            data = base_fd.read(sketch_writer.batch_size)
+            if not data:
+                break
+            sketch_writer.update(data)
+    sketch_writer.close()
+
+
+class SimilarityIndex(object):
+    MAGIC = 0x534b4348     # "SKCH"
+    HEADER_FORMAT = "!IIQ"
+    # diff algorithms that can use a base chunk at other offset
+    DIFF_ALGORITHMS = ("xdelta3", "bsdiff")
+    # look for a similar chunk when the diff at the same offset is larger
+    # than 1/8 of the chunk. For 4KB chunks of a shared library, bsdiff
+    # gives 0.04 of the chunk for a changed byte, 0.08 for 64 and 0.13 for
+    # 128 scattered bytes, while an unrelated chunk still gives 0.25 (10th
+    # percentile) to 0.6 (median) because the patch is compressed. A larger
+    # diff means the same offset is no longer a close base
+    POOR_DIFF_RATIO = 0.125
+
+    def __init__(self, chunk_size, sketches):
+        """Sorted arrays of each super-feature and the offset of its first
+        chunk. The arrays are built once by the diff stage and shared with
+        its diff children, which are forked from it
+        """
+        self.chunk_size = chunk_size
+        indexed = numpy.nonzero((sketches[:, 0] != 0) |
+                                (sketches[:, 1] != 0))[0]
+        self.feature_list = list()
+        self.offset_list = list()
+        for index in xrange(SUPER_FEATURE_COUNT):
+            features = sketches[indexed, index]
+            # stable sort keeps the first chunk of the same feature first
+            order = numpy.argsort(features, kind="mergesort")
+            self.feature_list.append(features[order])
+            self.offset_list.append(
+                indexed[order].astype(numpy.uint64)*numpy.uint64(chunk_size))
+        self.similar_count = 0
+
+    @staticmethod
+    def from_file(sketch_path):
+        with open(sketch_path, "rb") as fd:
+            header = fd.read(struct.calcsize(SimilarityIndex.HEADER_FORMAT))
+            (magic, chunk_size, chunk_count) = struct.unpack(
+                SimilarityIndex.HEADER_FORMAT, header)
+            if magic != SimilarityIndex.MAGIC:
+                raise SimilarityIndexError("Invalid sketch file %s" %
+                                           sketch_path)
+            sketches = numpy.fromfile(
+                fd, dtype="<u8", count=chunk_count*SUPER_FEATURE_COUNT)
+        if len(sketches) != chunk_count*SUPER_FEATURE_COUNT:
+            raise SimilarityIndexError("Truncated sketch file %s" %
+                                       sketch_path)
+        sketches = sketches.reshape(chunk_count, SUPER_FEATURE_COUNT)
+        return SimilarityIndex(chunk_size, sketches)
+
+    @staticmethod
+    def load(sketch_path):
+        if sketch_path is None or os.path.exists(sketch_path) is False:
+            LOG.warning("No base sketch at %s" % str(sketch_path))
+            return None
+        return SimilarityIndex.from_file(sketch_path)
+
+    def lookup(self, sketch):
+        """Return offset of the base chunk that shares the most
+        super-features with the sketch
+        """
+        candidate_count = dict()
+        for features, offsets, feature in zip(self.feature_list,
+                                              self.offset_list, sketch):
+            feature = numpy.uint64(feature)
+            position = numpy.searchsorted(features, feature)
+            if position < len(features) and features[position] == feature:
+                offset = long(offsets[position])
+                candidate_count[offset] = candidate_count.get(offset, 0) + 1
+        if len(candidate_count) == 0:
+            return None
+        return max(candidate_count.iteritems(), key=lambda x: x[1])[0]
+
+    def diff_similar_chunk(self, base_data, offset, data, diff_algorithm):
+        """Return REF_BASE_SIMILAR payload of the chunk or None
+        :param base_data: buffer of the base image (e.g. mmap)
+        :param offset: offset of the chunk, which is already compared
+        """
+        if len(data) != self.chunk_size:
+            return None
+        sketch = compute_sketches(data, self.chunk_size)[0]
+        source_offset = self.lookup(sketch)
+        if source_offset is None or source_offset == offset:
+            return None
+        source_data = base_data[source_offset:source_offset+len(data)]
+        try:
+            patch, patch_ref = diff_codec.diff_chunk(
+                diff_algorithm, source_data, data)
+        except IOError as e:
+            return None
+        payload = struct.pack("!Qc", source_offset, chr(patch_ref)) + patch
+        if len(payload) >= len(data):
+            return None
+        self.similar_count += 1
+        return payload
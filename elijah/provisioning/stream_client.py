@@ -43,6 +43,8 @@ from configuration import Const
 from configuration import VMOverlayCreationMode
 from synthesis_protocol import Protocol
 import process_manager
+import network_emulator
+from chunk_store import BloomFilter
 import log as logging
 
 LOG = logging.getLogger(__name__)
@@ -54,10 +56,52 @@ ACK_DATA_SIZE = 100*1024
 class StreamSynthesisClientError(Exception):
     pass
 
+
+def _recv_all(sock, recv_size):
+    data = ''
+    while len(data) < recv_size:
+        tmp_data = sock.recv(recv_size-len(data))
+        if tmp_data == None or len(tmp_data) == 0:
+            raise StreamSynthesisClientError("Connection is closed")
+        data += tmp_data
+    return data
+
+
+def request_chunk_filter(remote_addr, remote_port):
+    """Get bloom filter of chunks that the destination already has.
+    Return None if the destination does not support it.
+    """
+    address = (remote_addr, remote_port)
+    try:
+        sock = socket.create_connection(address, 10)
+        header = NetworkUtil.encoding({
+            Protocol.KEY_COMMAND: Protocol.MESSAGE_COMMAND_GET_CHUNK_FILTER,
+            })
+        sock.sendall(struct.pack("!I", len(header)))
+        sock.sendall(header)
+
+        # server acks once for the header size and once for the header
+        _recv_all(sock, 8*2)
+        message_size = struct.unpack("!I", _recv_all(sock, 4))[0]
+        message = NetworkUtil.decoding(_recv_all(sock, message_size))
+        sock.close()
+    except (socket.error, StreamSynthesisClientError) as e:
+        LOG.warning("Failed to get chunk filter from %s: %s" % (str(address), str(e)))
+        return None
+    if message.get(Protocol.KEY_COMMAND) != Protocol.MESSAGE_COMMAND_SUCCESS:
+        LOG.warning("Destination does not support chunk filter: %s" % str(message))
+        return None
+    chunk_filter = BloomFilter.from_dict(message[Protocol.KEY_CHUNK_FILTER])
+    LOG.info("Get chunk filter from %s (%d bytes)" % (str(address), len(chunk_filter.bits)))
+    return chunk_filter
+
+
 class NetworkMeasurementThread(threading.Thread):
-    def __init__(self, sock, blob_sent_time_dict, monitor_network_bw, vm_resume_time_at_dest):
+    def __init__(self, sock, blob_sent_time_dict, monitor_network_bw, vm_resume_time_at_dest,
+                 remote_chunk_dict=None):
         self.sock = sock
         self.blob_sent_time_dict = blob_sent_time_dict
+        self.remote_chunk_dict = remote_chunk_dict
 
         # shared memory
         self.monitor_network_bw = monitor_network_bw
@@ -97,7 +141,7 @@ class NetworkMeasurementThread(threading.Thread):
         time_start = 0
         measured_bw_list = list()
         while True:
-            ack_data = self.sock.recv(ack_size)
+            ack_data = _recv_all(self.sock, ack_size)
             ack = struct.unpack("!Q", ack_data)[0]
             time_recv_prev = time.time()
             if (ack == 0x01):
@@ -137,6 +181,26 @@ class NetworkMeasurementThread(threading.Thread):
                 self.monitor_network_bw.value = self.time_average(measured_bw_list,
                                                                   time_start,
                                                                   time_recv_cur)
+            elif (ack == Protocol.ACK_RESEND_CHUNKS):
+                # destination does not have chunks that we referenced by
+                # hash (false positive of the chunk filter)
+                data = _recv_all(self.sock, 8)
+                chunk_count = struct.unpack("!Q", data)[0]
+                data = _recv_all(self.sock, 32*chunk_count)
+                chunk_data_list = list()
+                for index in xrange(chunk_count):
+                    hash_value = data[32*index:32*(index+1)]
+                    chunk_data = None
+                    if self.remote_chunk_dict is not None:
+                        chunk_data = self.remote_chunk_dict.get(hash_value, None)
+                    if chunk_data is None:
+                        msg = "Cannot find requested chunk: %s" % hash_value.encode("hex")
+                        raise StreamSynthesisClientError(msg)
+                    chunk_data_list.append(chunk_data)
+                chunk_data = ''.join(chunk_data_list)
+                LOG.debug("Resend %d chunks (%d bytes)" % (chunk_count, len(chunk_data)))
+                self.sock.sendall(struct.pack("!I", len(chunk_data)))
+                self.sock.sendall(chunk_data)
             elif (ack == 0x10):
                 data = self.sock.recv(8)
                 vm_resume_time = struct.unpack("!d", data)[0]
@@ -149,11 +213,13 @@ class NetworkMeasurementThread(threading.Thread):
 
 class StreamSynthesisClient(process_manager.ProcWorker):
 
-    def __init__(self, remote_addr, remote_port, metadata, compdata_queue):
+    def __init__(self, remote_addr, remote_port, metadata, compdata_queue,
+                 remote_chunk_dict=None):
         self.remote_addr = remote_addr
         self.remote_port = remote_port
         self.metadata = metadata
         self.compdata_queue = compdata_queue
+        self.remote_chunk_dict = remote_chunk_dict
 
         # measurement
         self.monitor_network_bw = multiprocessing.RawValue(ctypes.c_double, 0)
@@ -182,11 +248,18 @@ class StreamSynthesisClient(process_manager.ProcWorker):
             msg = "failed to connect to %s" % str(address)
             raise StreamSynthesisClientError(msg)
         sock.setblocking(True)
+        if VMOverlayCreationMode.EMULATED_NETWORK_TRACE is not None:
+            # offline experiment: shape outgoing traffic following the trace
+            token_bucket = network_emulator.get_token_bucket(
+                VMOverlayCreationMode.EMULATED_BANDWIDTH_Mbps,
+                trace_path=VMOverlayCreationMode.EMULATED_NETWORK_TRACE)
+            sock = network_emulator.ShapedSocket(sock, token_bucket)
         self.blob_sent_time_dict = dict()
         self.receive_thread = NetworkMeasurementThread(sock,
                                                        self.blob_sent_time_dict,
                                                        self.monitor_network_bw,
-                                                       self.vm_resume_time_at_dest)
+                                                       self.vm_resume_time_at_dest,
+                                                       self.remote_chunk_dict)
         self.receive_thread.start()
 
         # send header
@@ -45,12 +45,16 @@ from db.api import DBConnector
 from db.table_def import BaseVM
 from configuration import Const as Cloudlet_Const
 from compression import DecompProc
+from chunk_store import ChunkStore
+from chunk_bitmap import ChunkBitmap
 from pprint import pformat
 import log as logging
 
 import mmap
 import tool
 from delta import DeltaItem
+from delta import recover_xor_items
+from delta import recover_similar_data
 
 LOG = logging.getLogger(__name__)
 session_resources = dict()   # dict[session_id] = obj(SessionResource)
@@ -65,7 +69,8 @@ class RecoverDeltaProc(multiprocessing.Process):
     def __init__(self, base_disk, base_mem,
                  decomp_delta_queue, output_mem_path,
                  output_disk_path, chunk_size,
-                 fuse_info_queue):
+                 fuse_info_queue, chunk_store_dir=None,
+                 missing_chunk_queue=None, fetched_chunk_queue=None):
         if base_disk == None and base_mem == None:
             raise StreamSynthesisError("Need either base_disk or base_memory")
 
@@ -88,6 +93,12 @@ class RecoverDeltaProc(multiprocessing.Process):
         self.recovered_hash_dict = dict()
         self.live_migration_iteration_dict = dict()
 
+        # local chunks that the sender can refer by hash
+        self.chunk_store_dir = chunk_store_dir
+        self.chunk_store = None
+        self.missing_chunk_queue = missing_chunk_queue
+        self.fetched_chunk_queue = fetched_chunk_queue
+
         multiprocessing.Process.__init__(self, target=self.recover_deltaitem)
 
     def recover_deltaitem(self):
@@ -101,6 +112,10 @@ class RecoverDeltaProc(multiprocessing.Process):
         self.raw_mem = mmap.mmap(self.base_mem_fd.fileno(), 0, prot=mmap.PROT_READ)
         self.recover_mem_fd = open(self.output_mem_path, "wrb")
         self.recover_disk_fd = open(self.output_disk_path, "wrb")
+        if self.chunk_store_dir is not None:
+            self.chunk_store = ChunkStore(
+                self.chunk_store_dir,
+                capacity=Cloudlet_Const.CHUNK_STORE_CAPACITY)
         delta_counter = collections.Counter()
         delta_times = collections.Counter()
         unresolved_deltaitem_list = []
@@ -114,6 +129,8 @@ class RecoverDeltaProc(multiprocessing.Process):
             LOG.debug("%f\trecover one blob" % (time.time()))
 
             delta_item_list = RecoverDeltaProc.from_buffer(recv_data,delta_counter,delta_times)
+            recover_xor_items(delta_item_list, self.raw_mem, self.raw_disk,
+                              delta_times)
             for delta_item in delta_item_list:
                 ret = self.recover_item(delta_item,delta_counter,delta_times)
                 if ret == None:
@@ -131,14 +148,32 @@ class RecoverDeltaProc(multiprocessing.Process):
 
         LOG.info("[Delta] Handle dangling DeltaItem (%d)" % len(unresolved_deltaitem_list))
         overlay_chunk_ids = list()
-        for delta_item in unresolved_deltaitem_list:
-            ret = self.recover_item(delta_item,delta_counter,delta_times)
-            if ret == None:
-                msg = "Cannot find self reference: type(%ld), offset(%ld), index(%ld)" % \
-                        (delta_item.delta_type, delta_item.offset, delta_item.index)
-                raise StreamSynthesisError(msg)
-            self.process_deltaitem(delta_item, delta_counter,delta_times)
-            count += 1
+        unresolved_deltaitem_list, resolved_count = self._recover_dangling_items(
+            unresolved_deltaitem_list, delta_counter, delta_times)
+        count += resolved_count
+        if self.missing_chunk_queue is not None:
+            # fetch chunks that are referenced by hash but do not exist in
+            # local chunk store (false positive of the chunk filter)
+            missing_hash_set = set([item.data for item in unresolved_deltaitem_list
+                                    if item.ref_id == DeltaItem.REF_SELF_HASH])
+            self.missing_chunk_queue.put(list(missing_hash_set))
+            if len(missing_hash_set) > 0:
+                fetched_data = self.fetched_chunk_queue.get()
+                for fetched_item in RecoverDeltaProc.from_buffer(
+                        fetched_data, delta_counter, delta_times):
+                    if self.recover_item(fetched_item, delta_counter, delta_times) == None:
+                        raise StreamSynthesisError("Cannot recover fetched chunk")
+                    self.recovered_hash_dict[fetched_item.hash_value] = fetched_item
+                LOG.info("[Delta] Fetch %d missing chunks" % len(missing_hash_set))
+                unresolved_deltaitem_list, resolved_count = self._recover_dangling_items(
+                    unresolved_deltaitem_list, delta_counter, delta_times)
+                count += resolved_count
+        if len(unresolved_deltaitem_list) > 0:
+            delta_item = unresolved_deltaitem_list[0]
+            msg = "Cannot find self reference: type(%ld), offset(%ld), index(%ld)" % \
+                    (delta_item.delta_type, delta_item.offset, delta_item.index)
+            raise StreamSynthesisError(msg)
+        self._update_chunk_store()
 
         self.recover_mem_fd.close()
         self.recover_mem_fd = None
@@ -156,6 +191,34 @@ class RecoverDeltaProc(multiprocessing.Process):
                 (count, time_start, time_end, (time_end-time_start)))
         LOG.info("Finish VM handoff")
 
+    def _recover_dangling_items(self, deltaitem_list, delta_counter, delta_times):
+        # resolving an item can make other items resolvable, so repeat until
+        # there is no progress
+        resolved_count = 0
+        while len(deltaitem_list) > 0:
+            unresolved_deltaitem_list = list()
+            for delta_item in deltaitem_list:
+                ret = self.recover_item(delta_item, delta_counter, delta_times)
+                if ret == None:
+                    unresolved_deltaitem_list.append(delta_item)
+                    continue
+                self.process_deltaitem(delta_item, delta_counter, delta_times)
+                resolved_count += 1
+            if len(unresolved_deltaitem_list) == len(deltaitem_list):
+                break
+            deltaitem_list = unresolved_deltaitem_list
+        return deltaitem_list, resolved_count
+
+    def _update_chunk_store(self):
+        if self.chunk_store is None:
+            return
+        added_count = self.chunk_store.add_chunks(
+            [(hash_value, delta_item.data) for (hash_value, delta_item)
+             in self.recovered_hash_dict.iteritems()])
+        self.chunk_store.close()
+        LOG.info("[Delta] Add %d chunks to chunk store (total %d)" %
+                 (added_count, len(self.chunk_store)))
+
     def recover_item(self, delta_item, delta_counter, delta_times):
         if type(delta_item) != DeltaItem:
             raise StreamSynthesisError("Need list of DeltaItem")
@@ -184,9 +247,12 @@ class RecoverDeltaProc(multiprocessing.Process):
         elif delta_item.ref_id == DeltaItem.REF_SELF_HASH:
             ref_hashvalue = delta_item.data
             self_ref_delta_item = self.recovered_hash_dict.get(ref_hashvalue, None)
-            if self_ref_delta_item == None:
+            if self_ref_delta_item != None:
+                recover_data = self_ref_delta_item.data
+            elif self.chunk_store != None and ref_hashvalue in self.chunk_store:
+                recover_data = self.chunk_store.get(ref_hashvalue)
+            else:
                 return None
-            recover_data = self_ref_delta_item.data
             delta_item.hash_value = ref_hashvalue
         elif delta_item.ref_id == DeltaItem.REF_XDELTA:
             patch_data = delta_item.data
@@ -223,7 +289,10 @@ class RecoverDeltaProc(multiprocessing.Process):
                 base_data = self.raw_disk[delta_item.offset:delta_item.offset+patch_original_size]
             else:
                 raise StreamSynthesisError("Delta type should be either disk or memory")
-            recover_data = tool.cython_xor(base_data, patch_data)
+            recover_data = tool.xor_data(base_data, patch_data)
+        elif delta_item.ref_id == DeltaItem.REF_BASE_SIMILAR:
+            recover_data = recover_similar_data(
+                delta_item, self.raw_mem, self.raw_disk)
         else:
             raise StreamSynthesisError("Cannot recover: invalid referce id %d" % delta_item.ref_id)
 
@@ -276,7 +345,8 @@ class RecoverDeltaProc(multiprocessing.Process):
         if ref_id == DeltaItem.REF_RAW or \
                 ref_id == DeltaItem.REF_XDELTA or \
                 ref_id == DeltaItem.REF_XOR or \
-                ref_id == DeltaItem.REF_BSDIFF:
+                ref_id == DeltaItem.REF_BSDIFF or \
+                ref_id == DeltaItem.REF_BASE_SIMILAR:
             data_len = struct.unpack_from("!Q", stream, offset)[0]
             offset += struct.calcsize("!Q")
             data = stream[offset:offset+data_len]
@@ -401,6 +471,29 @@ class FuseFeedingProc(multiprocessing.Process):
 def handlesig(signum, frame):
     LOG.info("Received signal(%d) to terminate VM..." % signum)
 
+def _recv_exact(sock, recv_size):
+    data = ''
+    while len(data) < recv_size:
+        tmp_data = sock.recv(recv_size-len(data))
+        if tmp_data == None or len(tmp_data) == 0:
+            raise StreamSynthesisError("Connection is closed")
+        data += tmp_data
+    return data
+
+
+def request_missing_chunks(sock, missing_hash_list):
+    """Ask the client to resend the delta items of chunks that it referred
+    by hash, but are not in the chunk store.
+    Return the serialized delta items
+    """
+    request_data = struct.pack("!QQ", Protocol.ACK_RESEND_CHUNKS,
+                               len(missing_hash_list))
+    request_data += ''.join(missing_hash_list)
+    sock.sendall(request_data)
+    fetched_size = struct.unpack("!I", _recv_exact(sock, 4))[0]
+    return _recv_exact(sock, fetched_size)
+
+
 class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
     synthesis_option = {
             Protocol.SYNTHESIS_OPTION_DISPLAY_VNC : False,
@@ -443,7 +536,7 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
         except socket.error as e:
             pass
 
-    def _recv_all(self, recv_size, ack_size=1024*1024):
+    def _recv_all(self, recv_size, ack_size=1024*1024, send_ack=True):
         prev_ack_sent_size = 0
         data = ''
         while len(data) < recv_size:
@@ -457,12 +550,22 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
             # to send ack for every PERIODIC_ACK_BYTES bytes
             cur_recv_size = len(data)
             data_diff = cur_recv_size-prev_ack_sent_size
+            if send_ack == False:
+                continue
             if  data_diff > ack_size or cur_recv_size >= recv_size:
                 ack_data = struct.pack("!Q", data_diff)
                 self.request.sendall(ack_data)
                 prev_ack_sent_size = cur_recv_size
         return data
 
+    def _send_chunk_filter(self):
+        chunk_store = ChunkStore(self.server.chunk_store_dir)
+        chunk_filter = chunk_store.get_bloom_filter()
+        LOG.info("Send chunk filter of %d chunks (%d bytes)" % \
+                (len(chunk_store), len(chunk_filter.bits)))
+        self.ret_success(Protocol.MESSAGE_COMMAND_GET_CHUNK_FILTER,
+                         payload={Protocol.KEY_CHUNK_FILTER: chunk_filter.to_dict()})
+
     def _check_validity(self, message):
         header_info = None
         requested_base = None
@@ -477,6 +580,45 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
                 requested_base = each_basevm['diskpath']
         return [synthesis_option, requested_base]
 
+    def _recv_blobs(self, network_out_queue, disk_chunk_all, memory_chunk_all):
+        '''Receive blobs until the end of stream, pass them to
+        network_out_queue and add their chunks to the chunk bitmaps.
+        Return the number of received blobs
+        '''
+        recv_blob_counter = 0
+        while True:
+            data = self._recv_all(4)
+            if data == None or len(data) != 4:
+                raise StreamSynthesisError("Failed to receive first byte of header")
+
+            blob_header_size = struct.unpack("!I", data)[0]
+            blob_header_raw = self._recv_all(blob_header_size)
+            blob_header = NetworkUtil.decoding(blob_header_raw)
+            blob_size = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_SIZE)
+            if blob_size == None:
+                raise StreamSynthesisError("Failed to receive blob")
+            if blob_size == 0:
+                LOG.debug("%f\tend of stream" % (time.time()))
+                break
+            blob_comp_type = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_COMPRESSION)
+            blob_disk_chunk = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_DISK_CHUNKS)
+            blob_memory_chunk = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_MEMORY_CHUNKS)
+
+            # send ack right before getting the blob
+            ack_data = struct.pack("!Q", 0x01)
+            self.request.send(ack_data)
+            compressed_blob = self._recv_all(blob_size, ack_size=200*1024)
+            # send ack right after getting the blob
+            ack_data = struct.pack("!Q", 0x02)
+            self.request.send(ack_data)
+
+            network_out_queue.put((blob_comp_type, compressed_blob))
+            memory_chunk_all.update(blob_memory_chunk)
+            disk_chunk_all.update(blob_disk_chunk)
+            LOG.debug("%f\treceive one blob" % (time.time()))
+            recv_blob_counter += 1
+        return recv_blob_counter
+
     def handle(self):
         '''Handle request from the client
         Each request follows this format:
@@ -500,6 +642,10 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
         message_size = struct.unpack("!I", data)[0]
         msgpack_data = self._recv_all(message_size)
         metadata = NetworkUtil.decoding(msgpack_data)
+        if metadata.get(Protocol.KEY_COMMAND, None) == \
+                Protocol.MESSAGE_COMMAND_GET_CHUNK_FILTER:
+            self._send_chunk_filter()
+            return
         launch_disk_size = metadata[Cloudlet_Const.META_RESUME_VM_DISK_SIZE]
         launch_memory_size = metadata[Cloudlet_Const.META_RESUME_VM_MEMORY_SIZE]
 
@@ -519,14 +665,16 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
         temp_synthesis_dir = tempfile.mkdtemp(prefix="cloudlet-comp-")
         launch_disk = os.path.join(temp_synthesis_dir, "launch-disk")
         launch_mem = os.path.join(temp_synthesis_dir, "launch-mem")
-        memory_chunk_all = set()
-        disk_chunk_all = set()
+        memory_chunk_all = ChunkBitmap()
+        disk_chunk_all = ChunkBitmap()
 
         # start pipelining processes
         network_out_queue = multiprocessing.Queue()
         decomp_queue = multiprocessing.Queue()
         fuse_info_queue = multiprocessing.Queue()
-        decomp_proc = DecompProc(network_out_queue, decomp_queue, num_proc=4)
+        missing_chunk_queue = multiprocessing.Queue()
+        fetched_chunk_queue = multiprocessing.Queue()
+        decomp_proc = DecompProc(network_out_queue, decomp_queue)
         decomp_proc.start()
         LOG.info("Start Decompression process")
         delta_proc = RecoverDeltaProc(base_diskpath, base_mempath,
@@ -534,45 +682,22 @@ class StreamSynthesisHandler(SocketServer.StreamRequestHandler):
                                     launch_mem,
                                     launch_disk,
                                     Cloudlet_Const.CHUNK_SIZE,
-                                    fuse_info_queue)
+                                    fuse_info_queue,
+                                    chunk_store_dir=self.server.chunk_store_dir,
+                                    missing_chunk_queue=missing_chunk_queue,
+                                    fetched_chunk_queue=fetched_chunk_queue)
         delta_proc.start()
         LOG.info("Start Synthesis process")
 
         # get each blob
-        recv_blob_counter = 0
-        while True:
-            data = self._recv_all(4)
-            if data == None or len(data) != 4:
-                raise StreamSynthesisError("Failed to receive first byte of header")
-
-            blob_header_size = struct.unpack("!I", data)[0]
-            blob_header_raw = self._recv_all(blob_header_size)
-            blob_header = NetworkUtil.decoding(blob_header_raw)
-            blob_size = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_SIZE)
-            if blob_size == None:
-                raise StreamSynthesisError("Failed to receive blob")
-            if blob_size == 0:
-                LOG.debug("%f\tend of stream" % (time.time()))
-                break
-            blob_comp_type = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_COMPRESSION)
-            blob_disk_chunk = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_DISK_CHUNKS)
-            blob_memory_chunk = blob_header.get(Cloudlet_Const.META_OVERLAY_FILE_MEMORY_CHUNKS)
-
-            # send ack right before getting the blob
-            ack_data = struct.pack("!Q", 0x01)
-            self.request.send(ack_data)
-            compressed_blob = self._recv_all(blob_size, ack_size=200*1024)
-            # send ack right after getting the blob
-            ack_data = struct.pack("!Q", 0x02)
-            self.request.send(ack_data)
-
-            network_out_queue.put((blob_comp_type, compressed_blob))
-            memory_chunk_all.update(blob_memory_chunk)
-            disk_chunk_all.update(blob_disk_chunk)
-            LOG.debug("%f\treceive one blob" % (time.time()))
-            recv_blob_counter += 1
-
+        self._recv_blobs(network_out_queue, disk_chunk_all, memory_chunk_all)
         network_out_queue.put(Cloudlet_Const.QUEUE_SUCCESS_MESSAGE)
+        missing_hash_list = missing_chunk_queue.get()
+        if len(missing_hash_list) > 0:
+            # request chunks that were referenced by hash but not found
+            LOG.info("Request %d missing chunks to client" % len(missing_hash_list))
+            fetched_chunk_queue.put(
+                request_missing_chunks(self.request, missing_hash_list))
         delta_proc.join()
         LOG.debug("%f\tdeltaproc join" % (time.time()))
 
@@ -677,9 +802,11 @@ class StreamSynthesisConst(object):
 
 class StreamSynthesisServer(SocketServer.TCPServer):
     def __init__(self, port_number=StreamSynthesisConst.SERVER_PORT_NUMBER,
-                 timeout=None, handoff_datafile=None):
+                 timeout=None, handoff_datafile=None,
+                 chunk_store_dir=Cloudlet_Const.CHUNK_STORE_DIR):
         self.port_number = port_number
         self.timeout = timeout
+        self.chunk_store_dir = chunk_store_dir
         self._handoff_datafile = handoff_datafile
         if self._handoff_datafile:
             self.handoff_data = self._load_handoff_data(self._handoff_datafile)
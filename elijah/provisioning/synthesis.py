@@ -31,6 +31,7 @@ import json
 import msgpack
 import signal
 import threading
+import multiprocessing
 import traceback
 from operator import itemgetter
 from urlparse import urlsplit
@@ -49,6 +50,11 @@ from . import disk
 from . import cloudletfs
 from . import memory_util
 from . import delta
+from . import base_meta
+from . import access_trace
+from . import chunk_map
+from . import byte_queue
+from . import overlay_meta
 from .db import api as db_api
 from .db import table_def as db_table
 from .configuration import Const
@@ -59,6 +65,7 @@ from .progressbar import AnimatedProgressBar
 from .package import VMOverlayPackage
 from . import handoff
 from . import qmp_af_unix
+from . import process_manager
 from .tool import comp_lzma
 from . import compression
 from . import log as logging
@@ -125,11 +132,17 @@ class VM_Overlay(native_threading.Thread):
     def __init__(self, base_disk, options, qemu_args=None,
                  base_mem=None, base_diskmeta=None,
                  base_memmeta=None, base_hashvalue=None,
-                 nova_xml=None, nova_util=None, nova_conn=None):
+                 nova_xml=None, nova_util=None, nova_conn=None,
+                 overlay_mode=None):
         """create VM overlay from a user-customized VM.
+        :param overlay_mode: VMOverlayCreationMode to create the overlay
+        with the pipeline of VM handoff, which processes the memory snapshot
+        while QEMU saves it ('cloudlet overlay -p'). The overlay is created
+        serially after saving the memory snapshot if None
         """
         self.base_disk = os.path.abspath(base_disk)
         self.options = options
+        self.overlay_mode = overlay_mode
         self.nova_xml = nova_xml or None
         self.qemu_args = qemu_args or None
         (self.base_diskmeta, self.base_mem, self.base_memmeta) = \
@@ -172,12 +185,20 @@ class VM_Overlay(native_threading.Thread):
         # filename for overlay VM
         temp_qemu_dir = mkdtemp(prefix="cloudlet-qemu-")
         self.qemu_logfile = os.path.join(temp_qemu_dir, "qemu-trim-log")
+        self.qmp_channel = None
+        qemu_files = [self.qemu_logfile]
+        if self._is_pipelined():
+            self.qmp_channel = os.path.abspath(
+                os.path.join(temp_qemu_dir, "qmp-channel"))
+            qemu_files.append(self.qmp_channel)
         # change permission of the file
-        for qemu_file in [self.qemu_logfile]:
+        for qemu_file in qemu_files:
             open(qemu_file, "w+").close()
             os.chmod(os.path.dirname(qemu_file), 0o777)
             os.chmod(qemu_file, 0o666)
             LOG.info("QEMU access file : %s" % qemu_file)
+        if self.qmp_channel is not None and os.path.exists(self.qmp_channel):
+            os.remove(self.qmp_channel)
 
         # make FUSE disk & memory
         self.fuse = run_fuse(Const.CLOUDLETFS_PATH, Const.CHUNK_SIZE,
@@ -207,7 +228,11 @@ class VM_Overlay(native_threading.Thread):
                                      'memory',
                                      'streams',
                                      'chunks_accessed')
-        self.fuse_stream_monitor = cloudletfs.StreamMonitor()
+        self.modified_disk_queue = None
+        if self._is_pipelined():
+            self.modified_disk_queue = multiprocessing.Queue()
+        self.fuse_stream_monitor = cloudletfs.StreamMonitor(
+            modified_disk_queue=self.modified_disk_queue)
         self.fuse_stream_monitor.add_path(
             stream_modified, cloudletfs.StreamMonitor.DISK_MODIFY)
         self.fuse_stream_monitor.add_path(
@@ -222,16 +247,120 @@ class VM_Overlay(native_threading.Thread):
         # resume & get modified disk
         LOG.info("* Overlay creation configuration")
         LOG.info("  - %s" % str(self.options))
-        self.old_xml_str, self.new_xml_str = _convert_xml(
-            self.modified_disk, mem_snapshot=self.base_mem_fuse,
-            qemu_logfile=self.qemu_logfile, qemu_args=self.qemu_args,
-            nova_xml=self.nova_xml)
+        if self._is_pipelined():
+            # QEMU streams memory snapshot with page headers, so the
+            # pipeline can process it while it is being saved
+            self.old_xml_str, self.new_xml_str = _convert_xml(
+                self.modified_disk, mem_snapshot=self.base_mem_fuse,
+                qemu_logfile=self.qemu_logfile,
+                qmp_channel=self.qmp_channel, qemu_args=self.qemu_args,
+                nova_xml=self.nova_xml, memory_snapshot_mode="live")
+        else:
+            self.old_xml_str, self.new_xml_str = _convert_xml(
+                self.modified_disk, mem_snapshot=self.base_mem_fuse,
+                qemu_logfile=self.qemu_logfile, qemu_args=self.qemu_args,
+                nova_xml=self.nova_xml)
         self.machine = run_snapshot(self.conn, self.modified_disk,
                                     self.base_mem_fuse, self.new_xml_str)
+        if self.nova_util and self.qmp_channel is not None:
+            self.nova_util.execute(
+                'chmod', 775, self.qmp_channel, run_as_root=True)
         return self.machine
 
+    def _is_pipelined(self):
+        # disk only overlay does not have memory snapshot to stream
+        return self.overlay_mode is not None and not self.options.DISK_ONLY
+
     @wrap_vm_fault
     def create_overlay(self):
+        if self._is_pipelined():
+            self._create_overlay_pipelined()
+        else:
+            self._create_overlay_serial()
+
+        # terminate
+        self.terminate()
+
+    def _create_overlay_pipelined(self):
+        """create VM overlay with the pipeline of VM handoff.
+        Memory snapshot is diffed, deduplicated and compressed while QEMU
+        saves it. Disk chunks join the pipeline once the VM is stopped and
+        its TRIM log is complete.
+        """
+        overlay_mode = self.overlay_mode
+        temp_dir = mkdtemp(prefix="cloudlet-overlay-")
+        process_controller = process_manager.get_instance()
+        process_controller.set_mode(
+            overlay_mode, "file://%s" % os.path.join(temp_dir, Const.OVERLAY_ZIP))
+        LOG.debug("* Overlay creation mode start\n%s" % str(overlay_mode))
+        LOG.debug("* Overlay creation mode end")
+
+        memory_snapshot_queue = multiprocessing.Queue(
+            overlay_mode.QUEUE_SIZE_MEMORY_SNAPSHOT)
+        disk_deltalist_queue = byte_queue.get_stage_queue(
+            overlay_mode.QUEUE_SIZE_DISK_DELTA_LIST,
+            overlay_mode.QUEUE_BYTES_DISK_DELTA_LIST)
+        basedisk_hashdict = delta.DeltaDedup.disk_import_hashdict(
+            self.base_diskmeta)
+        basemem_hashdict = delta.DeltaDedup.memory_import_hashdict(
+            self.base_memmeta)
+        # chunks accessed since the resume, before snapshotting touches
+        # every memory page
+        trace = access_trace.AccessTrace.from_monitor(
+            self.fuse_stream_monitor)
+        LOG.info("Access trace of %d chunks" % len(trace))
+
+        # stream memory snapshot and stop the VM at the first iteration
+        memory_read_proc = handoff.save_mem_snapshot(
+            self.conn, self.machine, memory_snapshot_queue,
+            fuse_stream_monitor=self.fuse_stream_monitor)
+        qmp_thread = QmpThreadSerial(self.qmp_channel,
+                                     self.fuse_stream_monitor)
+        qmp_thread.daemon = True
+        qmp_thread.start()
+        if overlay_mode.PROCESS_PIPELINED == False:
+            handoff._waiting_to_finish(process_controller,
+                                       "MemoryReadProcess")
+        memory_deltalist_queue = handoff.create_memory_delta_proc(
+            self.options, overlay_mode, self.base_mem, self.base_memmeta,
+            dict(), memory_snapshot_queue, process_controller)
+        synthesis_file = None
+        if overlay_mode.PROCESS_PIPELINED:
+            synthesis_file = _start_overlay_file_stages(
+                overlay_mode, self.base_hashvalue, memory_deltalist_queue,
+                disk_deltalist_queue, basedisk_hashdict, basemem_hashdict,
+                temp_dir, process_controller, trace=trace)
+
+        # TRIM log is complete only after the VM is stopped
+        qmp_thread.join()
+        monitoring_info = _get_pipeline_monitoring_info(
+            self.options, self.qemu_logfile, self.modified_disk,
+            self.modified_disk_queue)
+        handoff.create_disk_delta_proc(monitoring_info, overlay_mode,
+                                       self.base_disk, self.modified_disk,
+                                       disk_deltalist_queue,
+                                       process_controller)
+        if synthesis_file is None:
+            synthesis_file = _start_overlay_file_stages(
+                overlay_mode, self.base_hashvalue, memory_deltalist_queue,
+                disk_deltalist_queue, basedisk_hashdict, basemem_hashdict,
+                temp_dir, process_controller, trace=trace)
+        synthesis_file.join()
+        resume_memory_size = memory_read_proc.get_memory_snapshot_size()
+        process_manager.kill_instance()
+        memory_read_proc.finish()   # deallocate resources for snapshotting
+        self.machine = None
+        if resume_memory_size < 0:
+            msg = "Failed to get memory snapshot size"
+            raise CloudletGenerationError(msg)
+
+        self.overlay_metafile, self.overlay_files = _finish_overlay_file(
+            synthesis_file, self.base_hashvalue,
+            os.path.getsize(self.modified_disk), resume_memory_size,
+            temp_dir, trace=trace)
+        self._package_overlay(temp_dir)
+
+    def _create_overlay_serial(self):
         # get montoring info
         monitoring_info = _get_overlay_monitoring_info(
             self.conn,
@@ -270,6 +399,9 @@ class VM_Overlay(native_threading.Thread):
             os.path.getsize(self.modified_mem.name),
             overlay_metapath,
             overlay_prefix)
+        self._package_overlay(temp_dir)
+
+    def _package_overlay(self, temp_dir):
         # packaging VM overlay into a single zip file
         if self.options.ZIP_CONTAINER:
             self.overlay_zipfile = os.path.join(temp_dir, Const.OVERLAY_ZIP)
@@ -284,9 +416,6 @@ class VM_Overlay(native_threading.Thread):
                 if os.path.exists(overlay_file):
                     os.remove(overlay_file)
 
-        # terminate
-        self.terminate()
-
     def terminate(self):
         if hasattr(self, 'fuse_stream_monitor') and\
                 (self.fuse_stream_monitor is not None):
@@ -478,7 +607,7 @@ def _update_overlay_meta(original_meta, new_path, blob_info=None):
 
     if blob_info:
         original_meta[Const.META_OVERLAY_FILES] = blob_info
-    serialized = msgpack.packb(original_meta)
+    serialized = overlay_meta.pack_meta(original_meta)
     fout.write(serialized)
     fout.close()
 
@@ -796,6 +925,89 @@ def _get_overlay_monitoring_info(conn, machine, options,
     return monitoring_info
 
 
+def _start_overlay_file_stages(overlay_mode, base_hashvalue,
+                               memory_deltalist_queue, disk_deltalist_queue,
+                               basedisk_hashdict, basemem_hashdict, temp_dir,
+                               process_controller, trace=None):
+    """start deduplication and compression of the overlay creation pipeline
+    with a file sink writing compressed blobs at temp_dir.
+    Return the file sink thread
+    """
+    residue_deltalist_queue = byte_queue.get_stage_queue(
+        overlay_mode.QUEUE_SIZE_OPTIMIZATION,
+        overlay_mode.QUEUE_BYTES_OPTIMIZATION)
+    compdata_queue = byte_queue.get_stage_queue(
+        overlay_mode.QUEUE_SIZE_COMPRESSION,
+        overlay_mode.QUEUE_BYTES_COMPRESSION)
+    LOG.info("Generate VM overlay using deduplication")
+    handoff.create_dedup_proc(overlay_mode, basedisk_hashdict,
+                              basemem_hashdict, memory_deltalist_queue,
+                              disk_deltalist_queue, residue_deltalist_queue,
+                              access_trace=trace)
+    if overlay_mode.PROCESS_PIPELINED == False:
+        handoff._waiting_to_finish(process_controller, "DeltaDedup")
+
+    LOG.info("Compressing overlay blobs")
+    compress_proc = compression.CompressProc(residue_deltalist_queue,
+                                             compdata_queue,
+                                             overlay_mode,
+                                             access_trace=trace)
+    compress_proc.start()
+    if overlay_mode.PROCESS_PIPELINED == False:
+        handoff._waiting_to_finish(process_controller, "CompressProc")
+
+    # write compressed blobs to files without network emulation
+    synthesis_file = handoff.StreamSynthesisFile(
+        base_hashvalue, compdata_queue, temp_dir, emulate_network=False)
+    synthesis_file.start()
+    return synthesis_file
+
+
+def _finish_overlay_file(synthesis_file, base_hashvalue, launchdisk_size,
+                         launchmem_size, temp_dir, trace=None):
+    """write overlay meta of the blobs written by the file sink
+    :return: [overlay_metapath, [overlayfilepath1, overlayfilepath2]]
+    """
+    # blobs of the accessed chunks come first
+    overlay_info, overlay_files = synthesis_file.get_overlay_info()
+    overlay_info = access_trace.order_overlay_files(overlay_info, trace)
+    overlay_metapath = handoff._generate_overlaymeta(
+        os.path.join(temp_dir, Const.OVERLAY_META),
+        overlay_info,
+        base_hashvalue,
+        launchdisk_size,
+        launchmem_size,
+        access_trace=trace)
+    return overlay_metapath, overlay_files
+
+
+def _get_pipeline_monitoring_info(options, qemu_logfile, modified_disk,
+                                  modified_disk_queue):
+    """return montioring information for the overlay creation pipeline.
+    Modified disk chunks are streamed through modified_disk_queue
+    """
+    if options.TRIM_SUPPORT:
+        dma_dict, trim_dict = disk.parse_qemu_log(
+            qemu_logfile, Const.CHUNK_SIZE)
+        if len(trim_dict) == 0:
+            LOG.warning("No TRIM Discard, Check /etc/fstab configuration")
+    else:
+        trim_dict = dict()
+
+    # get used sector information from x-ray
+    used_blocks_dict = None
+    if options.XRAY_SUPPORT:
+        import xray
+        used_blocks_dict = xray.get_used_blocks(modified_disk)
+
+    info_dict = dict()
+    info_dict[OverlayMonitoringInfo.DISK_USED_BLOCKS] = used_blocks_dict
+    info_dict[OverlayMonitoringInfo.DISK_MODIFIED_BLOCKS] = modified_disk_queue
+    info_dict[OverlayMonitoringInfo.DISK_FREE_BLOCKS] = trim_dict
+    info_dict[OverlayMonitoringInfo.MEMORY_FREE_BLOCKS] = dict()
+    return OverlayMonitoringInfo(info_dict)
+
+
 def copy_disk(in_path, out_path):
     LOG.info("Copying disk image to %s" % out_path)
     cmd = ["cp",  "%s" % (in_path), "%s" % (out_path)]
@@ -886,7 +1098,7 @@ def _create_overlay_meta(overlay_metafile, base_hash, modified_disksize,
     meta_dict[Const.META_RESUME_VM_MEMORY_SIZE] = long(modified_memsize)
     meta_dict[Const.META_OVERLAY_FILES] = blob_info
 
-    serialized = msgpack.packb(meta_dict)
+    serialized = overlay_meta.pack_meta(meta_dict)
     fout.write(serialized)
     fout.close()
 
@@ -942,13 +1154,11 @@ def recover_launchVM(base_image, meta_info, overlay_file, **kwargs):
     # Get modified list from overlay_meta
     vm_disk_size = meta_info[Const.META_RESUME_VM_DISK_SIZE]
     vm_memory_size = meta_info[Const.META_RESUME_VM_MEMORY_SIZE]
-    memory_chunks_all = set()
-    disk_chunks_all = set()
-    for each_file in meta_info[Const.META_OVERLAY_FILES]:
-        memory_chunks = each_file[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
-        disk_chunks = each_file[Const.META_OVERLAY_FILE_DISK_CHUNKS]
-        memory_chunks_all.update(memory_chunks)
-        disk_chunks_all.update(disk_chunks)
+    overlay_files = meta_info[Const.META_OVERLAY_FILES]
+    memory_chunks_all = overlay_meta.get_chunk_bitmap(
+        overlay_files, Const.META_OVERLAY_FILE_MEMORY_CHUNKS)
+    disk_chunks_all = overlay_meta.get_chunk_bitmap(
+        overlay_files, Const.META_OVERLAY_FILE_DISK_CHUNKS)
 
     # make FUSE disk & memory
     kwargs['meta_info'] = meta_info
@@ -998,12 +1208,27 @@ def run_fuse(bin_path, chunk_size, original_disk, fuse_disk_size,
     resumed_disk = os.path.abspath(resumed_disk) if resumed_disk else ""
     resumed_memory = os.path.abspath(resumed_memory) if resumed_memory else ""
 
+    # pass overlay maps to cloudletfs through files if it reads them
+    map_dir = mkdtemp(prefix="cloudlet-chunk-map-")
+    use_map_file = chunk_map.is_supported(bin_path)
     if disk_overlay_map is None:
-        disk_overlay_map = ','.join("%ld:%d" % (item, valid_bit)
-                                     for item in disk_chunks or [])
+        if use_map_file:
+            disk_map_path = os.path.join(map_dir, "disk")
+            chunk_map.write_chunk_map(disk_map_path, disk_chunks or [],
+                                      valid_bit)
+            disk_overlay_map = chunk_map.get_argument(disk_map_path)
+        else:
+            disk_overlay_map = chunk_map.get_string_argument(
+                disk_chunks or [], valid_bit)
     if memory_overlay_map is None:
-        memory_overlay_map = ','.join("%ld:%d" % (item, valid_bit)
-                                      for item in memory_chunks or [])
+        if use_map_file:
+            memory_map_path = os.path.join(map_dir, "memory")
+            chunk_map.write_chunk_map(memory_map_path, memory_chunks or [],
+                                      valid_bit)
+            memory_overlay_map = chunk_map.get_argument(memory_map_path)
+        else:
+            memory_overlay_map = chunk_map.get_string_argument(
+                memory_chunks or [], valid_bit)
 
     # launch fuse
     execute_args = [
@@ -1034,7 +1259,11 @@ def run_fuse(bin_path, chunk_size, original_disk, fuse_disk_size,
         modified_disk_chunks=disk_chunks,
         modified_memory_chunks=memory_chunks,
         **kwargs)
-    fuse_process.launch()
+    try:
+        # cloudletfs reads the maps before it mounts
+        fuse_process.launch()
+    finally:
+        shutil.rmtree(map_dir, ignore_errors=True)
     fuse_process.start()
     return fuse_process
 
@@ -1513,16 +1742,26 @@ def _create_baseVM(conn, domain,
     # make memory snapshot
     # VM has to be paused first to perform stable disk hashing
     save_mem_snapshot(conn, domain, base_mempath, **kwargs)
+    # sketches to find similar base chunks at any offset are computed
+    # while hashing
+    (base_disksketch, base_memsketch) = \
+        Const.get_base_sketchpath(base_diskpath)
     LOG.info("Start Base VM Memory hashing")
-    base_mem = memory.hashing(base_mempath)
+    base_mem = memory.hashing(base_mempath, sketch_path=base_memsketch)
     base_mem.export_to_file(base_memmeta)
     LOG.info("Finish Base VM Memory hashing")
 
     # generate disk hashing
     # TODO: need more efficient implementation, e.g. bisect
     LOG.info("Start Base VM Disk hashing")
-    base_hashvalue = disk.hashing(base_diskpath, base_diskmeta)
+    base_hashvalue = disk.hashing(base_diskpath, base_diskmeta,
+                                  sketch_path=base_disksketch)
     LOG.info("Finish Base VM Disk hashing")
+
+    # region hash tree to refresh the meta files incrementally
+    (base_disktree, base_memtree) = Const.get_base_treepath(base_diskpath)
+    base_meta.create_tree_file(base_diskpath, base_disktree)
+    base_meta.create_tree_file(base_mempath, base_memtree)
     return base_hashvalue
 
 
@@ -1598,6 +1837,10 @@ def create_baseVM(disk_image_path):
         os.unlink(base_mempath)
     if os.path.exists(base_memmeta):
         os.unlink(base_memmeta)
+    for base_file in Const.get_base_sketchpath(disk_image_path) + \
+            Const.get_base_treepath(disk_image_path):
+        if os.path.exists(base_file):
+            os.unlink(base_file)
 
     # edit default XML to have new disk path
     conn = get_libvirt_connection()
@@ -1637,6 +1880,44 @@ def create_baseVM(disk_image_path):
 
     return disk_image_path, base_mempath
 
+
+def update_baseVM(disk_image_path):
+    # Refresh meta files of the base VM after its disk or memory image is
+    # slightly changed. Only regions whose region hash changed are hashed.
+    # :returns: new hash value of the base VM
+    disk_image_path = os.path.abspath(disk_image_path)
+    (base_diskmeta, base_mempath, base_memmeta) = \
+        Const.get_basepath(disk_image_path, check_exist=True)
+    (base_disktree, base_memtree) = Const.get_base_treepath(disk_image_path)
+    (base_disksketch, base_memsketch) = \
+        Const.get_base_sketchpath(disk_image_path)
+
+    mem_region_list = base_meta.update_memory_meta(
+        base_mempath, base_memmeta, base_memtree)
+    base_meta.update_sketch(base_mempath, base_memsketch, mem_region_list)
+    disk_region_list, base_hashvalue = base_meta.update_disk_meta(
+        disk_image_path, base_diskmeta, base_disktree)
+    base_meta.update_sketch(disk_image_path, base_disksketch,
+                            disk_region_list)
+    LOG.info("Refresh base VM: %d memory regions, %d disk regions" %
+             (len(mem_region_list), len(disk_region_list)))
+
+    # save the result to DB
+    dbconn = db_api.DBConnector()
+    basevm_list = dbconn.list_item(db_table.BaseVM)
+    for item in basevm_list:
+        if disk_image_path == item.disk_path:
+            dbconn.del_item(item)
+            break
+    new_basevm = db_table.BaseVM(disk_image_path, base_hashvalue)
+    dbconn.add_item(new_basevm)
+
+    # write hashvalue to file
+    hashfile_path = Const.get_base_hashpath(disk_image_path)
+    open(hashfile_path, "w+").write(str(base_hashvalue) + "\n")
+    return base_hashvalue
+
+
 def handlesig(signum, frame):
     LOG.info("Received signal(%d) to start handoff..." % signum)
 
@@ -1790,7 +2071,7 @@ def info_vm_overlay(overlay_path):
         raise IOError(msg)
     overlay_package = VMOverlayPackage("file://%s" % overlay_path)
     meta_raw = overlay_package.read_meta()
-    meta_info = msgpack.unpackb(meta_raw)
+    meta_info = overlay_meta.unpack_meta(meta_raw)
     baseVMsha256 = meta_info[Const.META_BASE_VM_SHA256]
     vm_disk_size = meta_info[Const.META_RESUME_VM_DISK_SIZE]
     vm_memory_size = meta_info[Const.META_RESUME_VM_MEMORY_SIZE]
@@ -28,6 +28,7 @@ class Protocol(object):
     MESSAGE_COMMAND_SEND_META = 0x11
     MESSAGE_COMMAND_SEND_OVERLAY = 0x12
     MESSAGE_COMMAND_SEND_OVERLAY_URL = 0x17
+    MESSAGE_COMMAND_GET_CHUNK_FILTER = 0x18
 
     MESSAGE_COMMAND_FINISH = 0x13
     MESSAGE_COMMAND_GET_RESOURCE_INFO = 0x14
@@ -52,6 +53,12 @@ class Protocol(object):
     KEY_SESSION_ID = "session_id"
     KEY_REQUESTED_COMMAND = "requested_command"
     KEY_OVERLAY_URL = "overlay_url"
+    KEY_CHUNK_FILTER = "chunk_filter"
+
+    # stream handoff acks from server are "!Q" values. Other than the tags
+    # below, an ack is the number of received bytes, which never sets the
+    # top bit
+    ACK_RESEND_CHUNKS = 0x8000000000000020
 
     # synthesis option
     KEY_SYNTHESIS_OPTION = "synthesis_option"
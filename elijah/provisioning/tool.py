@@ -32,16 +32,19 @@ import struct
 from lzma import LZMACompressor
 from lzma import LZMADecompressor
 
-import pyximport
-pyximport.install()
-from cython_xor import cython_xor
-
+import numpy
 import msgpack
 from .configuration import Const
 from . import log as logging
 
 LOG = logging.getLogger(__name__)
 
+try:
+    # extension module built by setup.py
+    from .cython_xor import xor_batch as _cython_xor_batch
+except ImportError as e:
+    _cython_xor_batch = None
+
 
 # global
 _HASHFILE_MAGIC = 0x1145511a
@@ -95,6 +98,49 @@ def merge_data_bsdiff(source_data, overlay_data):
     return recover
 
 
+def _xor_buffer(source_buf, modi_buf):
+    if len(source_buf) % 8 == 0:
+        dtype = numpy.uint64
+    else:
+        dtype = numpy.uint8
+    source_array = numpy.frombuffer(source_buf, dtype=dtype)
+    modi_array = numpy.frombuffer(modi_buf, dtype=dtype)
+    return numpy.bitwise_xor(source_array, modi_array).tostring()
+
+
+def xor_data(source_data, modi_data):
+    if len(source_data) != len(modi_data):
+        raise IOError(
+            "[Error] Not valid data length: %d, %d" %
+            (len(source_data), len(modi_data)))
+    return _xor_buffer(source_data, modi_data)
+
+
+def xor_batch(source_list, modi_list):
+    """XOR N chunk pairs in a single call
+    Uses the prebuilt cython extension if it exists. Otherwise, chunks are
+    concatenated into one contiguous buffer and XORed with numpy at once.
+    """
+    if len(source_list) != len(modi_list):
+        raise IOError(
+            "[Error] Not valid batch size: %d, %d" %
+            (len(source_list), len(modi_list)))
+    for source_data, modi_data in zip(source_list, modi_list):
+        if len(source_data) != len(modi_data):
+            raise IOError(
+                "[Error] Not valid data length: %d, %d" %
+                (len(source_data), len(modi_data)))
+    if _cython_xor_batch is not None:
+        return _cython_xor_batch(list(source_list), list(modi_list))
+    xor_buf = _xor_buffer(''.join(source_list), ''.join(modi_list))
+    xor_list = list()
+    offset = 0
+    for modi_data in modi_list:
+        xor_list.append(xor_buf[offset:offset+len(modi_data)])
+        offset += len(modi_data)
+    return xor_list
+
+
 def comp_lzma(inputname, outputname, **kwargs):
     log = kwargs.get("log", None)
     nova_util = kwargs.get('nova_util', None)
@@ -176,3 +222,39 @@ if __name__ == "__main__":
             print len(patch)
         else:
             print "Failed %d == %d" % (len(modi), len(recover))
+
+    elif sys.argv[1] == "xor":
+        # compare batched XOR with per-page cython XOR
+        from .cython_xor import cython_xor_vectorised
+
+        page_count = 1024*16
+        base_list = [os.urandom(4096) for x in range(page_count)]
+        modi_list = [os.urandom(4096) for x in range(page_count)]
+
+        start_time = time()
+        cython_list = [cython_xor_vectorised(base, modi) for (base, modi)
+                       in zip(base_list, modi_list)]
+        cython_time = time() - start_time
+
+        start_time = time()
+        batch_list = list()
+        for index in range(0, page_count, 256):
+            batch_list += xor_batch(base_list[index:index+256],
+                                    modi_list[index:index+256])
+        batch_time = time() - start_time
+
+        start_time = time()
+        numpy_list = list()
+        for index in range(0, page_count, 256):
+            xor_buf = _xor_buffer(''.join(base_list[index:index+256]),
+                                  ''.join(modi_list[index:index+256]))
+            numpy_list += [xor_buf[offset:offset+4096] for offset
+                           in range(0, len(xor_buf), 4096)]
+        numpy_time = time() - start_time
+
+        if cython_list != batch_list or cython_list != numpy_list:
+            print "Failed: XOR result is different"
+            sys.exit(1)
+        print "cython_xor_vectorised\t%f pages/s" % (page_count/cython_time)
+        print "xor_batch(256)\t%f pages/s" % (page_count/batch_time)
+        print "numpy xor(256)\t%f pages/s" % (page_count/numpy_time)
@@ -0,0 +1,264 @@
+import unittest
+import os
+import sys
+import zlib
+import time
+import random
+import shutil
+import multiprocessing
+from hashlib import sha256
+from StringIO import StringIO
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+import msgpack
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import VMOverlayCreationMode
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import DeltaDedup
+from elijah.provisioning import process_manager
+from elijah.provisioning import access_trace
+from elijah.provisioning.compression import decompress_blob
+from elijah.provisioning.access_trace import AccessTrace
+from elijah.provisioning.access_trace import BlobPacker
+
+
+class _StreamMonitor(object):
+
+    def __init__(self, disk_first_access_dict, mem_first_access_dict):
+        self.disk_first_access_dict = disk_first_access_dict
+        self.mem_first_access_dict = mem_first_access_dict
+
+
+def _replay_first_access(overlay_info, trace, read_blob, access_count,
+                         bandwidth_mbps):
+    """Replay receiving and decompressing blobs in the order of the overlay
+    meta, and return seconds until the first access_count chunks of the
+    trace that are in the overlay become available. A chunk referring to
+    another chunk becomes available only after its target is received.
+    :param read_blob: function returning compressed data of a blob name
+    """
+    overlay_key_set = set()
+    for blob_info in overlay_info:
+        for chunk in blob_info[Const.META_OVERLAY_FILE_DISK_CHUNKS]:
+            overlay_key_set.add(
+                AccessTrace.get_key(DeltaItem.DELTA_DISK, chunk))
+        for chunk in blob_info[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]:
+            overlay_key_set.add(
+                AccessTrace.get_key(DeltaItem.DELTA_MEMORY, chunk))
+    waiting_key_set = set([chunk_key for chunk_key in trace.chunk_key_list
+                           if chunk_key in overlay_key_set][:access_count])
+
+    elapsed_time = 0.0
+    received_hash_set = set()
+    pending_dict = dict()   # target hash -> keys waiting for it
+    for blob_info in overlay_info:
+        if len(waiting_key_set) == 0:
+            break
+        comp_data = read_blob(blob_info[Const.META_OVERLAY_FILE_NAME])
+        elapsed_time += len(comp_data)*8.0/(bandwidth_mbps*1024*1024)
+        time_s = time.time()
+        decomp_data = decompress_blob(
+            blob_info[Const.META_OVERLAY_FILE_COMPRESSION], comp_data)
+        elapsed_time += (time.time()-time_s)
+        stream = StringIO(decomp_data)
+        while True:
+            delta_item = DeltaItem.unpack_stream(stream)
+            if delta_item is None:
+                break
+            chunk_key = AccessTrace.get_key(
+                delta_item.delta_type, delta_item.offset/Const.CHUNK_SIZE)
+            if delta_item.ref_id == DeltaItem.REF_SELF_HASH and \
+                    delta_item.data not in received_hash_set:
+                pending_dict.setdefault(delta_item.data, []).append(chunk_key)
+                continue
+            waiting_key_set.discard(chunk_key)
+            if delta_item.ref_id == DeltaItem.REF_RAW:
+                hash_value = sha256(delta_item.data).digest()
+                received_hash_set.add(hash_value)
+                for pending_key in pending_dict.pop(hash_value, []):
+                    waiting_key_set.discard(pending_key)
+    return elapsed_time
+
+
+class TestAccessTrace(unittest.TestCase):
+    CHUNK_COUNT = 2048
+    ACCESS_COUNT = 64
+    BLOCK_SIZE = 256*1024
+    BANDWIDTH_Mbps = 100
+    DUPLICATE_RATIO = 0.25
+
+    def setUp(self):
+        super(TestAccessTrace, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-trace-")
+        self.profile_path = VMOverlayCreationMode.PROFILE_DATAPATH
+        # ProcessManager needs a profile, which can be empty
+        VMOverlayCreationMode.PROFILE_DATAPATH = os.path.join(
+            self.temp_dir, "mode-profile")
+        open(VMOverlayCreationMode.PROFILE_DATAPATH, "w").close()
+        self.rand = random.Random(1234)
+        self.deltalist = list()
+        for index in xrange(self.CHUNK_COUNT):
+            if index > 0 and self.rand.random() < self.DUPLICATE_RATIO:
+                data = self.rand.choice(self.deltalist).data
+            else:
+                data = ''.join([chr(self.rand.randint(0, 255))
+                                for x in xrange(512)])*8
+            delta_type = DeltaItem.DELTA_MEMORY
+            if index % 4 == 0:
+                delta_type = DeltaItem.DELTA_DISK
+            self.deltalist.append(DeltaItem(
+                delta_type, index*Const.CHUNK_SIZE, len(data),
+                hash_value=sha256(data).digest(), ref_id=DeltaItem.REF_RAW,
+                data_len=len(data), data=data))
+
+    def tearDown(self):
+        super(TestAccessTrace, self).tearDown()
+        process_manager.kill_instance()
+        VMOverlayCreationMode.PROFILE_DATAPATH = self.profile_path
+        shutil.rmtree(self.temp_dir)
+
+    def _get_trace(self):
+        # working set spread over the whole overlay plus chunks from base
+        access_list = self.rand.sample(self.deltalist, self.ACCESS_COUNT)
+        chunk_key_list = [AccessTrace.get_key(
+            item.delta_type, item.offset/Const.CHUNK_SIZE)
+            for item in access_list]
+        chunk_key_list.insert(10, AccessTrace.get_key(
+            DeltaItem.DELTA_DISK, self.CHUNK_COUNT*10))
+        return AccessTrace(chunk_key_list)
+
+    def _dedup(self, trace):
+        memory_queue = multiprocessing.Queue()
+        disk_queue = multiprocessing.Queue()
+        merged_queue = multiprocessing.Queue()
+        dedup = DeltaDedup(memory_queue, Const.CHUNK_SIZE, disk_queue,
+                           Const.CHUNK_SIZE, merged_queue, None,
+                           basedisk_hashdict=dict(), basemem_hashdict=dict(),
+                           access_trace=trace)
+        dedup.start()
+        memory_queue.put([item for item in self.deltalist
+                          if item.delta_type == DeltaItem.DELTA_MEMORY])
+        disk_queue.put([item for item in self.deltalist
+                        if item.delta_type == DeltaItem.DELTA_DISK])
+        memory_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        disk_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        deduped_list = list()
+        while True:
+            deltaitem_list = merged_queue.get(timeout=30)
+            if deltaitem_list == Const.QUEUE_SUCCESS_MESSAGE:
+                break
+            deduped_list += deltaitem_list
+        dedup.join()
+        return deduped_list
+
+    def _pack_overlay(self, deltalist, trace):
+        # compress blobs like compression.CompChildProc
+        blob_dict = dict()
+        overlay_info = list()
+        packer = BlobPacker(self.BLOCK_SIZE, trace)
+        blob_list = list()
+        for delta_item in deltalist:
+            packer.add(delta_item)
+            if packer.is_full():
+                blob_list += packer.pop_blobs()
+        blob_list += packer.pop_blobs(flush=True)
+        for index, deltaitem_list in enumerate(blob_list):
+            comp = zlib.compressobj(1, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            comp_data = ''.join([comp.compress(item.get_serialized())
+                                 for item in deltaitem_list]) + comp.flush()
+            blob_name = "blob-%d" % index
+            blob_dict[blob_name] = comp_data
+            overlay_info.append({
+                Const.META_OVERLAY_FILE_NAME: blob_name,
+                Const.META_OVERLAY_FILE_COMPRESSION: Const.COMPRESSION_GZIP,
+                Const.META_OVERLAY_FILE_SIZE: len(comp_data),
+                Const.META_OVERLAY_FILE_DISK_CHUNKS: [
+                    item.offset/Const.CHUNK_SIZE for item in deltaitem_list
+                    if item.delta_type == DeltaItem.DELTA_DISK],
+                Const.META_OVERLAY_FILE_MEMORY_CHUNKS: [
+                    item.offset/Const.CHUNK_SIZE for item in deltaitem_list
+                    if item.delta_type == DeltaItem.DELTA_MEMORY]})
+        return overlay_info, blob_dict
+
+    def test_trace_meta(self):
+        monitor = _StreamMonitor({3: 1.5, 1: 1.0}, {3: 1.2, 7: 2.0})
+        trace = AccessTrace.from_monitor(monitor)
+        self.assertEqual(trace.chunk_key_list, [
+            AccessTrace.get_key(DeltaItem.DELTA_DISK, 1),
+            AccessTrace.get_key(DeltaItem.DELTA_MEMORY, 3),
+            AccessTrace.get_key(DeltaItem.DELTA_DISK, 3),
+            AccessTrace.get_key(DeltaItem.DELTA_MEMORY, 7)])
+
+        meta_dict = {Const.META_OVERLAY_ACCESS_TRACE: trace.to_meta()}
+        meta_dict = msgpack.unpackb(msgpack.packb(meta_dict))
+        self.assertEqual(AccessTrace.from_meta(meta_dict).chunk_key_list,
+                         trace.chunk_key_list)
+        self.assertEqual(AccessTrace.from_meta(dict()), None)
+        meta_dict[Const.META_OVERLAY_ACCESS_TRACE] = "invalid"
+        self.assertRaises(access_trace.AccessTraceError,
+                          AccessTrace.from_meta, meta_dict)
+
+    def test_first_access_time(self):
+        trace = self._get_trace()
+        offset_info, offset_blobs = self._pack_overlay(
+            self._dedup(None), None)
+        trace_info, trace_blobs = self._pack_overlay(
+            self._dedup(trace), trace)
+        trace_info = access_trace.order_overlay_files(trace_info, trace)
+        self.assertTrue(len(trace_info) <= len(offset_info) + 1)
+        first_blob = trace_info[0]
+        first_chunks = first_blob[Const.META_OVERLAY_FILE_DISK_CHUNKS] + \
+            first_blob[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]
+        self.assertEqual(len(first_chunks), self.ACCESS_COUNT)
+
+        offset_time = _replay_first_access(
+            offset_info, trace, offset_blobs.get, self.ACCESS_COUNT,
+            self.BANDWIDTH_Mbps)
+        trace_time = _replay_first_access(
+            trace_info, trace, trace_blobs.get, self.ACCESS_COUNT,
+            self.BANDWIDTH_Mbps)
+        sys.stdout.write("first %d accessed chunks: offset order %f s, "
+                         "trace order %f s\n" %
+                         (self.ACCESS_COUNT, offset_time, trace_time))
+        self.assertTrue(trace_time < offset_time/4)
+
+    def test_self_reference(self):
+        trace = self._get_trace()
+        # without the trace, dedup turns some accessed chunks into
+        # references to chunks that end up in later blobs
+        untraced_list = self._dedup(None)
+        traced_self_ref = [item for item in untraced_list
+                           if item.ref_id == DeltaItem.REF_SELF_HASH and
+                           trace.get_rank(item) is not None]
+        self.assertTrue(len(traced_self_ref) > 0)
+        untraced_info, untraced_blobs = self._pack_overlay(
+            untraced_list, trace)
+        untraced_info = access_trace.order_overlay_files(untraced_info, trace)
+
+        traced_list = self._dedup(trace)
+        for delta_item in traced_list:
+            if trace.get_rank(delta_item) is not None:
+                self.assertEqual(delta_item.ref_id, DeltaItem.REF_RAW)
+        self.assertEqual(len(traced_list), len(untraced_list))
+        traced_info, traced_blobs = self._pack_overlay(traced_list, trace)
+        traced_info = access_trace.order_overlay_files(traced_info, trace)
+
+        untraced_time = _replay_first_access(
+            untraced_info, trace, untraced_blobs.get, self.ACCESS_COUNT,
+            self.BANDWIDTH_Mbps)
+        traced_time = _replay_first_access(
+            traced_info, trace, traced_blobs.get, self.ACCESS_COUNT,
+            self.BANDWIDTH_Mbps)
+        sys.stdout.write("first %d accessed chunks: %d self references "
+                         "%f s, inlined %f s\n" %
+                         (self.ACCESS_COUNT, len(traced_self_ref),
+                          untraced_time, traced_time))
+        self.assertTrue(traced_time < untraced_time/4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import os
+import sys
+import random
+import shutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning import disk
+from elijah.provisioning import similarity_index
+from elijah.provisioning.memory import Memory
+
+
+class TestBaseHashing(unittest.TestCase):
+
+    def setUp(self):
+        super(TestBaseHashing, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-hashing-")
+        rand = random.Random(1234)
+        # repeated blocks to have duplicated hashes, and a size that is
+        # not aligned with page or window
+        block_list = [os.urandom(4096) for index in range(8)]
+        block_list += ['\0'*4096]
+        data = ''.join(rand.choice(block_list) for index in range(600))
+        self.image_path = os.path.join(self.temp_dir, "image")
+        with open(self.image_path, "wb") as fd:
+            fd.write(data + os.urandom(1000))
+
+    def tearDown(self):
+        super(TestBaseHashing, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _read(self, path):
+        with open(path, "rb") as fd:
+            return fd.read()
+
+    def _create_sketch_file(self):
+        sketch_path = os.path.join(self.temp_dir, "sketch")
+        similarity_index.create_sketch_file(self.image_path, sketch_path)
+        return sketch_path
+
+    def test_memory_hashing(self):
+        file_size = os.path.getsize(self.image_path)
+        memory = Memory()
+        serial_sketch = os.path.join(self.temp_dir, "serial-sketch")
+        sketch_writer = similarity_index.SketchWriter(serial_sketch,
+                                                      file_size)
+        with open(self.image_path, "rb") as fin:
+            memory._get_mem_hash(fin, file_size, memory.hash_list,
+                                 sketch_writer=sketch_writer)
+        sketch_writer.close()
+        serial_meta = os.path.join(self.temp_dir, "serial-meta")
+        memory.export_to_file(serial_meta)
+
+        parallel_sketch = os.path.join(self.temp_dir, "parallel-sketch")
+        sketch_writer = similarity_index.SketchWriter(parallel_sketch,
+                                                      file_size)
+        Memory.HASH_RANGE_PAGES, range_pages = 7, Memory.HASH_RANGE_PAGES
+        try:
+            memory.hash_list = Memory._get_mem_hash_parallel(
+                self.image_path, file_size, 4, sketch_writer=sketch_writer)
+        finally:
+            Memory.HASH_RANGE_PAGES = range_pages
+        sketch_writer.close()
+        parallel_meta = os.path.join(self.temp_dir, "parallel-meta")
+        memory.export_to_file(parallel_meta)
+        self.assertEqual(self._read(serial_meta), self._read(parallel_meta))
+
+        # sketches computed while hashing are the same as a separate pass
+        sketch_data = self._read(self._create_sketch_file())
+        self.assertEqual(self._read(serial_sketch), sketch_data)
+        self.assertEqual(self._read(parallel_sketch), sketch_data)
+
+    def test_disk_hashing(self):
+        serial_meta = os.path.join(self.temp_dir, "serial-meta")
+        serial_sketch = os.path.join(self.temp_dir, "serial-sketch")
+        serial_hash = disk.hashing(self.image_path, serial_meta, num_proc=1,
+                                   sketch_path=serial_sketch)
+
+        disk.HASH_RANGE_WINDOWS, range_windows = 100, disk.HASH_RANGE_WINDOWS
+        try:
+            parallel_meta = os.path.join(self.temp_dir, "parallel-meta")
+            parallel_sketch = os.path.join(self.temp_dir, "parallel-sketch")
+            parallel_hash = disk.hashing(self.image_path, parallel_meta,
+                                         num_proc=4,
+                                         sketch_path=parallel_sketch)
+        finally:
+            disk.HASH_RANGE_WINDOWS = range_windows
+        self.assertEqual(serial_hash, parallel_hash)
+        self.assertEqual(self._read(serial_meta), self._read(parallel_meta))
+
+        sketch_data = self._read(self._create_sketch_file())
+        self.assertEqual(self._read(serial_sketch), sketch_data)
+        self.assertEqual(self._read(parallel_sketch), sketch_data)
+
+
+if __name__ == "__main__":
+    unittest.main()
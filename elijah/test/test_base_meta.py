@@ -0,0 +1,150 @@
+import unittest
+import os
+import sys
+import random
+import shutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+from hashlib import sha256
+
+from elijah.provisioning import disk
+from elijah.provisioning import base_meta
+from elijah.provisioning import similarity_index
+from elijah.provisioning.memory import Memory
+
+
+class TestBaseMeta(unittest.TestCase):
+    LEAF_SIZE = 64*1024
+    LEAF_COUNT = 128
+
+    def setUp(self):
+        super(TestBaseMeta, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-basemeta-")
+        self.rand = random.Random(1234)
+        block_list = [os.urandom(4096) for index in range(16)]
+        data = ''.join(self.rand.choice(block_list) for index in
+                       range(self.LEAF_COUNT*self.LEAF_SIZE/4096))
+        self.image_path = os.path.join(self.temp_dir, "image")
+        with open(self.image_path, "wb") as fd:
+            fd.write(data + os.urandom(1000))
+        self.meta_path = os.path.join(self.temp_dir, "meta")
+        self.tree_path = os.path.join(self.temp_dir, "tree")
+
+    def tearDown(self):
+        super(TestBaseMeta, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _read(self, path):
+        with open(path, "rb") as fd:
+            return fd.read()
+
+    def _modify_regions(self):
+        # modify 1% of the regions including the last one
+        region_list = [self.rand.randint(0, self.LEAF_COUNT-1),
+                       self.LEAF_COUNT]
+        with open(self.image_path, "r+b") as fd:
+            for leaf_index in region_list:
+                fd.seek(leaf_index*self.LEAF_SIZE + 100)
+                fd.write(os.urandom(600))
+        return region_list
+
+    def _get_memory_meta(self, meta_path):
+        memory = Memory()
+        with open(self.image_path, "rb") as fin:
+            memory._get_mem_hash(fin, os.path.getsize(self.image_path),
+                                 memory.hash_list)
+        memory.export_to_file(meta_path)
+
+    def test_memory_meta(self):
+        self._get_memory_meta(self.meta_path)
+        sketch_path = os.path.join(self.temp_dir, "sketch")
+        similarity_index.create_sketch_file(self.image_path, sketch_path)
+        base_meta.create_tree_file(self.image_path, self.tree_path,
+                                   self.LEAF_SIZE)
+        self.assertEqual(base_meta.update_memory_meta(
+            self.image_path, self.meta_path, self.tree_path,
+            self.LEAF_SIZE), [])
+
+        self._modify_regions()
+        region_list = base_meta.update_memory_meta(
+            self.image_path, self.meta_path, self.tree_path, self.LEAF_SIZE)
+        self.assertEqual(len(region_list), 2)
+        full_meta_path = os.path.join(self.temp_dir, "full-meta")
+        self._get_memory_meta(full_meta_path)
+        self.assertEqual(self._read(self.meta_path),
+                         self._read(full_meta_path))
+
+        base_meta.update_sketch(self.image_path, sketch_path, region_list)
+        full_sketch_path = os.path.join(self.temp_dir, "full-sketch")
+        similarity_index.create_sketch_file(self.image_path, full_sketch_path)
+        self.assertEqual(self._read(sketch_path),
+                         self._read(full_sketch_path))
+
+    def test_sketch_whole_image(self):
+        # region of the whole image is sketched in bounded batches
+        sketch_path = os.path.join(self.temp_dir, "sketch")
+        similarity_index.create_sketch_file(self.image_path, sketch_path)
+        self._modify_regions()
+        compute_sketches = similarity_index.compute_sketches
+        read_size_list = list()
+
+        def _compute_sketches(data, chunk_size):
+            read_size_list.append(len(data))
+            return compute_sketches(data, chunk_size)
+        similarity_index.compute_sketches = _compute_sketches
+        try:
+            base_meta.update_sketch(
+                self.image_path, sketch_path,
+                [(0, os.path.getsize(self.image_path))], batch_chunks=16)
+        finally:
+            similarity_index.compute_sketches = compute_sketches
+        # trailing partial chunk has no sketch
+        self.assertEqual(sum(read_size_list),
+                         os.path.getsize(self.image_path)/4096*4096)
+        self.assertEqual(max(read_size_list), 16*4096)
+        full_sketch_path = os.path.join(self.temp_dir, "full-sketch")
+        similarity_index.create_sketch_file(self.image_path, full_sketch_path)
+        self.assertEqual(self._read(sketch_path),
+                         self._read(full_sketch_path))
+
+    def test_disk_meta(self):
+        disk.hashing(self.image_path, self.meta_path, num_proc=1)
+        base_meta.create_tree_file(self.image_path, self.tree_path,
+                                   self.LEAF_SIZE)
+        self._modify_regions()
+        region_list, hash_value = base_meta.update_disk_meta(
+            self.image_path, self.meta_path, self.tree_path,
+            leaf_size=self.LEAF_SIZE)
+        self.assertEqual(len(region_list), 2)
+
+        full_meta_path = os.path.join(self.temp_dir, "full-meta")
+        full_hash_value = disk.hashing(self.image_path, full_meta_path,
+                                       num_proc=1)
+        self.assertEqual(hash_value, full_hash_value)
+        # every record points to the data of its hash
+        data = self._read(self.image_path)
+        hash_list = disk.base_hashlist(self.meta_path)
+        for (offset, length, hashed_data) in hash_list:
+            self.assertEqual(sha256(data[offset:offset+length]).digest(),
+                             hashed_data)
+        full_hash_set = set(x[2] for x in disk.base_hashlist(full_meta_path))
+        self.assertEqual(len(hash_list), len(set(x[2] for x in hash_list)))
+        self.assertTrue(set(x[2] for x in hash_list) <= full_hash_set)
+        # new content is hashed
+        last_offset = (len(data)-4096)/512*512
+        for (start, end) in region_list:
+            offset = min(start+512, last_offset)
+            hashed_data = sha256(data[offset:offset+4096]).digest()
+            self.assertTrue(hashed_data in set(x[2] for x in hash_list))
+
+    def test_invalid_tree(self):
+        with open(self.tree_path, "wb") as fd:
+            fd.write("invalid")
+        self.assertEqual(base_meta._load_tree(self.tree_path), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import unittest
+import os
+import sys
+import time
+import random
+import select
+import multiprocessing
+from Queue import Full
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning import byte_queue
+from elijah.provisioning.byte_queue import ByteBudgetQueue
+
+
+def _produce(stage_queue, size_list):
+    for index, size in enumerate(size_list):
+        stage_queue.put(["%08d" % index, "x"*(size-8)])
+        used_bytes = stage_queue.get_used_bytes()
+        if used_bytes > stage_queue.max_bytes:
+            stage_queue.put(Const.QUEUE_FAILED_MESSAGE)
+            return
+    stage_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+
+
+class TestByteQueue(unittest.TestCase):
+    MAX_BYTES = 4*1024*1024
+
+    def setUp(self):
+        super(TestByteQueue, self).setUp()
+        self.rand = random.Random(1234)
+
+    def test_budget_with_slow_consumer(self):
+        # from a short DeltaItem list to a 2 MB blob
+        size_list = [self.rand.choice([64, 4096, 256*1024, 2*1024*1024])
+                     for index in xrange(200)]
+        stage_queue = ByteBudgetQueue(self.MAX_BYTES)
+        producer = multiprocessing.Process(
+            target=_produce, args=(stage_queue, size_list))
+        producer.start()
+        recv_count = 0
+        while True:
+            # consumers select on the queue like a multiprocessing.Queue
+            select.select([stage_queue._reader.fileno()], [], [])
+            item = stage_queue.get()
+            if item in (Const.QUEUE_SUCCESS_MESSAGE,
+                        Const.QUEUE_FAILED_MESSAGE):
+                break
+            self.assertEqual(item[0], "%08d" % recv_count)
+            self.assertTrue(stage_queue.get_used_bytes() <= self.MAX_BYTES)
+            recv_count += 1
+            if recv_count % 10 == 0:
+                time.sleep(0.01)
+        producer.join()
+        self.assertEqual(item, Const.QUEUE_SUCCESS_MESSAGE)
+        self.assertEqual(recv_count, len(size_list))
+        self.assertEqual(stage_queue.get_used_bytes(), 0)
+        self.assertTrue(stage_queue.get_peak_bytes() <= self.MAX_BYTES)
+        # the budget, not the item count, limited the producer
+        self.assertTrue(stage_queue.get_peak_bytes() >= self.MAX_BYTES/2)
+
+    def test_full(self):
+        stage_queue = ByteBudgetQueue(1024)
+        stage_queue.put("x"*1000)
+        self.assertRaises(Full, stage_queue.put, "x"*100, False)
+        self.assertRaises(Full, stage_queue.put, "x"*100, True, 0.05)
+        self.assertEqual(stage_queue.get_used_bytes(), 1000)
+        self.assertEqual(stage_queue.get(), "x"*1000)
+
+        # an item over the budget goes through an empty queue alone
+        stage_queue.put("x"*4096)
+        self.assertRaises(Full, stage_queue.put, "x", False)
+        self.assertEqual(len(stage_queue.get()), 4096)
+        stage_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        self.assertEqual(stage_queue.get(), Const.QUEUE_SUCCESS_MESSAGE)
+
+    def test_stage_queue(self):
+        stage_queue = byte_queue.get_stage_queue(4, -1)
+        self.assertFalse(isinstance(stage_queue, ByteBudgetQueue))
+        stage_queue = byte_queue.get_stage_queue(-1, self.MAX_BYTES)
+        self.assertEqual(stage_queue.max_bytes, self.MAX_BYTES)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+import os
+import sys
+import time
+import random
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+
+import numpy
+
+from elijah.provisioning import chunk_bitmap
+from elijah.provisioning.chunk_bitmap import ChunkBitmap
+
+
+class TestChunkBitmap(unittest.TestCase):
+    LARGE_COUNT = 10*1000*1000
+
+    def setUp(self):
+        super(TestChunkBitmap, self).setUp()
+        self.rand = random.Random(1234)
+
+    def _get_chunk_set(self):
+        # dense range, sparse range and random chunks far away
+        chunk_set = set(xrange(70000, 90000))
+        chunk_set.update(xrange(200000, 260000, 37))
+        chunk_set.update([self.rand.randint(0, 1 << 40)
+                          for index in xrange(1000)])
+        return chunk_set
+
+    def test_set_operations(self):
+        chunk_set = self._get_chunk_set()
+        other_set = self._get_chunk_set()
+        other_set.update(xrange(80000, 140000, 2))
+        bitmap = ChunkBitmap(chunk_set)
+        other_bitmap = ChunkBitmap(list(other_set))
+
+        self.assertEqual(len(bitmap), len(chunk_set))
+        self.assertEqual(list(bitmap), sorted(chunk_set))
+        self.assertEqual(list(bitmap | other_bitmap),
+                         sorted(chunk_set | other_set))
+        self.assertEqual(list(bitmap & other_bitmap),
+                         sorted(chunk_set & other_set))
+        self.assertEqual(list(other_bitmap & bitmap),
+                         sorted(chunk_set & other_set))
+        for chunk in (70000, 89999, 90000, 200037, 200038, 1 << 41):
+            self.assertEqual(chunk in bitmap, chunk in chunk_set)
+
+        bitmap.add(90000)
+        bitmap.update(other_bitmap)
+        chunk_set.add(90000)
+        chunk_set.update(other_set)
+        self.assertEqual(bitmap.to_array().tolist(), sorted(chunk_set))
+
+    def test_serialization(self):
+        bitmap = ChunkBitmap(self._get_chunk_set())
+        data = bitmap.to_bytes()
+        self.assertEqual(ChunkBitmap.from_bytes(data), bitmap)
+        self.assertEqual(len(ChunkBitmap.from_bytes(
+            ChunkBitmap().to_bytes())), 0)
+        self.assertRaises(chunk_bitmap.ChunkBitmapError,
+                          ChunkBitmap.from_bytes, data[:-1])
+        self.assertRaises(chunk_bitmap.ChunkBitmapError,
+                          ChunkBitmap.from_bytes, "XXXX" + data[4:])
+
+    def test_large_bitmap(self):
+        # every third chunk of 3*10^7 chunks, and random chunks in 2^32
+        dense_array = numpy.arange(0, self.LARGE_COUNT*3, 3,
+                                   dtype=numpy.uint64)
+        random_array = numpy.random.RandomState(1234).randint(
+            0, 1 << 32, self.LARGE_COUNT).astype(numpy.uint64)
+
+        time_s = time.time()
+        dense = ChunkBitmap(dense_array)
+        sparse = ChunkBitmap(random_array)
+        build_time = time.time()-time_s
+        time_s = time.time()
+        union = dense | sparse
+        union_time = time.time()-time_s
+        time_s = time.time()
+        intersection = dense & sparse
+        intersection_time = time.time()-time_s
+        sys.stdout.write(
+            "10^7 chunks: build %f s, union %f s, intersection %f s, "
+            "%d bytes (dense), %d bytes (random)\n" %
+            (build_time/2, union_time, intersection_time,
+             dense.nbytes(), sparse.nbytes()))
+
+        self.assertEqual(len(dense), self.LARGE_COUNT)
+        self.assertTrue(dense.nbytes() < self.LARGE_COUNT/2)
+        self.assertTrue(sparse.nbytes() < self.LARGE_COUNT*3)
+        self.assertTrue(numpy.array_equal(
+            union.to_array(), numpy.union1d(dense_array, random_array)))
+        self.assertTrue(numpy.array_equal(
+            intersection.to_array(),
+            numpy.intersect1d(dense_array, random_array)))
+
+
+if __name__ == "__main__":
+    unittest.main()
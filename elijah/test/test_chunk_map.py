@@ -0,0 +1,110 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+import numpy
+
+from elijah.provisioning import chunk_map
+
+
+class TestChunkMap(unittest.TestCase):
+    CHUNK_COUNT = 10*1000*1000
+
+    def setUp(self):
+        super(TestChunkMap, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-chunk-map-")
+        self.map_path = os.path.join(self.temp_dir, "disk")
+
+    def tearDown(self):
+        super(TestChunkMap, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def test_large_map(self):
+        # every third chunk of 30M chunks in random order
+        chunks = numpy.arange(0, self.CHUNK_COUNT*3, 3, dtype=numpy.uint64)
+        numpy.random.RandomState(1234).shuffle(chunks)
+        time_s = time.time()
+        count = chunk_map.write_chunk_map(self.map_path, chunks, valid_bit=1)
+        write_time = time.time()-time_s
+        time_s = time.time()
+        read_chunks, valid_bits = chunk_map.read_chunk_map(self.map_path)
+        read_time = time.time()-time_s
+        sys.stdout.write("%d chunks: write %f s, read %f s, %d bytes\n" %
+                         (count, write_time, read_time,
+                          os.path.getsize(self.map_path)))
+
+        self.assertEqual(count, self.CHUNK_COUNT)
+        self.assertEqual(os.path.getsize(self.map_path),
+                         16 + 8*self.CHUNK_COUNT)
+        chunks.sort()
+        self.assertTrue(numpy.array_equal(read_chunks, chunks))
+        self.assertTrue(valid_bits.all())
+
+    def test_map_argument(self):
+        count = chunk_map.write_chunk_map(self.map_path, set([7, 3, 3, 1]))
+        self.assertEqual(count, 3)
+        read_chunks, valid_bits = chunk_map.read_chunk_map(self.map_path)
+        self.assertEqual(read_chunks.tolist(), [1, 3, 7])
+        self.assertFalse(valid_bits.any())
+
+        argument = chunk_map.get_argument(self.map_path)
+        self.assertEqual(argument, "mapfile:1:%s" % self.map_path)
+        self.assertEqual(chunk_map.parse_argument(argument), self.map_path)
+        self.assertEqual(chunk_map.parse_argument("1:0,3:0"), None)
+        self.assertRaises(chunk_map.ChunkMapError, chunk_map.parse_argument,
+                          "mapfile:2:%s" % self.map_path)
+
+        # empty map
+        self.assertEqual(chunk_map.write_chunk_map(self.map_path, []), 0)
+        self.assertEqual(len(chunk_map.read_chunk_map(self.map_path)[0]), 0)
+
+    def _write_daemon(self, name, script):
+        bin_path = os.path.join(self.temp_dir, name)
+        with open(bin_path, "w") as fd:
+            fd.write("#!/bin/sh\n" + script)
+        os.chmod(bin_path, 0755)
+        return bin_path
+
+    def test_daemon_support(self):
+        new_daemon = self._write_daemon(
+            "cloudletfs-new",
+            'if [ "$1" = "--capabilities" ]; then echo mapfile:1; exit 0; fi\n'
+            'exit 1\n')
+        # older daemon ignores arguments and fails on the empty stdin
+        old_daemon = self._write_daemon(
+            "cloudletfs-old", 'cat > /dev/null; echo Unexpected EOF; exit 1\n')
+        future_daemon = self._write_daemon(
+            "cloudletfs-future", 'echo mapfile:2\n')
+        self.assertTrue(chunk_map.is_supported(new_daemon))
+        self.assertFalse(chunk_map.is_supported(old_daemon))
+        self.assertFalse(chunk_map.is_supported(future_daemon))
+        self.assertFalse(chunk_map.is_supported(
+            os.path.join(self.temp_dir, "not-exist")))
+
+        self.assertEqual(chunk_map.get_string_argument(set([7, 3, 1]), 1),
+                         "1:1,3:1,7:1")
+        self.assertEqual(chunk_map.get_string_argument([]), "")
+
+    def test_invalid_map(self):
+        chunk_map.write_chunk_map(self.map_path, xrange(100))
+        with open(self.map_path, "rb") as fd:
+            data = fd.read()
+        with open(self.map_path, "wb") as fd:
+            fd.write(data[:-8])
+        self.assertRaises(chunk_map.ChunkMapError,
+                          chunk_map.read_chunk_map, self.map_path)
+        with open(self.map_path, "wb") as fd:
+            fd.write("XXXX" + data[4:])
+        self.assertRaises(chunk_map.ChunkMapError,
+                          chunk_map.read_chunk_map, self.map_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
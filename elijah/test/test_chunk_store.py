@@ -0,0 +1,318 @@
+import unittest
+import os
+import sys
+import random
+import shutil
+import socket
+import struct
+import ctypes
+import threading
+import SocketServer
+import multiprocessing
+import msgpack
+from hashlib import sha256
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import VMOverlayCreationMode
+from elijah.provisioning import process_manager
+from elijah.provisioning.chunk_store import BloomFilter
+from elijah.provisioning.chunk_store import ChunkStore
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import DeltaDedup
+from elijah.provisioning.stream_client import NetworkMeasurementThread
+from elijah.provisioning.stream_client import request_chunk_filter
+from elijah.provisioning.stream_server import RecoverDeltaProc
+from elijah.provisioning.stream_server import StreamSynthesisHandler
+from elijah.provisioning.stream_server import request_missing_chunks
+
+
+CHUNK_SIZE = 4096
+
+
+def _random_chunk(rand):
+    return ''.join(chr(rand.randint(0, 255)) for i in range(64)) * \
+        (CHUNK_SIZE/64)
+
+
+def _add_chunks(store_dir, seed, chunk_count):
+    # each chunk is added with its own update to contend for the lock
+    rand = random.Random(seed)
+    chunk_store = ChunkStore(store_dir)
+    for index in range(chunk_count):
+        chunk = _random_chunk(rand)
+        chunk_store.add(sha256(chunk).digest(), chunk)
+    chunk_store.close()
+
+
+class TestChunkStore(unittest.TestCase):
+
+    def setUp(self):
+        super(TestChunkStore, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-chunkstore-")
+        self.rand = random.Random(1234)
+
+    def tearDown(self):
+        super(TestChunkStore, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _random_chunk(self):
+        return _random_chunk(self.rand)
+
+    def test_bloom_filter(self):
+        bloom_filter = BloomFilter.for_capacity(10000, 0.01)
+        keys = [sha256(str(i)).digest() for i in range(10000)]
+        for key in keys:
+            bloom_filter.add(key)
+        for key in keys:
+            self.assertTrue(key in bloom_filter)
+        false_positive = 0
+        for i in range(10000, 20000):
+            if sha256(str(i)).digest() in bloom_filter:
+                false_positive += 1
+        self.assertTrue(false_positive < 10000*0.02)
+
+        # serialization
+        restored = BloomFilter.from_dict(
+            msgpack.unpackb(msgpack.packb(bloom_filter.to_dict())))
+        for key in keys:
+            self.assertTrue(key in restored)
+
+    def test_persistence(self):
+        chunks = [self._random_chunk() for i in range(10)]
+        chunk_store = ChunkStore(self.temp_dir)
+        for chunk in chunks:
+            self.assertTrue(chunk_store.add(sha256(chunk).digest(), chunk))
+        self.assertFalse(chunk_store.add(sha256(chunks[0]).digest(), chunks[0]))
+        chunk_store.close()
+
+        chunk_store = ChunkStore(self.temp_dir)
+        self.assertEqual(len(chunk_store), len(chunks))
+        for chunk in chunks:
+            self.assertEqual(chunk_store.get(sha256(chunk).digest()), chunk)
+        self.assertEqual(chunk_store.get(sha256("not exist").digest()), None)
+
+    def test_eviction(self):
+        chunks = [self._random_chunk() for i in range(30)]
+        chunk_store = ChunkStore(self.temp_dir, capacity=10*CHUNK_SIZE)
+        for index in range(0, len(chunks), 5):
+            chunk_store.add_chunks([(sha256(chunk).digest(), chunk)
+                                    for chunk in chunks[index:index+5]])
+            data_size = os.path.getsize(chunk_store.data_path)
+            self.assertTrue(data_size <= 10*CHUNK_SIZE)
+            self.assertEqual(len(chunk_store), data_size/CHUNK_SIZE)
+        chunk_store.close()
+
+        # the oldest chunks are evicted first
+        chunk_store = ChunkStore(self.temp_dir, capacity=10*CHUNK_SIZE)
+        kept_count = len(chunk_store)
+        self.assertTrue(kept_count >= 5)
+        for chunk in chunks[:-kept_count]:
+            self.assertFalse(sha256(chunk).digest() in chunk_store)
+        for chunk in chunks[-kept_count:]:
+            self.assertEqual(chunk_store.get(sha256(chunk).digest()), chunk)
+
+    def test_eviction_while_reading(self):
+        chunks = [self._random_chunk() for i in range(10)]
+        writer = ChunkStore(self.temp_dir, capacity=10*CHUNK_SIZE)
+        writer.add_chunks([(sha256(chunk).digest(), chunk)
+                           for chunk in chunks])
+        reader = ChunkStore(self.temp_dir)
+        writer.add_chunks([(sha256(chunk).digest(), chunk) for chunk in
+                           [self._random_chunk() for i in range(5)]])
+        # reader still reads the data it indexed before the eviction
+        for chunk in chunks:
+            self.assertEqual(reader.get(sha256(chunk).digest()), chunk)
+
+    def test_concurrent_update(self):
+        proc_list = [multiprocessing.Process(
+            target=_add_chunks, args=(self.temp_dir, seed, 50))
+            for seed in range(4)]
+        for proc in proc_list:
+            proc.start()
+        for proc in proc_list:
+            proc.join()
+            self.assertEqual(proc.exitcode, 0)
+
+        chunk_store = ChunkStore(self.temp_dir)
+        self.assertEqual(len(chunk_store), 4*50)
+        self.assertEqual(os.path.getsize(chunk_store.index_path),
+                         4*50*ChunkStore.INDEX_RECORD_SIZE)
+        for seed in range(4):
+            rand = random.Random(seed)
+            for index in range(50):
+                chunk = _random_chunk(rand)
+                self.assertEqual(chunk_store.get(sha256(chunk).digest()),
+                                 chunk)
+
+
+class TestRemoteChunkDedup(unittest.TestCase):
+    """Handoff with the chunk filter of the destination over loopback
+    sockets: chunk filter request to StreamSynthesisHandler, DeltaDedup,
+    RecoverDeltaProc and resending missing chunks to the client.
+    """
+
+    def setUp(self):
+        super(TestRemoteChunkDedup, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-chunkstore-")
+        self.rand = random.Random(1234)
+        self.manager = multiprocessing.Manager()
+        self.profile_path = VMOverlayCreationMode.PROFILE_DATAPATH
+        # ProcessManager needs a profile, which can be empty
+        VMOverlayCreationMode.PROFILE_DATAPATH = os.path.join(
+            self.temp_dir, "mode-profile")
+        open(VMOverlayCreationMode.PROFILE_DATAPATH, "w").close()
+
+    def tearDown(self):
+        super(TestRemoteChunkDedup, self).tearDown()
+        self.manager.shutdown()
+        process_manager.kill_instance()
+        VMOverlayCreationMode.PROFILE_DATAPATH = self.profile_path
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _request_chunk_filter(self, store_dir):
+        server = SocketServer.TCPServer(("127.0.0.1", 0),
+                                        StreamSynthesisHandler)
+        server.handoff_data = None
+        server.chunk_store_dir = store_dir
+        server_thread = threading.Thread(target=server.handle_request)
+        server_thread.start()
+        chunk_filter = request_chunk_filter("127.0.0.1",
+                                            server.server_address[1])
+        server_thread.join()
+        server.server_close()
+        self.assertTrue(chunk_filter is not None)
+        return chunk_filter
+
+    def _dedup(self, delta_list, chunk_filter, remote_chunk_dict):
+        memory_queue = multiprocessing.Queue()
+        disk_queue = multiprocessing.Queue()
+        merged_queue = multiprocessing.Queue()
+        dedup_proc = DeltaDedup(memory_queue, CHUNK_SIZE,
+                                disk_queue, CHUNK_SIZE,
+                                merged_queue, None,
+                                basedisk_hashdict=dict(),
+                                basemem_hashdict=dict(),
+                                remote_chunk_filter=chunk_filter,
+                                remote_chunk_dict=remote_chunk_dict)
+        memory_queue.put(delta_list)
+        memory_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        disk_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        dedup_proc.start()
+        deduped_list = list()
+        while True:
+            item_list = merged_queue.get()
+            if item_list == Const.QUEUE_SUCCESS_MESSAGE:
+                break
+            deduped_list += item_list
+        dedup_proc.join()
+        return deduped_list
+
+    def _resend(self, missing_hash_list, remote_chunk_dict):
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.bind(("127.0.0.1", 0))
+        listen_sock.listen(1)
+        client_sock = socket.create_connection(listen_sock.getsockname())
+        server_sock, address = listen_sock.accept()
+        client_thread = NetworkMeasurementThread(
+            client_sock, dict(), multiprocessing.RawValue(ctypes.c_double, 0),
+            multiprocessing.RawValue(ctypes.c_double, 0), remote_chunk_dict)
+        client_thread.start()
+
+        # size ack of 0x20 bytes is not a resend request
+        server_sock.sendall(struct.pack("!Q", 0x20))
+        fetched_data = request_missing_chunks(server_sock, missing_hash_list)
+        # destination resumed the VM
+        server_sock.sendall(struct.pack("!Qd", 0x10, 0))
+        client_thread.join()
+        for sock in (client_sock, server_sock, listen_sock):
+            sock.close()
+        return fetched_data
+
+    def _recover(self, blob, chunk_count, store_dir, remote_chunk_dict):
+        base_path = os.path.join(self.temp_dir, "base")
+        open(base_path, "wb").write(chr(0x00)*CHUNK_SIZE*chunk_count)
+        output_mem_path = os.path.join(self.temp_dir, "launch-mem")
+        output_disk_path = os.path.join(self.temp_dir, "launch-disk")
+        decomp_queue = multiprocessing.Queue()
+        missing_chunk_queue = multiprocessing.Queue()
+        fetched_chunk_queue = multiprocessing.Queue()
+        delta_proc = RecoverDeltaProc(base_path, base_path, decomp_queue,
+                                      output_mem_path, output_disk_path,
+                                      CHUNK_SIZE, multiprocessing.Queue(),
+                                      chunk_store_dir=store_dir,
+                                      missing_chunk_queue=missing_chunk_queue,
+                                      fetched_chunk_queue=fetched_chunk_queue)
+        decomp_queue.put(blob)
+        decomp_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        delta_proc.start()
+        missing_hash_list = missing_chunk_queue.get()
+        fetched_data = ''
+        if len(missing_hash_list) > 0:
+            fetched_data = self._resend(missing_hash_list, remote_chunk_dict)
+            fetched_chunk_queue.put(fetched_data)
+        delta_proc.join()
+        self.assertEqual(delta_proc.exitcode, 0)
+        return open(output_mem_path, "rb").read(), len(missing_hash_list), \
+            len(fetched_data)
+
+    def _handoff(self, vm_chunks, filter_store_dir, recover_store_dir=None):
+        '''handoff to the destination that publishes chunk filter of
+        filter_store_dir and recovers with recover_store_dir
+        return (number of bytes sent by sender, number of resent chunks)
+        '''
+        if recover_store_dir is None:
+            recover_store_dir = filter_store_dir
+        chunk_filter = self._request_chunk_filter(filter_store_dir)
+        remote_chunk_dict = self.manager.dict()
+        delta_list = [DeltaItem(DeltaItem.DELTA_MEMORY, index*CHUNK_SIZE,
+                                CHUNK_SIZE, hash_value=sha256(chunk).digest(),
+                                ref_id=DeltaItem.REF_RAW,
+                                data_len=len(chunk), data=chunk)
+                      for index, chunk in enumerate(vm_chunks)]
+        deduped_list = self._dedup(delta_list, chunk_filter,
+                                   remote_chunk_dict)
+        blob = ''.join([item.get_serialized() for item in deduped_list])
+        recovered_data, resent_count, resent_size = self._recover(
+            blob, len(vm_chunks), recover_store_dir, remote_chunk_dict)
+        self.assertEqual(recovered_data, ''.join(vm_chunks))
+        return len(blob) + resent_size, resent_count
+
+    def test_sequential_handoff(self):
+        store_dir = os.path.join(self.temp_dir, "store")
+        common_chunks = [_random_chunk(self.rand) for i in range(300)]
+        vm1_chunks = common_chunks + \
+            [_random_chunk(self.rand) for i in range(100)]
+        vm2_chunks = common_chunks + \
+            [_random_chunk(self.rand) for i in range(100)]
+
+        first_size, resent_count = self._handoff(vm1_chunks, store_dir)
+        self.assertEqual(resent_count, 0)
+        self.assertEqual(len(ChunkStore(store_dir)), len(vm1_chunks))
+        second_size, resent_count = self._handoff(vm2_chunks, store_dir)
+        # false positives of the filter among the new chunks
+        self.assertTrue(resent_count < 10)
+        saved_ratio = 1 - float(second_size)/first_size
+        sys.stdout.write("chunk filter: %d --> %d bytes (%f saved)\n" %
+                         (first_size, second_size, saved_ratio))
+        self.assertTrue(saved_ratio > 0.7)
+
+    def test_false_positive_fallback(self):
+        store_dir = os.path.join(self.temp_dir, "store")
+        vm_chunks = [_random_chunk(self.rand) for i in range(100)]
+        self._handoff(vm_chunks, store_dir)
+        # chunks in the filter are gone at the destination, e.g. evicted
+        # after the filter is sent
+        empty_store_dir = os.path.join(self.temp_dir, "empty-store")
+        sent_size, resent_count = self._handoff(vm_chunks, store_dir,
+                                                recover_store_dir=empty_store_dir)
+        self.assertEqual(resent_count, len(vm_chunks))
+
+
+if __name__ == "__main__":
+    unittest.main()
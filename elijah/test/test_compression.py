@@ -0,0 +1,213 @@
+import unittest
+import os
+import sys
+import time
+import zlib
+import random
+import shutil
+import hashlib
+import threading
+import tempfile
+import multiprocessing
+import psutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning import compression
+from elijah.provisioning import overlay_meta
+from elijah.provisioning.compression import DecompProc
+from elijah.provisioning.package import VMOverlayPackage
+
+
+def _gzip(data):
+    compressor = zlib.compressobj(1, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(data) + compressor.flush()
+
+
+class TestDecompProc(unittest.TestCase):
+    BLOB_COUNT = 60
+
+    def setUp(self):
+        super(TestDecompProc, self).setUp()
+        self.rand = random.Random(1234)
+        # skewed blob sizes so that children finish out of order
+        self.blob_list = list()
+        for index in xrange(self.BLOB_COUNT):
+            if index % 7 == 0:
+                size = 4*1024*1024
+            else:
+                size = self.rand.randint(1, 64)*1024
+            block = os.urandom(1024)
+            self.blob_list.append(
+                "%08d" % index + block*(size/1024))
+
+    def _decompress(self, blob_list, num_proc, comp_type=Const.COMPRESSION_GZIP):
+        input_queue = multiprocessing.Queue()
+        output_queue = multiprocessing.Queue()
+        decomp_proc = DecompProc(input_queue, output_queue, num_proc=num_proc)
+        decomp_proc.start()
+        time_s = time.time()
+        for blob in blob_list:
+            input_queue.put((comp_type, _gzip(blob)))
+        input_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        output_list = list()
+        while True:
+            decomp_data = output_queue.get()
+            if decomp_data == Const.QUEUE_SUCCESS_MESSAGE or \
+                    decomp_data == Const.QUEUE_FAILED_MESSAGE:
+                break
+            output_list.append(decomp_data)
+        elapsed_time = time.time()-time_s
+        decomp_proc.join()
+        return output_list, decomp_data, elapsed_time
+
+    def test_output_order(self):
+        first_list, end_message, first_time = self._decompress(
+            self.blob_list, num_proc=3)
+        second_list, end_message, second_time = self._decompress(
+            self.blob_list, num_proc=3)
+        sys.stdout.write("decompress %d blobs with 3 proc: %f s, %f s\n" %
+                         (self.BLOB_COUNT, first_time, second_time))
+        self.assertEqual(end_message, Const.QUEUE_SUCCESS_MESSAGE)
+        self.assertEqual(''.join(first_list), ''.join(self.blob_list))
+        self.assertEqual(''.join(first_list), ''.join(second_list))
+
+        single_list, end_message, single_time = self._decompress(
+            self.blob_list, num_proc=1)
+        self.assertEqual(single_list, first_list)
+
+    def test_invalid_blob(self):
+        output_list, end_message, elapsed_time = self._decompress(
+            self.blob_list[:5], num_proc=2, comp_type=-1)
+        self.assertEqual(end_message, Const.QUEUE_FAILED_MESSAGE)
+        self.assertEqual(output_list, list())
+
+    def test_idle_children(self):
+        input_queue = multiprocessing.Queue()
+        output_queue = multiprocessing.Queue()
+        decomp_proc = DecompProc(input_queue, output_queue, num_proc=3)
+        decomp_proc.start()
+        time.sleep(0.3)
+        children = psutil.Process(decomp_proc.pid).children()
+        cpu_start = sum([sum(child.cpu_times()[:2]) for child in children])
+        time.sleep(2)
+        cpu_time = sum([sum(child.cpu_times()[:2]) for child in children]) - \
+            cpu_start
+        input_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        self.assertEqual(output_queue.get(), Const.QUEUE_SUCCESS_MESSAGE)
+        decomp_proc.join()
+        sys.stdout.write("CPU time of %d idle children in 2 s: %f s\n" %
+                         (len(children), cpu_time))
+        # children block on their task queue instead of polling
+        self.assertEqual(len(children), 3)
+        self.assertTrue(cpu_time < 0.03)
+
+
+def _get_rss_kb(field):
+    for line in open("/proc/self/status"):
+        if line.startswith(field + ":"):
+            return int(line.split()[1])
+
+
+def _decomp_child(decomp_func, input_path, output_path, result_queue):
+    rss_start = _get_rss_kb("VmRSS")
+    decomp_func(input_path, output_path, num_threads=2)
+    result_queue.put(_get_rss_kb("VmHWM") - rss_start)
+
+
+class TestDecompOverlay(unittest.TestCase):
+    BLOB_SIZE = 64*1024*1024
+    BLOB_COUNT = 3
+    PIECE_SIZE = 1024*1024
+    COMPRESSION = Const.COMPRESSION_GZIP
+
+    def setUp(self):
+        super(TestDecompOverlay, self).setUp()
+        self.temp_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.temp_dir, "overlay.decomp")
+        # write blobs piece by piece so that this process stays small
+        blob_list = list()
+        blob_path_list = list()
+        overlay_hash = hashlib.sha256()
+        for index in xrange(self.BLOB_COUNT):
+            blob_name = "overlay-blob_%d" % index
+            blob_path = os.path.join(self.temp_dir, blob_name)
+            compressor = compression.get_compressor(self.COMPRESSION, 1)
+            with open(blob_path, "wb") as blob_fd:
+                for offset in xrange(0, self.BLOB_SIZE, self.PIECE_SIZE):
+                    piece = os.urandom(16*1024)*(self.PIECE_SIZE/(16*1024))
+                    overlay_hash.update(piece)
+                    blob_fd.write(compressor.compress(piece))
+                blob_fd.write(compressor.flush())
+            blob_list.append({
+                Const.META_OVERLAY_FILE_NAME: blob_name,
+                Const.META_OVERLAY_FILE_COMPRESSION: self.COMPRESSION,
+                Const.META_OVERLAY_FILE_SIZE: os.path.getsize(blob_path)})
+            blob_path_list.append(blob_path)
+        self.overlay_sha256 = overlay_hash.hexdigest()
+        self.meta_path = os.path.join(self.temp_dir, Const.OVERLAY_META)
+        with open(self.meta_path, "wb") as meta_fd:
+            meta_fd.write(overlay_meta.pack_meta(
+                {Const.META_OVERLAY_FILES: blob_list}))
+        self.zip_path = os.path.join(self.temp_dir, "overlay.zip")
+        VMOverlayPackage.create(self.zip_path, self.meta_path, blob_path_list)
+
+    def tearDown(self):
+        super(TestDecompOverlay, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def _run_child(self, decomp_func, input_path):
+        result_queue = multiprocessing.Queue()
+        child = multiprocessing.Process(
+            target=_decomp_child,
+            args=(decomp_func, input_path, self.output_path, result_queue))
+        time_s = time.time()
+        child.start()
+        child.join()
+        self.assertEqual(child.exitcode, 0)
+        rss_growth = result_queue.get()*1024
+        sys.stdout.write("%s: %f s, peak memory growth %d MB\n" % (
+            decomp_func.__name__, time.time()-time_s, rss_growth/1024/1024))
+        output_hash = hashlib.sha256()
+        with open(self.output_path, "rb") as output_fd:
+            while True:
+                data = output_fd.read(self.PIECE_SIZE)
+                if not data:
+                    break
+                output_hash.update(data)
+        self.assertEqual(output_hash.hexdigest(), self.overlay_sha256)
+        return rss_growth
+
+    def test_decomp_overlay_memory(self):
+        rss_growth = self._run_child(compression.decomp_overlay,
+                                     self.meta_path)
+        # a blob is never held in memory as a whole
+        self.assertTrue(rss_growth < self.BLOB_SIZE/2)
+
+    def test_decomp_overlayzip_memory(self):
+        rss_growth = self._run_child(compression.decomp_overlayzip,
+                                     "file://%s" % self.zip_path)
+        self.assertTrue(rss_growth < self.BLOB_SIZE/2)
+
+    def test_invalid_blob(self):
+        with open(os.path.join(self.temp_dir, "overlay-blob_1"),
+                  "r+b") as blob_fd:
+            blob_fd.seek(1024)
+            blob_fd.write("\0"*4096)
+        thread_count = threading.active_count()
+        self.assertRaises(compression.CompressionError,
+                          compression.decomp_overlay,
+                          self.meta_path, self.output_path)
+        # threads decompressing the other blobs are stopped, not left
+        # blocked on their full output queues
+        self.assertEqual(threading.active_count(), thread_count)
+
+
+class TestDecompOverlayLZMA(TestDecompOverlay):
+    COMPRESSION = Const.COMPRESSION_LZMA
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import unittest
+import os
+import sys
+import shutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning import cpu_allocator
+from elijah.provisioning.cpu_allocator import CPUAllocator
+from elijah.provisioning.cpu_allocator import CPUTopology
+
+
+def _write(path, data):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as fd:
+        fd.write(data)
+
+
+def _make_sysfs(root, num_nodes, cores_per_node, threads_per_core,
+                with_node_dir=True):
+    """Linux numbering: cpu = thread*(all cores) + node*cores + core"""
+    num_cores = num_nodes*cores_per_node
+    num_cpus = num_cores*threads_per_core
+    _write(os.path.join(root, "online"), "0-%d\n" % (num_cpus-1))
+    for cpu_id in range(num_cpus):
+        node_id = (cpu_id % num_cores)/cores_per_node
+        core_id = cpu_id % cores_per_node
+        cpu_dir = os.path.join(root, "cpu%d" % cpu_id)
+        _write(os.path.join(cpu_dir, "topology", "physical_package_id"),
+               "%d\n" % node_id)
+        _write(os.path.join(cpu_dir, "topology", "core_id"), "%d\n" % core_id)
+        if with_node_dir:
+            os.makedirs(os.path.join(cpu_dir, "node%d" % node_id))
+    return num_cpus
+
+
+class TestCPUAllocator(unittest.TestCase):
+    STAGE_WEIGHTS = [("CreateMemoryDeltalist", 1.0),
+                     ("CreateDiskDeltalist", 1.0),
+                     ("DeltaDedup", 2.0),
+                     ("CompressProc", 8.0)]
+
+    def setUp(self):
+        super(TestCPUAllocator, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-cpu-")
+
+    def tearDown(self):
+        super(TestCPUAllocator, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def _get_topology(self, *args, **kwargs):
+        _make_sysfs(self.temp_dir, *args, **kwargs)
+        return CPUTopology.from_sysfs(self.temp_dir)
+
+    def _get_info(self, topology):
+        return dict([(info.cpu_id, info) for info in topology.cpu_info_list])
+
+    def test_parse_cpu_list(self):
+        self.assertEqual(cpu_allocator.parse_cpu_list("0-3,8,10-11\n"),
+                         [0, 1, 2, 3, 8, 10, 11])
+        self.assertEqual(cpu_allocator.parse_cpu_list("0"), [0])
+        self.assertRaises(cpu_allocator.CPUAllocatorError,
+                          cpu_allocator.parse_cpu_list, "0-a")
+
+    def test_topology(self):
+        topology = self._get_topology(2, 4, 2)
+        self.assertEqual(len(topology), 16)
+        info_dict = self._get_info(topology)
+        self.assertEqual(info_dict[5].node_id, 1)
+        self.assertEqual(info_dict[5].thread_index, 0)
+        self.assertEqual(info_dict[13].core_id, info_dict[5].core_id)
+        self.assertEqual(info_dict[13].thread_index, 1)
+
+    def test_topology_without_numa(self):
+        topology = self._get_topology(2, 2, 1, with_node_dir=False)
+        # falls back to the package
+        self.assertEqual([info.node_id for info in topology.cpu_info_list],
+                         [0, 0, 1, 1])
+
+    def test_allocation(self):
+        topology = self._get_topology(2, 4, 2)
+        info_dict = self._get_info(topology)
+        allocator = CPUAllocator(topology)
+        allocation = allocator.allocate(self.STAGE_WEIGHTS, 8)
+
+        # disjoint, and only physical cores while there are enough
+        cpu_list = sum(allocation.values(), [])
+        self.assertEqual(len(cpu_list), 8)
+        self.assertEqual(len(set(cpu_list)), 8)
+        self.assertTrue(all([info_dict[cpu_id].thread_index == 0
+                             for cpu_id in cpu_list]))
+        # in proportion to the weights
+        self.assertEqual(len(allocation["CompressProc"]), 4)
+        self.assertEqual(len(allocation["DeltaDedup"]), 2)
+        self.assertEqual(len(allocation["CreateMemoryDeltalist"]), 1)
+        # a small stage stays in a node
+        for stage in ("CreateMemoryDeltalist", "CreateDiskDeltalist",
+                      "DeltaDedup"):
+            node_set = set([info_dict[cpu_id].node_id
+                            for cpu_id in allocation[stage]])
+            self.assertEqual(len(node_set), 1)
+
+        # fill the first node before the next one
+        allocation = allocator.allocate(self.STAGE_WEIGHTS, 4)
+        cpu_list = sum(allocation.values(), [])
+        self.assertEqual(sorted(cpu_list), [0, 1, 2, 3])
+        # siblings come after all physical cores
+        allocation = allocator.allocate(self.STAGE_WEIGHTS, 10)
+        cpu_list = sum(allocation.values(), [])
+        self.assertEqual(
+            len([cpu_id for cpu_id in cpu_list
+                 if info_dict[cpu_id].thread_index == 1]), 2)
+
+    def test_rebalance(self):
+        allocator = CPUAllocator(self._get_topology(1, 8, 1))
+        allocation = allocator.allocate(self.STAGE_WEIGHTS, 8)
+        self.assertEqual(len(allocation["CompressProc"]), 4)
+        # compression became cheap, e.g. after switching to gzip
+        stage_weights = [("CreateMemoryDeltalist", 4.0),
+                         ("CreateDiskDeltalist", 4.0),
+                         ("DeltaDedup", 1.0),
+                         ("CompressProc", 1.0)]
+        allocation = allocator.allocate(stage_weights, 8)
+        self.assertEqual(len(allocation["CompressProc"]), 1)
+        self.assertEqual(len(allocation["CreateMemoryDeltalist"]), 3)
+
+        # equal share before measurement
+        allocation = allocator.allocate(
+            [(stage, 0) for (stage, weight) in self.STAGE_WEIGHTS], 8)
+        self.assertEqual([len(cpu_list) for cpu_list in allocation.values()],
+                         [2, 2, 2, 2])
+
+    def test_few_cpus(self):
+        allocator = CPUAllocator(self._get_topology(1, 2, 1))
+        allocation = allocator.allocate(self.STAGE_WEIGHTS, 8)
+        self.assertEqual(sorted(allocation.keys()),
+                         sorted([stage for (stage, w) in self.STAGE_WEIGHTS]))
+        self.assertTrue(all([len(cpu_list) == 1
+                             for cpu_list in allocation.values()]))
+        self.assertEqual(set(sum(allocation.values(), [])), set([0, 1]))
+        allocation = allocator.allocate(self.STAGE_WEIGHTS, 1,
+                                        allowed_cpus=[1])
+        self.assertEqual(set(sum(allocation.values(), [])), set([1]))
+
+    def test_stage_weights(self):
+        p_dict = {"CreateMemoryDeltalist": 2.0, "CreateDiskDeltalist": 4.0,
+                  "DeltaDedup": 1.0, "CompressProc": 3.0}
+        size_dict = {"CreateMemoryDeltalist": 300, "CreateDiskDeltalist": 100}
+        self.assertEqual(cpu_allocator.get_stage_weights(p_dict, size_dict),
+                         [("CreateMemoryDeltalist", 1.5),
+                          ("CreateDiskDeltalist", 1.0),
+                          ("DeltaDedup", 1.0),
+                          ("CompressProc", 3.0)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import os
+import sys
+import shutil
+import random
+import multiprocessing
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning import diff_codec
+from elijah.provisioning import tool
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.disk import DiskDiffProc
+from elijah.provisioning.diff_codec import ChunkFeature
+from elijah.provisioning.diff_codec import DiffCostModel
+from elijah.provisioning.diff_codec import DiffCodecSelector
+
+
+class TestDiffCodec(unittest.TestCase):
+    ALGORITHMS = ["xor", "none"]
+
+    def setUp(self):
+        super(TestDiffCodec, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-diffcodec-")
+        self.chunk_pairs = diff_codec.generate_synthetic_chunks(300)
+
+    def tearDown(self):
+        super(TestDiffCodec, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def test_chunk_feature(self):
+        (source, modi) = self.chunk_pairs[0]    # lightly edited
+        feature = ChunkFeature.from_chunk(source, modi)
+        self.assertTrue(0 < feature.changed_bytes <= 64)
+        (source, modi) = self.chunk_pairs[1]    # content moved
+        feature = ChunkFeature.from_chunk(source, modi)
+        self.assertTrue(feature.changed_bytes > len(modi)/2)
+        self.assertTrue(feature.novel_bytes < len(modi)/2)
+        feature = ChunkFeature.from_chunk(source, source)
+        self.assertEqual(feature.changed_bytes, 0)
+
+    def test_calibrated_selection(self):
+        cost_model = diff_codec.calibrate(self.chunk_pairs,
+                                          self.ALGORITHMS, 10)
+        model_path = os.path.join(self.temp_dir, "model.json")
+        cost_model.to_file(model_path)
+        selector = DiffCodecSelector.load(model_path)
+        self.assertEqual(selector.select(*self.chunk_pairs[0]), "xor")
+        self.assertEqual(selector.select(*self.chunk_pairs[2]), "none")
+
+        result = diff_codec.compare_algorithms(
+            diff_codec.generate_synthetic_chunks(300, seed=2),
+            self.ALGORITHMS, selector)
+        for algorithm, (size, diff_time) in sorted(result.iteritems()):
+            sys.stdout.write("%s: %d bytes, %f s\n" % (algorithm, size, diff_time))
+        adaptive_size = result["adaptive"][0]
+        for algorithm in self.ALGORITHMS:
+            self.assertTrue(adaptive_size < result[algorithm][0])
+
+    def test_invalid_model(self):
+        self.assertRaises(diff_codec.DiffCodecError, DiffCostModel,
+                          {"unknown": {}}, 10)
+        self.assertEqual(DiffCodecSelector.load(
+            os.path.join(self.temp_dir, "not-exist")), None)
+
+    def test_diff_chunk(self):
+        (source, modi) = self.chunk_pairs[0]
+        diff_data, ref_id = diff_codec.diff_chunk("xor", source, modi)
+        self.assertEqual(diff_data, tool.xor_data(source, modi))
+        self.assertEqual(ref_id, DeltaItem.REF_XOR)
+        diff_data, ref_id = diff_codec.diff_chunk("xor", source, modi,
+                                                  batch_xor=True)
+        self.assertEqual(diff_data, modi)
+        self.assertRaises(IOError, diff_codec.diff_chunk, "xor",
+                          source[:-1], modi)
+        # patch of new content is bigger than the chunk
+        rand = random.Random(1)
+        new_data = ''.join([chr(rand.randint(0, 255)) for i in range(4096)])
+        self.assertRaises(IOError, diff_codec.diff_chunk, "bsdiff",
+                          source, new_data)
+        self.assertRaises(diff_codec.DiffCodecError, diff_codec.diff_chunk,
+                          "unknown", source, modi)
+
+    def _run_disk_diff(self, diff_algorithm):
+        base_path = os.path.join(self.temp_dir, "base-disk")
+        modified_path = os.path.join(self.temp_dir, "modified-disk")
+        with open(base_path, "wb") as base_fd:
+            with open(modified_path, "wb") as modified_fd:
+                for (source, modi) in self.chunk_pairs[:3]:
+                    base_fd.write(source)
+                    modified_fd.write(modi)
+        command_queue = multiprocessing.Queue()
+        task_queue = multiprocessing.Queue()
+        mode_queue = multiprocessing.Queue()
+        deltalist_queue = multiprocessing.Queue()
+        diff_proc = DiskDiffProc(command_queue, task_queue, mode_queue,
+                                 deltalist_queue, diff_algorithm, base_path,
+                                 modified_path, 4096)
+        diff_proc.start()
+        task_queue.put([0, 1, 2])
+        task_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        delta_list = deltalist_queue.get(timeout=30)
+        command_queue.get(timeout=30)
+        diff_proc.join()
+        return delta_list
+
+    def test_disk_diff_proc(self):
+        # cost model is not loaded unless the algorithm is adaptive
+        model_path = Const.DIFF_COST_MODEL
+        Const.DIFF_COST_MODEL = os.path.join(self.temp_dir, "broken.json")
+        try:
+            with open(Const.DIFF_COST_MODEL, "w") as fd:
+                fd.write("not json")
+            delta_list = self._run_disk_diff("xor")
+        finally:
+            Const.DIFF_COST_MODEL = model_path
+        self.assertEqual([item.ref_id for item in delta_list],
+                         [DeltaItem.REF_XOR]*3)
+        for item, (source, modi) in zip(delta_list, self.chunk_pairs):
+            self.assertEqual(item.data, tool.xor_data(source, modi))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,275 @@
+import unittest
+import os
+import sys
+import time
+import Queue
+import select
+import shutil
+import random
+import multiprocessing
+from hashlib import sha256
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import VMOverlayCreationMode
+from elijah.provisioning import process_manager
+from elijah.provisioning.compression import CompressProc
+from elijah.provisioning.compression import CompChildProc
+from elijah.provisioning.memory import MemoryDiffProc
+from elijah.provisioning.disk import DiskDiffProc
+from elijah.provisioning.delta import DeltaItem
+
+
+class _SleepChildProc(multiprocessing.Process):
+
+    def __init__(self, command_queue, task_queue, mode_queue, output_queue):
+        self.command_queue = command_queue
+        self.task_queue = task_queue
+        self.mode_queue = mode_queue
+        self.output_queue = output_queue
+        super(_SleepChildProc, self).__init__(target=self._process)
+
+    def _process(self):
+        task_count = 0
+        input_list = [self.task_queue._reader.fileno(),
+                      self.mode_queue._reader.fileno()]
+        while True:
+            inready, outready, errready = select.select(input_list, [], [])
+            if self.mode_queue._reader.fileno() in inready:
+                (command, value) = self.mode_queue.get()
+                if command == "retire":
+                    break
+            if self.task_queue._reader.fileno() in inready:
+                task = self.task_queue.get()
+                if task == Const.QUEUE_SUCCESS_MESSAGE:
+                    break
+                (index, delay) = task
+                time.sleep(delay)
+                self.output_queue.put(index)
+                task_count += 1
+        self.command_queue.put(task_count)
+
+
+class _SleepStage(process_manager.ProcWorker):
+    """Stage whose children sleep for the delay of each task, so that more
+    children give more throughput even on a single core.
+    """
+
+    def __init__(self, task_list, output_queue, num_proc):
+        self.task_list = task_list
+        self.output_queue = output_queue
+        self.num_proc = num_proc
+        self.proc_list = list()
+        super(_SleepStage, self).__init__(target=self._process,
+                                          worker_name="SleepStage")
+
+    def _create_child(self):
+        command_queue = multiprocessing.Queue()
+        mode_queue = multiprocessing.Queue()
+        child = _SleepChildProc(command_queue, self.task_queue, mode_queue,
+                                self.output_queue)
+        return (child, command_queue, mode_queue)
+
+    def _handle_control(self):
+        control_fd = self.control_queue._reader.fileno()
+        while control_fd in select.select([control_fd], [], [], 0)[0]:
+            self._handle_control_msg(self.control_queue.get())
+
+    def _process(self):
+        self.task_queue = multiprocessing.Queue(maxsize=2)
+        for index in range(self.num_proc):
+            (child, c_queue, m_queue) = self._create_child()
+            child.start()
+            self.proc_list.append((child, c_queue, m_queue))
+        for task in self.task_list:
+            self._handle_control()
+            self.task_queue.put(task)
+        self.finish_processing_input.value = True
+        self.send_end_messages(self.task_queue)
+        task_count = 0
+        for (child, c_queue, m_queue) in self.proc_list:
+            task_count += c_queue.get()
+            child.join()
+        self.is_processing_alive.value = False
+        self.output_queue.put((len(self.proc_list), task_count))
+
+
+class TestElasticWorker(unittest.TestCase):
+    FAST_TASKS = 40
+    SLOW_TASKS = 60
+    SLOW_DELAY = 0.05
+
+    def setUp(self):
+        super(TestElasticWorker, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-worker-")
+        self.profile_path = VMOverlayCreationMode.PROFILE_DATAPATH
+        # ProcessManager needs a profile, which can be empty
+        VMOverlayCreationMode.PROFILE_DATAPATH = os.path.join(
+            self.temp_dir, "mode-profile")
+        open(VMOverlayCreationMode.PROFILE_DATAPATH, "w").close()
+        # bottleneck moves to the stage midway
+        self.task_list = [(index, 0.001) for index in range(self.FAST_TASKS)]
+        self.task_list += [(index, self.SLOW_DELAY) for index in range(
+            self.FAST_TASKS, self.FAST_TASKS+self.SLOW_TASKS)]
+
+    def tearDown(self):
+        super(TestElasticWorker, self).tearDown()
+        process_manager.kill_instance()
+        VMOverlayCreationMode.PROFILE_DATAPATH = self.profile_path
+        shutil.rmtree(self.temp_dir)
+
+    def _run_stage(self, num_proc, num_proc_change, change_at):
+        output_queue = multiprocessing.Queue()
+        stage = _SleepStage(self.task_list, output_queue, num_proc)
+        stage.start()
+        recv_time_list = list()
+        index_list = list()
+        while True:
+            output = output_queue.get()
+            if isinstance(output, tuple):
+                break
+            index_list.append(output)
+            recv_time_list.append(time.time())
+            if len(index_list) == change_at:
+                process_manager.get_instance()._change_num_proc(
+                    "SleepStage", num_proc_change)
+        stage.join()
+        # every task is processed exactly once
+        self.assertEqual(sorted(index_list), range(len(self.task_list)))
+        (child_count, task_count) = output
+        self.assertEqual(task_count, len(self.task_list))
+        return recv_time_list, child_count
+
+    @staticmethod
+    def _throughput(recv_time_list, start, end):
+        return (end-start)/(recv_time_list[end]-recv_time_list[start])
+
+    def test_scale_up(self):
+        change_at = self.FAST_TASKS + 10
+        recv_time_list, child_count = self._run_stage(1, 4, change_at)
+        self.assertEqual(child_count, 4)
+        before = self._throughput(recv_time_list, self.FAST_TASKS,
+                                  change_at)
+        after = self._throughput(recv_time_list, change_at + 10,
+                                 len(recv_time_list) - 1)
+        sys.stdout.write("throughput before/after scaling: %f, %f tasks/s\n"
+                         % (before, after))
+        self.assertTrue(after > before*2)
+
+    def test_scale_down(self):
+        change_at = self.FAST_TASKS + 10
+        recv_time_list, child_count = self._run_stage(4, 1, change_at)
+        # retired children stay in the list until the end
+        self.assertEqual(child_count, 4)
+        before = self._throughput(recv_time_list, self.FAST_TASKS,
+                                  change_at)
+        after = self._throughput(recv_time_list, change_at + 10,
+                                 len(recv_time_list) - 1)
+        self.assertTrue(after < before)
+
+    def test_stage_without_children(self):
+        stage = process_manager.ProcWorker(worker_name="NoChildStage")
+        # a stage without children ignores the request
+        stage.change_num_children(4)
+        self.assertFalse(hasattr(stage, "proc_list"))
+        self.assertEqual(stage.retired_proc_list, list())
+
+
+class TestRetireChildren(unittest.TestCase):
+    CHUNK_COUNT = 512
+    BATCH_SIZE = 16
+
+    def setUp(self):
+        super(TestRetireChildren, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-worker-")
+        self.profile_path = VMOverlayCreationMode.PROFILE_DATAPATH
+        VMOverlayCreationMode.PROFILE_DATAPATH = os.path.join(
+            self.temp_dir, "mode-profile")
+        open(VMOverlayCreationMode.PROFILE_DATAPATH, "w").close()
+        rand = random.Random(1234)
+        self.delta_list = list()
+        for index in xrange(self.CHUNK_COUNT):
+            data = "".join(chr(rand.randint(0, 15)) for i in xrange(4096))
+            self.delta_list.append(DeltaItem(
+                DeltaItem.DELTA_MEMORY, index*4096, 4096,
+                sha256(data).digest(), DeltaItem.REF_RAW, 4096, data))
+
+    def tearDown(self):
+        super(TestRetireChildren, self).tearDown()
+        process_manager.kill_instance()
+        VMOverlayCreationMode.PROFILE_DATAPATH = self.profile_path
+        shutil.rmtree(self.temp_dir)
+
+    def _compress(self, num_proc, num_proc_change):
+        delta_list_queue = multiprocessing.Queue()
+        comp_delta_queue = multiprocessing.Queue()
+        overlay_mode = \
+            VMOverlayCreationMode.get_pipelined_multi_process_finite_queue(
+                num_cores=1)
+        stage = CompressProc(delta_list_queue, comp_delta_queue,
+                             overlay_mode, block_size=64*1024)
+        stage.num_proc = num_proc
+        stage.start()
+        for index in xrange(0, self.CHUNK_COUNT, self.BATCH_SIZE):
+            delta_list_queue.put(
+                self.delta_list[index:index+self.BATCH_SIZE])
+        # children retire right before the end messages are sent
+        process_manager.get_instance()._change_num_proc(
+            "CompressProc", num_proc_change)
+        time.sleep(0.1)
+        delta_list_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        chunk_list = list()
+        while True:
+            # hangs if a retiring child took an end message
+            output = comp_delta_queue.get(timeout=30)
+            if output == Const.QUEUE_SUCCESS_MESSAGE:
+                break
+            (comp_type, comp_data, disk_chunks, memory_chunks) = output
+            chunk_list += memory_chunks
+        stage.join()
+        self.assertEqual(sorted(chunk_list), range(self.CHUNK_COUNT))
+
+    def test_retire_comp_children(self):
+        for index in xrange(5):
+            self._compress(8, 1)
+
+    def test_add_comp_children(self):
+        self._compress(1, 4)
+
+    def _retire_child(self, child_class, *args):
+        command_queue = multiprocessing.Queue()
+        task_queue = multiprocessing.Queue()
+        mode_queue = multiprocessing.Queue()
+        output_queue = multiprocessing.Queue()
+        # retire message and an end message meant for another child are
+        # both ready when the child starts
+        mode_queue.put(("retire", None))
+        task_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        self.assertTrue(mode_queue._reader.poll(5))
+        self.assertTrue(task_queue._reader.poll(5))
+        child = child_class(command_queue, task_queue, mode_queue,
+                            output_queue, *args)
+        child.start()
+        command_queue.get(timeout=30)
+        child.join()
+        self.assertEqual(child.exitcode, 0)
+        # end message is left for the active children
+        self.assertEqual(task_queue.get(timeout=5),
+                         Const.QUEUE_SUCCESS_MESSAGE)
+
+    def test_retire_children(self):
+        base_path = os.path.join(self.temp_dir, "base")
+        with open(base_path, "wb") as base_fd:
+            base_fd.write("\0"*4096*4)
+        self._retire_child(CompChildProc, Const.COMPRESSION_GZIP, 1)
+        self._retire_child(DiskDiffProc, "xdelta3", base_path, base_path,
+                           4096)
+        self._retire_child(MemoryDiffProc, "xdelta3", base_path, 4, list(),
+                           0, dict(), False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,227 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+import struct
+import random
+import numpy
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning import free_page
+from elijah.provisioning.free_page import FreePageProfile
+from elijah.provisioning.free_page import FreePageBitmap
+from elijah.provisioning.free_page import FreePageError
+
+
+class TestFreePage(unittest.TestCase):
+    PAGE_SIZE = 4096
+    MEM_SIZE = 64*1024*1024
+    MEM_OFFSET = 3*4096     # pc.ram offset in the snapshot file
+
+    def setUp(self):
+        super(TestFreePage, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-freepage-")
+        self.snapshot_path = os.path.join(self.temp_dir, "snapshot")
+        self.profile_path = os.path.join(self.temp_dir, "profile")
+        self.kpageflags_path = os.path.join(self.temp_dir, "kpageflags")
+        self.profile = FreePageProfile(mem_map_paddr=0x100000,
+                                       struct_page_size=32,
+                                       mapcount_offset=12,
+                                       buddy_mapcount_value=-128,
+                                       private_offset=16,
+                                       word_size=4)
+        self.profile.to_file(self.profile_path)
+        self.expected_free, head_pfns = self._create_snapshot()
+        self._write_kpageflags(head_pfns, self.MEM_SIZE/self.PAGE_SIZE)
+
+    def tearDown(self):
+        super(TestFreePage, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _create_snapshot(self):
+        '''write guest memory whose mem_map has random free buddy blocks
+        return set of free pfn and list of head pfn of free blocks
+        '''
+        rand = random.Random(1234)
+        page_count = self.MEM_SIZE/self.PAGE_SIZE
+        mem_map = bytearray(page_count*self.profile.struct_page_size)
+        # pages of mem_map itself are never free
+        mem_map_end = self.profile.mem_map_paddr + len(mem_map)
+        pfn = (mem_map_end + self.PAGE_SIZE - 1)/self.PAGE_SIZE
+        expected_free = set()
+        head_pfns = list()
+        while pfn < page_count:
+            order = rand.randint(0, self.profile.max_order-1)
+            block_size = 1 << order
+            pfn = (pfn + block_size - 1) & ~(block_size - 1)
+            if pfn + block_size > page_count:
+                break
+            if rand.random() < 0.5:
+                entry = pfn*self.profile.struct_page_size
+                struct.pack_into("<i", mem_map,
+                                 entry+self.profile.mapcount_offset,
+                                 self.profile.buddy_mapcount_value)
+                struct.pack_into("<I", mem_map,
+                                 entry+self.profile.private_offset, order)
+                expected_free.update(range(pfn, pfn+block_size))
+                head_pfns.append(pfn)
+            pfn += block_size
+
+        with open(self.snapshot_path, "wb") as fd:
+            fd.write("\0"*self.MEM_OFFSET)
+            fd.write("\0"*self.profile.mem_map_paddr)
+            fd.write(mem_map)
+            fd.truncate(self.MEM_OFFSET+self.MEM_SIZE)
+        return expected_free, head_pfns
+
+    def _write_kpageflags(self, head_pfns, page_count):
+        # /proc/kpageflags of the guest, with KPF_BUDDY at the head pages
+        flags = numpy.zeros(page_count, dtype=numpy.dtype("<u8"))
+        flags[head_pfns] |= 1 << free_page.KPF_BUDDY
+        with open(self.kpageflags_path, "wb") as fd:
+            fd.write(flags.tostring())
+
+    def _validate(self, mem_size=None):
+        mem_size = mem_size or self.MEM_SIZE
+        return free_page.validate_profile_file(
+            self.snapshot_path, mem_size, self.MEM_OFFSET, self.profile_path,
+            self.kpageflags_path)
+
+    def test_bitmap(self):
+        free_array = [False]*100
+        for pfn in (0, 7, 8, 63, 99):
+            free_array[pfn] = True
+        bitmap = FreePageBitmap.from_bool_array(numpy.array(free_array),
+                                                pfn_offset=3)
+        self.assertEqual(len(bitmap), 5)
+        for pfn in range(-1, 110):
+            self.assertEqual(pfn in bitmap, (pfn-3) in (0, 7, 8, 63, 99))
+
+    def test_scan_free_pages(self):
+        # unvalidated profile does not eliminate any page
+        bitmap = free_page.get_free_page_bitmap(
+            self.snapshot_path, self.MEM_SIZE, self.MEM_OFFSET,
+            self.profile_path)
+        self.assertEqual(bitmap, None)
+        self.assertTrue(self._validate().validated)
+
+        time_start = time.time()
+        bitmap = free_page.get_free_page_bitmap(
+            self.snapshot_path, self.MEM_SIZE, self.MEM_OFFSET,
+            self.profile_path)
+        sys.stdout.write("free page scan: %d pages in %f s\n" %
+                         (len(bitmap), time.time()-time_start))
+        self.assertEqual(len(bitmap), len(self.expected_free))
+        pfn_offset = self.MEM_OFFSET/self.PAGE_SIZE
+        for pfn in range(self.MEM_SIZE/self.PAGE_SIZE):
+            self.assertEqual(pfn+pfn_offset in bitmap,
+                             pfn in self.expected_free)
+
+    def test_no_profile(self):
+        bitmap = free_page.get_free_page_bitmap(
+            self.snapshot_path, self.MEM_SIZE, self.MEM_OFFSET,
+            os.path.join(self.temp_dir, "not-exist"))
+        self.assertEqual(bitmap, None)
+
+    def test_wrong_layout(self):
+        # _mapcount at a wrong offset finds no free block
+        self.profile.mapcount_offset = 16
+        self.profile.to_file(self.profile_path)
+        self.assertRaises(FreePageError, self._validate)
+        # flags word read as PG_buddy finds blocks that are not free
+        self.profile.buddy_flag_bit = 7
+        self.profile.flags_offset = self.profile.private_offset
+        self.profile.to_file(self.profile_path)
+        self.assertRaises(FreePageError, self._validate)
+        self.assertFalse(
+            FreePageProfile.from_file(self.profile_path).validated)
+        bitmap = free_page.get_free_page_bitmap(
+            self.snapshot_path, self.MEM_SIZE, self.MEM_OFFSET,
+            self.profile_path)
+        self.assertEqual(bitmap, None)
+
+    def test_recorded_kpageflags(self):
+        # buddy heads recorded from a running kernel (this machine)
+        try:
+            with open("/proc/kpageflags", "rb") as fd:
+                recorded = numpy.frombuffer(fd.read(8*1024*1024),
+                                            dtype=numpy.dtype("<u8"))
+        except IOError:
+            raise unittest.SkipTest("Cannot read /proc/kpageflags")
+        page_count = self.MEM_SIZE/self.PAGE_SIZE
+        is_buddy = (recorded >> free_page.KPF_BUDDY) & 1 == 1
+        if numpy.count_nonzero(is_buddy) == 0:
+            raise unittest.SkipTest("No free page at /proc/kpageflags")
+        # window of the guest memory size with free and used pages mixed
+        window_count = len(recorded)/page_count
+        head_counts = [numpy.count_nonzero(
+            is_buddy[index*page_count:(index+1)*page_count])
+            for index in range(window_count)]
+        mixed_counts = [min(count, page_count-count)
+                        for count in head_counts]
+        window = mixed_counts.index(max(mixed_counts))
+        window_flags = recorded[window*page_count:(window+1)*page_count]
+        with open(self.kpageflags_path, "wb") as fd:
+            fd.write(window_flags.tostring())
+        head_pfns = numpy.nonzero(
+            is_buddy[window*page_count:(window+1)*page_count])[0]
+
+        mem_map = numpy.zeros((page_count, self.profile.struct_page_size),
+                              dtype=numpy.uint8)
+        mapcount = numpy.array([self.profile.buddy_mapcount_value],
+                               dtype=numpy.dtype("<i4")).view(numpy.uint8)
+        offset = self.profile.mapcount_offset
+        mem_map[head_pfns, offset:offset+4] = mapcount
+        with open(self.snapshot_path, "wb") as fd:
+            fd.seek(self.MEM_OFFSET+self.profile.mem_map_paddr)
+            fd.write(mem_map.tostring())
+            fd.truncate(self.MEM_OFFSET+self.MEM_SIZE)
+        self.assertTrue(self._validate().validated)
+        bitmap = free_page.get_free_page_bitmap(
+            self.snapshot_path, self.MEM_SIZE, self.MEM_OFFSET,
+            self.profile_path)
+        self.assertEqual(len(bitmap), len(head_pfns))
+
+        # a profile that misses the layout by one word fails
+        self.profile.mapcount_offset += 4
+        self.profile.to_file(self.profile_path)
+        self.assertRaises(FreePageError, self._validate)
+
+    def test_builtin_profile(self):
+        # 1GB base VM without profile starts from the built-in mem_map
+        # address, but needs validation before eliminating free pages
+        mem_size = 1024*1024*1024
+        profile = FreePageProfile.get_builtin(mem_size)
+        self.assertEqual(profile.mem_map_paddr, 0x373fd000)
+        self.assertEqual(FreePageProfile.get_builtin(self.MEM_SIZE), None)
+        free_pfn = 0x1000
+        entry = bytearray(profile.struct_page_size)
+        struct.pack_into("<i", entry, profile.mapcount_offset,
+                         profile.buddy_mapcount_value)
+        struct.pack_into("<I", entry, profile.private_offset, 2)
+        with open(self.snapshot_path, "wb") as fd:
+            fd.seek(self.MEM_OFFSET + profile.mem_map_paddr +
+                    free_pfn*profile.struct_page_size)
+            fd.write(entry)
+            fd.truncate(self.MEM_OFFSET+mem_size)
+        os.remove(self.profile_path)
+        bitmap = free_page.get_free_page_bitmap(
+            self.snapshot_path, mem_size, self.MEM_OFFSET, self.profile_path)
+        self.assertEqual(bitmap, None)
+        self._write_kpageflags([free_pfn], mem_size/self.PAGE_SIZE)
+        self.assertTrue(self._validate(mem_size).validated)
+        bitmap = free_page.get_free_page_bitmap(
+            self.snapshot_path, mem_size, self.MEM_OFFSET, self.profile_path)
+        self.assertEqual(len(bitmap), 4)
+        pfn_offset = self.MEM_OFFSET/self.PAGE_SIZE
+        for pfn in range(free_pfn, free_pfn+4):
+            self.assertTrue(pfn+pfn_offset in bitmap)
+
+
+if __name__ == "__main__":
+    unittest.main()
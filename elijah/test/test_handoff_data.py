@@ -0,0 +1,153 @@
+import unittest
+import os
+import sys
+import struct
+import random
+import shutil
+from hashlib import sha256
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning.configuration import Options
+from elijah.provisioning.handoff import BaseHashIndex
+from elijah.provisioning.handoff import HandoffDataSend
+from elijah.provisioning.handoff import HandoffDataRecv
+from elijah.provisioning.handoff import HandoffError
+from elijah.provisioning.delta import DeltaDedup
+
+
+class TestHandoffData(unittest.TestCase):
+
+    def setUp(self):
+        super(TestHandoffData, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-handoff-")
+        self.rand = random.Random(1234)
+
+    def tearDown(self):
+        super(TestHandoffData, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def _create_basevm(self, name, chunk_count):
+        # meta files of the same format as base VM's disk and memory meta
+        base_dir = os.path.join(self.temp_dir, name)
+        os.mkdir(base_dir)
+        base_vm_paths = [os.path.join(base_dir, filename) for filename in
+                         ("disk", "memory", "disk-meta", "memory-meta")]
+        for meta_path in base_vm_paths[2:]:
+            with open(meta_path, "wb") as fd:
+                for index in xrange(chunk_count):
+                    hash_value = sha256(
+                        str(self.rand.getrandbits(64))).digest()
+                    fd.write(struct.pack("!qI32s", index*4096, 4096,
+                                         hash_value))
+        return base_vm_paths
+
+    def _save_send_data(self, base_vm_paths, filename):
+        handoff_ds = HandoffDataSend()
+        handoff_ds.save_data(
+            base_vm_paths, sha256(base_vm_paths[0]).hexdigest(),
+            DeltaDedup.disk_import_hashdict(base_vm_paths[2]),
+            DeltaDedup.memory_import_hashdict(base_vm_paths[3]),
+            Options(), "tcp://127.0.0.1:8022", None,
+            "/tmp/fuse", "/tmp/qemu-log", "/tmp/qmp", 1,
+            [1, 5, 6, 15], "qemu:///session")
+        handoff_datafile = os.path.join(self.temp_dir, filename)
+        handoff_ds.to_file(handoff_datafile)
+        return handoff_ds, handoff_datafile
+
+    def test_send_data(self):
+        small_paths = self._create_basevm("small", 100)
+        large_paths = self._create_basevm("large", 100*100)
+        handoff_ds, small_datafile = self._save_send_data(small_paths,
+                                                          "small-data")
+        large_ds, large_datafile = self._save_send_data(large_paths,
+                                                        "large-data")
+        # hash dicts are not in the handoff data. Only the encoding of the
+        # size, mtime and checksum of meta files differs
+        self.assertTrue(abs(os.path.getsize(small_datafile) -
+                            os.path.getsize(large_datafile)) < 16)
+        self.assertTrue(os.path.getsize(large_datafile) <
+                        os.path.getsize(large_paths[3])/100)
+
+        loaded = HandoffDataSend.from_file(large_datafile,
+                                           load_vm_data=False)
+        self._assert_same_index(loaded.basedisk_hashdict,
+                                large_ds.basedisk_hashdict)
+        self._assert_same_index(loaded.basemem_hashdict,
+                                large_ds.basemem_hashdict)
+        self.assertEqual(len(loaded.basemem_hashdict), 100*100)
+        self.assertEqual(loaded.base_vm_paths, large_paths)
+        self.assertEqual(loaded.handoff_addr, large_ds.handoff_addr)
+        self.assertEqual(loaded.dirty_disk_chunks, [1, 5, 6, 15])
+        self.assertEqual(loaded.options.to_dict(),
+                         large_ds.options.to_dict())
+
+        # base VM meta is changed after saving handoff data
+        with open(large_paths[2], "ab") as fd:
+            fd.write(struct.pack("!qI32s", 0, 4096, sha256("new").digest()))
+        self.assertRaises(HandoffError, HandoffDataSend.from_file,
+                          large_datafile, load_vm_data=False)
+
+    def _assert_same_index(self, hash_index, hash_dict):
+        for hash_value, offset in hash_dict.iteritems():
+            self.assertEqual(hash_index.get(hash_value), offset)
+        self.assertEqual(hash_index.get(sha256("unknown").digest()), None)
+
+    def test_hash_index(self):
+        base_vm_paths = self._create_basevm("base", 1000)
+        # duplicated hash and hashes sharing the sorted prefix
+        with open(base_vm_paths[3], "ab") as fd:
+            for (offset, hash_value) in (
+                    (1000*4096, sha256("0").digest()),
+                    (1001*4096, "\0"*8 + sha256("1").digest()[8:]),
+                    (1002*4096, "\0"*8 + sha256("2").digest()[8:]),
+                    (1003*4096, sha256("0").digest())):
+                fd.write(struct.pack("!qI32s", offset, 4096, hash_value))
+        index = BaseHashIndex(BaseHashIndex.INDEX_MEMORY, base_vm_paths[3])
+        loaded = BaseHashIndex.from_dict(index.to_dict()).load()
+        self._assert_same_index(
+            loaded, DeltaDedup.memory_import_hashdict(base_vm_paths[3]))
+        self.assertEqual(loaded.get(sha256("0").digest()), 1003*4096)
+        self.assertEqual(len(loaded), 1004)
+        self.assertRaises(HandoffError, BaseHashIndex, "cpu",
+                          base_vm_paths[3])
+
+        # rewritten in place
+        meta_stat = os.stat(base_vm_paths[3])
+        with open(base_vm_paths[3], "r+b") as fd:
+            fd.write(struct.pack("!qI32s", 0, 4096, sha256("new").digest()))
+        os.utime(base_vm_paths[3], (meta_stat.st_atime,
+                                    meta_stat.st_mtime+1))
+        self.assertRaises(HandoffError, BaseHashIndex.from_dict(
+            index.to_dict()).load)
+
+        # changed in place with the same size and mtime
+        meta_mtime = int(os.stat(base_vm_paths[3]).st_mtime)
+        os.utime(base_vm_paths[3], (meta_mtime, meta_mtime))
+        index = BaseHashIndex(BaseHashIndex.INDEX_MEMORY, base_vm_paths[3])
+        with open(base_vm_paths[3], "r+b") as fd:
+            fd.write(struct.pack("!qI32s", 0, 4096, sha256("old").digest()))
+        os.utime(base_vm_paths[3], (meta_mtime, meta_mtime))
+        self.assertEqual(BaseHashIndex.get_stat(base_vm_paths[3])[:2],
+                         index.meta_stat[:2])
+        self.assertRaises(HandoffError, BaseHashIndex.from_dict(
+            index.to_dict()).load)
+        os.remove(base_vm_paths[3])
+        self.assertRaises(HandoffError, BaseHashIndex.from_dict(
+            index.to_dict()).load)
+
+    def test_recv_data(self):
+        base_vm_paths = self._create_basevm("base", 10)
+        handoff_dr = HandoffDataRecv()
+        handoff_dr.save_data(base_vm_paths, sha256("base").hexdigest(),
+                             "/tmp/launch-disk", "/tmp/launch-memory")
+        handoff_datafile = os.path.join(self.temp_dir, "recv-data")
+        handoff_dr.to_file(handoff_datafile)
+        loaded = HandoffDataRecv.from_file(handoff_datafile)
+        self.assertEqual(loaded.__dict__, handoff_dr.__dict__)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,134 @@
+import unittest
+import os
+import sys
+import random
+import shutil
+import multiprocessing
+from hashlib import sha256
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import VMOverlayCreationMode
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import DeltaDedup
+from elijah.provisioning import process_manager
+
+
+class TestLiveMemoryDedup(unittest.TestCase):
+    PAGE_SIZE = 4096
+
+    def setUp(self):
+        super(TestLiveMemoryDedup, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-dedup-")
+        self.profile_path = VMOverlayCreationMode.PROFILE_DATAPATH
+        # ProcessManager needs a profile, which can be empty
+        VMOverlayCreationMode.PROFILE_DATAPATH = os.path.join(
+            self.temp_dir, "mode-profile")
+        open(VMOverlayCreationMode.PROFILE_DATAPATH, "w").close()
+        # each page oscillates between a few states over iterations
+        self.page_states = [chr(state+1)*self.PAGE_SIZE
+                            for state in range(3)]
+        self.page_count = 256
+        self.iteration_count = 8
+        rand = random.Random(1234)
+        self.trace = list()
+        for iter_seq in range(self.iteration_count):
+            dirty_pages = dict()
+            for page_num in range(self.page_count):
+                if iter_seq == 0 or rand.random() < 0.5:
+                    dirty_pages[page_num] = rand.randint(
+                        0, len(self.page_states)-1)
+            self.trace.append(dirty_pages)
+
+    def tearDown(self):
+        super(TestLiveMemoryDedup, self).tearDown()
+        process_manager.kill_instance()
+        VMOverlayCreationMode.PROFILE_DATAPATH = self.profile_path
+        shutil.rmtree(self.temp_dir)
+
+    def _get_deltaitem_list(self, iter_seq, dirty_pages, is_live=True):
+        if iter_seq == 0 or not is_live:
+            delta_type = DeltaItem.DELTA_MEMORY
+        else:
+            delta_type = DeltaItem.DELTA_MEMORY_LIVE
+        deltaitem_list = list()
+        for page_num, state in sorted(dirty_pages.iteritems()):
+            data = self.page_states[state]
+            deltaitem_list.append(
+                DeltaItem(delta_type, page_num*self.PAGE_SIZE, len(data),
+                          hash_value=sha256(data).digest(),
+                          ref_id=DeltaItem.REF_RAW, data_len=len(data),
+                          data=data, live_seq=iter_seq))
+        return deltaitem_list
+
+    def _dedup(self, is_live):
+        memory_queue = multiprocessing.Queue()
+        disk_queue = multiprocessing.Queue()
+        merged_queue = multiprocessing.Queue()
+        dedup = DeltaDedup(memory_queue, self.PAGE_SIZE, disk_queue,
+                           self.PAGE_SIZE, merged_queue, None,
+                           basedisk_hashdict=dict(), basemem_hashdict=dict())
+        dedup.start()
+        for iter_seq, dirty_pages in enumerate(self.trace):
+            memory_queue.put(self._get_deltaitem_list(iter_seq, dirty_pages,
+                                                      is_live))
+        memory_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        disk_queue.put(Const.QUEUE_SUCCESS_MESSAGE)
+        deduped_list = list()
+        while True:
+            deltaitem_list = merged_queue.get(timeout=30)
+            if deltaitem_list == Const.QUEUE_SUCCESS_MESSAGE:
+                break
+            deduped_list += deltaitem_list
+        dedup.join()
+        out_size = sum([item.data_len+11 for item in deduped_list])
+        return deduped_list, out_size
+
+    def test_unchanged_pages(self):
+        deduped_list, live_size = self._dedup(True)
+        # the same pages as non-live items go only through the existing
+        # zero, base and self-hash deduplication
+        self_hash_list, self_hash_size = self._dedup(False)
+        sys.stdout.write("self hash: %d items, %d bytes\n"
+                         "unchanged live pages dropped: %d items, %d bytes\n"
+                         % (len(self_hash_list), self_hash_size,
+                            len(deduped_list), live_size))
+        self.assertTrue(len(deduped_list) < len(self_hash_list))
+        self.assertTrue(live_size < self_hash_size)
+
+        # receiver should have the latest version of every page
+        recovered_hash_dict = dict()
+        recovered_pages = dict()
+        for delta_item in deduped_list:
+            if delta_item.ref_id == DeltaItem.REF_SELF_HASH:
+                data = recovered_hash_dict[delta_item.data]
+            else:
+                self.assertEqual(delta_item.ref_id, DeltaItem.REF_RAW)
+                data = delta_item.data
+            recovered_hash_dict[sha256(data).digest()] = data
+            recovered_pages[delta_item.offset/self.PAGE_SIZE] = data
+        latest_pages = dict()
+        for dirty_pages in self.trace:
+            latest_pages.update(dirty_pages)
+        for page_num, state in latest_pages.iteritems():
+            self.assertEqual(recovered_pages[page_num],
+                             self.page_states[state])
+
+    def test_out_of_order_iteration(self):
+        dedup = DeltaDedup(None, self.PAGE_SIZE, None, self.PAGE_SIZE, None,
+                           None)
+        old_item = self._get_deltaitem_list(1, {0: 0})[0]
+        new_item = self._get_deltaitem_list(2, {0: 1})[0]
+        dedup._update_live_page(new_item)
+        # older iteration does not overwrite the latest hash of the page
+        self.assertFalse(dedup._is_unchanged_live_page(old_item))
+        dedup._update_live_page(old_item)
+        same_item = self._get_deltaitem_list(3, {0: 1})[0]
+        self.assertTrue(dedup._is_unchanged_live_page(same_item))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,211 @@
+import unittest
+import os
+import sys
+import random
+import shutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning.configuration import VMOverlayCreationMode
+from elijah.provisioning.migration_profile import MigrationMode
+from elijah.provisioning.migration_profile import ModeProfile
+from elijah.provisioning.migration_profile import stage_names
+from elijah.provisioning.process_manager import ProcessManager
+
+
+class TestModeLearning(unittest.TestCase):
+    TRUE_P = {"CreateMemoryDeltalist": 0.8, "CreateDiskDeltalist": 0.4,
+              "DeltaDedup": 0.01, "CompressProc": 1.2}
+    TRUE_R = {"CreateMemoryDeltalist": 0.5, "CreateDiskDeltalist": 0.3,
+              "DeltaDedup": 0.7, "CompressProc": 0.4}
+    BLOCK_SIZE_IN = {"CreateMemoryDeltalist": 3000,
+                     "CreateDiskDeltalist": 1000,
+                     "DeltaDedup": 4000, "CompressProc": 3000}
+
+    def setUp(self):
+        super(TestModeLearning, self).setUp()
+        self.rand = random.Random(1234)
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-profile-")
+        # offline profile measured on a machine twice as fast
+        self.mode = self._get_mode("xdelta3", 5)
+        profiled_mode = self._get_mode("xdelta3", 5)
+        for stage_name in stage_names:
+            profiled_mode.block_time[stage_name] = \
+                self.TRUE_P[stage_name]/2
+            profiled_mode.block_size_ratio[stage_name] = \
+                self.TRUE_R[stage_name]*1.5
+            profiled_mode.block_size_in[stage_name] = \
+                self.BLOCK_SIZE_IN[stage_name]
+        profiled_mode.update_total()
+        self.mode_profile = ModeProfile([profiled_mode])
+
+    def tearDown(self):
+        super(TestModeLearning, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    @staticmethod
+    def _get_mode(disk_diff, comp_level):
+        mode = MigrationMode()
+        mode.workload = "test"
+        mode.mode = {"MEMORY_DIFF_ALGORITHM": "xdelta3",
+                     "DISK_DIFF_ALGORITHM": disk_diff,
+                     "COMPRESSION_ALGORITHM_TYPE": 2,
+                     "COMPRESSION_ALGORITHM_SPEED": comp_level}
+        return mode
+
+    def _observe(self, noise, sample_count):
+        # a handoff averages noisy samples of P and R
+        p_list = list()
+        r_list = list()
+        for index in range(sample_count):
+            p_list.append(dict(
+                [(key, value*self.rand.gauss(1.0, noise))
+                 for (key, value) in self.TRUE_P.iteritems()]))
+            r_list.append(dict(
+                [(key, value*self.rand.gauss(1.0, noise))
+                 for (key, value) in self.TRUE_R.iteritems()]))
+        p_dict = dict([(key, sum([p[key] for p in p_list])/sample_count)
+                       for key in stage_names])
+        r_dict = dict([(key, sum([r[key] for r in r_list])/sample_count)
+                       for key in stage_names])
+        total_p_list = [sum(p.values()) for p in p_list]
+        return p_dict, r_dict, ModeProfile.get_confidence(total_p_list)
+
+    def _assert_close(self, learned, truth, tolerance):
+        for stage_name in stage_names:
+            error = abs(learned[stage_name]-truth[stage_name]) / \
+                truth[stage_name]
+            self.assertTrue(error < tolerance, "%s: %f vs %f" % (
+                stage_name, learned[stage_name], truth[stage_name]))
+
+    def test_convergence(self):
+        for index in range(40):
+            sample_count = self.rand.randint(5, 80)
+            p_dict, r_dict, confidence = self._observe(0.3, sample_count)
+            self.assertTrue(0 < confidence <= 1)
+            learned = self.mode_profile.update_mode(
+                self.mode, p_dict, r_dict, self.BLOCK_SIZE_IN, confidence)
+        self._assert_close(learned.block_time, self.TRUE_P, 0.05)
+        self._assert_close(learned.block_size_ratio, self.TRUE_R, 0.05)
+        alpha = 0.75
+        self.assertAlmostEqual(
+            learned.total_p, MigrationMode.get_total_P(learned.block_time,
+                                                       alpha))
+
+    def test_confidence(self):
+        p_dict, r_dict, confidence = self._observe(0.01, 100)
+        self.assertTrue(confidence > 0.95)
+        p_dict, r_dict, confidence = self._observe(0.5, 5)
+        self.assertTrue(confidence < 0.1)
+        self.assertEqual(ModeProfile.get_confidence([]), 0.0)
+
+        # an observation without confidence does not change the profile
+        profiled_p = self.mode_profile.overlay_mode_list[0].total_p
+        outlier_p = dict([(key, value*100)
+                          for (key, value) in self.TRUE_P.iteritems()])
+        self.mode_profile.update_mode(self.mode, outlier_p, self.TRUE_R,
+                                      self.BLOCK_SIZE_IN, 0.0)
+        self.assertEqual(self.mode_profile.overlay_mode_list[0].total_p,
+                         profiled_p)
+        # and a confident one moves it by LEARNING_RATE at most
+        self.mode_profile.update_mode(self.mode, outlier_p, self.TRUE_R,
+                                      self.BLOCK_SIZE_IN, 1.0)
+        learned_p = self.mode_profile.overlay_mode_list[0].block_time
+        self.assertAlmostEqual(
+            learned_p["CompressProc"],
+            0.6 + ModeProfile.LEARNING_RATE*(120-0.6))
+
+    def test_new_mode(self):
+        new_mode = self._get_mode("bsdiff", 9)
+        self.mode_profile.update_mode(new_mode, self.TRUE_P, self.TRUE_R,
+                                      self.BLOCK_SIZE_IN, 0.1)
+        self.assertEqual(len(self.mode_profile.overlay_mode_list), 2)
+        learned = ModeProfile.find_same_mode(
+            self.mode_profile.overlay_mode_list, new_mode)
+        self._assert_close(learned.block_time, self.TRUE_P, 1e-9)
+
+    def test_save_atomic(self):
+        profile_path = os.path.join(self.temp_dir, "mode-profile")
+        learned_path = ModeProfile.get_learned_path(profile_path,
+                                                    self.temp_dir)
+        p_dict, r_dict, confidence = self._observe(0.1, 50)
+        self.mode_profile.update_mode(self.mode, p_dict, r_dict,
+                                      self.BLOCK_SIZE_IN, confidence)
+        ModeProfile.save_to_file(learned_path,
+                                 self.mode_profile.overlay_mode_list)
+        self.assertEqual(os.listdir(self.temp_dir),
+                         [os.path.basename(learned_path)])
+
+        loaded_profile = ModeProfile.load_from_file(learned_path)
+        self.assertEqual(len(loaded_profile.overlay_mode_list), 1)
+        loaded = loaded_profile.overlay_mode_list[0]
+        saved = self.mode_profile.overlay_mode_list[0]
+        self.assertEqual(loaded.get_mode_id(), saved.get_mode_id())
+        self.assertAlmostEqual(loaded.total_p, saved.total_p)
+        self.assertAlmostEqual(loaded.total_r, saved.total_r)
+
+        # a failed save leaves the previous profile and no temp file
+        self.assertRaises(AttributeError, ModeProfile.save_to_file,
+                          learned_path, [object()])
+        self.assertEqual(os.listdir(self.temp_dir),
+                         [os.path.basename(learned_path)])
+        loaded_profile = ModeProfile.load_from_file(learned_path)
+        self.assertAlmostEqual(loaded_profile.overlay_mode_list[0].total_p,
+                               saved.total_p)
+
+    def test_stale_learned_profile(self):
+        profile_dir = os.path.join(self.temp_dir, "conf")
+        learned_dir = os.path.join(self.temp_dir, "learned")
+        os.mkdir(profile_dir)
+        profile_path = os.path.join(profile_dir, "mode-profile")
+        ModeProfile.save_to_file(profile_path,
+                                 self.mode_profile.overlay_mode_list)
+        learned_path = ModeProfile.get_learned_path(profile_path, learned_dir)
+        p_dict, r_dict, confidence = self._observe(0.1, 50)
+        self.mode_profile.update_mode(self.mode, p_dict, r_dict,
+                                      self.BLOCK_SIZE_IN, confidence)
+        os.mkdir(learned_dir)
+        ModeProfile.save_to_file(learned_path,
+                                 self.mode_profile.overlay_mode_list,
+                                 source_checksum=ModeProfile.get_checksum(
+                                     profile_path))
+        learned_p = self.mode_profile.overlay_mode_list[0].total_p
+
+        saved_config = (VMOverlayCreationMode.PROFILE_DATAPATH,
+                        VMOverlayCreationMode.LEARN_MODE_PROFILE,
+                        VMOverlayCreationMode.LEARNED_PROFILE_DIR)
+        VMOverlayCreationMode.PROFILE_DATAPATH = profile_path
+        VMOverlayCreationMode.LEARN_MODE_PROFILE = True
+        VMOverlayCreationMode.LEARNED_PROFILE_DIR = learned_dir
+        try:
+            manager = ProcessManager()
+            self.assertAlmostEqual(
+                manager.mode_profile.overlay_mode_list[0].total_p, learned_p)
+
+            # a new profile replaces what is learned from the old one
+            new_mode = self._get_mode("bsdiff", 1)
+            for stage_name in stage_names:
+                new_mode.block_time[stage_name] = self.TRUE_P[stage_name]
+                new_mode.block_size_ratio[stage_name] = \
+                    self.TRUE_R[stage_name]
+                new_mode.block_size_in[stage_name] = \
+                    self.BLOCK_SIZE_IN[stage_name]
+            with open(profile_path, "a") as fd:
+                MigrationMode.to_file(new_mode, fd)
+            manager = ProcessManager()
+            self.assertEqual(len(manager.mode_profile.overlay_mode_list), 2)
+            self.assertNotAlmostEqual(
+                manager.mode_profile.overlay_mode_list[0].total_p, learned_p)
+            self.assertFalse(os.path.exists(learned_path))
+            self.assertEqual(os.listdir(profile_dir),
+                             [os.path.basename(profile_path)])
+        finally:
+            (VMOverlayCreationMode.PROFILE_DATAPATH,
+             VMOverlayCreationMode.LEARN_MODE_PROFILE,
+             VMOverlayCreationMode.LEARNED_PROFILE_DIR) = saved_config
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+import os
+import sys
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import VMOverlayCreationMode
+from elijah.provisioning.migration_profile import BIT_PER_BLOCK
+from elijah.provisioning.migration_profile import MigrationMode
+from elijah.provisioning.migration_profile import ModeProfile
+from elijah.provisioning.network_emulator import NetworkTrace
+from elijah.provisioning import mode_switch
+from elijah.provisioning.mode_switch import ModeSwitchCost
+
+
+class TestModeSwitch(unittest.TestCase):
+
+    def setUp(self):
+        super(TestModeSwitch, self).setUp()
+        # fast mode sends more, slow mode compresses better
+        self.fast_mode = self._get_mode(Const.COMPRESSION_GZIP, 1, 1.0, 0.5)
+        self.slow_mode = self._get_mode(Const.COMPRESSION_LZMA, 9, 4.0, 0.2)
+        self.mode_profile = ModeProfile([self.fast_mode, self.slow_mode])
+        num_cores = VMOverlayCreationMode.get_num_cores()
+        self.slow_block_per_sec = MigrationMode.get_system_throughput(
+            num_cores, self.slow_mode.total_p, self.slow_mode.total_r)[0]
+        # bandwidth where the network bound fast mode is as fast as the
+        # compute bound slow mode
+        self.crossover_bw = self.slow_block_per_sec * \
+            self.fast_mode.total_r*BIT_PER_BLOCK/1024.0/1024
+        self.total_blocks = self.slow_block_per_sec*100
+        parameter_dict = dict(
+            [(parameter, {ModeSwitchCost.KEY_LOST_BYTES: 64*1024})
+             for parameter in VMOverlayCreationMode.VARYING_PARAMETERS])
+        self.switch_cost = ModeSwitchCost(parameter_dict, 1.0, 0.1)
+
+    @staticmethod
+    def _get_mode(comp_type, comp_level, total_p, total_r):
+        mode = MigrationMode()
+        mode.mode = {"MEMORY_DIFF_ALGORITHM": "xdelta3",
+                     "DISK_DIFF_ALGORITHM": "xdelta3",
+                     "COMPRESSION_ALGORITHM_TYPE": comp_type,
+                     "COMPRESSION_ALGORITHM_SPEED": comp_level}
+        mode.block_time = {"CreateMemoryDeltalist": total_p/4,
+                           "CreateDiskDeltalist": total_p/4,
+                           "DeltaDedup": total_p/4,
+                           "CompressProc": total_p/2}
+        mode.block_size_ratio = {"CreateMemoryDeltalist": total_r,
+                                 "CreateDiskDeltalist": total_r,
+                                 "DeltaDedup": 1.0, "CompressProc": 1.0}
+        mode.block_size_in = {"CreateMemoryDeltalist": 1,
+                              "CreateDiskDeltalist": 1}
+        mode.update_total()
+        return mode
+
+    def _simulate(self, trace, switch_cost):
+        return mode_switch.simulate(
+            self.mode_profile, self.fast_mode, trace, self.total_blocks,
+            self.switch_cost, switch_cost=switch_cost)
+
+    def test_cost(self):
+        changed_dict = MigrationMode.mode_diff(self.fast_mode.mode,
+                                               self.slow_mode.mode)
+        self.assertEqual(len(changed_dict), 2)
+        # compressors flush once for both parameters: 64 KB at 1 Mbps
+        self.assertAlmostEqual(self.switch_cost.get_cost(changed_dict, 1.0),
+                               1.5)
+        self.assertEqual(self.switch_cost.get_cost(dict(), 1.0), 0.0)
+        self.assertAlmostEqual(ModeSwitchCost.get_gain(100, 200, 1000), 5.0)
+
+        model_dict = self.switch_cost.to_dict()
+        self.assertEqual(ModeSwitchCost.from_dict(model_dict).to_dict(),
+                         model_dict)
+        # calibrated model shipped with the configuration
+        model_path = os.path.join(os.path.dirname(mode_switch.__file__),
+                                  "config", "mode-switch-cost.json")
+        self.assertTrue(ModeSwitchCost.load(model_path) is not None)
+
+    def test_oscillating_bandwidth(self):
+        # bandwidth hovers around the break-even point
+        entries = [(index*5, self.crossover_bw*(1.05 if index % 2 else 0.95),
+                    0) for index in range(100)]
+        trace = NetworkTrace(entries)
+        always_time, always_count = self._simulate(trace, None)
+        cost_time, cost_count = self._simulate(trace, self.switch_cost)
+        sys.stdout.write("always switch: %f s, %d switches\n"
+                         "switch cost: %f s, %d switches\n" %
+                         (always_time, always_count, cost_time, cost_count))
+        self.assertTrue(always_count > 10)
+        self.assertTrue(cost_count <= 1)
+        self.assertTrue(cost_time < always_time)
+
+    def test_bandwidth_drop(self):
+        # a lasting drop pays off the switch to the slow mode
+        trace = NetworkTrace([(0, self.crossover_bw*2, 0),
+                              (20, self.crossover_bw/4, 0)])
+        always_time, always_count = self._simulate(trace, None)
+        cost_time, cost_count = self._simulate(trace, self.switch_cost)
+        self.assertEqual(cost_count, 1)
+        self.assertTrue(cost_time <= always_time)
+
+    def test_remaining_data(self):
+        network_bw = self.crossover_bw/4
+        mode = self.fast_mode
+        item = self.mode_profile.predict_new_mode(
+            mode, mode.block_time, mode.block_size_ratio, mode.block_size_in,
+            network_bw, remaining_blocks=self.total_blocks,
+            switch_cost=self.switch_cost)
+        self.assertEqual(item[0], self.slow_mode)
+        # not worth it near the end of the handoff
+        item = self.mode_profile.predict_new_mode(
+            mode, mode.block_time, mode.block_size_ratio, mode.block_size_in,
+            network_bw, remaining_blocks=10, switch_cost=self.switch_cost)
+        self.assertEqual(item, None)
+
+
+if __name__ == "__main__":
+    unittest.main()
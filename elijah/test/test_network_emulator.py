@@ -0,0 +1,93 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning import network_emulator
+from elijah.provisioning.network_emulator import NetworkTrace
+from elijah.provisioning.network_emulator import TokenBucket
+
+
+class _NullWriter(object):
+
+    def __init__(self):
+        self.written_size = 0
+
+    def write(self, data):
+        self.written_size += len(data)
+
+    def sendall(self, data):
+        self.written_size += len(data)
+
+
+class TestNetworkEmulator(unittest.TestCase):
+
+    def setUp(self):
+        super(TestNetworkEmulator, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-network-")
+        self.trace_path = os.path.join(self.temp_dir, "trace")
+        with open(self.trace_path, "w") as fd:
+            fd.write("# time(s)\tbandwidth(Mbps)\tlatency(ms)\n")
+            fd.write("0\t40\t0\n")
+            fd.write("0.5\t10\t0\n")
+            fd.write("1.0\t20\t0\n")
+
+    def tearDown(self):
+        super(TestNetworkEmulator, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _measure(self, write_func, duration, write_size=32*1024):
+        data = "x" * write_size
+        time_start = time.time()
+        while time.time() - time_start < duration:
+            write_func(data)
+        return time.time() - time_start
+
+    def test_load_trace(self):
+        trace = NetworkTrace.load_from_file(self.trace_path)
+        self.assertEqual(trace.get_bandwidth(0.2), 40)
+        self.assertEqual(trace.get_bandwidth(0.7), 10)
+        self.assertEqual(trace.get_bandwidth(10), 20)
+        self.assertEqual(trace.next_change(0.7), 1.0)
+        self.assertEqual(trace.next_change(1.5), None)
+
+    def test_static_bandwidth(self):
+        bandwidth_mbps = 16
+        null_writer = _NullWriter()
+        writer = network_emulator.ShapedFile(
+            null_writer, TokenBucket(bandwidth_mbps=bandwidth_mbps))
+        duration = self._measure(writer.write, 1.0)
+        expected = bandwidth_mbps*1024*1024/8.0*duration
+        self.assertTrue(
+            abs(null_writer.written_size - expected) < expected*0.05,
+            "sent %d bytes, expected %d" % (null_writer.written_size, expected))
+
+    def test_trace_bandwidth(self):
+        trace = NetworkTrace.load_from_file(self.trace_path)
+        null_writer = _NullWriter()
+        token_bucket = TokenBucket(trace=trace)
+        writer = network_emulator.ShapedSocket(null_writer, token_bucket)
+        self._measure(writer.sendall, 1.5)
+        duration = token_bucket.elapsed_time()
+        expected = trace.transferable_bytes(0, duration)
+        self.assertTrue(
+            abs(null_writer.written_size - expected) < expected*0.05,
+            "sent %d bytes, expected %d" % (null_writer.written_size, expected))
+
+    def test_latency(self):
+        trace = NetworkTrace.constant(100, latency_ms=200)
+        writer = network_emulator.ShapedFile(
+            _NullWriter(), TokenBucket(trace=trace))
+        time_start = time.time()
+        writer.write("x"*1024)
+        self.assertTrue(time.time() - time_start >= 0.2)
+
+
+if __name__ == "__main__":
+    unittest.main()
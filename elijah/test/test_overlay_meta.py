@@ -0,0 +1,257 @@
+import unittest
+import os
+import sys
+import time
+import random
+import imp
+import shutil
+import socket
+import struct
+import multiprocessing
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+import msgpack
+import numpy
+
+from elijah.provisioning import overlay_meta
+from elijah.provisioning import process_manager
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import VMOverlayCreationMode
+from elijah.provisioning.chunk_bitmap import ChunkBitmap
+from elijah.provisioning.package import VMOverlayPackage
+from elijah.provisioning.stream_client import StreamSynthesisClient
+from elijah.provisioning.stream_server import StreamSynthesisHandler
+
+STREAM_CLIENT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "..", "..", "bin", "stream-client")
+
+
+class TestOverlayMeta(unittest.TestCase):
+    CHUNK_COUNT = 2*1000*1000
+    BLOB_CHUNK_COUNT = 2000
+
+    def setUp(self):
+        super(TestOverlayMeta, self).setUp()
+        self.rand = random.Random(1234)
+
+    def _get_meta(self, chunk_list_list):
+        blob_list = list()
+        for index, (disk_chunks, memory_chunks) in enumerate(chunk_list_list):
+            blob_list.append({
+                Const.META_OVERLAY_FILE_NAME: "overlay-blob_%d.xz" % index,
+                Const.META_OVERLAY_FILE_COMPRESSION: Const.COMPRESSION_LZMA,
+                Const.META_OVERLAY_FILE_SIZE: 1024*1024,
+                Const.META_OVERLAY_FILE_DISK_CHUNKS: disk_chunks,
+                Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks})
+        return {
+            Const.META_BASE_VM_SHA256: "0"*64,
+            Const.META_RESUME_VM_DISK_SIZE: 8*1024*1024*1024,
+            Const.META_RESUME_VM_MEMORY_SIZE: 1024*1024*1024,
+            Const.META_OVERLAY_FILES: blob_list}
+
+    def test_chunk_list_encoding(self):
+        sequential = range(100, 5000)
+        unordered = [self.rand.randint(0, 1 << 40) for index in xrange(1000)]
+        mixed = range(10, 20) + [3, 1 << 33, 7] + range(50, 60) + [0]
+        for chunks in (sequential, unordered, mixed, [], [0], [5, 5]):
+            data = overlay_meta.encode_chunk_list(chunks)
+            self.assertEqual(
+                overlay_meta.decode_chunk_list(data).tolist(), chunks)
+        # runs are smaller than varints
+        data = overlay_meta.encode_chunk_list(sequential)
+        self.assertEqual(ord(data[0]), overlay_meta.ENCODING_RUN)
+        self.assertTrue(len(data) < 20)
+
+        self.assertRaises(overlay_meta.OverlayMetaError,
+                          overlay_meta.encode_chunk_list, [1, -1])
+        data = overlay_meta.encode_chunk_list(unordered)
+        self.assertRaises(overlay_meta.OverlayMetaError,
+                          overlay_meta.decode_chunk_list, data[:-1])
+        self.assertRaises(overlay_meta.OverlayMetaError,
+                          overlay_meta.decode_chunk_list, data[:5])
+
+    def test_meta_versions(self):
+        meta_dict = self._get_meta([(range(10), [3, 1, 2]), ([], [7])])
+        meta_v1 = msgpack.packb(meta_dict)
+        self.assertEqual(overlay_meta.unpack_meta(meta_v1), meta_dict)
+        self.assertEqual(
+            overlay_meta.pack_meta(meta_dict, overlay_meta.META_VERSION_1),
+            meta_v1)
+
+        meta_v2 = overlay_meta.pack_meta(meta_dict)
+        meta_info = overlay_meta.unpack_meta(meta_v2)
+        self.assertEqual(meta_info[Const.META_VERSION],
+                         overlay_meta.META_VERSION_2)
+        for blob_info, v2_blob_info in zip(
+                meta_dict[Const.META_OVERLAY_FILES],
+                meta_info[Const.META_OVERLAY_FILES]):
+            for key in overlay_meta.CHUNK_KEYS:
+                chunks = v2_blob_info[key]
+                self.assertTrue(isinstance(chunks, overlay_meta.ChunkList))
+                self.assertEqual(len(chunks), len(blob_info[key]))
+                self.assertEqual(list(chunks), blob_info[key])
+        self.assertEqual(list(overlay_meta.get_chunk_bitmap(
+            meta_info[Const.META_OVERLAY_FILES],
+            Const.META_OVERLAY_FILE_MEMORY_CHUNKS)), [1, 2, 3, 7])
+
+        # repacking keeps the encoded lists and converts back to v1
+        self.assertEqual(overlay_meta.pack_meta(meta_info), meta_v2)
+        self.assertEqual(
+            overlay_meta.pack_meta(meta_info, overlay_meta.META_VERSION_1),
+            meta_v1)
+        meta_dict[Const.META_VERSION] = 3
+        self.assertRaises(overlay_meta.OverlayMetaError,
+                          overlay_meta.unpack_meta, msgpack.packb(meta_dict))
+
+    def test_large_meta(self):
+        # 2M chunks in blobs mixing runs and random chunks
+        state = numpy.random.RandomState(1234)
+        chunk_list_list = list()
+        chunk_count = 0
+        while chunk_count < self.CHUNK_COUNT:
+            start = int(state.randint(0, 1 << 21))
+            disk_chunks = range(start, start + self.BLOB_CHUNK_COUNT/2)
+            memory_chunks = state.randint(
+                0, 1 << 18, self.BLOB_CHUNK_COUNT/2).tolist()
+            chunk_list_list.append((disk_chunks, memory_chunks))
+            chunk_count += self.BLOB_CHUNK_COUNT
+        meta_dict = self._get_meta(chunk_list_list)
+        meta_v1 = overlay_meta.pack_meta(meta_dict, overlay_meta.META_VERSION_1)
+        meta_v2 = overlay_meta.pack_meta(meta_dict)
+
+        result_list = list()
+        for meta_raw in (meta_v1, meta_v2):
+            time_s = time.time()
+            meta_info = overlay_meta.unpack_meta(meta_raw)
+            parse_time = time.time()-time_s
+            time_s = time.time()
+            blob_list = meta_info[Const.META_OVERLAY_FILES]
+            disk_bitmap = overlay_meta.get_chunk_bitmap(
+                blob_list, Const.META_OVERLAY_FILE_DISK_CHUNKS)
+            memory_bitmap = overlay_meta.get_chunk_bitmap(
+                blob_list, Const.META_OVERLAY_FILE_MEMORY_CHUNKS)
+            bitmap_time = time.time()-time_s
+            result_list.append((disk_bitmap, memory_bitmap))
+            sys.stdout.write(
+                "%d chunks, meta %d bytes: parse %f s, to bitmap %f s\n" %
+                (chunk_count, len(meta_raw), parse_time, bitmap_time))
+
+        self.assertTrue(len(meta_v2) < len(meta_v1)/2)
+        self.assertEqual(result_list[0], result_list[1])
+        disk_chunks = ChunkBitmap()
+        for disk_list, memory_list in chunk_list_list:
+            disk_chunks.update(disk_list)
+        self.assertEqual(result_list[1][0], disk_chunks)
+
+
+class _BlobReceiver(StreamSynthesisHandler):
+    """Handler on an accepted socket without the synthesis of handle()"""
+
+    def __init__(self, request):
+        self.request = request
+
+
+class TestStreamOverlay(unittest.TestCase):
+    """Version 2 overlay from bin/stream-client to the blob loop of
+    StreamSynthesisHandler over a loopback socket
+    """
+
+    def setUp(self):
+        super(TestStreamOverlay, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-stream-overlay-")
+        self.profile_path = VMOverlayCreationMode.PROFILE_DATAPATH
+        # ProcessManager needs a profile, which can be empty
+        VMOverlayCreationMode.PROFILE_DATAPATH = os.path.join(
+            self.temp_dir, "mode-profile")
+        open(VMOverlayCreationMode.PROFILE_DATAPATH, "w").close()
+        self.rand = random.Random(1234)
+
+    def tearDown(self):
+        super(TestStreamOverlay, self).tearDown()
+        process_manager.kill_instance()
+        VMOverlayCreationMode.PROFILE_DATAPATH = self.profile_path
+        shutil.rmtree(self.temp_dir)
+
+    def _create_overlay(self, chunk_list_list):
+        blob_list = list()
+        blob_path_list = list()
+        for index, (disk_chunks, memory_chunks) in enumerate(chunk_list_list):
+            blob_name = "overlay-blob_%d.xz" % index
+            blob_path = os.path.join(self.temp_dir, blob_name)
+            blob_data = os.urandom(1024 + index)
+            open(blob_path, "wb").write(blob_data)
+            blob_path_list.append(blob_path)
+            blob_list.append({
+                Const.META_OVERLAY_FILE_NAME: blob_name,
+                Const.META_OVERLAY_FILE_COMPRESSION: Const.COMPRESSION_LZMA,
+                Const.META_OVERLAY_FILE_SIZE: len(blob_data),
+                Const.META_OVERLAY_FILE_DISK_CHUNKS: disk_chunks,
+                Const.META_OVERLAY_FILE_MEMORY_CHUNKS: memory_chunks})
+        meta_dict = {
+            Const.META_BASE_VM_SHA256: "0"*64,
+            Const.META_RESUME_VM_DISK_SIZE: 8*1024*1024*1024,
+            Const.META_RESUME_VM_MEMORY_SIZE: 1024*1024*1024,
+            Const.META_OVERLAY_FILES: blob_list}
+        meta_path = os.path.join(self.temp_dir, Const.OVERLAY_META)
+        open(meta_path, "wb").write(overlay_meta.pack_meta(meta_dict))
+        overlay_path = os.path.join(self.temp_dir, "overlay.zip")
+        VMOverlayPackage.create(overlay_path, meta_path, blob_path_list)
+        return overlay_path
+
+    def test_stream_v2_overlay(self):
+        chunk_list_list = list()
+        for index in range(4):
+            disk_chunks = range(index*10000, index*10000+3000)
+            memory_chunks = sorted(self.rand.sample(xrange(1 << 20), 500))
+            chunk_list_list.append((disk_chunks, memory_chunks))
+        overlay_path = self._create_overlay(chunk_list_list)
+        stream_client_bin = imp.load_source("stream_client_bin",
+                                            STREAM_CLIENT_PATH)
+
+        comp_queue = multiprocessing.Queue()
+        metadata = stream_client_bin.synthesize_data(overlay_path, comp_queue)
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.bind(("127.0.0.1", 0))
+        listen_sock.listen(1)
+        client = StreamSynthesisClient("127.0.0.1",
+                                       listen_sock.getsockname()[1],
+                                       metadata, comp_queue)
+        client.start()
+        server_sock, address = listen_sock.accept()
+        handler = _BlobReceiver(server_sock)
+
+        header_size = struct.unpack("!I", handler._recv_all(4))[0]
+        header = msgpack.unpackb(handler._recv_all(header_size))
+        self.assertEqual(header[Const.META_BASE_VM_SHA256], "0"*64)
+        network_out_queue = multiprocessing.Queue()
+        disk_chunk_all = ChunkBitmap()
+        memory_chunk_all = ChunkBitmap()
+        blob_count = handler._recv_blobs(network_out_queue, disk_chunk_all,
+                                         memory_chunk_all)
+        # destination resumed the VM
+        server_sock.sendall(struct.pack("!Qd", 0x10, 0))
+        client.join()
+        server_sock.close()
+        listen_sock.close()
+
+        self.assertEqual(blob_count, len(chunk_list_list))
+        overlay_package = VMOverlayPackage("file:///%s" % overlay_path)
+        for index in range(blob_count):
+            comp_type, blob_data = network_out_queue.get()
+            self.assertEqual(comp_type, Const.COMPRESSION_LZMA)
+            self.assertEqual(blob_data, overlay_package.read_blob(
+                "overlay-blob_%d.xz" % index))
+        disk_chunks = ChunkBitmap()
+        memory_chunks = ChunkBitmap()
+        for disk_list, memory_list in chunk_list_list:
+            disk_chunks.update(disk_list)
+            memory_chunks.update(memory_list)
+        self.assertEqual(disk_chunk_all, disk_chunks)
+        self.assertEqual(memory_chunk_all, memory_chunks)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,207 @@
+import unittest
+import os
+import sys
+import time
+import random
+import urllib2
+import threading
+import BaseHTTPServer
+from Queue import Queue
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning import network_emulator
+from elijah.provisioning import prefetch
+from elijah.provisioning.prefetch import ChunkPrefetcher
+from elijah.provisioning.access_trace import AccessTrace
+
+
+class _OverlayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        blob_data = self.server.blob_dict.get(self.path.lstrip("/"), None)
+        if blob_data is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(blob_data)))
+        self.end_headers()
+        network_emulator.ShapedFile(
+            self.wfile, self.server.token_bucket).write(blob_data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FetchThread(threading.Thread):
+    """Fetch blobs in the priority of server.URLFetchStep"""
+
+    def __init__(self, base_url, overlay_urls, demanding_queue,
+                 prefetch_queue):
+        self.base_url = base_url
+        self.overlay_urls = list(overlay_urls)
+        self.demanding_queue = demanding_queue
+        self.prefetch_queue = prefetch_queue
+        self.fetched_dict = dict([(url, threading.Event())
+                                  for url in overlay_urls])
+        threading.Thread.__init__(self, target=self.fetch_blobs)
+
+    def fetch_blobs(self):
+        while len(self.overlay_urls) > 0:
+            url, is_demand = prefetch.pop_priority_url(
+                self.demanding_queue, self.prefetch_queue,
+                lambda url: url not in self.overlay_urls)
+            if url is None:
+                url = self.overlay_urls[0]
+            self.overlay_urls.remove(url)
+            urllib2.urlopen(self.base_url + url).read()
+            self.fetched_dict[url].set()
+
+
+class TestPrefetch(unittest.TestCase):
+    BLOB_COUNT = 96
+    CHUNKS_PER_BLOB = 8
+    BLOB_SIZE = 16*1024
+    ACCESS_COUNT = 40
+    BANDWIDTH_Mbps = 16
+    THINK_TIME = 0.012
+
+    def setUp(self):
+        super(TestPrefetch, self).setUp()
+        self.rand = random.Random(1234)
+        self.blob_dict = dict()
+        self.overlay_info = list()
+        for index in xrange(self.BLOB_COUNT):
+            blob_name = "blob-%d" % index
+            self.blob_dict[blob_name] = os.urandom(self.BLOB_SIZE)
+            chunk_list = range(index*self.CHUNKS_PER_BLOB,
+                               (index+1)*self.CHUNKS_PER_BLOB)
+            self.overlay_info.append({
+                Const.META_OVERLAY_FILE_NAME: blob_name,
+                Const.META_OVERLAY_FILE_SIZE: self.BLOB_SIZE,
+                Const.META_OVERLAY_FILE_DISK_CHUNKS: list(),
+                Const.META_OVERLAY_FILE_MEMORY_CHUNKS: chunk_list})
+        self.meta_info = {Const.META_OVERLAY_FILES: self.overlay_info}
+
+        self.http_server = BaseHTTPServer.HTTPServer(("localhost", 0),
+                                                     _OverlayHandler)
+        self.http_server.blob_dict = self.blob_dict
+        self.http_server.token_bucket = network_emulator.TokenBucket(
+            bandwidth_mbps=self.BANDWIDTH_Mbps, bucket_size=16*1024)
+        self.server_thread = threading.Thread(
+            target=self.http_server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.base_url = "http://localhost:%d/" % \
+            self.http_server.server_address[1]
+
+    def tearDown(self):
+        super(TestPrefetch, self).tearDown()
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def _get_recorded_trace(self):
+        # working set touched in random order at the previous run
+        chunk_list = [self.rand.randint(
+            index*self.CHUNKS_PER_BLOB, (index+1)*self.CHUNKS_PER_BLOB-1)
+            for index in self.rand.sample(xrange(self.BLOB_COUNT),
+                                          self.ACCESS_COUNT)]
+        return [AccessTrace.get_key(DeltaItem.DELTA_MEMORY, chunk)
+                for chunk in chunk_list]
+
+    def _perturb(self, chunk_key_list):
+        # drop some accesses and swap some neighbors
+        perturbed_list = [chunk_key for chunk_key in chunk_key_list
+                          if self.rand.random() > 0.1]
+        for index in xrange(0, len(perturbed_list)-1, 5):
+            perturbed_list[index], perturbed_list[index+1] = \
+                perturbed_list[index+1], perturbed_list[index]
+        return perturbed_list
+
+    def _replay(self, chunk_key_list, prefetcher):
+        """Replay accesses of the VM and return (stall count, stall time)
+        """
+        demanding_queue = Queue()
+        prefetch_queue = None
+        if prefetcher is not None:
+            prefetch_queue = prefetcher.prefetch_queue
+        overlay_urls = [blob[Const.META_OVERLAY_FILE_NAME]
+                        for blob in self.overlay_info]
+        fetch_thread = _FetchThread(self.base_url, overlay_urls,
+                                    demanding_queue, prefetch_queue)
+        chunk_url_dict = dict()
+        for blob in self.overlay_info:
+            for chunk in blob[Const.META_OVERLAY_FILE_MEMORY_CHUNKS]:
+                chunk_url_dict[chunk] = blob[Const.META_OVERLAY_FILE_NAME]
+
+        stall_count = 0
+        stall_time = 0.0
+        fetch_thread.start()
+        for chunk_key in chunk_key_list:
+            chunk = chunk_key >> 1
+            url = chunk_url_dict[chunk]
+            fetched = fetch_thread.fetched_dict[url]
+            if not fetched.is_set():
+                # demand miss like cloudletfs.CloudletFS.fuse_read
+                time_s = time.time()
+                stall_count += 1
+                demanding_queue.put(url)
+                if prefetcher is not None:
+                    prefetcher.on_demand(DeltaItem.DELTA_MEMORY, chunk)
+                fetched.wait()
+                stall_time += (time.time()-time_s)
+            time.sleep(self.THINK_TIME)
+        fetch_thread.join()
+        return stall_count, stall_time
+
+    def test_transition_prefetch(self):
+        recorded_list = self._get_recorded_trace()
+        replay_list = self._perturb(recorded_list)
+        no_prefetch = self._replay(replay_list, None)
+        prefetcher = ChunkPrefetcher(
+            self.meta_info, Queue(),
+            access_trace_list=[AccessTrace(recorded_list)])
+        with_prefetch = self._replay(replay_list, prefetcher)
+        sys.stdout.write("%d accesses, demand-miss stalls: no prefetch "
+                         "%d (%f s), prefetch %d (%f s), %d prefetched\n" %
+                         (len(replay_list), no_prefetch[0], no_prefetch[1],
+                          with_prefetch[0], with_prefetch[1],
+                          prefetcher.prefetch_count))
+        self.assertTrue(with_prefetch[0] < no_prefetch[0]/2)
+
+    def test_stride_prefetch(self):
+        # scan every other blob without any recorded trace
+        replay_list = [AccessTrace.get_key(DeltaItem.DELTA_MEMORY, chunk)
+                       for chunk in xrange(self.BLOB_COUNT/2*self.CHUNKS_PER_BLOB,
+                                           self.BLOB_COUNT*self.CHUNKS_PER_BLOB,
+                                           self.CHUNKS_PER_BLOB*2)]
+        no_prefetch = self._replay(replay_list, None)
+        prefetcher = ChunkPrefetcher(self.meta_info, Queue())
+        with_prefetch = self._replay(replay_list, prefetcher)
+        sys.stdout.write("stride scan, demand-miss stalls: no prefetch %d, "
+                         "prefetch %d\n" % (no_prefetch[0], with_prefetch[0]))
+        self.assertTrue(with_prefetch[0] < no_prefetch[0]/2)
+
+    def test_bandwidth_budget(self):
+        recorded_list = self._get_recorded_trace()
+        prefetcher = ChunkPrefetcher(
+            self.meta_info, Queue(),
+            access_trace_list=[AccessTrace(recorded_list)],
+            bandwidth_mbps=0.001, burst_size=self.BLOB_SIZE*2,
+            depth=len(recorded_list))
+        prefetch_list = prefetcher.on_demand(DeltaItem.DELTA_MEMORY,
+                                             recorded_list[0] >> 1)
+        self.assertEqual(len(prefetch_list), 2)
+        self.assertEqual(prefetcher.prefetch_size, self.BLOB_SIZE*2)
+        # demanded or prefetched blobs are not predicted again
+        prefetcher.budget.tokens = self.BLOB_SIZE*2
+        prefetch_list += prefetcher.on_demand(DeltaItem.DELTA_MEMORY,
+                                              recorded_list[0] >> 1)
+        self.assertEqual(len(set(prefetch_list)), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+import os
+import sys
+import time
+import random
+import shutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.configuration import VMOverlayCreationMode
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.migration_profile import ModeProfile
+from elijah.provisioning import profile_generator
+from elijah.provisioning.profile_generator import StageInput
+
+
+class TestProfileGenerator(unittest.TestCase):
+    # xdelta3, bsdiff and xor need the native library
+    DIFF_ALGORITHMS = ["none"]
+    COMPRESSION_TYPES = [Const.COMPRESSION_GZIP, Const.COMPRESSION_BZIP2]
+    COMPRESSION_LEVELS = [1, 9]
+
+    def setUp(self):
+        super(TestProfileGenerator, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-profile-")
+        self.memory_input = StageInput.synthetic(DeltaItem.DELTA_MEMORY,
+                                                 1024, seed=1)
+        self.disk_input = StageInput.synthetic(DeltaItem.DELTA_DISK,
+                                               512, seed=2)
+        self.mode_list = profile_generator.get_mode_list(
+            self.DIFF_ALGORITHMS, self.COMPRESSION_TYPES,
+            self.COMPRESSION_LEVELS)
+
+    def tearDown(self):
+        super(TestProfileGenerator, self).tearDown()
+        shutil.rmtree(self.temp_dir)
+
+    def test_mode_list(self):
+        mode_list = profile_generator.get_mode_list()
+        self.assertEqual(len(mode_list), 4*4*3*9)
+        for mode_dict in mode_list:
+            self.assertEqual(sorted(mode_dict.keys()),
+                             sorted(VMOverlayCreationMode.VARYING_PARAMETERS))
+        self.assertEqual(len(self.mode_list), 4)
+
+    def test_generate(self):
+        exp_list = profile_generator.generate_profile(
+            self.memory_input, self.disk_input, mode_list=self.mode_list,
+            sample_count=256)
+        self.assertEqual(len(exp_list), len(self.mode_list))
+        for exp in exp_list:
+            self.assertEqual(exp.block["CreateMemoryDeltalist"], 256)
+            for stage_name in exp.block_time.keys():
+                self.assertTrue(exp.block_time[stage_name] >= 0)
+            # zero and duplicated pages
+            self.assertTrue(exp.block_size_ratio["DeltaDedup"] < 0.9)
+            self.assertTrue(exp.block_size_ratio["CompressProc"] < 1)
+
+        profile_path = os.path.join(self.temp_dir, "mode-profile")
+        ModeProfile.save_to_file(profile_path, exp_list)
+        mode_profile = ModeProfile.load_from_file(profile_path)
+        self.assertEqual(len(mode_profile.overlay_mode_list), len(exp_list))
+        for (loaded, exp) in zip(mode_profile.overlay_mode_list, exp_list):
+            self.assertEqual(loaded.get_mode_id(), exp.get_mode_id())
+            self.assertAlmostEqual(loaded.total_r, exp.total_r)
+
+        # higher level compresses better at the cost of time
+        exp_dict = dict([((exp.mode['COMPRESSION_ALGORITHM_TYPE'],
+                           exp.mode['COMPRESSION_ALGORITHM_SPEED']), exp)
+                         for exp in exp_list])
+        gzip1 = exp_dict[(Const.COMPRESSION_GZIP, 1)]
+        gzip9 = exp_dict[(Const.COMPRESSION_GZIP, 9)]
+        self.assertTrue(gzip9.total_r < gzip1.total_r)
+
+    @staticmethod
+    def _relative(exp_list, attr_name):
+        # value of each mode relative to the mean, as in compare_profiles
+        value_dict = dict([(exp.get_mode_id(), getattr(exp, attr_name))
+                           for exp in exp_list])
+        mean = sum(value_dict.values())/len(value_dict)
+        return dict([(mode_id, value/mean)
+                     for (mode_id, value) in value_dict.iteritems()])
+
+    def test_consistency(self):
+        time_start = time.time()
+        exp_list = profile_generator.generate_profile(
+            self.memory_input, self.disk_input, mode_list=self.mode_list,
+            sample_count=256)
+        time_sampled = time.time() - time_start
+        time_start = time.time()
+        exhaustive_list = profile_generator.generate_exhaustive_profile(
+            self.memory_input, self.disk_input, mode_list=self.mode_list)
+        time_exhaustive = time.time() - time_start
+        sys.stdout.write("sampled: %f s, exhaustive: %f s\n" %
+                         (time_sampled, time_exhaustive))
+        matched_count, total_count = profile_generator.compare_profiles(
+            exhaustive_list, exp_list, threshold_percent=20)
+        self.assertEqual(total_count, len(self.mode_list))
+        sys.stdout.write("%d out of %d modes match\n" %
+                         (matched_count, total_count))
+
+        # R depends only on the sampled data
+        exhaustive_r = self._relative(exhaustive_list, "total_r")
+        sampled_r = self._relative(exp_list, "total_r")
+        for mode_id, ratio in exhaustive_r.iteritems():
+            self.assertTrue(abs(sampled_r[mode_id]-ratio) < ratio*0.2)
+        # P is measured time, so it only needs to keep the modes apart
+        exhaustive_p = self._relative(exhaustive_list, "total_p")
+        sampled_p = self._relative(exp_list, "total_p")
+        for mode_id, ratio in exhaustive_p.iteritems():
+            self.assertTrue(ratio/2 < sampled_p[mode_id] < ratio*2)
+
+    def test_from_files(self):
+        rand = random.Random(1234)
+        base_data = ''.join([chr(rand.randint(0, 255))
+                             for index in xrange(Const.CHUNK_SIZE*16)])
+        modi_data = bytearray(base_data)
+        for chunk_index in (1, 5, 6, 15):
+            modi_data[chunk_index*Const.CHUNK_SIZE] ^= 0xff
+        base_path = os.path.join(self.temp_dir, "base")
+        modi_path = os.path.join(self.temp_dir, "modified")
+        open(base_path, "wb").write(base_data)
+        open(modi_path, "wb").write(str(modi_data))
+        stage_input = StageInput.from_files(DeltaItem.DELTA_DISK,
+                                            base_path, modi_path)
+        self.assertEqual([chunk[0]/Const.CHUNK_SIZE
+                          for chunk in stage_input.chunk_list], [1, 5, 6, 15])
+        self.assertRaises(profile_generator.ProfileGeneratorError,
+                          StageInput.from_files, DeltaItem.DELTA_DISK,
+                          base_path, base_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+import os
+import sys
+import zlib
+import random
+import shutil
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning import tool
+from elijah.provisioning import diff_codec
+from elijah.provisioning import similarity_index
+from elijah.provisioning.similarity_index import SimilarityIndex
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import recover_similar_data
+
+
+class TestSimilarityIndex(unittest.TestCase):
+    CHUNK_SIZE = 4096
+    CHUNK_COUNT = 512
+
+    def setUp(self):
+        super(TestSimilarityIndex, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-similarity-")
+        self.rand = random.Random(1234)
+        chunk_pairs = diff_codec.generate_synthetic_chunks(
+            self.CHUNK_COUNT, chunk_size=self.CHUNK_SIZE)
+        self.base_data = ''.join(source for (source, modi) in chunk_pairs)
+        # zero page is not indexed
+        self.base_data = self.base_data[:-self.CHUNK_SIZE] + \
+            '\0'*self.CHUNK_SIZE
+        self.base_path = os.path.join(self.temp_dir, "base")
+        with open(self.base_path, "wb") as fd:
+            fd.write(self.base_data)
+
+    def tearDown(self):
+        super(TestSimilarityIndex, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _get_modified_chunks(self):
+        # chunks of the base image moved to other offset with light edits
+        offset_list = range(0, len(self.base_data), self.CHUNK_SIZE)
+        shuffled_list = list(offset_list)
+        self.rand.shuffle(shuffled_list)
+        modified_list = list()
+        for offset, source_offset in zip(offset_list, shuffled_list)[:-1]:
+            data = bytearray(
+                self.base_data[source_offset:source_offset+self.CHUNK_SIZE])
+            for edit in xrange(self.rand.randint(1, 16)):
+                data[self.rand.randint(0, self.CHUNK_SIZE-1)] = \
+                    self.rand.randint(0, 255)
+            modified_list.append((offset, str(data)))
+        return modified_list
+
+    def test_sketch_file(self):
+        sketch_path = os.path.join(self.temp_dir, "sketch")
+        similarity_index.create_sketch_file(self.base_path, sketch_path,
+                                            batch_chunks=100)
+        index = SimilarityIndex.from_file(sketch_path)
+        self.assertEqual(index.chunk_size, self.CHUNK_SIZE)
+        sketches = similarity_index.compute_sketches(self.base_data,
+                                                     self.CHUNK_SIZE)
+        for offset in (0, 99*self.CHUNK_SIZE, 100*self.CHUNK_SIZE):
+            sketch = sketches[offset/self.CHUNK_SIZE].tolist()
+            self.assertEqual(index.lookup(sketch), offset)
+        self.assertEqual(sketches[-1].tolist(), [0]*4)
+
+        with open(sketch_path, "r+b") as fd:
+            fd.write('\0'*4)
+        self.assertRaises(similarity_index.SimilarityIndexError,
+                          SimilarityIndex.from_file, sketch_path)
+        self.assertEqual(SimilarityIndex.load(
+            os.path.join(self.temp_dir, "not-exist")), None)
+
+    def test_poor_diff_ratio(self):
+        # light edits at the same offset stay under the ratio, and an
+        # unrelated base chunk goes over it
+        offset_list = range(0, len(self.base_data)-self.CHUNK_SIZE,
+                            self.CHUNK_SIZE)
+        edited_count = unrelated_count = 0
+        for offset, data in self._get_modified_chunks()[:100]:
+            same_data = bytearray(
+                self.base_data[offset:offset+self.CHUNK_SIZE])
+            for edit in xrange(64):
+                same_data[self.rand.randint(0, self.CHUNK_SIZE-1)] = \
+                    self.rand.randint(0, 255)
+            diff_data = tool.diff_data_bsdiff(
+                self.base_data[offset:offset+self.CHUNK_SIZE],
+                str(same_data))
+            if len(diff_data) <= \
+                    self.CHUNK_SIZE*SimilarityIndex.POOR_DIFF_RATIO:
+                edited_count += 1
+            other_offset = self.rand.choice(offset_list)
+            diff_data = tool.diff_data_bsdiff(
+                self.base_data[other_offset:other_offset+self.CHUNK_SIZE],
+                data)
+            if len(diff_data) > \
+                    self.CHUNK_SIZE*SimilarityIndex.POOR_DIFF_RATIO:
+                unrelated_count += 1
+        self.assertEqual(edited_count, 100)
+        self.assertTrue(unrelated_count > 95)
+
+    def test_diff_similar_chunk(self):
+        sketch_path = os.path.join(self.temp_dir, "sketch")
+        similarity_index.create_sketch_file(self.base_path, sketch_path)
+        index = SimilarityIndex.from_file(sketch_path)
+
+        same_offset_list = list()
+        similar_list = list()
+        for offset, data in self._get_modified_chunks():
+            source_data = self.base_data[offset:offset+self.CHUNK_SIZE]
+            diff_data = tool.diff_data_bsdiff(source_data, data)
+            if len(diff_data) > len(data):
+                diff_data = data
+            same_offset_list.append(diff_data)
+            if len(diff_data) > len(data)*SimilarityIndex.POOR_DIFF_RATIO:
+                similar_data = index.diff_similar_chunk(
+                    self.base_data, offset, data, "bsdiff")
+                if similar_data is not None and \
+                        len(similar_data) < len(diff_data):
+                    delta_item = DeltaItem(
+                        DeltaItem.DELTA_DISK, offset, len(data), None,
+                        ref_id=DeltaItem.REF_BASE_SIMILAR,
+                        data_len=len(similar_data), data=similar_data)
+                    self.assertEqual(recover_similar_data(
+                        delta_item, None, self.base_data), data)
+                    diff_data = similar_data
+            similar_list.append(diff_data)
+
+        same_offset_size = len(zlib.compress(''.join(same_offset_list), 6))
+        similar_size = len(zlib.compress(''.join(similar_list), 6))
+        sys.stdout.write("same offset: %d bytes, similar chunk: %d bytes "
+                         "(%d chunks)\n" % (same_offset_size, similar_size,
+                                            index.similar_count))
+        self.assertTrue(index.similar_count > self.CHUNK_COUNT*0.9)
+        self.assertTrue(similar_size < same_offset_size/4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,216 @@
+import unittest
+import os
+import sys
+import time
+import shutil
+import multiprocessing
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+from tempfile import mkdtemp
+
+from elijah.provisioning.configuration import Const
+from elijah.provisioning.cloudletfs import StreamMonitor
+from elijah.provisioning.cloudletfs import FileMonitor
+
+
+class _QemuLogMonitor(FileMonitor):
+
+    def __init__(self, path, name):
+        self.log_list = list()
+        FileMonitor.__init__(self, path, name)
+
+    def _handle_qemu_log(self, line):
+        self.log_list.append((time.time(), line))
+
+
+class _CountingStreamMonitor(StreamMonitor):
+
+    def __init__(self):
+        self.handle_count = dict()
+        StreamMonitor.__init__(self)
+
+    def _handle(self, fd, event):
+        name = self.stream_dict[fd]['name']
+        self.handle_count[name] = self.handle_count.get(name, 0) + 1
+        StreamMonitor._handle(self, fd, event)
+
+
+class TestStreamMonitor(unittest.TestCase):
+    EVENT_COUNT = 100
+
+    def setUp(self):
+        super(TestStreamMonitor, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-monitor-")
+
+    def tearDown(self):
+        super(TestStreamMonitor, self).tearDown()
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _make_stream(self, name):
+        # FIFO behaves like the stream files of cloudletfs
+        path = os.path.join(self.temp_dir, name)
+        os.mkfifo(path)
+        return path
+
+    def test_modified_chunk_latency(self):
+        stream_path = self._make_stream("chunks_modified")
+        modified_disk_queue = multiprocessing.Queue()
+        monitor = StreamMonitor(modified_disk_queue=modified_disk_queue)
+        monitor.add_path(stream_path, StreamMonitor.DISK_MODIFY)
+        monitor.start()
+        write_fd = os.open(stream_path, os.O_WRONLY)
+        latency_list = list()
+        for chunk in xrange(self.EVENT_COUNT):
+            os.write(write_fd, "%f\t%d\n" % (time.time(), chunk))
+            recv_chunk, ctime = modified_disk_queue.get()
+            latency_list.append(time.time()-ctime)
+            self.assertEqual(recv_chunk, chunk)
+            time.sleep(0.002)
+        latency_list.sort()
+        sys.stdout.write("event-to-consumer latency of %d modified chunks: "
+                         "avg %f ms, max %f ms\n" %
+                         (self.EVENT_COUNT,
+                          1000.0*sum(latency_list)/len(latency_list),
+                          1000.0*latency_list[-1]))
+        self.assertTrue(latency_list[len(latency_list)/2] < 0.02)
+        self.assertEqual(len(monitor.modified_chunk_dict), self.EVENT_COUNT)
+
+        # terminate() wakes up the thread without any new data
+        monitor.terminate()
+        monitor.join(1)
+        self.assertFalse(monitor.is_alive())
+        self.assertEqual(modified_disk_queue.get(1),
+                         Const.QUEUE_SUCCESS_MESSAGE)
+        os.close(write_fd)
+
+    def test_access_stream(self):
+        disk_path = self._make_stream("disk_accessed")
+        memory_path = self._make_stream("memory_accessed")
+        monitor = StreamMonitor()
+        monitor.add_path(disk_path, StreamMonitor.DISK_ACCESS)
+        monitor.add_path(memory_path, StreamMonitor.MEMORY_ACCESS)
+        monitor.start()
+        disk_fd = os.open(disk_path, os.O_WRONLY)
+        memory_fd = os.open(memory_path, os.O_WRONLY)
+
+        # line split across writes and a batch of lines in one write
+        os.write(disk_fd, "1.5\t3\n2.0\t")
+        os.write(memory_fd, "1.2\t3\n2.0\t7\n2.5\t3\n")
+        time.sleep(0.05)
+        os.write(disk_fd, "1\n2.5\t3\n")
+        time.sleep(0.05)
+        self.assertEqual(monitor.disk_access_chunk_list.tolist(), [3, 1, 3])
+        self.assertEqual(monitor.disk_first_access_dict, {3: 1.5, 1: 2.0})
+        self.assertEqual(monitor.mem_access_chunk_list.tolist(), [3, 7, 3])
+        self.assertEqual(monitor.mem_first_access_dict, {3: 1.2, 7: 2.0})
+
+        # stop monitoring memory access
+        monitor.del_path(StreamMonitor.MEMORY_ACCESS)
+        time.sleep(0.05)
+        self.assertEqual(len(monitor.stream_dict), 1)
+        os.write(disk_fd, "invalid line\n3.0\t9\n")
+        time.sleep(0.05)
+        self.assertEqual(monitor.disk_access_chunk_list.tolist(),
+                         [3, 1, 3, 9])
+
+        # writer closed the stream
+        os.close(disk_fd)
+        time.sleep(0.05)
+        self.assertEqual(len(monitor.stream_dict), 0)
+        monitor.terminate()
+        monitor.join(1)
+        self.assertFalse(monitor.is_alive())
+        os.close(memory_fd)
+
+    def test_idle_stream(self):
+        # regular file is always readable without data like FUSE files
+        idle_path = os.path.join(self.temp_dir, "memory_accessed")
+        open(idle_path, "w").close()
+        disk_path = self._make_stream("disk_accessed")
+        monitor = _CountingStreamMonitor()
+        monitor.add_path(idle_path, StreamMonitor.MEMORY_ACCESS)
+        monitor.add_path(disk_path, StreamMonitor.DISK_ACCESS)
+        monitor.start()
+        disk_fd = os.open(disk_path, os.O_WRONLY)
+        latency_list = list()
+        time_start = time.time()
+        for chunk in xrange(self.EVENT_COUNT/2):
+            write_time = time.time()
+            os.write(disk_fd, "%f\t%d\n" % (write_time, chunk))
+            while len(monitor.disk_access_chunk_list) < chunk+1:
+                time.sleep(0.0005)
+            latency_list.append(time.time()-write_time)
+            time.sleep(0.02)
+        duration = time.time() - time_start
+        idle_count = monitor.handle_count[StreamMonitor.MEMORY_ACCESS]
+        latency_list.sort()
+        sys.stdout.write("idle stream polled %d times in %f s, max latency "
+                         "of the other stream %f ms\n" %
+                         (idle_count, duration, 1000.0*latency_list[-1]))
+        # idle stream backs off instead of waking up the loop every 10 ms
+        self.assertTrue(idle_count < duration/StreamMonitor.IDLE_DELAY_MAX+5)
+        # and does not delay the other stream
+        self.assertTrue(latency_list[len(latency_list)/2] < 0.005)
+        monitor.terminate()
+        monitor.join(1)
+        self.assertFalse(monitor.is_alive())
+        os.close(disk_fd)
+
+    def test_first_event_after_idle(self):
+        # regular file is always readable without data like FUSE files
+        stream_path = os.path.join(self.temp_dir, "disk_accessed")
+        stream_file = open(stream_path, "w")
+        monitor = StreamMonitor()
+        monitor.add_path(stream_path, StreamMonitor.DISK_ACCESS)
+        monitor.start()
+        latency_list = list()
+        for chunk in xrange(self.EVENT_COUNT/10):
+            # long enough for the poll delay to reach its maximum
+            time.sleep(0.2)
+            write_time = time.time()
+            stream_file.write("%f\t%d\n" % (write_time, chunk))
+            stream_file.flush()
+            while len(monitor.disk_access_chunk_list) < chunk+1:
+                time.sleep(0.0005)
+            latency_list.append(time.time()-write_time)
+        sys.stdout.write("first event latency after idle: avg %f ms, "
+                         "max %f ms\n" %
+                         (1000.0*sum(latency_list)/len(latency_list),
+                          1000.0*max(latency_list)))
+        self.assertTrue(max(latency_list) < StreamMonitor.IDLE_DELAY_MAX+0.01)
+        monitor.terminate()
+        monitor.join(1)
+        self.assertFalse(monitor.is_alive())
+        stream_file.close()
+
+    def test_file_monitor(self):
+        log_path = os.path.join(self.temp_dir, "qemu_log")
+        log_file = open(log_path, "w")
+        log_file.write("0.1, dma, existing\n")
+        log_file.flush()
+        monitor = _QemuLogMonitor(log_path, FileMonitor.QEMU_LOG)
+        monitor.start()
+        latency_list = list()
+        for index in xrange(self.EVENT_COUNT/10):
+            write_time = time.time()
+            log_file.write("%f, bdrv_discard, %d\n" % (write_time, index))
+            log_file.flush()
+            while len(monitor.log_list) < index+2:
+                time.sleep(0.001)
+            latency_list.append(monitor.log_list[-1][0]-write_time)
+        sys.stdout.write("qemu log latency (inotify: %s): avg %f ms\n" %
+                         (monitor.inotify_fd is not None,
+                          1000.0*sum(latency_list)/len(latency_list)))
+        self.assertEqual(monitor.log_list[0][1], "0.1, dma, existing")
+        if monitor.inotify_fd is not None:
+            self.assertTrue(max(latency_list) < 0.1)
+        monitor.terminate()
+        monitor.join(1)
+        self.assertFalse(monitor.is_alive())
+        log_file.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
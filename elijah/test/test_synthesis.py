@@ -2,6 +2,10 @@
 import unittest
 import os
 import sys
+import time
+import random
+import multiprocessing
+from hashlib import sha256
 # for local debugging
 if os.path.exists("../provisioning") is True:
     sys.path.insert(0, "../../")
@@ -15,8 +19,14 @@ from elijah.test.util import Const as Const
 from elijah.test.util import VMUtility
 from elijah.provisioning import synthesis as synthesis
 from elijah.provisioning import compression
+from elijah.provisioning import delta
+from elijah.provisioning import process_manager
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.handoff import StreamSynthesisFile
 from elijah.provisioning.cloudletfs import CloudletFS
 from elijah.provisioning.configuration import Const as Cloudlet_Const
+from elijah.provisioning.configuration import Options
+from elijah.provisioning.configuration import VMOverlayCreationMode
 from elijah.provisioning.package import PackagingUtil
 
 
@@ -96,3 +106,190 @@ class TestSynthesis(unittest.TestCase):
             )
         except Exception as e:
             self.assertTrue(False, str(e))
+
+
+class TestOverlayFile(unittest.TestCase):
+    CHUNK_SIZE = 4096
+    CHUNK_COUNT = 256
+
+    def setUp(self):
+        super(TestOverlayFile, self).setUp()
+        self.temp_dir = mkdtemp(prefix="cloudlet-test-overlayfile-")
+        self.profile_path = VMOverlayCreationMode.PROFILE_DATAPATH
+        # ProcessManager needs a profile, which can be empty
+        VMOverlayCreationMode.PROFILE_DATAPATH = os.path.join(
+            self.temp_dir, "mode-profile")
+        open(VMOverlayCreationMode.PROFILE_DATAPATH, "w").close()
+        self.rand = random.Random(1234)
+        self.base_data = dict()
+        self.base_path = dict()
+        self.base_hashlist = dict()
+        for delta_type, name in ((DeltaItem.DELTA_MEMORY, "base-mem"),
+                                 (DeltaItem.DELTA_DISK, "base-disk")):
+            chunk_list = [self._random_chunk()
+                          for index in xrange(self.CHUNK_COUNT)]
+            self.base_data[delta_type] = chunk_list
+            self.base_path[delta_type] = os.path.join(self.temp_dir, name)
+            with open(self.base_path[delta_type], "wb") as fd:
+                fd.write(''.join(chunk_list))
+            self.base_hashlist[delta_type] = [
+                (index*self.CHUNK_SIZE, self.CHUNK_SIZE,
+                 sha256(data).digest())
+                for index, data in enumerate(chunk_list)]
+        self.modified_data = self._get_modified_chunks()
+
+    def tearDown(self):
+        super(TestOverlayFile, self).tearDown()
+        process_manager.kill_instance()
+        VMOverlayCreationMode.PROFILE_DATAPATH = self.profile_path
+        if os.path.exists(self.temp_dir):
+            shutil.rmtree(self.temp_dir)
+
+    def _random_chunk(self):
+        # compressible, but unique
+        return ''.join([chr(self.rand.randint(0, 255))
+                        for index in xrange(512)])*8
+
+    def _get_modified_chunks(self):
+        # zero, base, duplicated and new chunks at half of the offsets
+        modified_data = dict()
+        for delta_type in (DeltaItem.DELTA_MEMORY, DeltaItem.DELTA_DISK):
+            chunk_dict = dict()
+            for index in self.rand.sample(xrange(self.CHUNK_COUNT),
+                                          self.CHUNK_COUNT/2):
+                kind = self.rand.randint(0, 3)
+                if kind == 0:
+                    data = '\0'*self.CHUNK_SIZE
+                elif kind == 1:
+                    data = self.rand.choice(
+                        self.base_data[self.rand.choice(
+                            (DeltaItem.DELTA_MEMORY, DeltaItem.DELTA_DISK))])
+                elif kind == 2 and len(chunk_dict) > 0:
+                    data = self.rand.choice(chunk_dict.values())
+                else:
+                    data = self._random_chunk()
+                chunk_dict[index] = data
+            modified_data[delta_type] = chunk_dict
+        return modified_data
+
+    def _get_deltalist(self, delta_type):
+        return [DeltaItem(delta_type, index*self.CHUNK_SIZE,
+                          self.CHUNK_SIZE, hash_value=sha256(data).digest(),
+                          ref_id=DeltaItem.REF_RAW, data_len=len(data),
+                          data=data)
+                for index, data in
+                sorted(self.modified_data[delta_type].iteritems())]
+
+    def _create_serial(self, output_dir):
+        # as VM_Overlay._create_overlay_serial after getting deltalists
+        os.mkdir(output_dir)
+        merged_deltalist = delta.create_overlay(
+            self._get_deltalist(DeltaItem.DELTA_MEMORY), self.CHUNK_SIZE,
+            self._get_deltalist(DeltaItem.DELTA_DISK), self.CHUNK_SIZE,
+            basedisk_hashlist=list(self.base_hashlist[DeltaItem.DELTA_DISK]),
+            basemem_hashlist=list(self.base_hashlist[DeltaItem.DELTA_MEMORY]))
+        overlay_metafile, overlay_files = synthesis.generate_overlayfile(
+            merged_deltalist, Options(), "base-hash",
+            self.CHUNK_COUNT*self.CHUNK_SIZE,
+            self.CHUNK_COUNT*self.CHUNK_SIZE,
+            os.path.join(output_dir, Cloudlet_Const.OVERLAY_META),
+            os.path.join(output_dir, Cloudlet_Const.OVERLAY_FILE_PREFIX))
+        return overlay_metafile, overlay_files
+
+    def _create_pipelined(self, output_dir, overlay_mode):
+        # as VM_Overlay._create_overlay_pipelined after the delta stages
+        os.mkdir(output_dir)
+        process_controller = process_manager.get_instance()
+        queue_dict = dict()
+        for delta_type in (DeltaItem.DELTA_MEMORY, DeltaItem.DELTA_DISK):
+            deltalist_queue = multiprocessing.Queue()
+            deltalist = self._get_deltalist(delta_type)
+            for index in xrange(0, len(deltalist), 16):
+                deltalist_queue.put(deltalist[index:index+16])
+            deltalist_queue.put(Cloudlet_Const.QUEUE_SUCCESS_MESSAGE)
+            queue_dict[delta_type] = deltalist_queue
+        hashdict = dict()
+        for delta_type in (DeltaItem.DELTA_MEMORY, DeltaItem.DELTA_DISK):
+            hashdict[delta_type] = dict(
+                [(hash_value, offset) for (offset, length, hash_value)
+                 in self.base_hashlist[delta_type]])
+        synthesis_file = synthesis._start_overlay_file_stages(
+            overlay_mode, "base-hash", queue_dict[DeltaItem.DELTA_MEMORY],
+            queue_dict[DeltaItem.DELTA_DISK],
+            hashdict[DeltaItem.DELTA_DISK], hashdict[DeltaItem.DELTA_MEMORY],
+            output_dir, process_controller)
+        synthesis_file.join()
+        return synthesis._finish_overlay_file(
+            synthesis_file, "base-hash", self.CHUNK_COUNT*self.CHUNK_SIZE,
+            self.CHUNK_COUNT*self.CHUNK_SIZE, output_dir)
+
+    def _recover(self, overlay_metafile):
+        # apply the overlay on the base like synthesis does
+        output_dir = os.path.dirname(overlay_metafile)
+        overlay_path = os.path.join(output_dir, "overlay")
+        compression.decomp_overlay(overlay_metafile, overlay_path)
+        recovered = dict()
+        for delta_type in (DeltaItem.DELTA_MEMORY, DeltaItem.DELTA_DISK):
+            recovered[delta_type] = os.path.join(output_dir,
+                                                 "recovered-%d" % delta_type)
+        delta_proc = delta.Recovered_delta(
+            self.base_path[DeltaItem.DELTA_DISK],
+            self.base_path[DeltaItem.DELTA_MEMORY], overlay_path,
+            recovered[DeltaItem.DELTA_MEMORY],
+            self.CHUNK_COUNT*self.CHUNK_SIZE,
+            recovered[DeltaItem.DELTA_DISK],
+            self.CHUNK_COUNT*self.CHUNK_SIZE, self.CHUNK_SIZE,
+            out_pipename=os.path.join(output_dir, "chunks"))
+        delta_proc.run()
+        for delta_type in (DeltaItem.DELTA_MEMORY, DeltaItem.DELTA_DISK):
+            with open(recovered[delta_type], "rb") as fd:
+                recovered_data = fd.read()
+            for index, data in self.modified_data[delta_type].iteritems():
+                offset = index*self.CHUNK_SIZE
+                self.assertEqual(
+                    recovered_data[offset:offset+self.CHUNK_SIZE], data)
+        with open(os.path.join(output_dir, "chunks"), "r") as fd:
+            chunk_list = fd.read().split()
+        return sorted(chunk_list[:-1])
+
+    def test_pipelined_overlay(self):
+        serial_meta, serial_files = self._create_serial(
+            os.path.join(self.temp_dir, "serial"))
+        overlay_mode = \
+            VMOverlayCreationMode.get_pipelined_multi_process_finite_queue(
+                num_cores=1)
+        pipelined_meta, pipelined_files = self._create_pipelined(
+            os.path.join(self.temp_dir, "pipelined"), overlay_mode)
+        sys.stdout.write(
+            "serial overlay: %d bytes, pipelined overlay: %d bytes\n" %
+            (sum([os.path.getsize(path) for path in serial_files]),
+             sum([os.path.getsize(path) for path in pipelined_files])))
+        # both overlays give the same modified chunks
+        self.assertEqual(self._recover(serial_meta),
+                         self._recover(pipelined_meta))
+
+    def _write_blobs(self, emulate_network):
+        compdata_queue = multiprocessing.Queue()
+        compdata_queue.put((Cloudlet_Const.COMPRESSION_GZIP, "x"*128*1024,
+                            [1], []))
+        compdata_queue.put(Cloudlet_Const.QUEUE_SUCCESS_MESSAGE)
+        synthesis_file = StreamSynthesisFile(
+            "base-uuid", compdata_queue, self.temp_dir,
+            emulate_network=emulate_network)
+        time_start = time.time()
+        synthesis_file.start()
+        synthesis_file.join()
+        overlay_info, overlay_files = synthesis_file.get_overlay_info()
+        self.assertEqual(len(overlay_files), 1)
+        self.assertEqual(os.path.getsize(overlay_files[0]), 128*1024)
+        return time.time() - time_start
+
+    def test_synthesis_file_emulation(self):
+        # 128KB takes 1 second at the emulated 1 Mbps
+        bandwidth = VMOverlayCreationMode.EMULATED_BANDWIDTH_Mbps
+        VMOverlayCreationMode.EMULATED_BANDWIDTH_Mbps = 1
+        try:
+            self.assertTrue(self._write_blobs(True) >= 0.9)
+            self.assertTrue(self._write_blobs(False) < 0.5)
+        finally:
+            VMOverlayCreationMode.EMULATED_BANDWIDTH_Mbps = bandwidth
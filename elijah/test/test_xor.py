@@ -0,0 +1,74 @@
+import unittest
+import os
+import sys
+import random
+# for local debugging
+if os.path.exists("../provisioning") is True:
+    sys.path.insert(0, "../../")
+
+from elijah.provisioning import tool
+from elijah.provisioning.delta import DeltaItem
+from elijah.provisioning.delta import recover_xor_items
+
+
+class TestXOR(unittest.TestCase):
+    PAGE_SIZE = 4096
+
+    def setUp(self):
+        super(TestXOR, self).setUp()
+        self.rand = random.Random(1234)
+
+    def _random_data(self, length):
+        return ''.join(chr(self.rand.randint(0, 255)) for i in range(length))
+
+    def _xor(self, a, b):
+        return ''.join(chr(ord(x) ^ ord(y)) for (x, y) in zip(a, b))
+
+    def test_xor_batch(self):
+        # odd length chunk is XORed byte by byte
+        lengths = [self.PAGE_SIZE]*8 + [100]
+        source_list = [self._random_data(length) for length in lengths]
+        modi_list = [self._random_data(length) for length in lengths]
+        xor_list = tool.xor_batch(source_list, modi_list)
+        self.assertEqual(len(xor_list), len(lengths))
+        for source, modi, xor in zip(source_list, modi_list, xor_list):
+            self.assertEqual(xor, self._xor(source, modi))
+            self.assertEqual(tool.xor_data(source, modi), xor)
+        self.assertEqual(tool.xor_batch([], []), [])
+        self.assertRaises(IOError, tool.xor_batch, ["ab"], ["abc"])
+
+    def test_recover_xor_items(self):
+        page_count = 16
+        raw_mem = self._random_data(page_count*self.PAGE_SIZE)
+        raw_disk = self._random_data(page_count*self.PAGE_SIZE)
+        modified_pages = dict()
+        deltaitem_list = list()
+        for index in range(page_count):
+            offset = index*self.PAGE_SIZE
+            if index % 2 == 0:
+                delta_type = DeltaItem.DELTA_MEMORY
+                base_data = raw_mem[offset:offset+self.PAGE_SIZE]
+            else:
+                delta_type = DeltaItem.DELTA_DISK
+                base_data = raw_disk[offset:offset+self.PAGE_SIZE]
+            data = self._random_data(self.PAGE_SIZE)
+            modified_pages[(delta_type, offset)] = data
+            if index % 4 == 3:
+                ref_id, patch = DeltaItem.REF_RAW, data
+            else:
+                ref_id, patch = DeltaItem.REF_XOR, tool.xor_data(base_data, data)
+            deltaitem_list.append(
+                DeltaItem(delta_type, offset, self.PAGE_SIZE, None,
+                          ref_id=ref_id, data_len=len(patch), data=patch))
+
+        recovered_count = recover_xor_items(deltaitem_list, raw_mem, raw_disk)
+        self.assertEqual(recovered_count, 12)
+        for delta_item in deltaitem_list:
+            self.assertEqual(delta_item.ref_id, DeltaItem.REF_RAW)
+            self.assertEqual(
+                delta_item.data,
+                modified_pages[(delta_item.delta_type, delta_item.offset)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -78,7 +78,7 @@ def install():
     with settings(hide('running'), warn_only=True):
         cmd = "apt-get install --force-yes -y qemu-kvm libvirt-bin libglu1-mesa "
         cmd += "gvncviewer python-dev python-libvirt python-lxml python-lzma "
-        cmd += "apparmor-utils libc6-i386 python-pip libxml2-dev libxslt1-dev"
+        cmd += "apparmor-utils python-pip libxml2-dev libxslt1-dev"
         if dist == "precise":
             cmd += " python-xdelta3"
             if sudo(cmd).failed: